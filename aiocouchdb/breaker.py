@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import functools
+import urllib.parse
+from collections import deque
+
+import aiohttp.errors
+
+from .client import path_template
+
+
+__all__ = (
+    'AdaptiveLimiter',
+    'BreakerPolicy',
+    'CircuitBreaker',
+    'CircuitOpenError',
+)
+
+
+class CircuitOpenError(aiohttp.errors.ClientConnectionError):
+    """Raised when request is rejected since circuit breaker of the target
+    host is open."""
+
+
+class CircuitBreaker(object):
+    """Circuit breaker state machine.
+
+    - ``closed``: requests pass through. After :attr:`failure_threshold`
+      failures in a row the circuit get opened;
+    - ``open``: requests are rejected for :attr:`recovery_timeout` seconds,
+      after that the circuit get half-opened;
+    - ``half-open``: up to :attr:`half_open_requests` trial requests are
+      allowed. Success closes the circuit, failure opens it again.
+
+    >>> breaker = CircuitBreaker(failure_threshold=2, clock=lambda: 0)
+    >>> breaker.state
+    'closed'
+    >>> breaker.record_failure(); breaker.record_failure()
+    >>> breaker.state
+    'open'
+    >>> breaker.allow()
+    False
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    #: Amount of failures in a row which opens the circuit
+    failure_threshold = 5
+    #: Time in seconds to keep circuit open before trying to close it
+    recovery_timeout = 30.0
+    #: Amount of trial requests allowed in half-open state
+    half_open_requests = 1
+
+    def __init__(self, *,
+                 clock=None,
+                 failure_threshold=None,
+                 half_open_requests=None,
+                 recovery_timeout=None):
+        if failure_threshold is not None:
+            self.failure_threshold = failure_threshold
+        if half_open_requests is not None:
+            self.half_open_requests = half_open_requests
+        if recovery_timeout is not None:
+            self.recovery_timeout = recovery_timeout
+        self._clock = clock or asyncio.get_event_loop().time
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = None
+        self._trials = 0
+        self.opened = 0
+
+    @property
+    def state(self):
+        """Returns current circuit state.
+
+        :rtype: str
+        """
+        if self._state == self.OPEN:
+            if self._clock() - self._opened_at >= self.recovery_timeout:
+                self._state = self.HALF_OPEN
+                self._trials = 0
+        return self._state
+
+    @property
+    def failures(self):
+        """Returns amount of failures in a row.
+
+        :rtype: int
+        """
+        return self._failures
+
+    def allow(self):
+        """Checks if request is allowed to pass. In half-open state, each
+        allowed request is considered as a trial one.
+
+        :rtype: bool
+        """
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self._trials < self.half_open_requests:
+            self._trials += 1
+            return True
+        return False
+
+    def record_success(self):
+        """Records successful request."""
+        self._failures = 0
+        self._state = self.CLOSED
+
+    def record_failure(self):
+        """Records failed request."""
+        self._failures += 1
+        state = self.state
+        if state == self.CLOSED and self._failures < self.failure_threshold:
+            return
+        if state != self.OPEN:
+            self._state = self.OPEN
+            self._opened_at = self._clock()
+            self.opened += 1
+
+    def record_cancel(self):
+        """Records request which was cancelled before it get completed, so
+        it's unknown was it successful or not."""
+        if self._state == self.HALF_OPEN and self._trials:
+            self._trials -= 1
+
+
+class AdaptiveLimiter(object):
+    """Adaptive concurrency limiter which follows AIMD algorithm.
+
+    Limit increases by one per window of successful requests (additive
+    increase) and multiplies by :attr:`backoff_ratio` on failure or when
+    request latency exceeds :attr:`tolerance` times the minimal observed
+    one, which is a sign of queueing on the server (multiplicative decrease).
+    Latencies are compared within the same endpoint only, so slow by nature
+    requests, like view queries, don't look as overload next to fast
+    document reads.
+
+    >>> limiter = AdaptiveLimiter(initial_limit=4)
+    >>> limiter.release(0.01, True)
+    >>> limiter.limit
+    4.25
+    >>> limiter.release(0.05, True)
+    >>> limiter.limit
+    3.825
+    """
+
+    #: Initial concurrency limit
+    initial_limit = 10
+    #: Minimal concurrency limit
+    min_limit = 1
+    #: Maximum concurrency limit
+    max_limit = 200
+    #: Limit multiplier on overload
+    backoff_ratio = 0.9
+    #: Latency ratio to the minimal one which signs about overload
+    tolerance = 2.0
+    #: Amount of latest latency samples per endpoint to find the minimal one
+    window = 100
+
+    def __init__(self, *,
+                 backoff_ratio=None,
+                 initial_limit=None,
+                 loop=None,
+                 max_limit=None,
+                 min_limit=None,
+                 tolerance=None):
+        if backoff_ratio is not None:
+            self.backoff_ratio = backoff_ratio
+        if initial_limit is not None:
+            self.initial_limit = initial_limit
+        if max_limit is not None:
+            self.max_limit = max_limit
+        if min_limit is not None:
+            self.min_limit = min_limit
+        if tolerance is not None:
+            self.tolerance = tolerance
+        self._loop = loop
+        self._limit = float(self.initial_limit)
+        self._inflight = 0
+        self._latencies = {}
+        self._waiters = deque()
+
+    @property
+    def limit(self):
+        """Returns current concurrency limit.
+
+        :rtype: float
+        """
+        return self._limit
+
+    @property
+    def inflight(self):
+        """Returns amount of requests in flight.
+
+        :rtype: int
+        """
+        return self._inflight
+
+    @property
+    def waiting(self):
+        """Returns amount of requests waiting for the free slot.
+
+        :rtype: int
+        """
+        return len(self._waiters)
+
+    @asyncio.coroutine
+    def acquire(self):
+        """Waits for the free slot for the request."""
+        while self._inflight >= int(self._limit):
+            waiter = asyncio.Future(loop=self._loop)
+            self._waiters.append(waiter)
+            try:
+                yield from waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # woken up, but cancelled before got the slot:
+                    # pass it on to the next waiter
+                    self._wakeup()
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+        self._inflight += 1
+
+    def release(self, latency=None, ok=None, endpoint=None):
+        """Releases the slot and adjusts the limit.
+
+        :param float latency: Request latency in seconds
+        :param bool ok: Whenever request was successful. If ``None``, request
+                        outcome is unknown and the limit stays unchanged
+        :param str endpoint: Endpoint of the request, e.g.
+                             ``GET /{db}/{docid}``, which latency baseline
+                             the request latency is compared with
+        """
+        self._inflight = max(0, self._inflight - 1)
+        if ok is None:
+            self._wakeup()
+            return
+        if ok and latency is not None:
+            latencies = self._latencies.get(endpoint)
+            if latencies is None:
+                latencies = self._latencies[endpoint] = deque(
+                    maxlen=self.window)
+            latencies.append(latency)
+            overloaded = latency > min(latencies) * self.tolerance
+        else:
+            overloaded = True
+        if overloaded:
+            self._limit = max(self.min_limit, self._limit * self.backoff_ratio)
+        else:
+            self._limit = min(self.max_limit, self._limit + 1 / self._limit)
+        self._wakeup()
+
+    def _wakeup(self):
+        free = int(self._limit) - self._inflight
+        while free > 0 and self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                free -= 1
+
+
+class BreakerPolicy(object):
+    """Per host circuit breaker and adaptive concurrency limit policy for
+    :class:`~aiocouchdb.client.HttpSession`.
+
+    Requests to the host with open circuit are failed fast with
+    :exc:`CircuitOpenError`. Requests over the host concurrency limit are
+    waiting for the free slot. Request is considered as failed if it raised
+    an error or response status code is ``5xx``. The slot is released once
+    response headers are received.
+
+    >>> policy = BreakerPolicy()
+    >>> policy.host('http://localhost:5984/db/doc')
+    'localhost:5984'
+    """
+
+    #: Default :class:`CircuitBreaker` instance class
+    breaker_class = CircuitBreaker
+    #: Default :class:`AdaptiveLimiter` instance class
+    limiter_class = AdaptiveLimiter
+
+    def __init__(self, *,
+                 breaker_class=None,
+                 breaker_options=None,
+                 limiter_class=None,
+                 limiter_options=None,
+                 loop=None):
+        if breaker_class is not None:
+            self.breaker_class = breaker_class
+        if limiter_class is not None:
+            self.limiter_class = limiter_class
+        self._breaker_options = breaker_options or {}
+        self._limiter_options = limiter_options or {}
+        self._loop = loop
+        self._breakers = {}
+        self._limiters = {}
+
+    def host(self, url):
+        """Returns host key for the URL.
+
+        :param str url: Request URL
+
+        :rtype: str
+        """
+        return urllib.parse.urlsplit(url).netloc.rsplit('@', 1)[-1]
+
+    def breaker(self, host):
+        """Returns :class:`CircuitBreaker` instance for the host.
+
+        :param str host: Host key
+
+        :rtype: :attr:`BreakerPolicy.breaker_class`
+        """
+        if host not in self._breakers:
+            loop = self._loop or asyncio.get_event_loop()
+            self._breakers[host] = self.breaker_class(
+                clock=loop.time, **self._breaker_options)
+        return self._breakers[host]
+
+    def limiter(self, host):
+        """Returns :class:`AdaptiveLimiter` instance for the host.
+
+        :param str host: Host key
+
+        :rtype: :attr:`BreakerPolicy.limiter_class`
+        """
+        if host not in self._limiters:
+            self._limiters[host] = self.limiter_class(
+                loop=self._loop, **self._limiter_options)
+        return self._limiters[host]
+
+    def stats(self):
+        """Returns state of circuit breaker and concurrency limiter for each
+        known host.
+
+        :rtype: dict
+        """
+        return {
+            host: {
+                'state': self.breaker(host).state,
+                'failures': self.breaker(host).failures,
+                'opened': self.breaker(host).opened,
+                'limit': self.limiter(host).limit,
+                'inflight': self.limiter(host).inflight,
+                'waiting': self.limiter(host).waiting,
+            }
+            for host in self._breakers
+        }
+
+    def wrap(self, request_func):
+        """Wraps request coroutine function to apply the policy."""
+        @functools.wraps(request_func)
+        @asyncio.coroutine
+        def wrapper(method, url, **kwargs):
+            loop = kwargs.get('loop') or self._loop or asyncio.get_event_loop()
+            host = self.host(url)
+            endpoint = '{} {}'.format(method.upper(), path_template(url))
+            breaker = self.breaker(host)
+            limiter = self.limiter(host)
+
+            if not breaker.allow():
+                raise CircuitOpenError('circuit breaker for %s is open' % host)
+
+            try:
+                yield from limiter.acquire()
+            except BaseException:
+                # half-open trial slot shouldn't be lost with the request
+                breaker.record_cancel()
+                raise
+            start = loop.time()
+            ok = False
+            try:
+                resp = yield from request_func(method, url, **kwargs)
+                ok = resp.status < 500
+                return resp
+            except asyncio.CancelledError:
+                ok = None
+                raise
+            finally:
+                if ok is None:
+                    limiter.release()
+                    breaker.record_cancel()
+                else:
+                    limiter.release(loop.time() - start, ok, endpoint)
+                    if ok:
+                        breaker.record_success()
+                    else:
+                        breaker.record_failure()
+        return wrapper
@@ -12,6 +12,9 @@ import aiohttp
 import aiohttp.log
 import io
 import json
+import mmap
+import os
+import stat
 import types
 import urllib.parse
 
@@ -20,6 +23,7 @@ from .errors import maybe_raise_error
 from .hdrs import (
     ACCEPT,
     ACCEPT_ENCODING,
+    CONTENT_ENCODING,
     CONTENT_LENGTH,
     CONTENT_TYPE,
     LOCATION,
@@ -28,7 +32,7 @@ from .hdrs import (
     TRANSFER_ENCODING,
     URI,
 )
-from .multipart import MultipartWriter
+from .multipart import GzipStream, MultipartWriter, SizedStream
 
 
 __all__ = (
@@ -37,6 +41,7 @@ __all__ = (
     'HttpSession',
     'Resource',
     'extract_credentials',
+    'path_template',
     'urljoin'
 )
 
@@ -97,6 +102,7 @@ def request(method, url, *,
             encoding='utf-8',
             expect100=False,
             headers=None,
+            instrumentation=None,
             loop=None,
             max_redirects=10,
             params=None,
@@ -105,8 +111,61 @@ def request(method, url, *,
             response_class=None,
             version=aiohttp.HttpVersion11):
 
-    redirects = 0
     method = method.upper()
+    if instrumentation is None:
+        trace = None
+    else:
+        trace = instrumentation.start(method, url)
+
+    try:
+        resp = yield from _request(method, url,
+                                   allow_redirects=allow_redirects,
+                                   compress=compress,
+                                   connector=connector,
+                                   cookies=cookies,
+                                   data=data,
+                                   encoding=encoding,
+                                   expect100=expect100,
+                                   headers=headers,
+                                   loop=loop,
+                                   max_redirects=max_redirects,
+                                   params=params,
+                                   read_until_eof=read_until_eof,
+                                   request_class=request_class,
+                                   response_class=response_class,
+                                   trace=trace,
+                                   version=version)
+    except BaseException as exc:
+        if trace is not None:
+            trace.fail(exc)
+        raise
+
+    if trace is not None:
+        resp._trace = trace
+        if resp._closed:
+            trace.complete()
+    return resp
+
+
+@asyncio.coroutine
+def _request(method, url, *,
+             allow_redirects,
+             compress,
+             connector,
+             cookies,
+             data,
+             encoding,
+             expect100,
+             headers,
+             loop,
+             max_redirects,
+             params,
+             read_until_eof,
+             request_class,
+             response_class,
+             trace,
+             version):
+    redirects = 0
     connector = connector or aiohttp.TCPConnector(force_close=True, loop=loop)
     request_class = request_class or HttpRequest
     response_class = response_class or HttpResponse
@@ -125,6 +184,8 @@ def request(method, url, *,
                             version=version)
 
         conn = yield from connector.connect(req)
+        if trace is not None:
+            trace.connection_acquired()
         try:
             resp = req.send(conn.writer, conn.reader)
             try:
@@ -139,6 +200,9 @@ def request(method, url, *,
         except OSError as exc:
             raise aiohttp.ClientOSError() from exc
 
+        if trace is not None:
+            trace.response_started(resp)
+
         # redirects
         if allow_redirects and resp.status in {301, 302, 303, 307}:
             redirects += 1
@@ -172,6 +236,115 @@ def request(method, url, *,
     return resp
 
 
+def regular_file_size(data):
+    """Returns amount of bytes left to read from the regular file object or
+    ``None`` if ``data`` is not a file object or it's not a regular file,
+    like pipe, socket or in memory stream."""
+    if not isinstance(data, io.IOBase):
+        return None
+    try:
+        info = os.fstat(data.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not stat.S_ISREG(info.st_mode):
+        return None
+    return max(info.st_size - data.tell(), 0)
+
+
+def can_sendfile(transport):
+    """Checks if :func:`os.sendfile` could write directly into the transport
+    socket: it's plain TCP one and there is no pending data to send."""
+    return (hasattr(os, 'sendfile') and
+            transport.get_extra_info('sslcontext') is None and
+            transport.get_extra_info('socket') is not None and
+            transport.get_write_buffer_size() == 0)
+
+
+@asyncio.coroutine
+def send_file(writer, fileobj, count, *, loop, chunk_size=65536):
+    """Sends ``count`` bytes of the file starting from its current
+    position without reading them into Python objects where it's possible.
+
+    Uses :func:`os.sendfile` for plain sockets and :mod:`mmap` backed memory
+    views as the fallback. Encrypted connections and file objects which are
+    not regular files, like :class:`io.BytesIO`, get the data read by
+    chunks.
+
+    On return file position is set past the sent data.
+    """
+    offset = fileobj.tell()
+    transport = writer.transport
+    regular = regular_file_size(fileobj) is not None
+    if not count:
+        pass
+    elif regular and can_sendfile(transport):
+        yield from sendfile_socket(transport.get_extra_info('socket'),
+                                   fileobj.fileno(), offset, count,
+                                   loop=loop)
+    elif regular and transport.get_extra_info('sslcontext') is None:
+        yield from send_mmap(writer, fileobj.fileno(), offset, count,
+                             chunk_size=chunk_size)
+    else:
+        fileobj.seek(offset)
+        left = count
+        while left:
+            chunk = fileobj.read(min(chunk_size, left))
+            if not chunk:
+                raise EOFError('file ended {} bytes earlier than expected'
+                               ''.format(left))
+            writer.write(chunk)
+            left -= len(chunk)
+            yield from writer.drain()
+    fileobj.seek(offset + count)
+
+
+@asyncio.coroutine
+def sendfile_socket(sock, fd, offset, count, *, loop):
+    """Sends file data into non-blocking socket with :func:`os.sendfile`
+    waiting for the socket to become writable when it's full.
+
+    Socket descriptor is owned by the transport, so event loop is asked
+    to watch its duplicate instead."""
+    watched = None
+    try:
+        while count:
+            try:
+                sent = os.sendfile(sock.fileno(), fd, offset, count)
+            except (BlockingIOError, InterruptedError):
+                if watched is None:
+                    watched = os.dup(sock.fileno())
+                waiter = asyncio.Future(loop=loop)
+                loop.add_writer(watched, waiter.set_result, None)
+                try:
+                    yield from waiter
+                finally:
+                    loop.remove_writer(watched)
+                continue
+            if not sent:
+                raise EOFError('file ended {} bytes earlier than expected'
+                               ''.format(count))
+            offset += sent
+            count -= sent
+    finally:
+        if watched is not None:
+            os.close(watched)
+
+
+@asyncio.coroutine
+def send_mmap(writer, fd, offset, count, *, chunk_size=65536):
+    """Sends file data by chunks of memory mapped file, so transport gets
+    them without intermediate copies."""
+    with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mapped:
+        if len(mapped) < offset + count:
+            raise EOFError('file ended {} bytes earlier than expected'
+                           ''.format(offset + count - len(mapped)))
+        with memoryview(mapped) as view:
+            for pos in range(offset, offset + count, chunk_size):
+                with view[pos:min(pos + chunk_size, offset + count)] as chunk:
+                    writer.write(chunk)
+                yield from writer.drain()
+
+
 class HttpRequest(aiohttp.client.ClientRequest):
     """:class:`aiohttp.client.ClientRequest` class with CouchDB specifics."""
 
@@ -183,20 +356,99 @@ class HttpRequest(aiohttp.client.ClientRequest):
     }
     CHUNK_SIZE = 8192
 
+    #: Amount of bytes to send from regular file body with :func:`send_file`
+    file_size = None
+    #: :class:`~aiocouchdb.multipart.MultipartWriter` body
+    multipart = None
+
+    def update_content_encoding(self):
+        """Payload with `Content-Encoding` header is compressed by aiohttp
+        unless ``compress`` is explicitly ``False``: then it's expected to be
+        encoded already and is sent as is."""
+        if self.compress is False and CONTENT_ENCODING in self.headers:
+            return
+        return super().update_content_encoding()
+
     def update_body_from_data(self, data):
         """Encodes ``data`` as JSON if `Content-Type`
-        is :mimetype:`application/json`."""
+        is :mimetype:`application/json`.
+
+        Regular files are sent with exact `Content-Length` by
+        :func:`send_file` unless request payload gets compressed. The same
+        happens for file payloads of
+        :class:`~aiocouchdb.multipart.MultipartWriter` body which length
+        is known.
+        :class:`~aiocouchdb.multipart.SizedStream` payload is sent with
+        its declared length as well, while
+        :class:`~aiocouchdb.multipart.GzipStream` one is always chunked."""
         if data is None:
             return
         if self.headers.get(CONTENT_TYPE) == 'application/json':
-            non_json_types = (types.GeneratorType, io.IOBase, MultipartWriter)
+            non_json_types = (types.GeneratorType, io.IOBase, GzipStream,
+                              MultipartWriter, SizedStream)
             if not (isinstance(data, non_json_types)):
                 data = json.dumps(data)
 
-        rv = super().update_body_from_data(data)
-        if isinstance(data, MultipartWriter) and CONTENT_LENGTH in self.headers:
-            self.chunked = False
-        return rv
+        if not self.compress and not self.chunked:
+            size = regular_file_size(data)
+            if size is not None:
+                self.body = data
+                self.file_size = size
+                self.headers[CONTENT_LENGTH] = str(size)
+                return
+
+        if isinstance(data, MultipartWriter):
+            self.multipart = data
+            self.body = data.stream()
+            self.headers.update(data.headers)
+            if CONTENT_LENGTH in self.headers:
+                self.chunked = False
+            else:
+                self.chunked = self.chunked or 8192
+            return
+
+        if isinstance(data, SizedStream):
+            self.body = data.stream()
+            if not self.compress and not self.chunked:
+                self.headers[CONTENT_LENGTH] = str(data.length)
+            return
+
+        if isinstance(data, GzipStream):
+            self.body = data.stream()
+            self.chunked = self.chunked or 8192
+            return
+
+        return super().update_body_from_data(data)
+
+    @asyncio.coroutine
+    def write_bytes(self, request, reader):
+        if (self.multipart is not None and
+                not self.chunked and not self.compress):
+            # file parts of multipart body with known length are sent
+            # with send_file as well
+            def send_part(fileobj, count):
+                return asyncio.Task(send_file(request.transport, fileobj,
+                                              count, loop=self.loop),
+                                    loop=self.loop)
+            self.body = self.multipart.stream(send_part)
+        if self.file_size is None:
+            return (yield from super().write_bytes(request, reader))
+
+        if self._continue is not None:
+            yield from self._continue
+        try:
+            yield from send_file(request.transport, self.body, self.file_size,
+                                 loop=self.loop)
+            ret = request.write_eof()
+            if asyncio.iscoroutine(ret) or isinstance(ret, asyncio.Future):
+                yield from ret
+        except Exception as exc:
+            new_exc = aiohttp.ClientRequestError(
+                'Can not write request body for %s' % self.url)
+            new_exc.__context__ = exc
+            new_exc.__cause__ = exc
+            reader.set_exception(new_exc)
+        self._writer = None
 
     def update_path(self, params):
         if isinstance(params, dict):
@@ -215,6 +467,8 @@ class HttpResponse(aiohttp.client.ClientResponse):
     flow control which fits the best to handle chunked responses.
     """
 
+    _trace = None  # aiocouchdb.instrumentation.RequestTrace
+
     def __enter__(self):
         return self
 
@@ -226,6 +480,11 @@ class HttpResponse(aiohttp.client.ClientResponse):
         greater or equal `400`."""
         return maybe_raise_error(self)
 
+    def close(self, force=False):
+        super().close(force)
+        if self._trace is not None:
+            self._trace.complete()
+
     @asyncio.coroutine
     def read(self):
         """Read response payload."""
@@ -234,10 +493,14 @@ class HttpResponse(aiohttp.client.ClientResponse):
             try:
                 while not self.content.at_eof():
                     data.extend((yield from self.content.read()))
-            except:
+            except BaseException as exc:
+                if self._trace is not None:
+                    self._trace.fail(exc)
                 self.close(True)
                 raise
             else:
+                if self._trace is not None:
+                    self._trace.bytes += len(data)
                 self.close()
 
             self._content = data
@@ -259,13 +522,29 @@ class HttpResponse(aiohttp.client.ClientResponse):
 class HttpSession(object):
     """HTTP client session which holds default :class:`Authentication Provider
     <aiocouchdb.authn.AuthProvider>` instance (if any) and :class:`TCP Connector
-    <aiohttp.connector.TCPConnector>`."""
+    <aiohttp.connector.TCPConnector>`.
+
+    Optionally, session may apply :class:`retry policy
+    <aiocouchdb.retry.RetryPolicy>` to survive transient failures,
+    :class:`hedging policy <aiocouchdb.hedging.HedgingPolicy>` to cut off tail
+    latency of idempotent requests and :class:`per host circuit breaker
+    <aiocouchdb.breaker.BreakerPolicy>` to shed load from unhealthy nodes.
+
+    To find out which endpoints burn the latency, pass :class:`instrumentation
+    <aiocouchdb.instrumentation.Instrumentation>` instance which collects
+    per request phase timings and calls the hooks on request events.
+    """
 
     request_class = HttpRequest
     response_class = HttpResponse
 
-    def __init__(self, *, auth=None, connector=None, loop=None):
+    def __init__(self, *, auth=None, breaker=None, connector=None,
+                 hedging=None, instrumentation=None, loop=None, retry=None):
         self._auth = auth or NoAuthProvider()
+        self.breaker = breaker
+        self.hedging = hedging
+        self.instrumentation = instrumentation
+        self.retry = retry
 
         if loop is None:
             loop = asyncio.get_event_loop()
@@ -349,22 +628,31 @@ class HttpSession(object):
         request_class = request_class or self.request_class
         response_class = response_class or self.response_class
 
-        return auth.wrap(request)(method, url,
-                                  allow_redirects=allow_redirects,
-                                  compress=compress,
-                                  connector=self.connector,
-                                  cookies=cookies,
-                                  data=data,
-                                  encoding=encoding,
-                                  expect100=expect100,
-                                  headers=headers,
-                                  loop=loop or self._loop,
-                                  max_redirects=max_redirects,
-                                  params=params,
-                                  read_until_eof=read_until_eof,
-                                  request_class=request_class,
-                                  response_class=response_class,
-                                  version=version)
+        request_func = auth.wrap(request)
+        if self.breaker is not None:
+            request_func = self.breaker.wrap(request_func)
+        if self.hedging is not None:
+            request_func = self.hedging.wrap(request_func)
+        if self.retry is not None:
+            request_func = self.retry.wrap(request_func)
+
+        return request_func(method, url,
+                            allow_redirects=allow_redirects,
+                            compress=compress,
+                            connector=self.connector,
+                            cookies=cookies,
+                            data=data,
+                            encoding=encoding,
+                            expect100=expect100,
+                            headers=headers,
+                            instrumentation=self.instrumentation,
+                            loop=loop or self._loop,
+                            max_redirects=max_redirects,
+                            params=params,
+                            read_until_eof=read_until_eof,
+                            request_class=request_class,
+                            response_class=response_class,
+                            version=version)
 
 
 class Resource(object):
@@ -503,6 +791,80 @@ def urljoin(base, *path):
     return '/'.join([base] + [urllib.parse.quote(s, '') for s in path])
 
 
+#: Design document functions which are followed by the function name
+DDOC_FUNCTIONS = {
+    '_list': '{list}',
+    '_show': '{show}',
+    '_update': '{update}',
+    '_view': '{view}',
+}
+
+
+def path_template(url):
+    """Normalizes the URL path into CouchDB endpoint template, so requests
+    to the same API could be grouped together regardless of database,
+    document or view names.
+
+    >>> path_template('http://localhost:5984/')
+    '/'
+    >>> path_template('http://localhost:5984/_config/couchdb/uuid')
+    '/_config/{arg}/{arg}'
+    >>> path_template('http://localhost:5984/db')
+    '/{db}'
+    >>> path_template('http://localhost:5984/db/_all_docs?limit=1')
+    '/{db}/_all_docs'
+    >>> path_template('http://localhost:5984/db/docid')
+    '/{db}/{docid}'
+    >>> path_template('http://localhost:5984/db/docid/att/name.txt')
+    '/{db}/{docid}/{att}'
+    >>> path_template('http://localhost:5984/db/_local/docid')
+    '/{db}/_local/{docid}'
+    >>> path_template('http://localhost:5984/db/_design/ddoc/_view/view')
+    '/{db}/_design/{ddoc}/_view/{view}'
+    >>> path_template('http://localhost:5984/db/_design/ddoc/_list/list/view')
+    '/{db}/_design/{ddoc}/_list/{list}/{view}'
+    >>> path_template('http://localhost:5984/db/_design/ddoc/_rewrite/a/b')
+    '/{db}/_design/{ddoc}/_rewrite/{path}'
+    >>> path_template('http://localhost:5984/db/_design/ddoc/att.txt')
+    '/{db}/_design/{ddoc}/{att}'
+    """
+    path = urllib.parse.urlsplit(url).path
+    parts = [part for part in path.split('/') if part]
+    if not parts:
+        return '/'
+    if parts[0].startswith('_'):
+        return '/'.join([''] + parts[:1] + ['{arg}'] * len(parts[1:]))
+
+    tpl = ['', '{db}']
+    rest = parts[1:]
+    if not rest:
+        pass
+    elif rest[0] in ('_design', '_local'):
+        tpl.append(rest[0])
+        tpl.append('{ddoc}' if rest[0] == '_design' else '{docid}')
+        rest = rest[2:]
+        if not rest or tpl[-1] == '{docid}':
+            pass
+        elif rest[0] in DDOC_FUNCTIONS:
+            tpl.extend([rest[0], DDOC_FUNCTIONS[rest[0]]])
+            if rest[0] == '_list' and len(rest) > 2:
+                tpl.append('{view}')
+        elif rest[0].startswith('_'):
+            tpl.append(rest[0])
+            if len(rest) > 1:
+                tpl.append('{path}')
+        else:
+            tpl.append('{att}')
+    elif rest[0].startswith('_'):
+        tpl.append(rest[0])
+        tpl.extend(['{arg}'] * len(rest[1:]))
+    else:
+        tpl.append('{docid}')
+        if len(rest) > 1:
+            tpl.append('{att}')
+    return '/'.join(tpl)
+
+
 def extract_credentials(url):
     """Extract authentication (user name and password) credentials from the
     given URL.
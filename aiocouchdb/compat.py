@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import sys
+
+
+__all__ = (
+    'PY_35',
+    'StopAsyncIteration',
+)
+
+
+PY_35 = sys.version_info >= (3, 5)
+
+if PY_35:
+    StopAsyncIteration = StopAsyncIteration  # pylint: disable=W0622
+else:
+    class StopAsyncIteration(Exception):  # pylint: disable=W0622
+        """Signals the end of asynchronous iteration on Python 3.4, where
+        the builtin exception doesn't exists yet. Readers raise it from
+        ``__anext__`` the same way on all the supported versions."""
@@ -8,9 +8,11 @@
 #
 
 import asyncio
+import collections
 import json
 
 from aiohttp.helpers import parse_mimetype
+from .compat import StopAsyncIteration
 from .hdrs import CONTENT_TYPE
 
 
@@ -22,30 +24,50 @@ __all__ = (
     'LongPollChangesFeed',
     'ContinuousChangesFeed',
     'EventSourceFeed',
-    'EventSourceChangesFeed'
+    'EventSourceChangesFeed',
+    'PrefetchChangesFeed',
+    'FilteredChangesFeed'
 )
 
 
 class Feed(object):
     """Wrapper over :class:`HttpResponse` content to stream continuous response
-    by emitted chunks."""
+    by emitted chunks.
 
-    #: Limits amount of items feed would fetch and keep for further iteration.
+    On Python 3.5+ feeds could be iterated with ``async for`` statement::
+
+        async for event in feed:
+            ...
+
+    By default feed reads the response on demand within the consumer task,
+    so there is no background task and no buffer between the connection and
+    the consumer: when consumer stops reading, nobody reads the connection and
+    TCP flow control slows down the server. Optionally, feed could read ahead
+    up to :attr:`buffer_size` items in background task to let the consumer
+    process the fetched items while the next ones are on the way.
+    """
+
+    #: Amount of items feed reads ahead in background task. Zero means that
+    #: the response is read on demand by :meth:`next` call.
     buffer_size = 0
     _ignore_heartbeats = True
 
     def __init__(self, resp, *, loop=None, buffer_size=0):
         self._active = True
         self._exc = None
-        self._queue = asyncio.Queue(maxsize=buffer_size or self.buffer_size,
-                                    loop=loop)
         self._resp = resp
 
         ctype = resp.headers.get(CONTENT_TYPE, '').lower()
         *_, params = parse_mimetype(ctype)
         self._encoding = params.get('charset', 'utf-8')  # pylint: disable=E1101
 
-        asyncio.Task(self._loop(), loop=loop)
+        buffer_size = buffer_size or self.buffer_size
+        if buffer_size:
+            self._queue = asyncio.Queue(maxsize=buffer_size, loop=loop)
+            self._reader = asyncio.Task(self._loop(), loop=loop)
+        else:
+            self._queue = None
+            self._reader = None
 
     def __enter__(self):
         return self
@@ -53,20 +75,45 @@ class Feed(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close(force=True if exc_type else False)
 
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        item = yield from self.next()
+        if item is None:
+            raise StopAsyncIteration
+        return item
+
+    @asyncio.coroutine
+    def _readline(self):
+        content = self._resp.content
+        while not content.at_eof():
+            chunk = yield from content.readline()
+            if not chunk:
+                continue
+            if chunk == b'\n' and self._ignore_heartbeats:
+                continue
+            return chunk
+        return None
+
     @asyncio.coroutine
     def _loop(self):
         try:
-            while not self._resp.content.at_eof() and self._active:
-                chunk = yield from self._resp.content.readline()
-                if not chunk:
-                    continue
-                if chunk == b'\n' and self._ignore_heartbeats:
-                    continue
+            while self._active:
+                chunk = yield from self._readline()
+                if chunk is None:
+                    break
                 yield from self._queue.put(chunk)
+        except asyncio.CancelledError:
+            # feed was closed while waiting for free space in the buffer
+            pass
         except Exception as exc:
             self._exc = exc
+            self._reader = None
             self.close(True)
         else:
+            self._reader = None
             self.close()
 
     @asyncio.coroutine
@@ -79,6 +126,16 @@ class Feed(object):
             if self._exc is not None:
                 raise self._exc from None  # pylint: disable=raising-bad-type
             return None
+        if self._queue is None:
+            try:
+                chunk = yield from self._readline()
+            except Exception as exc:
+                self._exc = exc
+                self.close(True)
+                raise
+            if chunk is None:
+                self.close()
+            return chunk
         chunk = yield from self._queue.get()
         if chunk is None:
             # in case of race condition, raising an error should have more
@@ -87,11 +144,23 @@ class Feed(object):
                 raise self._exc from None  # pylint: disable=raising-bad-type
         return chunk
 
+    @property
+    def backlog(self):
+        """Amount of received items which are not consumed yet.
+
+        :rtype: int
+        """
+        if self._queue is None:
+            return 0
+        return self._queue.qsize()
+
     def is_active(self):
         """Checks if the feed is still able to emit any data.
 
         :rtype: bool
         """
+        if self._queue is None:
+            return self._active
         return self._active or not self._queue.empty()
 
     def close(self, force=False):
@@ -103,9 +172,18 @@ class Feed(object):
                            the details
         """
         self._active = False
+        if self._reader is not None:
+            self._reader.cancel()
+            self._reader = None
         self._resp.close(force=force)
-        # put stop signal into queue to break waiting loop on queue.get()
-        self._queue.put_nowait(None)
+        if self._queue is None:
+            return
+        # put stop signal into queue to break waiting loop on queue.get().
+        # If the buffer is full, nobody waits for it
+        try:
+            self._queue.put_nowait(None)
+        except asyncio.QueueFull:
+            pass
 
 
 class JsonFeed(Feed):
@@ -339,3 +417,269 @@ class EventSourceChangesFeed(ChangesFeed, EventSourceFeed):
         if 'id' in event:
             self._last_seq = int(event['id'])
         return event['data']
+
+
+class PrefetchChangesFeed(object):
+    """Pipeline stage over :class:`ChangesFeed` which fetches documents of
+    the emitted events concurrently while the feed is been read and emits
+    the events with ``doc`` field set, preserving their order.
+
+    Once there is a free fetch slot, all the events received by that time,
+    but no more than :attr:`batch_size`, are fetched with a single ``fetch``
+    call. So batches grow while fetches are slower than the feed and events
+    of an idle feed are fetched without delay. Up to :attr:`concurrency`
+    fetches run at the same time and the amount of events read ahead is
+    bounded, so slow consumer slows down reading of the feed.
+
+    :param feed: :class:`ChangesFeed` instance
+    :param fetch: Coroutine function which accepts list of events and returns
+                  list of their documents in the same order
+    :param int batch_size: Max amount of events to fetch at once
+    :param int concurrency: Max amount of fetches to run concurrently
+    :param loop: Event loop instance
+    """
+
+    #: Max amount of events to fetch at once
+    batch_size = 100
+    #: Max amount of fetches to run concurrently
+    concurrency = 4
+
+    def __init__(self, feed, fetch, *, batch_size=None, concurrency=None,
+                 loop=None):
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if self.batch_size < 1 or self.concurrency < 1:
+            raise ValueError('batch_size and concurrency should be positive')
+        self._feed = feed
+        self._fetch = fetch
+        self._loop = loop
+        self._active = True
+        self._exc = None
+        self._last_seq = None
+        self._ready = collections.deque()
+        self._fetches = set()
+        self._slots = asyncio.Semaphore(self.concurrency, loop=loop)
+        self._events = asyncio.Queue(maxsize=self.batch_size, loop=loop)
+        self._batches = asyncio.Queue(maxsize=self.concurrency, loop=loop)
+        self._tasks = [asyncio.Task(self._read(), loop=loop),
+                       asyncio.Task(self._dispatch(), loop=loop)]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(force=True if exc_type else False)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        event = yield from self.next()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    @asyncio.coroutine
+    def _read(self):
+        try:
+            while True:
+                event = yield from self._feed.next()
+                yield from self._events.put(event)
+                if event is None:
+                    break
+        except asyncio.CancelledError:
+            pass
+        except Exception as exc:
+            yield from self._events.put(exc)
+
+    @asyncio.coroutine
+    def _dispatch(self):
+        try:
+            while True:
+                yield from self._slots.acquire()
+                items = [(yield from self._events.get())]
+                while (isinstance(items[-1], dict) and
+                       len(items) < self.batch_size and
+                       not self._events.empty()):
+                    items.append(self._events.get_nowait())
+                last = items[-1]
+                batch = items if isinstance(last, dict) else items[:-1]
+                if batch:
+                    task = asyncio.Task(self._fetch_batch(batch),
+                                        loop=self._loop)
+                    self._fetches.add(task)
+                    yield from self._batches.put((batch, task))
+                else:
+                    self._slots.release()
+                if not isinstance(last, dict):
+                    # end of feed or reading error
+                    yield from self._batches.put((None, last))
+                    break
+        except asyncio.CancelledError:
+            pass
+
+    @asyncio.coroutine
+    def _fetch_batch(self, batch):
+        try:
+            docs = yield from self._fetch(batch)
+        finally:
+            self._slots.release()
+        docs = list(docs)
+        if len(docs) != len(batch):
+            raise ValueError('fetch returned {} documents for {} events'
+                             ''.format(len(docs), len(batch)))
+        return docs
+
+    @asyncio.coroutine
+    def next(self):
+        """Emits the next event from changes feed with the related document
+        in ``doc`` field or ``None`` if feed is empty.
+
+        :rtype: dict
+        """
+        while not self._ready:
+            if not self._active:
+                if self._exc is not None:
+                    raise self._exc from None
+                return None
+            batch, task = yield from self._batches.get()
+            if batch is None:
+                if task is not None:
+                    self._exc = task
+                    self.close(True)
+                    raise task
+                self._last_seq = self._feed.last_seq
+                self.close()
+                return None
+            try:
+                docs = yield from task
+            except Exception as exc:
+                self._exc = exc
+                self.close(True)
+                raise
+            finally:
+                self._fetches.discard(task)
+            for event, doc in zip(batch, docs):
+                event['doc'] = doc
+            self._ready.extend(batch)
+        event = self._ready.popleft()
+        self._last_seq = event['seq']
+        return event
+
+    @property
+    def backlog(self):
+        """Amount of fetched events which are not consumed yet.
+
+        :rtype: int
+        """
+        return len(self._ready)
+
+    @property
+    def last_seq(self):
+        """Returns last emitted sequence number.
+
+        :rtype: int
+        """
+        return self._last_seq
+
+    def is_active(self):
+        """Checks if the feed is still able to emit any data.
+
+        :rtype: bool
+        """
+        return self._active or bool(self._ready)
+
+    def close(self, force=False):
+        """Closes the underlying feed and cancels pending fetches.
+
+        :param bool force: In case of True, close connection instead of release
+        """
+        self._active = False
+        for task in self._tasks:
+            task.cancel()
+        for task in self._fetches:
+            if not task.done():
+                task.cancel()
+            elif not task.cancelled():
+                # error is not interesting anymore
+                task.exception()
+        self._fetches.clear()
+        self._feed.close(force=force)
+
+
+class FilteredChangesFeed(object):
+    """Pipeline stage over :class:`ChangesFeed` which emits only the events
+    matching :class:`~aiocouchdb.filters.Predicate`. Unless the predicate
+    checks document ID only, the events should carry the documents.
+
+    :param feed: :class:`ChangesFeed` or :class:`PrefetchChangesFeed`
+    :param predicate: :class:`~aiocouchdb.filters.Predicate` instance
+    :param bool strip_docs: Removes ``doc`` field from the emitted events
+                            if the documents were requested only to check
+                            the predicate
+    """
+
+    def __init__(self, feed, predicate, *, strip_docs=False):
+        self._feed = feed
+        self.predicate = predicate
+        self.strip_docs = strip_docs
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close(force=True if exc_type else False)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        event = yield from self.next()
+        if event is None:
+            raise StopAsyncIteration
+        return event
+
+    @asyncio.coroutine
+    def next(self):
+        """Emits the next matched event from changes feed or ``None`` if
+        feed is empty.
+
+        :rtype: dict
+        """
+        while True:
+            event = yield from self._feed.next()
+            if event is None:
+                return None
+            doc = event.get('doc') or {'_id': event['id']}
+            if not self.predicate.match(doc):
+                continue
+            if self.strip_docs:
+                event.pop('doc', None)
+            return event
+
+    @property
+    def last_seq(self):
+        """Returns last sequence number seen by the feed, including the ones
+        of filtered out events.
+
+        :rtype: int
+        """
+        return self._feed.last_seq
+
+    def is_active(self):
+        """Checks if the feed is still able to emit any data.
+
+        :rtype: bool
+        """
+        return self._feed.is_active()
+
+    def close(self, force=False):
+        """Closes the underlying feed.
+
+        :param bool force: In case of True, close connection instead of release
+        """
+        self._feed.close(force=force)
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import hashlib
+import json
+
+
+__all__ = (
+    'Predicate',
+    'Equals',
+    'Prefix',
+    'All',
+    'Any',
+    'Not',
+)
+
+
+_MISSING = object()
+
+JS_TEMPLATE = '''\
+function(doc, req) {{
+  function get(path) {{
+    var value = doc;
+    for (var i = 0; i < path.length; i++) {{
+      if (value === null || typeof value !== 'object' ||
+          Array.isArray(value) || !value.hasOwnProperty(path[i])) {{
+        return undefined;
+      }}
+      value = value[path[i]];
+    }}
+    return value;
+  }}
+  return !!({expr});
+}}
+'''
+
+PYTHON_TEMPLATE = '''\
+def fun(doc, req):
+    missing = object()
+
+    def get(path):
+        value = doc
+        for key in path:
+            if not isinstance(value, dict) or key not in value:
+                return missing
+            value = value[key]
+        return value
+
+    def eq(value, expected):
+        return (value is not missing and
+                isinstance(value, bool) == isinstance(expected, bool) and
+                value == expected)
+
+    return bool({expr})
+'''
+
+TEMPLATES = {
+    'javascript': JS_TEMPLATE,
+    'python': PYTHON_TEMPLATE,
+}
+
+
+def field_path(field):
+    """Returns document field path as tuple of keys.
+
+    >>> field_path('address.city')
+    ('address', 'city')
+    """
+    if isinstance(field, str):
+        return tuple(field.split('.'))
+    return tuple(field)
+
+
+def get_field(doc, path):
+    value = doc
+    for key in path:
+        if not isinstance(value, dict) or key not in value:
+            return _MISSING
+        value = value[key]
+    return value
+
+
+class Predicate(object):
+    """Declarative predicate over documents which could be evaluated both
+    locally and by CouchDB as changes feed filter function.
+
+    Predicates are combined with ``&``, ``|`` and ``~`` operators::
+
+        Equals('type', 'order') & ~Prefix('_id', 'draft:')
+    """
+
+    #: Whether predicate checks anything beside document ID
+    needs_doc = True
+
+    def __and__(self, other):
+        return All(self, other)
+
+    def __or__(self, other):
+        return Any(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def __repr__(self):
+        return '<{}.{} {}>'.format(self.__module__,
+                                   self.__class__.__qualname__,
+                                   json.dumps(self.spec()))
+
+    def match(self, doc):
+        """Evaluates predicate for the document.
+
+        :param dict doc: Document
+
+        :rtype: bool
+        """
+        raise NotImplementedError
+
+    def spec(self):
+        """Returns JSON serializable predicate definition."""
+        raise NotImplementedError
+
+    def expression(self, language):
+        """Returns predicate expression for the design function.
+
+        :param str language: ``javascript`` or ``python``
+
+        :rtype: str
+        """
+        raise NotImplementedError
+
+    def filter_function(self, language='javascript'):
+        """Returns source code of the changes filter function.
+
+        :param str language: Design document language: ``javascript`` or
+                             ``python`` for `couchdb-python`_ query server
+
+        .. _couchdb-python: https://pythonhosted.org/CouchDB/views.html
+
+        :rtype: str
+        """
+        if language not in TEMPLATES:
+            raise ValueError('unsupported language: {!r}'.format(language))
+        return TEMPLATES[language].format(expr=self.expression(language))
+
+    def design_doc(self, language='javascript'):
+        """Returns design document which holds the predicate as ``match``
+        changes filter. Document ID is derived from the filter source code,
+        so the same predicate always maps to the same design document.
+
+        :param str language: Design document language
+
+        :returns: Tuple of design document ID and its body
+        :rtype: tuple
+        """
+        source = self.filter_function(language)
+        digest = hashlib.sha1((language + '\n' + source).encode('utf-8'))
+        docid = '_design/aiocouchdb-filter-' + digest.hexdigest()
+        return docid, {'language': language, 'filters': {'match': source}}
+
+
+class Equals(Predicate):
+    """Matches documents which field is equal to the value.
+
+    :param field: Field name, dotted path for nested field or tuple of keys
+    :param value: JSON scalar value: string, number, boolean or ``None``
+    """
+
+    def __init__(self, field, value):
+        if not isinstance(value, (str, int, float, bool, type(None))):
+            raise TypeError('only JSON scalar values are supported, got {!r}'
+                            ''.format(value))
+        self.path = field_path(field)
+        self.value = value
+        self.needs_doc = self.path != ('_id',)
+
+    def match(self, doc):
+        value = get_field(doc, self.path)
+        return (value is not _MISSING and
+                isinstance(value, bool) == isinstance(self.value, bool) and
+                value == self.value)
+
+    def spec(self):
+        return ['eq', list(self.path), self.value]
+
+    def expression(self, language):
+        path = json.dumps(list(self.path))
+        if language == 'python':
+            return 'eq(get({}), {!r})'.format(path, self.value)
+        return 'get({}) === {}'.format(path, json.dumps(self.value))
+
+
+class Prefix(Predicate):
+    """Matches documents which string field starts with the prefix. Being
+    applied to ``_id`` field, it doesn't require document body.
+
+    :param field: Field name, dotted path for nested field or tuple of keys
+    :param str prefix: Value prefix
+    """
+
+    def __init__(self, field, prefix):
+        if not isinstance(prefix, str):
+            raise TypeError('prefix should be a string, got {!r}'
+                            ''.format(prefix))
+        self.path = field_path(field)
+        self.prefix = prefix
+        self.needs_doc = self.path != ('_id',)
+
+    def match(self, doc):
+        value = get_field(doc, self.path)
+        return isinstance(value, str) and value.startswith(self.prefix)
+
+    def spec(self):
+        return ['prefix', list(self.path), self.prefix]
+
+    def expression(self, language):
+        path = json.dumps(list(self.path))
+        if language == 'python':
+            return ('(isinstance(get({0}), str) and'
+                    ' get({0}).startswith({1!r}))'.format(path, self.prefix))
+        return ('(typeof get({0}) === "string" &&'
+                ' get({0}).indexOf({1}) === 0)'
+                ''.format(path, json.dumps(self.prefix)))
+
+
+class All(Predicate):
+    """Matches documents which match all the predicates."""
+
+    operators = {'javascript': ' && ', 'python': ' and '}
+    empty = {'javascript': 'true', 'python': 'True'}
+
+    def __init__(self, *predicates):
+        self.predicates = predicates
+        self.needs_doc = any(pred.needs_doc for pred in predicates)
+
+    def match(self, doc):
+        return all(pred.match(doc) for pred in self.predicates)
+
+    def spec(self):
+        return [self.__class__.__name__.lower()] + [
+            pred.spec() for pred in self.predicates]
+
+    def expression(self, language):
+        if not self.predicates:
+            return self.empty[language]
+        return '({})'.format(self.operators[language].join(
+            pred.expression(language) for pred in self.predicates))
+
+
+class Any(All):
+    """Matches documents which match any of the predicates."""
+
+    operators = {'javascript': ' || ', 'python': ' or '}
+    empty = {'javascript': 'false', 'python': 'False'}
+
+    def match(self, doc):
+        return any(pred.match(doc) for pred in self.predicates)
+
+
+class Not(Predicate):
+    """Matches documents which don't match the predicate."""
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+        self.needs_doc = predicate.needs_doc
+
+    def match(self, doc):
+        return not self.predicate.match(doc)
+
+    def spec(self):
+        return ['not', self.predicate.spec()]
+
+    def expression(self, language):
+        if language == 'python':
+            return '(not {})'.format(self.predicate.expression(language))
+        return '!({})'.format(self.predicate.expression(language))
@@ -18,3 +18,6 @@ X_AUTH_COUCHDB_USERNAME = upstr('X-Auth-CouchDB-UserName')
 X_AUTH_COUCHDB_ROLES = upstr('X-Auth-CouchDB-Roles')
 #: Defines CouchDB Proxy Auth token
 X_AUTH_COUCHDB_TOKEN = upstr('X-Auth-CouchDB-Token')
+
+#: Defines CouchDB specific COPY request method
+METH_COPY = upstr('COPY')
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import functools
+import itertools
+from collections import deque
+
+from .client import path_template
+from .hdrs import METH_GET, METH_HEAD
+
+
+__all__ = (
+    'HedgingPolicy',
+    'LatencyTracker',
+)
+
+
+class LatencyTracker(object):
+    """Keeps sliding window of observed request latencies per endpoint class
+    and estimates their quantiles.
+
+    >>> tracker = LatencyTracker(min_samples=10)
+    >>> for value in range(1, 101):
+    ...     tracker.add('GET /{db}', value / 1000)
+    >>> tracker.quantile('GET /{db}', 0.95)
+    0.095
+    >>> tracker.quantile('GET /{db}/{docid}', 0.95) is None
+    True
+    """
+
+    #: Amount of latest samples to keep per endpoint class
+    window = 1000
+    #: Minimal amount of samples required to estimate the quantile
+    min_samples = 20
+    #: Amount of new samples after which quantiles get recalculated
+    refresh = 16
+
+    def __init__(self, *, min_samples=None, window=None):
+        if min_samples is not None:
+            self.min_samples = min_samples
+        if window is not None:
+            self.window = window
+        self._samples = {}
+        self._sorted = {}
+
+    def __contains__(self, key):
+        return key in self._samples
+
+    def __iter__(self):
+        return iter(self._samples)
+
+    def add(self, key, value):
+        """Records request latency for the endpoint class.
+
+        :param str key: Endpoint class
+        :param float value: Latency in seconds
+        """
+        samples = self._samples.get(key)
+        if samples is None:
+            samples = self._samples[key] = deque(maxlen=self.window)
+        samples.append(value)
+        # sorting the whole window on every request is too expensive,
+        # so the estimation is reused until enough new samples arrive
+        cached = self._sorted.get(key)
+        if cached is not None:
+            cached[0] += 1
+            if cached[0] >= self.refresh:
+                del self._sorted[key]
+
+    def quantile(self, key, q):
+        """Estimates latency quantile for the endpoint class.
+
+        :param str key: Endpoint class
+        :param float q: Quantile value in ``(0, 1]`` range
+
+        :returns: Latency in seconds or ``None`` if there are not enough
+                  samples collected
+        :rtype: float
+        """
+        samples = self._samples.get(key)
+        if samples is None or len(samples) < self.min_samples:
+            return None
+        cached = self._sorted.get(key)
+        if cached is None:
+            cached = self._sorted[key] = [0, sorted(samples)]
+        ordered = cached[1]
+        idx = min(len(ordered) - 1, max(0, int(round(q * len(ordered))) - 1))
+        return ordered[idx]
+
+
+class HedgingPolicy(object):
+    """Hedged requests policy for :class:`~aiocouchdb.client.HttpSession`.
+
+    If idempotent request hadn't received a response within the observed
+    latency quantile for its endpoint class, the duplicate request is sent to
+    another node. The first succeeded response wins, the other request
+    get cancelled.
+
+    Extra load is capped by the ``budget``: each request earns ``budget``
+    tokens and each hedge spends one, so with default settings no more than
+    5% of requests gets duplicated.
+
+    >>> policy = HedgingPolicy(['http://couch1:5984', 'http://couch2:5984'])
+    >>> policy.alternatives('http://couch1:5984/db/doc')
+    ['http://couch2:5984/db/doc']
+
+    :param list urls: Base URLs of CouchDB nodes which holds the same data.
+                      If request URL doesn't belongs to any of them, hedge
+                      request is sent to the same URL via new connection
+    :param float budget: Fraction of requests which are allowed to be hedged
+    :param float quantile: Latency quantile after which request get hedged
+    :param tracker: :class:`LatencyTracker` instance
+    """
+
+    #: Request methods which are safe to duplicate
+    methods = frozenset({METH_GET, METH_HEAD})
+    #: Endpoints which responses are delayed by design and should never
+    #: get hedged
+    exclude = frozenset({'/_db_updates', '/{db}/_changes'})
+    #: Fraction of requests which are allowed to be hedged
+    budget = 0.05
+    #: Maximum amount of hedges which could be made in a row
+    burst = 10
+    #: Latency quantile after which request get hedged
+    quantile = 0.95
+    #: Default :class:`LatencyTracker` instance class
+    tracker_class = LatencyTracker
+
+    def __init__(self, urls=(), *,
+                 budget=None,
+                 burst=None,
+                 quantile=None,
+                 tracker=None):
+        if budget is not None:
+            self.budget = budget
+        if burst is not None:
+            self.burst = burst
+        if quantile is not None:
+            self.quantile = quantile
+        self.tracker = tracker or self.tracker_class()
+        self._urls = [url.rstrip('/') for url in urls]
+        self._rotation = itertools.cycle(range(max(len(self._urls), 1)))
+        self._tokens = 0.0
+        self.requests = 0
+        self.hedged = 0
+
+    def alternatives(self, url):
+        """Returns list of the URLs pointed to the same resource on the other
+        nodes.
+
+        :param str url: Request URL
+
+        :rtype: list
+        """
+        for base in self._urls:
+            if url == base or url.startswith(base + '/'):
+                tail = url[len(base):]
+                return [other + tail for other in self._urls if other != base]
+        return []
+
+    def pick(self, url):
+        """Returns URL for the hedge request.
+
+        :param str url: Request URL
+
+        :rtype: str
+        """
+        alternatives = self.alternatives(url)
+        if not alternatives:
+            return url
+        return alternatives[next(self._rotation) % len(alternatives)]
+
+    def should_hedge(self, method, url):
+        """Checks if request is eligible for hedging.
+
+        :param str method: Request method
+        :param str url: Request URL
+
+        :rtype: bool
+        """
+        if method.upper() not in self.methods:
+            return False
+        return path_template(url) not in self.exclude
+
+    def wrap(self, request_func):
+        """Wraps request coroutine function to apply hedging policy."""
+        @functools.wraps(request_func)
+        @asyncio.coroutine
+        def wrapper(method, url, **kwargs):
+            loop = kwargs.get('loop') or asyncio.get_event_loop()
+            key = '{} {}'.format(method.upper(), path_template(url))
+
+            self.requests += 1
+            self._tokens = min(self._tokens + self.budget, self.burst)
+
+            if not self.should_hedge(method, url):
+                return (yield from request_func(method, url, **kwargs))
+
+            delay = self.tracker.quantile(key, self.quantile)
+            primary = self._attempt(request_func, key, method, url, **kwargs)
+            if delay is None:
+                return (yield from primary)
+
+            primary = asyncio.Task(primary, loop=loop)
+            try:
+                done, _ = yield from asyncio.wait([primary], timeout=delay,
+                                                  loop=loop)
+            except asyncio.CancelledError:
+                # asyncio.wait doesn't cancel the tasks it waits for
+                if not primary.done():
+                    primary.cancel()
+                elif not primary.cancelled() and primary.exception() is None:
+                    primary.result().close(force=True)
+                raise
+            if done or self._tokens < 1:
+                return (yield from primary)
+
+            self._tokens -= 1
+            self.hedged += 1
+            hedge = asyncio.Task(self._attempt(request_func, key, method,
+                                               self.pick(url), **kwargs),
+                                 loop=loop)
+            return (yield from self._race([primary, hedge], loop))
+        return wrapper
+
+    @asyncio.coroutine
+    def _attempt(self, request_func, key, method, url, **kwargs):
+        loop = kwargs.get('loop') or asyncio.get_event_loop()
+        start = loop.time()
+        resp = yield from request_func(method, url, **kwargs)
+        self.tracker.add(key, loop.time() - start)
+        return resp
+
+    @asyncio.coroutine
+    def _race(self, tasks, loop):
+        pending = set(tasks)
+        winner = None
+        try:
+            while pending:
+                done, pending = yield from asyncio.wait(
+                    pending, loop=loop, return_when=asyncio.FIRST_COMPLETED)
+                # successful response wins regardless of the order in which
+                # tasks completed within the same iteration
+                for task in tasks:
+                    if (task in done and not task.cancelled() and
+                            task.exception() is None and
+                            task.result().status < 500):
+                        winner = task
+                        break
+                if winner is None and not pending:
+                    # all attempts failed, report the primary one
+                    winner = tasks[0]
+                if winner is not None:
+                    break
+        finally:
+            for task in tasks:
+                if task is winner:
+                    continue
+                if not task.done():
+                    task.cancel()
+                elif not task.cancelled() and task.exception() is None:
+                    task.result().close(force=True)
+        return winner.result()
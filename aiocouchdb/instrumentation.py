@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import logging
+import math
+import time
+
+from .client import path_template
+
+
+__all__ = (
+    'Instrumentation',
+    'LatencyHistogram',
+    'RequestTrace',
+)
+
+
+log = logging.getLogger(__name__)
+
+
+class LatencyHistogram(object):
+    """HDR-style latency histogram.
+
+    Values are bucketed with fixed relative precision: each bucket keeps
+    :attr:`precision` significant binary digits of the value, so memory usage
+    depends on the values range, not on amount of recorded values, and
+    quantile estimation error is bounded by ``2 ** -precision``.
+
+    >>> hist = LatencyHistogram()
+    >>> for value in range(1, 101):
+    ...     hist.record(value / 1000)
+    >>> hist.count
+    100
+    >>> round(hist.quantile(0.5), 3)
+    0.05
+    >>> round(hist.quantile(0.99), 3)
+    0.099
+    >>> hist.max
+    0.1
+    """
+
+    #: Amount of significant binary digits kept for each value
+    precision = 7
+    #: Smallest distinguishable value in seconds
+    unit = 1e-6
+
+    def __init__(self, *, precision=None, unit=None):
+        if precision is not None:
+            self.precision = precision
+        if unit is not None:
+            self.unit = unit
+        self._buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def record(self, value):
+        """Records the value.
+
+        :param float value: Latency in seconds
+        """
+        value = max(0.0, value)
+        self.count += 1
+        self.total += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+        bucket = self._bucket(int(round(value / self.unit)))
+        self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+
+    def merge(self, other):
+        """Adds values recorded by other histogram with the same settings.
+
+        :param other: :class:`LatencyHistogram` instance
+        """
+        for bucket, count in other._buckets.items():
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        for value in (other.min, other.max):
+            if value is None:
+                continue
+            if self.min is None or value < self.min:
+                self.min = value
+            if self.max is None or value > self.max:
+                self.max = value
+
+    @property
+    def mean(self):
+        """Returns mean of recorded values.
+
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        return self.total / self.count
+
+    def quantile(self, q):
+        """Estimates quantile of recorded values.
+
+        :param float q: Quantile value in ``(0, 1]`` range
+
+        :returns: Latency in seconds or ``None`` if histogram is empty
+        :rtype: float
+        """
+        if not self.count:
+            return None
+        rank = max(1, int(math.ceil(q * self.count)))
+        seen = 0
+        for bucket in sorted(self._buckets):
+            seen += self._buckets[bucket]
+            if seen >= rank:
+                # like HDR histogram, report the highest value of the bucket
+                value = round(self._highest(bucket) * self.unit, 9)
+                return max(self.min, min(self.max, value))
+        return self.max
+
+    def snapshot(self, quantiles=(0.5, 0.9, 0.99)):
+        """Returns summary of recorded values.
+
+        :param tuple quantiles: Quantiles to estimate
+
+        :rtype: dict
+        """
+        summary = {
+            'count': self.count,
+            'mean': self.mean,
+            'min': self.min,
+            'max': self.max,
+        }
+        for q in quantiles:
+            summary['p{:g}'.format(q * 100)] = self.quantile(q)
+        return summary
+
+    def _bucket(self, value):
+        shift = max(0, value.bit_length() - self.precision)
+        return (value >> shift) << shift
+
+    def _highest(self, bucket):
+        shift = max(0, bucket.bit_length() - self.precision)
+        return bucket + (1 << shift) - 1
+
+
+class RequestTrace(object):
+    """Timings of a single HTTP request. Timestamps are taken from the
+    :attr:`Instrumentation.clock` and are ``None`` until the corresponding
+    phase is reached.
+
+    Phases are:
+
+    - ``connection_wait``: from the request start till the connection is
+      acquired from the connector pool;
+    - ``ttfb``: from the acquired connection till the response headers are
+      received (time to first byte);
+    - ``body_transfer``: from the received headers till the response get
+      closed;
+    - ``total``: from the request start till its completion.
+    """
+
+    def __init__(self, instrumentation, method, url):
+        self.instrumentation = instrumentation
+        self.method = method.upper()
+        self.url = url
+        self.template = path_template(url)
+        self.started = instrumentation.clock()
+        self.connected = None
+        self.headers_received = None
+        self.completed = None
+        self.status = None
+        self.bytes = 0
+        self.error = None
+
+    def __repr__(self):
+        return '<{}.{}({} {}) object at {}>'.format(
+            self.__module__,
+            self.__class__.__qualname__,  # pylint: disable=no-member
+            self.method,
+            self.url,
+            hex(id(self)))
+
+    @property
+    def key(self):
+        """Endpoint key: request method and path template.
+
+        :rtype: str
+        """
+        return '{} {}'.format(self.method, self.template)
+
+    @property
+    def done(self):
+        """Whenever request is completed.
+
+        :rtype: bool
+        """
+        return self.completed is not None
+
+    @property
+    def connection_wait(self):
+        return self._delta(self.started, self.connected)
+
+    @property
+    def ttfb(self):
+        return self._delta(self.connected, self.headers_received)
+
+    @property
+    def body_transfer(self):
+        return self._delta(self.headers_received, self.completed)
+
+    @property
+    def total(self):
+        return self._delta(self.started, self.completed)
+
+    def connection_acquired(self):
+        """Marks that connection is acquired."""
+        self.connected = self.instrumentation.clock()
+        self.instrumentation.emit('on_connection_acquired', self)
+
+    def response_started(self, resp):
+        """Marks that response headers are received.
+
+        :param resp: :class:`~aiocouchdb.client.HttpResponse` instance
+        """
+        self.headers_received = self.instrumentation.clock()
+        self.status = resp.status
+        self.instrumentation.emit('on_headers_received', self)
+
+    def complete(self):
+        """Marks that response body is received and response is closed."""
+        if self.done:
+            return
+        self.completed = self.instrumentation.clock()
+        self.instrumentation.emit('on_body_complete', self)
+
+    def fail(self, exc):
+        """Marks request as failed.
+
+        :param Exception exc: Raised exception
+        """
+        if self.done:
+            return
+        self.error = exc
+        self.completed = self.instrumentation.clock()
+        self.instrumentation.emit('on_error', self)
+
+    def _delta(self, start, stop):
+        if start is None or stop is None:
+            return None
+        return stop - start
+
+
+class Instrumentation(object):
+    """Request instrumentation for :class:`~aiocouchdb.client.HttpSession`.
+
+    Holds callbacks for request events and latency histograms for each
+    request phase per endpoint key: request method and normalized path
+    template, like ``GET /{db}/_design/{ddoc}/_view/{view}``.
+
+    Callbacks are plain functions which accepts :class:`RequestTrace`
+    instance. Errors raised by callbacks are logged and ignored.
+
+    >>> instr = Instrumentation()
+    >>> instr.add_hook('on_error', print)
+    >>> trace = instr.start('GET', 'http://localhost:5984/db/doc')
+    >>> trace.key
+    'GET /{db}/{docid}'
+    """
+
+    #: Supported events
+    events = (
+        'on_request_start',
+        'on_connection_acquired',
+        'on_headers_received',
+        'on_body_complete',
+        'on_error',
+    )
+    #: Request phases to collect latency histograms for
+    phases = ('connection_wait', 'ttfb', 'body_transfer', 'total')
+    #: Default :class:`LatencyHistogram` instance class
+    histogram_class = LatencyHistogram
+    #: Default :class:`RequestTrace` instance class
+    trace_class = RequestTrace
+
+    def __init__(self, *, clock=None, histogram_class=None, trace_class=None):
+        if histogram_class is not None:
+            self.histogram_class = histogram_class
+        if trace_class is not None:
+            self.trace_class = trace_class
+        self.clock = clock or time.monotonic
+        self._hooks = {event: [] for event in self.events}
+        self._histograms = {}
+        self._errors = {}
+
+    def add_hook(self, event, callback):
+        """Registers callback for the event.
+
+        :param str event: Event name
+        :param callback: Callable which accepts :class:`RequestTrace`
+        """
+        if event not in self._hooks:
+            raise ValueError('unknown event {!r}'.format(event))
+        self._hooks[event].append(callback)
+
+    def remove_hook(self, event, callback):
+        """Unregisters callback for the event.
+
+        :param str event: Event name
+        :param callback: Registered callback
+        """
+        self._hooks[event].remove(callback)
+
+    def emit(self, event, trace):
+        """Calls the event callbacks.
+
+        :param str event: Event name
+        :param trace: :class:`RequestTrace` instance
+        """
+        if event == 'on_body_complete':
+            self._record(trace)
+        elif event == 'on_error':
+            self._errors[trace.key] = self._errors.get(trace.key, 0) + 1
+        for callback in self._hooks[event]:
+            try:
+                callback(trace)
+            except Exception:
+                log.exception('%s callback %r failed', event, callback)
+
+    def start(self, method, url):
+        """Starts request tracing.
+
+        :param str method: Request method
+        :param str url: Request URL
+
+        :rtype: :attr:`Instrumentation.trace_class`
+        """
+        trace = self.trace_class(self, method, url)
+        self.emit('on_request_start', trace)
+        return trace
+
+    def endpoints(self):
+        """Returns keys of endpoints which had completed requests.
+
+        :rtype: list
+        """
+        return list(self._histograms)
+
+    def histogram(self, key, phase='total'):
+        """Returns latency histogram for the endpoint and request phase.
+
+        :param str key: Endpoint key, like ``GET /{db}/{docid}``
+        :param str phase: Request phase
+
+        :returns: :attr:`Instrumentation.histogram_class` instance or ``None``
+                  if there were no such requests
+        """
+        histograms = self._histograms.get(key)
+        if histograms is None:
+            return None
+        return histograms[phase]
+
+    def stats(self, quantiles=(0.5, 0.9, 0.99)):
+        """Returns latency summary for each endpoint and request phase.
+
+        :param tuple quantiles: Quantiles to estimate
+
+        :rtype: dict
+        """
+        stats = {}
+        for key in set(self._histograms) | set(self._errors):
+            histograms = self._histograms.get(key, {})
+            stats[key] = {phase: hist.snapshot(quantiles)
+                          for phase, hist in histograms.items()}
+            stats[key]['errors'] = self._errors.get(key, 0)
+        return stats
+
+    def reset(self):
+        """Drops collected histograms."""
+        self._histograms.clear()
+        self._errors.clear()
+
+    def _record(self, trace):
+        histograms = self._histograms.get(trace.key)
+        if histograms is None:
+            histograms = self._histograms[trace.key] = {
+                phase: self.histogram_class() for phase in self.phases}
+        for phase in self.phases:
+            value = getattr(trace, phase)
+            if value is not None:
+                histograms[phase].record(value)
@@ -0,0 +1,403 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import logging
+import re
+
+from .errors import HTTP_ERROR_BY_CODE, HttpErrorException
+from .instrumentation import Instrumentation
+
+
+__all__ = (
+    'MetricsCollector',
+    'format_sample',
+)
+
+
+log = logging.getLogger(__name__)
+
+#: Prometheus text exposition format content type
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsCollector(object):
+    """Collects client side and server side metrics and renders them in
+    `Prometheus text format`_.
+
+    Client side metrics are fed by :class:`~aiocouchdb.instrumentation.
+    Instrumentation` hooks, so the same instance should be passed to
+    :class:`~aiocouchdb.client.HttpSession`:
+
+    .. code-block:: python
+
+        metrics = MetricsCollector()
+        server = Server(session=HttpSession(
+            instrumentation=metrics.instrumentation))
+        metrics.add_server(server)
+        metrics.start()
+        app.router.add_route('GET', '/metrics', metrics.handler)
+
+    Server side metrics are polled from :meth:`~aiocouchdb.v1.server.Server.
+    stats` and :meth:`~aiocouchdb.v1.server.Server.active_tasks` every
+    :attr:`interval` seconds. Rendered samples are cached per server and
+    get re-rendered only when polled values have changed.
+
+    >>> metrics = MetricsCollector()
+    >>> metrics.inc('requests_total', {'method': 'GET'})
+    >>> print(metrics.render(), end='')
+    # TYPE aiocouchdb_requests_total counter
+    aiocouchdb_requests_total{method="GET"} 1
+
+    .. _Prometheus text format: https://prometheus.io/docs/instrumenting/exposition_formats/
+    """
+
+    #: Client side metrics name prefix
+    namespace = 'aiocouchdb'
+    #: Server side metrics name prefix
+    server_namespace = 'couchdb'
+    #: Server metrics polling interval in seconds
+    interval = 15.0
+    #: Request latency quantiles to export
+    quantiles = (0.5, 0.9, 0.99)
+
+    def __init__(self, *,
+                 instrumentation=None,
+                 interval=None,
+                 loop=None,
+                 namespace=None):
+        if interval is not None:
+            self.interval = interval
+        if namespace is not None:
+            self.namespace = namespace
+        self._loop = loop
+        self.instrumentation = instrumentation or Instrumentation()
+        self.instrumentation.add_hook('on_body_complete', self._on_complete)
+        self.instrumentation.add_hook('on_error', self._on_error)
+        self._counters = {}
+        self._gauges = {}
+        self._servers = {}
+        self._server_values = {}
+        self._server_samples = {}
+        self._task = None
+
+    def inc(self, name, labels=None, value=1):
+        """Increments client side counter.
+
+        :param str name: Metric name without namespace
+        :param dict labels: Metric labels
+        :param value: Increment value
+        """
+        key = (name, tuple(sorted((labels or {}).items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def add_gauge(self, name, callback):
+        """Registers gauge which value is computed on render.
+
+        :param str name: Metric name without namespace
+        :param callback: Callable which returns a number or dict of
+                         ``{labels tuple: value}``
+        """
+        self._gauges[name] = callback
+
+    def track_connector(self, connector, name='default'):
+        """Exports connection pool usage.
+
+        :param connector: :class:`aiohttp.connector.BaseConnector` instance
+        :param str name: Pool name
+        """
+        def pool_usage():
+            conns = getattr(connector, '_conns', {})
+            acquired = getattr(connector, '_acquired', {})
+            return {
+                (('pool', name), ('state', 'idle')):
+                    sum(len(items) for items in conns.values()),
+                (('pool', name), ('state', 'acquired')):
+                    sum(len(items) for items in acquired.values()),
+            }
+        self._merge_gauge('connections', pool_usage)
+
+    def track_feed(self, feed, name):
+        """Exports amount of feed items which are received, but not consumed
+        yet. Growing value means that consumer lags behind the server.
+
+        :param feed: :class:`~aiocouchdb.feeds.Feed` instance
+        :param str name: Feed name
+        """
+        self._merge_gauge('feed_backlog',
+                          lambda: {(('feed', name),): feed.backlog})
+
+    def track_cache(self, cache, name):
+        """Exports cache hits and misses. Cache object should provide
+        ``hits`` and ``misses`` counters.
+
+        :param cache: Cache instance
+        :param str name: Cache name
+        """
+        def cache_usage():
+            return {
+                (('cache', name), ('result', 'hit')): cache.hits,
+                (('cache', name), ('result', 'miss')): cache.misses,
+            }
+        self._merge_gauge('cache_requests', cache_usage)
+
+    def track_breaker(self, policy, name='default'):
+        """Exports circuit breaker state and adaptive concurrency limit of
+        each host known by the policy. Circuit state is exported as ``1``
+        for the current state and ``0`` for others.
+
+        :param policy: :class:`~aiocouchdb.breaker.BreakerPolicy` instance
+        :param str name: Policy name
+        """
+        def host_values(key):
+            return lambda: {
+                (('host', host), ('policy', name)): stats[key]
+                for host, stats in policy.stats().items()}
+
+        def breaker_state():
+            breaker = policy.breaker_class
+            values = {}
+            for host, stats in policy.stats().items():
+                for state in (breaker.CLOSED, breaker.OPEN, breaker.HALF_OPEN):
+                    labels = (('host', host), ('policy', name),
+                              ('state', state))
+                    values[labels] = int(stats['state'] == state)
+            return values
+
+        self._merge_gauge('breaker_state', breaker_state)
+        for key in ('failures', 'opened', 'limit', 'inflight', 'waiting'):
+            self._merge_gauge('breaker_' + key, host_values(key))
+
+    def add_server(self, server, name=None):
+        """Adds server to poll metrics from.
+
+        :param server: :class:`~aiocouchdb.v1.server.Server` instance
+        :param str name: Server label value. Server URL by default
+        """
+        self._servers[name or server.resource.url] = server
+
+    def remove_server(self, name):
+        """Stops polling metrics from the server.
+
+        :param str name: Server label value
+        """
+        self._servers.pop(name, None)
+        self._server_values.pop(name, None)
+        self._server_samples.pop(name, None)
+
+    @asyncio.coroutine
+    def poll(self):
+        """Polls metrics from all the servers at once."""
+        names = list(self._servers)
+        results = yield from asyncio.gather(
+            *[self._poll_server(name) for name in names],
+            loop=self._loop, return_exceptions=True)
+        for name, result in zip(names, results):
+            if isinstance(result, Exception):
+                log.warning('failed to poll metrics from %s: %r', name, result)
+                self.inc('poll_errors_total', {'server': name})
+
+    def start(self):
+        """Starts background metrics polling."""
+        if self._task is None:
+            self._task = asyncio.Task(self._poll_loop(), loop=self._loop)
+
+    def stop(self):
+        """Stops background metrics polling."""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+    def render(self):
+        """Renders all the metrics in Prometheus text format.
+
+        :rtype: str
+        """
+        families = {}
+        for (name, labels), value in sorted(self._counters.items()):
+            self._add(families, name, 'counter', labels, value)
+        for name, callback in sorted(self._gauges.items()):
+            value = callback()
+            if not isinstance(value, dict):
+                value = {(): value}
+            for labels, item in sorted(value.items()):
+                self._add(families, name, 'gauge', labels, item)
+        self._render_latency(families)
+        for server in sorted(self._server_samples):
+            for name, (kind, help_text, samples) in \
+                    self._server_samples[server].items():
+                family = families.setdefault(name, (kind, help_text, []))
+                family[2].extend(samples)
+
+        lines = []
+        for name in sorted(families):
+            kind, help_text, samples = families[name]
+            if help_text:
+                lines.append('# HELP {} {}'.format(name, help_text))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            lines.extend(samples)
+        return ''.join(line + '\n' for line in lines)
+
+    @asyncio.coroutine
+    def handler(self, request):
+        """:mod:`aiohttp.web` request handler which responds with rendered
+        metrics.
+
+        :param request: :class:`aiohttp.web.Request` instance
+
+        :rtype: :class:`aiohttp.web.Response`
+        """
+        from aiohttp import web
+        return web.Response(body=self.render().encode('utf-8'),
+                            headers={'CONTENT-TYPE': CONTENT_TYPE})
+
+    def _merge_gauge(self, name, callback):
+        callbacks = getattr(self._gauges.get(name), 'callbacks', None)
+        if callbacks is None:
+            def merged():
+                values = {}
+                for item in merged.callbacks:
+                    values.update(item())
+                return values
+            merged.callbacks = callbacks = []
+            self._gauges[name] = merged
+        callbacks.append(callback)
+
+    def _add(self, families, name, kind, labels, value, help_text=None):
+        name = '{}_{}'.format(self.namespace, name)
+        family = families.setdefault(name, (kind, help_text, []))
+        family[2].append(format_sample(name, labels, value))
+
+    def _render_latency(self, families):
+        name = '{}_request_duration_seconds'.format(self.namespace)
+        for key in sorted(self.instrumentation.endpoints()):
+            method, endpoint = key.split(' ', 1)
+            for phase in self.instrumentation.phases:
+                hist = self.instrumentation.histogram(key, phase)
+                if hist is None or not hist.count:
+                    continue
+                labels = (('endpoint', endpoint), ('method', method),
+                          ('phase', phase))
+                family = families.setdefault(name, ('summary', None, []))
+                for q in self.quantiles:
+                    family[2].append(format_sample(
+                        name, labels + (('quantile', '{:g}'.format(q)),),
+                        hist.quantile(q)))
+                family[2].append(format_sample(name + '_sum', labels,
+                                               hist.total))
+                family[2].append(format_sample(name + '_count', labels,
+                                               hist.count))
+
+    def _on_complete(self, trace):
+        labels = {'method': trace.method, 'endpoint': trace.template}
+        self.inc('requests_total', dict(labels, status=str(trace.status)))
+        if trace.bytes:
+            self.inc('response_bytes_total', labels, trace.bytes)
+        if trace.status is not None and trace.status >= 400:
+            exc_cls = HTTP_ERROR_BY_CODE.get(trace.status, HttpErrorException)
+            self.inc('errors_total', dict(labels, error=exc_cls.__name__))
+
+    def _on_error(self, trace):
+        labels = {'method': trace.method, 'endpoint': trace.template}
+        self.inc('errors_total',
+                 dict(labels, error=type(trace.error).__name__))
+
+    @asyncio.coroutine
+    def _poll_loop(self):
+        while True:
+            yield from self.poll()
+            yield from asyncio.sleep(self.interval, loop=self._loop)
+
+    @asyncio.coroutine
+    def _poll_server(self, name):
+        server = self._servers[name]
+        stats = yield from server.stats()
+        tasks = yield from server.active_tasks()
+
+        values = {}
+        for group, metrics in sorted((stats or {}).items()):
+            for metric, info in sorted(metrics.items()):
+                if not isinstance(info, dict):
+                    continue
+                values[(group, metric)] = (info.get('current'),
+                                           info.get('description'))
+        counts = {}
+        for task in tasks or ():
+            kind = task.get('type', 'unknown')
+            counts[kind] = counts.get(kind, 0) + 1
+        values[('active', 'tasks')] = tuple(sorted(counts.items()))
+
+        # most of the stats are stale between polls, so don't render them
+        # again if nothing has changed
+        if self._server_values.get(name) == values:
+            return
+        self._server_values[name] = values
+        self._server_samples[name] = self._render_server(name, values)
+
+    def _render_server(self, name, values):
+        families = {}
+        server = (('server', name),)
+        for (group, metric), value in values.items():
+            if (group, metric) == ('active', 'tasks'):
+                continue
+            current, description = value
+            if current is None:
+                continue
+            metric_name = sanitize('{}_{}_{}'.format(
+                self.server_namespace, group, metric))
+            families[metric_name] = ('gauge', description, [
+                format_sample(metric_name, server, current)])
+
+        metric_name = '{}_active_tasks'.format(self.server_namespace)
+        families[metric_name] = ('gauge', None, [
+            format_sample(metric_name, server + (('type', kind),), count)
+            for kind, count in values[('active', 'tasks')]])
+        return families
+
+
+def sanitize(name):
+    """Makes valid Prometheus metric name.
+
+    >>> sanitize('couchdb_httpd_status_codes_200')
+    'couchdb_httpd_status_codes_200'
+    >>> sanitize('couchdb_couch-replicator/docs')
+    'couchdb_couch_replicator_docs'
+    """
+    return re.sub('[^a-zA-Z0-9_:]', '_', name)
+
+
+def format_sample(name, labels, value):
+    """Formats single metric sample.
+
+    >>> format_sample('requests_total', (('method', 'GET'),), 42)
+    'requests_total{method="GET"} 42'
+    >>> format_sample('up', (), 1.5)
+    'up 1.5'
+
+    :param str name: Metric name
+    :param tuple labels: Pairs of label name and value
+    :param value: Sample value
+
+    :rtype: str
+    """
+    if labels:
+        name += '{' + ','.join(
+            '{}="{}"'.format(key, str(val).replace('\\', r'\\')
+                                          .replace('"', r'\"')
+                                          .replace('\n', r'\n'))
+            for key, val in labels) + '}'
+    return '{} {}'.format(name, format_value(value))
+
+
+def format_value(value):
+    if value is None:
+        return 'NaN'
+    if isinstance(value, bool):
+        return str(int(value))
+    return repr(value)
@@ -9,28 +9,659 @@
 
 # flake8: noqa
 
+import asyncio
+import base64
+import binascii
+import io
+import json
+import zlib
+
+from aiohttp.helpers import parse_mimetype
+from aiohttp.multidict import CIMultiDict
 from aiohttp.multipart import (
-    MultipartReader,
+    MultipartReader as _MultipartReader,
     MultipartWriter as _MultipartWriter,
-    BodyPartReader,
+    BodyPartReader as _BodyPartReader,
     BodyPartWriter as _BodyPartWriter,
+    MultipartResponseWrapper as _MultipartResponseWrapper,
+    content_disposition_filename,
+    parse_content_disposition,
 )
+from aiocouchdb.compat import StopAsyncIteration
 from aiocouchdb.hdrs import (
+    CONTENT_DISPOSITION,
     CONTENT_ENCODING,
     CONTENT_LENGTH,
     CONTENT_TRANSFER_ENCODING,
+    CONTENT_TYPE,
 )
 
 
+class SizedStream(object):
+    """Asynchronous source of binary data of the declared length which could
+    be used as multipart body part payload.
+
+    The source is either an object with ``read(size)`` coroutine, like
+    :class:`~aiocouchdb.v1.attachment.AttachmentReader` or
+    :class:`asyncio.StreamReader`, or an asynchronous iterator of bytes.
+
+    :param source: Data source
+    :param int length: Amount of bytes the source will emit
+    :param str content_type: Content type of the data
+    :param int chunk_size: Size of chunks to read from the source
+    """
+
+    #: Size of chunks to read from the source
+    chunk_size = 65536
+
+    def __init__(self, source, length, *, content_type=None, chunk_size=None):
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.source = source
+        self.length = length
+        self.content_type = content_type
+
+    @asyncio.coroutine
+    def _read(self, size):
+        # request payload writer accepts only bytes and futures from us,
+        # so whatever the source awaits for is kept inside of the task
+        if hasattr(self.source, 'read'):
+            return (yield from asyncio.async(self.source.read(size)))
+        try:
+            return (yield from asyncio.async(self.source.__anext__()))
+        except StopAsyncIteration:
+            return b''
+
+    @asyncio.coroutine
+    def stream(self):
+        """Yields chunks of the source data awaiting for them. Raises
+        :exc:`EOFError` if the source ends before the declared length."""
+        left = self.length
+        while left > 0:
+            chunk = yield from self._read(min(left, self.chunk_size))
+            if not chunk:
+                raise EOFError('stream ended {} bytes earlier than declared'
+                               ''.format(left))
+            chunk = bytes(chunk[:left])
+            left -= len(chunk)
+            yield chunk
+
+
+class GzipStream(object):
+    """Source of gzip compressed data which is produced on the fly while
+    request payload is sent, so neither the whole content nor its compressed
+    copy are ever kept in memory or written to disk. Since compressed length
+    isn't known in advance, payload is sent with chunked transfer encoding.
+
+    The source is either a regular binary file object or any source which
+    :class:`SizedStream` accepts.
+
+    With ``threaded`` enabled, data is compressed in default executor of
+    the event loop, as well as regular file objects are read there, so large
+    uploads don't block the loop.
+
+    :param source: Data source
+    :param int chunk_size: Size of chunks to read from the source
+    :param int level: Compression level, from ``1`` to ``9``
+    :param bool threaded: Whenever to compress data in executor
+    :param loop: AsyncIO event loop instance
+    """
+
+    #: Size of chunks to read from the source
+    chunk_size = 65536
+    #: Compression level, from ``1`` (fastest) to ``9`` (smallest)
+    level = 6
+
+    def __init__(self, source, *,
+                 chunk_size=None,
+                 level=None,
+                 loop=None,
+                 threaded=False):
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if level is not None:
+            self.level = level
+        self.source = source
+        self.threaded = threaded
+        self._loop = loop
+        #: Amount of bytes read from the source
+        self.length = 0
+        #: Amount of compressed bytes emitted
+        self.compressed_length = 0
+
+    def _is_async(self):
+        read = getattr(self.source, 'read', None)
+        return read is None or asyncio.iscoroutinefunction(read)
+
+    @asyncio.coroutine
+    def _read(self, size):
+        if hasattr(self.source, 'read'):
+            return (yield from asyncio.async(self.source.read(size),
+                                             loop=self._loop))
+        try:
+            return (yield from asyncio.async(self.source.__anext__(),
+                                             loop=self._loop))
+        except StopAsyncIteration:
+            return b''
+
+    def _read_compress(self, compressor, size):
+        chunk = self.source.read(size)
+        return chunk, self._compress(compressor, chunk)
+
+    @staticmethod
+    def _compress(compressor, chunk):
+        if chunk:
+            return compressor.compress(chunk)
+        return compressor.flush()
+
+    @asyncio.coroutine
+    def stream(self):
+        """Yields chunks of compressed data."""
+        loop = self._loop or asyncio.get_event_loop()
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        is_async = self._is_async()
+        while True:
+            if is_async:
+                chunk = yield from self._read(self.chunk_size)
+                if self.threaded:
+                    data = yield from loop.run_in_executor(
+                        None, self._compress, compressor, chunk)
+                else:
+                    data = self._compress(compressor, chunk)
+            elif self.threaded:
+                chunk, data = yield from loop.run_in_executor(
+                    None, self._read_compress, compressor, self.chunk_size)
+            else:
+                chunk, data = self._read_compress(compressor, self.chunk_size)
+            self.length += len(chunk)
+            # empty chunk terminates chunked payload, so it's never yielded
+            if data:
+                self.compressed_length += len(data)
+                yield data
+            if not chunk:
+                break
+
+
+class BodyPartReader(_BodyPartReader):
+    """Body part reader which supports ``async for`` iteration over
+    the content chunks on Python 3.5+."""
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if self._length is None:
+            chunk = yield from self.readline()
+        else:
+            chunk = yield from self.read_chunk()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+
+class MultipartResponseWrapper(_MultipartResponseWrapper):
+    """Multipart response wrapper which supports ``async for`` iteration
+    on Python 3.5+. Connection is released once the iteration is over."""
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        try:
+            item = yield from self.stream.__anext__()
+        except StopAsyncIteration:
+            yield from self.release()
+            raise
+        if self.stream.at_eof():
+            yield from self.release()
+        return item
+
+
+class MultipartReader(_MultipartReader):
+    """Multipart reader which supports ``async for`` iteration over
+    the body parts on Python 3.5+."""
+
+    response_wrapper_cls = MultipartResponseWrapper
+    part_reader_cls = BodyPartReader
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        part = yield from self.next()
+        if part is None:
+            raise StopAsyncIteration
+        return part
+
+
+class BoundaryScanner(object):
+    """Splits multipart body into parts by searching delimiters with
+    :meth:`bytes.find` over chunks received from the stream, so parts
+    content is emitted as :class:`memoryview` slices of these chunks without
+    copying them. Only public stream API (``readany()``) is used.
+
+    :param content: Stream of multipart body
+    :param str boundary: Multipart boundary
+    """
+
+    def __init__(self, content, boundary):
+        self._content = content
+        self._delimiter = b'\r\n--' + boundary.encode('latin1')
+        # the very first delimiter comes without leading CRLF, so body starts
+        # within preamble part which is skipped
+        self._chunk = b'\r\n'
+        self._pos = 0
+        # end of the current part data within the chunk and whether
+        # the delimiter follows it, so each chunk is scanned only once
+        self._end = None
+        self._found = False
+        self._in_body = True
+        self._at_eof = False
+
+    def at_eof(self):
+        """Returns ``True`` if the close delimiter was reached."""
+        return self._at_eof
+
+    @asyncio.coroutine
+    def read_body(self, size):
+        """Returns up to ``size`` bytes of the current part body.
+
+        :returns: Part data or empty view once the part is over
+        :rtype: memoryview
+        """
+        while self._in_body:
+            if self._end is None:
+                self._scan()
+            pos = self._pos
+            if self._end > pos:
+                end = min(self._end, pos + size)
+                self._pos = end
+                return memoryview(self._chunk)[pos:end]
+            if self._found:
+                self._pos = self._end + len(self._delimiter)
+                self._end = None
+                self._in_body = False
+                break
+            yield from self._feed()
+        return memoryview(b'')
+
+    @asyncio.coroutine
+    def next_part(self):
+        """Skips the rest of the current part and reads headers of the next
+        one.
+
+        :returns: Part headers or ``None`` if the close delimiter is reached
+        :rtype: :class:`~aiohttp.multidict.CIMultiDict`
+        """
+        while self._in_body:
+            yield from self.read_body(1 << 30)
+        if self._at_eof:
+            return None
+        while len(self._chunk) - self._pos < 2:
+            yield from self._feed()
+        if self._chunk.startswith(b'--', self._pos):
+            self._at_eof = True
+            return None
+        line = yield from self._readline()
+        if line.strip(b' \t'):
+            raise ValueError('Invalid boundary line {!r}'.format(line))
+        headers = CIMultiDict()
+        while True:
+            line = yield from self._readline()
+            if not line:
+                break
+            name, sep, value = line.decode('latin1').partition(':')
+            if not sep:
+                raise ValueError('Invalid part header {!r}'.format(line))
+            headers.add(name.strip(), value.strip())
+        self._in_body = True
+        return headers
+
+    def _scan(self):
+        chunk, pos = self._chunk, self._pos
+        idx = chunk.find(self._delimiter, pos)
+        self._found = idx != -1
+        if self._found:
+            self._end = idx
+        else:
+            self._end = len(chunk) - self._delimiter_prefix(chunk, pos)
+
+    def _delimiter_prefix(self, chunk, pos):
+        # length of the chunk tail which may turn into delimiter with
+        # the next chunk, so it's kept till then
+        idx = chunk.find(b'\r', max(pos, len(chunk) - len(self._delimiter)))
+        while idx != -1:
+            if self._delimiter.startswith(chunk[idx:]):
+                return len(chunk) - idx
+            idx = chunk.find(b'\r', idx + 1)
+        return 0
+
+    @asyncio.coroutine
+    def _feed(self):
+        data = yield from self._content.readany()
+        if not data:
+            raise EOFError('multipart body ended unexpectedly')
+        rest = self._chunk[self._pos:]
+        self._chunk = rest + data if rest else data
+        self._pos = 0
+        self._end = None
+
+    @asyncio.coroutine
+    def _readline(self):
+        while True:
+            idx = self._chunk.find(b'\r\n', self._pos)
+            if idx != -1:
+                line = self._chunk[self._pos:idx]
+                self._pos = idx + 2
+                return line
+            yield from self._feed()
+
+
+class FastBodyPartReader(object):
+    """Reader of body part found by :class:`BoundaryScanner`. Provides
+    the same API as :class:`aiohttp.multipart.BodyPartReader` plus
+    :meth:`read_view` to access data without copying.
+
+    On Python 3.5+ it could be iterated with ``async for`` statement which
+    emits chunks of the part data."""
+
+    #: Size of chunks emitted on ``async for`` iteration
+    chunk_size = 8192
+
+    def __init__(self, headers, scanner):
+        #: Part headers
+        self.headers = headers
+        self._scanner = scanner
+        self._at_eof = False
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        chunk = yield from self.read_chunk()
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    @property
+    def filename(self):
+        """Returns filename specified in `Content-Disposition` header or
+        ``None`` if missed or header is malformed."""
+        _, params = parse_content_disposition(
+            self.headers.get(CONTENT_DISPOSITION))
+        return content_disposition_filename(params)
+
+    def at_eof(self):
+        """Returns ``True`` if all the part data was read."""
+        return self._at_eof
+
+    @asyncio.coroutine
+    def read_view(self, size=chunk_size):
+        """Reads up to ``size`` bytes of the part data without copying them.
+        Returns empty view once the part is over.
+
+        :rtype: memoryview
+        """
+        if self._at_eof:
+            return memoryview(b'')
+        view = yield from self._scanner.read_body(size)
+        if not view:
+            self._at_eof = True
+        return view
+
+    @asyncio.coroutine
+    def read_chunk(self, size=chunk_size):
+        """Reads up to ``size`` bytes of the part data.
+
+        :rtype: bytes
+        """
+        return bytes((yield from self.read_view(size)))
+
+    @asyncio.coroutine
+    def read(self, *, decode=False):
+        """Reads the whole part data.
+
+        :param bool decode: Decodes data following by encoding method
+                            from `Content-Encoding` header
+
+        :rtype: bytes
+        """
+        views = []
+        while True:
+            view = yield from self.read_view(1 << 30)
+            if not view:
+                break
+            views.append(view)
+        data = b''.join(views)
+        if decode:
+            return self.decode(data)
+        return data
+
+    @asyncio.coroutine
+    def next(self):
+        """Returns the whole part data or ``None`` if it was read already."""
+        data = yield from self.read()
+        return data or None
+
+    @asyncio.coroutine
+    def release(self):
+        """Reads the rest of the part data to the void."""
+        while not self._at_eof:
+            yield from self.read_view(1 << 30)
+
+    @asyncio.coroutine
+    def text(self, *, encoding=None):
+        """Like :meth:`read`, but assumes that the part contains text data.
+
+        :rtype: str
+        """
+        data = yield from self.read(decode=True)
+        return data.decode(encoding or self.get_charset(default='latin1'))
+
+    @asyncio.coroutine
+    def json(self, *, encoding=None):
+        """Like :meth:`read`, but assumes that the part contains JSON data."""
+        data = yield from self.read(decode=True)
+        if not data:
+            return None
+        encoding = encoding or self.get_charset(default='utf-8')
+        return json.loads(data.decode(encoding))
+
+    def decode(self, data):
+        """Decodes data according to `Content-Transfer-Encoding` and
+        `Content-Encoding` headers.
+
+        :raises: :exc:`RuntimeError` - if encoding is unknown
+
+        :rtype: bytes
+        """
+        encoding = self.headers.get(CONTENT_TRANSFER_ENCODING, '').lower()
+        if encoding == 'base64':
+            data = base64.b64decode(data)
+        elif encoding == 'quoted-printable':
+            data = binascii.a2b_qp(data)
+        elif encoding not in ('', 'binary', '7bit', '8bit'):
+            raise RuntimeError('unknown content transfer encoding: {}'
+                               ''.format(encoding))
+        encoding = self.headers.get(CONTENT_ENCODING, 'identity').lower()
+        if encoding == 'gzip':
+            return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+        elif encoding != 'identity':
+            raise RuntimeError('unknown content encoding: {}'.format(encoding))
+        return data
+
+    def get_charset(self, default=None):
+        """Returns charset parameter of `Content-Type` header or default."""
+        *_, params = parse_mimetype(self.headers.get(CONTENT_TYPE, ''))
+        return params.get('charset', default)
+
+
+class FastMultipartReader(object):
+    """Multipart reader built on :class:`BoundaryScanner` which doesn't
+    depend on :class:`aiohttp.multipart.MultipartReader` internals. Nested
+    multipart parts are emitted as regular ones.
+
+    On Python 3.5+ it could be iterated with ``async for`` statement which
+    emits the same parts as :meth:`next` does."""
+
+    part_reader_cls = FastBodyPartReader
+    response_wrapper_cls = MultipartResponseWrapper
+
+    def __init__(self, headers, content):
+        self.headers = headers
+        mimetype, *_, params = parse_mimetype(headers[CONTENT_TYPE])
+        if mimetype != 'multipart' or 'boundary' not in params:
+            raise ValueError('multipart Content-Type with boundary expected,'
+                             ' got {}'.format(headers[CONTENT_TYPE]))
+        self._scanner = BoundaryScanner(content, params['boundary'])
+        self._last_part = None
+
+    @classmethod
+    def from_response(cls, response):
+        """Constructs reader instance from HTTP response.
+
+        :param response: :class:`~aiocouchdb.client.HttpResponse` instance
+        """
+        return cls.response_wrapper_cls(response, cls(response.headers,
+                                                      response.content))
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        part = yield from self.next()
+        if part is None:
+            raise StopAsyncIteration
+        return part
+
+    def at_eof(self):
+        """Returns ``True`` if the close delimiter was reached."""
+        return self._scanner.at_eof()
+
+    @asyncio.coroutine
+    def next(self):
+        """Emits the next part reader skipping the rest of the previous
+        part.
+
+        :returns: :class:`FastBodyPartReader` or ``None`` if there are no
+                  more parts
+        """
+        if self._last_part is not None:
+            yield from self._last_part.release()
+            self._last_part = None
+        headers = yield from self._scanner.next_part()
+        if headers is None:
+            return None
+        self._last_part = self.part_reader_cls(headers, self._scanner)
+        return self._last_part
+
+    @asyncio.coroutine
+    def release(self):
+        """Reads all the parts to the void till the close delimiter."""
+        while (yield from self.next()) is not None:
+            pass
+
+
+class EmptyMultipartReader(object):
+    """Multipart reader without parts."""
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        raise StopAsyncIteration
+
+    def at_eof(self):
+        """Always returns ``True``."""
+        return True
+
+    @asyncio.coroutine
+    def next(self):
+        """Always returns ``None``."""
+        return None
+
+    @asyncio.coroutine
+    def release(self):
+        """Does nothing."""
+
+
 class BodyPartWriter(_BodyPartWriter):
+    """Body part writer which also knows length of seekable streams and
+    supports :class:`SizedStream` payloads."""
 
-    def calc_content_length(self):
-        has_encoding = (
+    def _guess_content_length(self, obj):
+        if isinstance(obj, SizedStream):
+            return obj.length
+        length = super()._guess_content_length(obj)
+        if length is None and isinstance(obj, io.IOBase) and obj.seekable():
+            position = obj.tell()
+            length = obj.seek(0, io.SEEK_END) - position
+            obj.seek(position)
+        return length
+
+    def _guess_content_type(self, obj, default='application/octet-stream'):
+        if isinstance(obj, SizedStream):
+            return obj.content_type or default
+        return super()._guess_content_type(obj, default)
+
+    def _serialize_json(self, obj):
+        if isinstance(obj, bytes):
+            # already serialized
+            return self._serialize_bytes(obj)
+        return super()._serialize_json(obj)
+
+    def _has_encoding(self):
+        return (
             CONTENT_ENCODING in self.headers
             and self.headers[CONTENT_ENCODING] != 'identity'
             or CONTENT_TRANSFER_ENCODING in self.headers
         )
-        if has_encoding:
+
+    def _can_send_file(self):
+        return (isinstance(self.obj, io.IOBase) and
+                not isinstance(self.obj, io.TextIOBase) and
+                CONTENT_LENGTH in self.headers and
+                not self._has_encoding())
+
+    @asyncio.coroutine
+    def stream(self, send_file=None):
+        """Yields body part chunks like :meth:`serialize` does, but also
+        awaits for :class:`SizedStream` payload data.
+
+        :param send_file: Function which takes binary file object payload
+                          and amount of bytes to send and returns future
+                          which writes them right into the transport. If
+                          specified, file payload of known length isn't
+                          read into chunks
+        """
+        send_file = send_file if self._can_send_file() else None
+        if not isinstance(self.obj, SizedStream) and send_file is None:
+            for chunk in self.serialize():
+                yield chunk
+            return
+        if self.headers:
+            yield b'\r\n'.join(
+                b': '.join(map(lambda i: i.encode('latin1'), item))
+                for item in self.headers.items()
+            )
+        yield b'\r\n\r\n'
+        if send_file is not None:
+            yield from send_file(self.obj, int(self.headers[CONTENT_LENGTH]))
+        else:
+            yield from self.obj.stream()
+        yield b'\r\n'
+
+    def calc_content_length(self):
+        if self._has_encoding():
             raise ValueError('Cannot calculate content length')
 
         if CONTENT_LENGTH not in self.headers:
@@ -48,9 +679,25 @@ class BodyPartWriter(_BodyPartWriter):
 
 
 class MultipartWriter(_MultipartWriter):
+    """Multipart writer which body could be streamed as request payload
+    with :meth:`stream`."""
 
     part_writer_cls = BodyPartWriter
 
+    @asyncio.coroutine
+    def stream(self, send_file=None):
+        """Yields multipart body chunks awaiting for data of asynchronous
+        body parts. Unlike :meth:`serialize` it's a coroutine, so request
+        writer waits for the transport to drain between the chunks.
+
+        :param send_file: Function which sends file payloads of body parts,
+                          see :meth:`BodyPartWriter.stream`
+        """
+        for part in self.parts:
+            yield b'--' + self.boundary + b'\r\n'
+            yield from part.stream(send_file)
+        yield b'--' + self.boundary + b'--\r\n'
+
     def calc_content_length(self):
         total = 0
         len_boundary = len(self.boundary)
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import datetime
+import email.utils
+import functools
+import io
+import random
+
+import aiohttp
+
+from .hdrs import (
+    METH_COPY,
+    METH_DELETE,
+    METH_GET,
+    METH_HEAD,
+    METH_OPTIONS,
+    METH_PUT,
+    RETRY_AFTER,
+)
+
+
+__all__ = (
+    'RetryPolicy',
+    'parse_retry_after',
+)
+
+
+#: Errors which signal about broken connection rather than a failed request
+CONNECTION_ERRORS = (
+    aiohttp.ClientOSError,
+    aiohttp.ClientResponseError,
+    aiohttp.ClientTimeoutError,
+    aiohttp.ServerDisconnectedError,
+    ConnectionError,
+)
+
+
+class RetryPolicy(object):
+    """Retry policy for :class:`~aiocouchdb.client.HttpSession`.
+
+    Failed requests are retried with exponential backoff and `full jitter`_
+    if they are safe to repeat:
+
+    - ``GET``, ``HEAD`` and ``OPTIONS`` requests are retried on connection
+      errors and on ``5xx`` responses;
+    - ``PUT``, ``DELETE`` and ``COPY`` requests for a specific document
+      revision are retried on connection errors only: if the first attempt had
+      reached the server, the retry fails with :exc:`~aiocouchdb.errors.
+      ResourceConflict` instead of creating a duplicate;
+    - the rest are never retried.
+
+    Requests with payload that cannot be replayed (generators, non-seekable
+    streams, multipart writers) are never retried.
+
+    The `Retry-After` response header is respected unless it asks to wait
+    longer than :attr:`max_retry_after` seconds. To prevent retry storms
+    while the server is in trouble, each request earns :attr:`budget` retry
+    tokens and each retry spends one.
+
+    >>> policy = RetryPolicy(jitter=False)
+    >>> [policy.backoff(attempt) for attempt in range(4)]
+    [0.1, 0.2, 0.4, 0.8]
+
+    .. _full jitter: https://www.awsarchitectureblog.com/2015/03/backoff.html
+    """
+
+    #: Maximum amount of retries per request
+    max_retries = 3
+    #: Base backoff delay in seconds
+    backoff_base = 0.1
+    #: Maximum backoff delay in seconds
+    backoff_max = 10.0
+    #: Whenever to randomize backoff delays
+    jitter = True
+    #: Maximum accepted `Retry-After` header value in seconds
+    max_retry_after = 60.0
+    #: Fraction of requests which are allowed to be retried
+    budget = 0.2
+    #: Maximum amount of retries which could be made in a row
+    burst = 10
+    #: Requests methods which are safe to retry on any failure
+    idempotent_methods = frozenset({METH_GET, METH_HEAD, METH_OPTIONS})
+    #: Requests methods which are safe to retry on connection errors
+    #: when document revision is specified
+    revision_methods = frozenset({METH_COPY, METH_DELETE, METH_PUT})
+    #: Response status codes which are considered as transient failures
+    retry_statuses = frozenset({500, 502, 503, 504})
+
+    def __init__(self, *,
+                 backoff_base=None,
+                 backoff_max=None,
+                 budget=None,
+                 burst=None,
+                 jitter=None,
+                 max_retries=None,
+                 max_retry_after=None,
+                 loop=None):
+        if backoff_base is not None:
+            self.backoff_base = backoff_base
+        if backoff_max is not None:
+            self.backoff_max = backoff_max
+        if budget is not None:
+            self.budget = budget
+        if burst is not None:
+            self.burst = burst
+        if jitter is not None:
+            self.jitter = jitter
+        if max_retries is not None:
+            self.max_retries = max_retries
+        if max_retry_after is not None:
+            self.max_retry_after = max_retry_after
+        self._loop = loop
+        self._random = random.Random()
+        self._tokens = float(self.burst)
+        self.requests = 0
+        self.retries = 0
+
+    def backoff(self, attempt):
+        """Returns delay in seconds before the next retry.
+
+        :param int attempt: Number of failed attempts made, starting from zero
+
+        :rtype: float
+        """
+        delay = min(self.backoff_max, self.backoff_base * 2 ** attempt)
+        if self.jitter:
+            delay = self._random.uniform(0, delay)
+        return delay
+
+    def is_replayable(self, data):
+        """Checks if request payload could be sent once again.
+
+        :param data: Request payload
+
+        :rtype: bool
+        """
+        if data is None or isinstance(data, (bytes, bytearray, str,
+                                             dict, list)):
+            return True
+        if isinstance(data, io.IOBase):
+            return data.seekable()
+        return False
+
+    def is_retryable(self, method, kwargs, *, exc=None, resp=None):
+        """Classifies the failure and decides if request could be retried.
+
+        :param str method: Request method
+        :param dict kwargs: Request arguments
+        :param Exception exc: Raised exception, if any
+        :param resp: :class:`~aiocouchdb.client.HttpResponse` instance,
+                     if any
+
+        :rtype: bool
+        """
+        method = method.upper()
+        if exc is not None and not isinstance(exc, CONNECTION_ERRORS):
+            return False
+        if resp is not None and resp.status not in self.retry_statuses:
+            return False
+        if method in self.idempotent_methods:
+            return True
+        if method in self.revision_methods and exc is not None:
+            return self._has_revision(kwargs)
+        return False
+
+    def retry_after(self, resp):
+        """Returns delay requested by `Retry-After` response header.
+
+        :param resp: :class:`~aiocouchdb.client.HttpResponse` instance
+
+        :returns: Delay in seconds or ``None`` if header is missed or invalid
+        :rtype: float
+        """
+        if resp is None:
+            return None
+        return parse_retry_after(resp.headers.get(RETRY_AFTER))
+
+    def wrap(self, request_func):
+        """Wraps request coroutine function to apply retry policy."""
+        @functools.wraps(request_func)
+        @asyncio.coroutine
+        def wrapper(method, url, **kwargs):
+            loop = kwargs.get('loop') or self._loop
+            data = kwargs.get('data')
+            replayable = self.is_replayable(data)
+            position = None
+            if replayable and isinstance(data, io.IOBase):
+                position = data.tell()
+
+            self.requests += 1
+            self._tokens = min(self._tokens + self.budget, self.burst)
+
+            attempt = 0
+            while True:
+                if attempt and position is not None:
+                    data.seek(position)
+                exc = resp = None
+                try:
+                    resp = yield from request_func(method, url, **kwargs)
+                except CONNECTION_ERRORS as err:
+                    exc = err
+                if resp is not None and resp.status not in self.retry_statuses:
+                    return resp
+
+                if not replayable or attempt >= self.max_retries:
+                    break
+                if self._tokens < 1:
+                    break
+                if not self.is_retryable(method, kwargs, exc=exc, resp=resp):
+                    break
+
+                delay = self.backoff(attempt)
+                retry_after = self.retry_after(resp)
+                if retry_after is not None:
+                    if retry_after > self.max_retry_after:
+                        break
+                    delay = max(delay, retry_after)
+
+                if resp is not None:
+                    yield from resp.release()
+
+                self._tokens -= 1
+                self.retries += 1
+                attempt += 1
+                yield from asyncio.sleep(delay, loop=loop)
+
+            if exc is not None:
+                raise exc
+            return resp
+        return wrapper
+
+    def _has_revision(self, kwargs):
+        params = kwargs.get('params') or {}
+        if params.get('rev'):
+            return True
+        data = kwargs.get('data')
+        return isinstance(data, dict) and bool(data.get('_rev'))
+
+
+def parse_retry_after(value):
+    """Parses `Retry-After` header value.
+
+    >>> parse_retry_after('120')
+    120.0
+    >>> parse_retry_after('Wed, 21 Oct 2015 07:28:00 GMT') <= 0
+    True
+    >>> parse_retry_after('soon') is None
+    True
+
+    :param str value: Header value: delay in seconds or HTTP date
+
+    :returns: Delay in seconds or ``None`` if value is invalid
+    :rtype: float
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    timestamp = email.utils.mktime_tz(parsed)
+    now = datetime.datetime.now(datetime.timezone.utc).timestamp()
+    return timestamp - now
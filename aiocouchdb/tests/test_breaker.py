@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import unittest
+
+import aiohttp
+import aiocouchdb.breaker
+import aiocouchdb.client
+
+from . import utils
+
+
+class CircuitBreakerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.now = 0
+        self.breaker = aiocouchdb.breaker.CircuitBreaker(
+            clock=lambda: self.now,
+            failure_threshold=3,
+            recovery_timeout=10)
+
+    def test_closed(self):
+        self.assertEqual(self.breaker.state, 'closed')
+        self.assertTrue(self.breaker.allow())
+
+    def test_open_on_failures_in_row(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'closed')
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertFalse(self.breaker.allow())
+        self.assertEqual(self.breaker.opened, 1)
+
+    def test_half_open(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now = 10
+        self.assertEqual(self.breaker.state, 'half-open')
+        self.assertTrue(self.breaker.allow())
+        self.assertFalse(self.breaker.allow())
+
+    def test_half_open_success(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, 'closed')
+
+    def test_half_open_failure(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_failure()
+        self.assertEqual(self.breaker.state, 'open')
+        self.assertEqual(self.breaker.opened, 2)
+
+    def test_half_open_cancel(self):
+        for _ in range(3):
+            self.breaker.record_failure()
+        self.now = 10
+        self.assertTrue(self.breaker.allow())
+        self.breaker.record_cancel()
+        self.assertTrue(self.breaker.allow())
+
+
+class AdaptiveLimiterTestCase(utils.TestCase):
+
+    def test_additive_increase(self):
+        limiter = aiocouchdb.breaker.AdaptiveLimiter(initial_limit=2,
+                                                     loop=self.loop)
+        for _ in range(10):
+            yield from limiter.acquire()
+            limiter.release(0.01, True)
+        self.assertTrue(4 < limiter.limit < 6)
+
+    def test_multiplicative_decrease(self):
+        limiter = aiocouchdb.breaker.AdaptiveLimiter(initial_limit=10,
+                                                     loop=self.loop)
+        yield from limiter.acquire()
+        limiter.release(0.01, False)
+        self.assertEqual(limiter.limit, 9)
+
+    def test_decrease_on_latency_growth(self):
+        limiter = aiocouchdb.breaker.AdaptiveLimiter(initial_limit=10,
+                                                     loop=self.loop)
+        limiter.release(0.01, True)
+        limiter.release(0.1, True)
+        self.assertTrue(limiter.limit < 10)
+
+    def test_latency_baseline_per_endpoint(self):
+        limiter = aiocouchdb.breaker.AdaptiveLimiter(initial_limit=10,
+                                                     loop=self.loop)
+        view = 'GET /{db}/_design/{ddoc}/_view/{view}'
+        for _ in range(10):
+            limiter.release(0.002, True, 'GET /{db}/{docid}')
+            limiter.release(0.05, True, view)
+        self.assertTrue(limiter.limit > 10)
+        limiter.release(0.01, True, 'GET /{db}/{docid}')
+        self.assertTrue(limiter.limit < 11)
+
+    def test_min_limit(self):
+        limiter = aiocouchdb.breaker.AdaptiveLimiter(initial_limit=1,
+                                                     loop=self.loop)
+        limiter.release(0.01, False)
+        self.assertEqual(limiter.limit, 1)
+
+    def test_wait_for_slot(self):
+        limiter = aiocouchdb.breaker.AdaptiveLimiter(initial_limit=1,
+                                                     loop=self.loop)
+        yield from limiter.acquire()
+        waiter = asyncio.Task(limiter.acquire(), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertFalse(waiter.done())
+        self.assertEqual(limiter.waiting, 1)
+        limiter.release()
+        yield from asyncio.wait_for(waiter, 1, loop=self.loop)
+        self.assertEqual(limiter.inflight, 1)
+        self.assertEqual(limiter.waiting, 0)
+
+    def test_cancel_woken_up_waiter(self):
+        limiter = aiocouchdb.breaker.AdaptiveLimiter(initial_limit=1,
+                                                     loop=self.loop)
+        yield from limiter.acquire()
+        first = asyncio.Task(limiter.acquire(), loop=self.loop)
+        second = asyncio.Task(limiter.acquire(), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertEqual(limiter.waiting, 2)
+        limiter.release()
+        first.cancel()
+        yield from asyncio.wait_for(second, 1, loop=self.loop)
+        self.assertTrue(first.cancelled())
+        self.assertEqual(limiter.inflight, 1)
+        self.assertEqual(limiter.waiting, 0)
+
+
+class BreakerPolicyTestCase(utils.TestCase):
+
+    _test_target = 'mock'
+
+    def setUp(self):
+        super().setUp()
+        self.outcomes = []
+        self.request.side_effect = self.fake_request
+        self.policy = aiocouchdb.breaker.BreakerPolicy(
+            breaker_options={'failure_threshold': 2},
+            loop=self.loop)
+        self.session = aiocouchdb.client.HttpSession(breaker=self.policy,
+                                                     loop=self.loop)
+
+    def fake_request(self, method, url, **kwargs):
+        fut = asyncio.Future(loop=self.loop)
+        outcome = self.outcomes.pop(0) if self.outcomes else 200
+        if isinstance(outcome, Exception):
+            fut.set_exception(outcome)
+        else:
+            fut.set_result(self.prepare_response(status=outcome))
+        return fut
+
+    def test_pass_through(self):
+        resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 200)
+        stats = self.policy.stats()['localhost:5984']
+        self.assertEqual(stats['state'], 'closed')
+        self.assertEqual(stats['inflight'], 0)
+
+    def test_open_circuit(self):
+        self.outcomes = [500, aiohttp.ClientOSError()]
+        yield from self.session.request('GET', self.url)
+        with self.assertRaises(aiohttp.ClientOSError):
+            yield from self.session.request('GET', self.url)
+        with self.assertRaises(aiocouchdb.breaker.CircuitOpenError):
+            yield from self.session.request('GET', self.url)
+        self.assertEqual(self.request.call_count, 2)
+        self.assertEqual('open',
+                         self.policy.stats()['localhost:5984']['state'])
+
+    def test_per_host(self):
+        self.outcomes = [500, 500]
+        yield from self.session.request('GET', self.url)
+        yield from self.session.request('GET', self.url)
+        resp = yield from self.session.request('GET', 'http://couch2:5984/')
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.policy.stats()['couch2:5984']['state'], 'closed')
+
+    def test_cancel_while_waiting_for_slot(self):
+        self.policy = aiocouchdb.breaker.BreakerPolicy(
+            breaker_options={'failure_threshold': 1, 'recovery_timeout': 0},
+            limiter_options={'initial_limit': 1},
+            loop=self.loop)
+        session = aiocouchdb.client.HttpSession(breaker=self.policy,
+                                                loop=self.loop)
+        self.outcomes = [500]
+        yield from session.request('GET', self.url)
+        self.assertEqual(self.policy.stats()['localhost:5984']['state'],
+                         'half-open')
+        limiter = self.policy.limiter('localhost:5984')
+        yield from limiter.acquire()
+
+        task = asyncio.Task(session.request('GET', self.url), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertEqual(limiter.waiting, 1)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            yield from task
+        limiter.release()
+
+        resp = yield from session.request('GET', self.url)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.policy.stats()['localhost:5984']['state'],
+                         'closed')
+
+    def test_client_errors_are_not_failures(self):
+        self.outcomes = [404, 404, 404]
+        for _ in range(3):
+            yield from self.session.request('GET', self.url)
+        self.assertEqual(self.policy.stats()['localhost:5984']['state'],
+                         'closed')
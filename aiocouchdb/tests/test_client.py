@@ -7,7 +7,10 @@
 # you should have received as part of this distribution.
 #
 
+import asyncio
 import io
+import os
+import tempfile
 import types
 import unittest.mock as mock
 
@@ -135,6 +138,94 @@ class HttpRequestTestCase(utils.TestCase):
             'post', self.url, data=io.BytesIO(b'foobarbaz'))
         self.assertIsInstance(req.body, io.IOBase)
 
+    def test_regular_file_body(self):
+        with tempfile.TemporaryFile() as fileobj:
+            fileobj.write(b'foobarbaz')
+            fileobj.seek(3)
+            req = aiocouchdb.client.HttpRequest('put', self.url, data=fileobj)
+            self.assertIs(fileobj, req.body)
+            self.assertEqual(6, req.file_size)
+            self.assertEqual('6', req.headers['CONTENT-LENGTH'])
+            self.assertFalse(req.chunked)
+
+    def test_compressed_regular_file_body(self):
+        with tempfile.TemporaryFile() as fileobj:
+            req = aiocouchdb.client.HttpRequest('put', self.url, data=fileobj,
+                                                compress='deflate')
+            self.assertIsNone(req.file_size)
+            self.assertTrue(req.chunked)
+
+
+class SendFileTestCase(utils.TestCase):
+
+    _test_target = 'mock'
+
+    def setUp(self):
+        super().setUp()
+        self.received = bytearray()
+        self.data = os.urandom(4 * 1024 * 1024 + 7)
+        self.fileobj = tempfile.TemporaryFile()
+        self.fileobj.write(self.data)
+        self.addCleanup(self.fileobj.close)
+
+        test = self
+
+        class Receiver(asyncio.Protocol):
+            def data_received(self, data):
+                test.received.extend(data)
+
+            def connection_lost(self, exc):
+                test.closed.set_result(None)
+
+        self.closed = asyncio.Future(loop=self.loop)
+        self.server = self.loop.run_until_complete(
+            self.loop.create_server(Receiver, '127.0.0.1', 0))
+        port = self.server.sockets[0].getsockname()[1]
+        _, self.writer = self.loop.run_until_complete(
+            asyncio.open_connection('127.0.0.1', port, loop=self.loop))
+
+    def tearDown(self):
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        super().tearDown()
+
+    @asyncio.coroutine
+    def send(self, offset=0):
+        self.fileobj.seek(offset)
+        yield from aiocouchdb.client.send_file(
+            self.writer, self.fileobj, len(self.data) - offset,
+            loop=self.loop, chunk_size=1000)
+        self.assertEqual(len(self.data), self.fileobj.tell())
+        self.writer.close()
+        yield from self.closed
+        self.assertEqual(self.data[offset:], self.received)
+
+    def test_sendfile(self):
+        with mock.patch('os.sendfile', wraps=os.sendfile) as sendfile:
+            yield from self.send(100)
+        self.assertTrue(sendfile.called)
+
+    def test_mmap(self):
+        with mock.patch('aiocouchdb.client.can_sendfile', return_value=False):
+            with mock.patch('mmap.mmap', wraps=__import__('mmap').mmap) as mm:
+                yield from self.send(100)
+        self.assertTrue(mm.called)
+
+    def test_encrypted(self):
+        get_extra_info = self.writer.transport.get_extra_info
+        with mock.patch.object(self.writer.transport, 'get_extra_info',
+                               lambda key, *args: (
+                                   object() if key == 'sslcontext'
+                                   else get_extra_info(key, *args))):
+            yield from self.send(100)
+
+    def test_truncated_file(self):
+        self.fileobj.truncate(10)
+        self.fileobj.seek(0)
+        with self.assertRaises(EOFError):
+            yield from aiocouchdb.client.send_file(
+                self.writer, self.fileobj, len(self.data), loop=self.loop)
+
 
 class HttpResponseTestCase(utils.TestCase):
 
@@ -10,6 +10,9 @@
 import asyncio
 import aiocouchdb.feeds
 
+from aiocouchdb.compat import StopAsyncIteration
+from aiocouchdb.filters import Equals, Prefix
+
 from . import utils
 
 
@@ -97,6 +100,46 @@ class FeedTestCase(utils.TestCase):
         self.assertFalse(feed.is_active())
         resp.close.assert_called_with(force=True)
 
+    def test_pull_mode(self):
+        resp = self.prepare_response(data=b'foo\r\n\nbar\r\n')
+
+        feed = aiocouchdb.feeds.Feed(resp, loop=self.loop)
+        self.assertIsNone(feed._reader)
+        self.assertEqual(0, feed.backlog)
+        self.assertFalse(resp.content.readline.called)
+
+        self.assertEqual(b'foo\r\n', (yield from feed.next()))
+        self.assertEqual(1, resp.content.readline.call_count)
+        self.assertEqual(b'bar\r\n', (yield from feed.next()))
+        self.assertTrue(feed.is_active())
+        self.assertIsNone((yield from feed.next()))
+        self.assertFalse(feed.is_active())
+        self.assertTrue(resp.close.called)
+
+    def test_read_ahead_mode(self):
+        resp = self.prepare_response(data=b'foo\r\nbar\r\n')
+
+        feed = aiocouchdb.feeds.Feed(resp, buffer_size=10, loop=self.loop)
+        self.assertIsNotNone(feed._reader)
+        yield from asyncio.sleep(0, loop=self.loop)
+        # both lines and the end of feed mark are already read
+        self.assertEqual(3, feed.backlog)
+        self.assertEqual(3, resp.content.readline.call_count)
+        self.assertEqual(b'foo\r\n', (yield from feed.next()))
+        self.assertEqual(b'bar\r\n', (yield from feed.next()))
+        self.assertIsNone((yield from feed.next()))
+
+    def test_async_iteration(self):
+        resp = self.prepare_response(data=b'foo\r\nbar\r\n')
+
+        feed = aiocouchdb.feeds.Feed(resp, loop=self.loop)
+        self.assertIs(feed, feed.__aiter__())
+
+        self.assertEqual(b'foo\r\n', (yield from feed.__anext__()))
+        self.assertEqual(b'bar\r\n', (yield from feed.__anext__()))
+        with self.assertRaises(StopAsyncIteration):
+            yield from feed.__anext__()
+
     def test_buffer_workflow(self):
         resp = self.prepare_response(data=[
             b'foo\r\n', b'bar\r\n',
@@ -423,3 +466,127 @@ class ChangesFeedTestCase(utils.TestCase):
         self.assertIsNone(event)
         self.assertFalse(feed.is_active())
         self.assertIsNotNone(feed.last_seq)
+
+
+class PrefetchChangesFeedTestCase(utils.TestCase):
+
+    def changes_feed(self, count):
+        data = [('{{"seq":{0},"id":"doc{0}","changes":[{{"rev":"1-A"}}]}}\n'
+                 ''.format(seq)).encode() for seq in range(1, count + 1)]
+        data.append('{{"last_seq":{}}}\n'.format(count + 5).encode())
+        resp = self.prepare_response(data=data)
+        return aiocouchdb.feeds.ContinuousChangesFeed(resp, loop=self.loop)
+
+    def test_emit_events_with_docs_in_order(self):
+        batches = []
+        running = []
+
+        @asyncio.coroutine
+        def fetch(events):
+            batches.append(len(events))
+            running.append(None)
+            self.assertLessEqual(len(running), 2)
+            # later batches complete first
+            for _ in range(10 - len(batches)):
+                yield from asyncio.sleep(0, loop=self.loop)
+            running.pop()
+            return [{'_id': event['id']} for event in events]
+
+        feed = aiocouchdb.feeds.PrefetchChangesFeed(
+            self.changes_feed(20), fetch,
+            batch_size=3, concurrency=2, loop=self.loop)
+        seqs = []
+        while True:
+            event = yield from feed.next()
+            if event is None:
+                break
+            self.assertEqual({'_id': event['id']}, event['doc'])
+            self.assertEqual(event['seq'], feed.last_seq)
+            seqs.append(event['seq'])
+        self.assertEqual(list(range(1, 21)), seqs)
+        self.assertEqual(20, sum(batches))
+        self.assertTrue(all(size <= 3 for size in batches))
+        self.assertFalse(feed.is_active())
+        self.assertEqual(25, feed.last_seq)
+        self.assertIsNone((yield from feed.next()))
+
+    def test_fetch_error(self):
+        @asyncio.coroutine
+        def fetch(events):
+            if events[0]['seq'] > 1:
+                raise ValueError
+            return [None] * len(events)
+
+        feed = aiocouchdb.feeds.PrefetchChangesFeed(
+            self.changes_feed(5), fetch,
+            batch_size=1, loop=self.loop)
+        event = yield from feed.next()
+        self.assertIsNone(event['doc'])
+        with self.assertRaises(ValueError):
+            yield from feed.next()
+        self.assertFalse(feed.is_active())
+        with self.assertRaises(ValueError):
+            yield from feed.next()
+
+    def test_fetch_wrong_amount_of_docs(self):
+        @asyncio.coroutine
+        def fetch(events):
+            return []
+
+        feed = aiocouchdb.feeds.PrefetchChangesFeed(
+            self.changes_feed(2), fetch, loop=self.loop)
+        with self.assertRaises(ValueError):
+            yield from feed.next()
+
+    def test_close(self):
+        @asyncio.coroutine
+        def fetch(events):
+            return [{}] * len(events)
+
+        with aiocouchdb.feeds.PrefetchChangesFeed(
+                self.changes_feed(10), fetch,
+                batch_size=2, loop=self.loop) as feed:
+            event = yield from feed.__anext__()
+            self.assertEqual(1, event['seq'])
+        self.assertFalse(feed._feed.is_active())
+
+
+class FilteredChangesFeedTestCase(utils.TestCase):
+
+    def changes_feed(self):
+        resp = self.prepare_response(data=[
+            b'{"seq":1,"id":"a:1","changes":[{"rev":"1-A"}],'
+            b'"doc":{"_id":"a:1","type":"x"}}\n',
+            b'{"seq":2,"id":"b:1","changes":[{"rev":"1-A"}],'
+            b'"doc":{"_id":"b:1","type":"y"}}\n',
+            b'{"seq":3,"id":"a:2","changes":[{"rev":"1-A"}],'
+            b'"doc":{"_id":"a:2","type":"y"}}\n',
+            b'{"last_seq":4}\n',
+        ])
+        return aiocouchdb.feeds.ContinuousChangesFeed(resp, loop=self.loop)
+
+    @asyncio.coroutine
+    def read(self, feed):
+        events = []
+        while True:
+            event = yield from feed.next()
+            if event is None:
+                break
+            events.append(event)
+        return events
+
+    def test_filter_events(self):
+        feed = aiocouchdb.feeds.FilteredChangesFeed(
+            self.changes_feed(), Equals('type', 'y'))
+        events = yield from self.read(feed)
+        self.assertEqual([2, 3], [event['seq'] for event in events])
+        self.assertEqual({'_id': 'b:1', 'type': 'y'}, events[0]['doc'])
+        self.assertFalse(feed.is_active())
+        self.assertEqual(4, feed.last_seq)
+
+    def test_strip_docs(self):
+        feed = aiocouchdb.feeds.FilteredChangesFeed(
+            self.changes_feed(), Prefix('_id', 'a:'), strip_docs=True)
+        events = yield from self.read(feed)
+        self.assertEqual([1, 3], [event['seq'] for event in events])
+        self.assertNotIn('doc', events[0])
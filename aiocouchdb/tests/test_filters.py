@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import unittest
+
+from aiocouchdb.filters import All, Any, Equals, Not, Prefix
+from aiocouchdb.v1.emulator.views import compile_function
+
+
+DOCS = [
+    {'_id': 'order:1', 'type': 'order', 'total': 10},
+    {'_id': 'order:2', 'type': 'order', 'total': 10.0},
+    {'_id': 'draft:order:3', 'type': 'order', 'total': True},
+    {'_id': 'user:1', 'type': 'user', 'address': {'city': 'Moscow'}},
+    {'_id': 'user:2', 'address': 'Moscow', 'type': None},
+    {'_id': 'user:3', 'address': ['Moscow']},
+]
+
+
+class PredicatesTestCase(unittest.TestCase):
+
+    def check(self, predicate, expected):
+        self.assertEqual(expected, [doc['_id'] for doc in DOCS
+                                    if predicate.match(doc)])
+        fun = compile_function(predicate.filter_function('python'))
+        self.assertEqual(expected, [doc['_id'] for doc in DOCS
+                                    if fun(doc, {})])
+
+    def test_equals(self):
+        self.check(Equals('type', 'order'),
+                   ['order:1', 'order:2', 'draft:order:3'])
+        self.check(Equals('total', 10), ['order:1', 'order:2'])
+        self.check(Equals('total', True), ['draft:order:3'])
+        self.check(Equals('type', None), ['user:2'])
+        self.check(Equals('address.city', 'Moscow'), ['user:1'])
+        self.check(Equals(('address', 'city'), 'Moscow'), ['user:1'])
+
+    def test_prefix(self):
+        self.check(Prefix('_id', 'user:'), ['user:1', 'user:2', 'user:3'])
+        self.check(Prefix('address', 'Mos'), ['user:2'])
+
+    def test_combinations(self):
+        self.check(Equals('type', 'order') & ~Prefix('_id', 'draft:'),
+                   ['order:1', 'order:2'])
+        self.check(Prefix('_id', 'draft:') | Equals('type', 'user'),
+                   ['draft:order:3', 'user:1'])
+        self.check(Not(Any(Prefix('_id', 'order:'), Prefix('_id', 'user:'))),
+                   ['draft:order:3'])
+        self.check(All(), [doc['_id'] for doc in DOCS])
+        self.check(Any(), [])
+
+    def test_needs_doc(self):
+        self.assertFalse(Prefix('_id', 'user:').needs_doc)
+        self.assertFalse(Equals('_id', 'user:1').needs_doc)
+        self.assertTrue(Equals('type', 'user').needs_doc)
+        self.assertTrue((Prefix('_id', 'a') | Equals('type', 'b')).needs_doc)
+        self.assertFalse((Prefix('_id', 'a') & ~Prefix('_id', 'b')).needs_doc)
+
+    def test_javascript_function(self):
+        source = (Equals('type', 'order') &
+                  ~Prefix('_id', 'draft:')).filter_function()
+        self.assertTrue(source.startswith('function(doc, req) {'))
+        self.assertIn('get(["type"]) === "order" && '
+                      '!((typeof get(["_id"]) === "string" &&'
+                      ' get(["_id"]).indexOf("draft:") === 0))', source)
+
+    def test_design_doc(self):
+        docid, ddoc = Equals('type', 'order').design_doc()
+        self.assertTrue(docid.startswith('_design/aiocouchdb-filter-'))
+        self.assertEqual('javascript', ddoc['language'])
+        self.assertEqual(Equals('type', 'order').filter_function(),
+                         ddoc['filters']['match'])
+        self.assertEqual(docid, Equals('type', 'order').design_doc()[0])
+        self.assertNotEqual(docid, Equals('type', 'user').design_doc()[0])
+        self.assertNotEqual(docid,
+                            Equals('type', 'order').design_doc('python')[0])
+
+    def test_invalid_arguments(self):
+        with self.assertRaises(TypeError):
+            Equals('type', ['order'])
+        with self.assertRaises(TypeError):
+            Prefix('_id', 1)
+        with self.assertRaises(ValueError):
+            Equals('type', 'order').filter_function('erlang')
@@ -0,0 +1,166 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+
+import aiohttp
+import aiocouchdb.client
+import aiocouchdb.hedging
+
+from . import utils
+
+
+class HedgingPolicyTestCase(utils.TestCase):
+
+    _test_target = 'mock'
+
+    urls = ['http://couch1:5984', 'http://couch2:5984']
+
+    def setUp(self):
+        super().setUp()
+        self.delays = {}
+        self.responses = []
+        self.request.side_effect = self.fake_request
+        self.policy = aiocouchdb.hedging.HedgingPolicy(self.urls, burst=1)
+        self.session = aiocouchdb.client.HttpSession(hedging=self.policy,
+                                                     loop=self.loop)
+
+    def fake_request(self, method, url, **kwargs):
+        @asyncio.coroutine
+        def request():
+            yield from asyncio.sleep(self.delays.get(url, 0), loop=self.loop)
+            resp = self.prepare_response(data=url.encode())
+            self.responses.append(resp)
+            return resp
+        return request()
+
+    def warm_up(self, method, url, delay):
+        key = '{} {}'.format(method, aiocouchdb.client.path_template(url))
+        for _ in range(self.policy.tracker.min_samples):
+            self.policy.tracker.add(key, delay)
+        self.policy._tokens = self.policy.burst
+
+    def test_no_hedge_without_samples(self):
+        url = self.urls[0] + '/db/doc'
+        self.delays[url] = 0.05
+        resp = yield from self.session.request('GET', url)
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual((yield from resp.read()), url.encode())
+        self.assertEqual(self.policy.hedged, 0)
+
+    def test_track_latency(self):
+        url = self.urls[0] + '/db/doc'
+        yield from self.session.request('GET', url)
+        self.assertIn('GET /{db}/{docid}', self.policy.tracker)
+
+    def test_hedge_slow_request(self):
+        url = self.urls[0] + '/db/doc'
+        self.warm_up('GET', url, 0.01)
+        self.delays[url] = 1
+        resp = yield from self.session.request('GET', url)
+        self.assertEqual(self.request.call_count, 2)
+        self.assertEqual(self.request.call_args[0],
+                         ('GET', self.urls[1] + '/db/doc'))
+        self.assertEqual((yield from resp.read()),
+                         (self.urls[1] + '/db/doc').encode())
+        self.assertEqual(self.policy.hedged, 1)
+        self.assertEqual(len(self.responses), 1)
+
+    def test_primary_wins(self):
+        url = self.urls[0] + '/db/doc'
+        self.warm_up('GET', url, 0.01)
+        self.delays[url] = 0.02
+        self.delays[self.urls[1] + '/db/doc'] = 1
+        resp = yield from self.session.request('GET', url)
+        self.assertEqual(self.request.call_count, 2)
+        self.assertEqual((yield from resp.read()), url.encode())
+
+    def test_hedge_on_error(self):
+        url = self.urls[0] + '/db/doc'
+        self.warm_up('GET', url, 0.01)
+        self.delays[url] = 0.02
+
+        def side_effect(method, url, **kwargs):
+            if url == self.urls[0] + '/db/doc':
+                return self.fake_request(method, url, **kwargs)
+            fut = asyncio.Future(loop=self.loop)
+            fut.set_exception(aiohttp.ClientOSError())
+            return fut
+        self.request.side_effect = side_effect
+        resp = yield from self.session.request('GET', url)
+        self.assertEqual((yield from resp.read()), url.encode())
+
+    def test_cancel_while_waiting_for_primary(self):
+        url = self.urls[0] + '/db/doc'
+        self.warm_up('GET', url, 1)
+        self.delays[url] = 10
+        cancelled = []
+
+        @asyncio.coroutine
+        def request(method, url, **kwargs):
+            try:
+                return (yield from self.fake_request(method, url, **kwargs))
+            except asyncio.CancelledError:
+                cancelled.append(url)
+                raise
+        self.request.side_effect = request
+
+        task = asyncio.Task(self.session.request('GET', url), loop=self.loop)
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        task.cancel()
+        with self.assertRaises(asyncio.CancelledError):
+            yield from task
+        yield from asyncio.sleep(0, loop=self.loop)
+        self.assertEqual([url], cancelled)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_success_wins_over_failure_completed_together(self):
+        for failure in (ValueError('boom'), self.prepare_response(status=503)):
+            failed = asyncio.Future(loop=self.loop)
+            if isinstance(failure, Exception):
+                failed.set_exception(failure)
+            else:
+                failed.set_result(failure)
+            resp = self.prepare_response()
+            succeeded = asyncio.Future(loop=self.loop)
+            succeeded.set_result(resp)
+            for tasks in ([failed, succeeded], [succeeded, failed]):
+                result = yield from self.policy._race(tasks, self.loop)
+                self.assertIs(resp, result)
+
+    def test_budget(self):
+        url = self.urls[0] + '/db/doc'
+        self.warm_up('GET', url, 0.01)
+        self.policy._tokens = 0
+        self.delays[url] = 0.05
+        yield from self.session.request('GET', url)
+        self.assertEqual(self.request.call_count, 1)
+        self.assertEqual(self.policy.hedged, 0)
+
+    def test_dont_hedge_unsafe_methods(self):
+        url = self.urls[0] + '/db/doc'
+        self.warm_up('PUT', url, 0.01)
+        self.delays[url] = 0.05
+        yield from self.session.request('PUT', url)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_dont_hedge_changes_feed(self):
+        url = self.urls[0] + '/db/_changes'
+        self.warm_up('GET', url, 0.01)
+        self.delays[url] = 0.05
+        yield from self.session.request('GET', url)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_hedge_same_url_for_unknown_node(self):
+        url = 'http://localhost:5984/db/doc'
+        self.warm_up('GET', url, 0.01)
+        self.delays[url] = 0.05
+        yield from self.session.request('GET', url)
+        self.assertEqual(self.request.call_count, 2)
+        self.assertEqual(self.request.call_args[0], ('GET', url))
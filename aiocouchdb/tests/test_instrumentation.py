@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import unittest
+
+import aiohttp
+import aiocouchdb.client
+import aiocouchdb.instrumentation
+
+from aiocouchdb.client import request
+
+from . import utils
+
+
+class LatencyHistogramTestCase(unittest.TestCase):
+
+    def test_empty(self):
+        hist = aiocouchdb.instrumentation.LatencyHistogram()
+        self.assertEqual(hist.count, 0)
+        self.assertIsNone(hist.quantile(0.5))
+        self.assertIsNone(hist.mean)
+
+    def test_relative_precision(self):
+        hist = aiocouchdb.instrumentation.LatencyHistogram()
+        for value in (0.000123, 0.0421, 1.5, 73.9):
+            hist.record(value)
+            self.assertLessEqual(abs(hist.quantile(1) - value),
+                                 value * 2 ** -hist.precision)
+            hist = aiocouchdb.instrumentation.LatencyHistogram()
+
+    def test_bounded_buckets(self):
+        hist = aiocouchdb.instrumentation.LatencyHistogram()
+        for value in range(100000):
+            hist.record(value / 100000)
+        self.assertEqual(hist.count, 100000)
+        self.assertLess(len(hist._buckets), 2 ** hist.precision * 12)
+
+    def test_merge(self):
+        hist1 = aiocouchdb.instrumentation.LatencyHistogram()
+        hist2 = aiocouchdb.instrumentation.LatencyHistogram()
+        hist1.record(0.01)
+        hist2.record(0.02)
+        hist1.merge(hist2)
+        self.assertEqual(hist1.count, 2)
+        self.assertEqual(hist1.min, 0.01)
+        self.assertEqual(hist1.max, 0.02)
+
+    def test_snapshot(self):
+        hist = aiocouchdb.instrumentation.LatencyHistogram()
+        hist.record(0.01)
+        self.assertEqual(hist.snapshot((0.5, 0.999)),
+                         {'count': 1, 'mean': 0.01, 'min': 0.01, 'max': 0.01,
+                          'p50': 0.01, 'p99.9': 0.01})
+
+
+class InstrumentationTestCase(utils.TestCase):
+
+    _test_target = 'mock'
+
+    def setUp(self):
+        super().setUp()
+        self.now = 0
+        self.events = []
+        self.instr = aiocouchdb.instrumentation.Instrumentation(
+            clock=lambda: self.now)
+        for event in self.instr.events:
+            self.instr.add_hook(event, self.make_hook(event))
+        self._request_patch = utils.mock.patch('aiocouchdb.client._request',
+                                               side_effect=self.fake_request)
+        self._request_patch.start()
+        self.request.side_effect = request
+
+    def tearDown(self):
+        self._request_patch.stop()
+        super().tearDown()
+
+    def make_hook(self, event):
+        def hook(trace):
+            self.events.append(event)
+        return hook
+
+    def fake_request(self, method, url, *, trace, **kwargs):
+        @asyncio.coroutine
+        def fake_request():
+            self.now += 1
+            trace.connection_acquired()
+            self.now += 2
+            resp = self.prepare_response(data=b'{"ok": true}')
+            trace.response_started(resp)
+            self.now += 3
+            return resp
+        return fake_request()
+
+    def test_phases(self):
+        session = aiocouchdb.client.HttpSession(instrumentation=self.instr,
+                                                loop=self.loop)
+        resp = yield from session.request('GET', self.url + '/db/doc')
+        trace = resp._trace
+        self.assertEqual(trace.key, 'GET /{db}/{docid}')
+        self.assertEqual(self.events, ['on_request_start',
+                                       'on_connection_acquired',
+                                       'on_headers_received'])
+        yield from resp.read()
+        self.assertEqual(self.events[-1], 'on_body_complete')
+        self.assertEqual(trace.connection_wait, 1)
+        self.assertEqual(trace.ttfb, 2)
+        self.assertEqual(trace.body_transfer, 3)
+        self.assertEqual(trace.total, 6)
+        self.assertEqual(trace.status, 200)
+        self.assertEqual(trace.bytes, 12)
+
+    def test_body_complete_once(self):
+        session = aiocouchdb.client.HttpSession(instrumentation=self.instr,
+                                                loop=self.loop)
+        resp = yield from session.request('GET', self.url + '/db')
+        yield from resp.read()
+        resp.close()
+        self.assertEqual(self.events.count('on_body_complete'), 1)
+
+    def test_histograms(self):
+        session = aiocouchdb.client.HttpSession(instrumentation=self.instr,
+                                                loop=self.loop)
+        for name in ('foo', 'bar'):
+            url = self.url + '/db/_design/ddoc/_view/' + name
+            resp = yield from session.request('GET', url)
+            yield from resp.read()
+        key = 'GET /{db}/_design/{ddoc}/_view/{view}'
+        self.assertEqual(self.instr.histogram(key).count, 2)
+        self.assertEqual(self.instr.histogram(key, 'ttfb').max, 2)
+        stats = self.instr.stats()
+        self.assertEqual(stats[key]['total']['p50'], 6)
+        self.assertEqual(stats[key]['errors'], 0)
+
+    def test_error(self):
+        self._request_patch.stop()
+        self._request_patch = utils.mock.patch(
+            'aiocouchdb.client._request',
+            side_effect=aiohttp.ClientOSError())
+        self._request_patch.start()
+        session = aiocouchdb.client.HttpSession(instrumentation=self.instr,
+                                                loop=self.loop)
+        with self.assertRaises(aiohttp.ClientOSError):
+            yield from session.request('GET', self.url + '/db')
+        self.assertEqual(self.events, ['on_request_start', 'on_error'])
+        self.assertEqual(self.instr.stats()['GET /{db}']['errors'], 1)
+
+    def test_broken_hook(self):
+        self.instr.add_hook('on_request_start', lambda trace: 1 / 0)
+        session = aiocouchdb.client.HttpSession(instrumentation=self.instr,
+                                                loop=self.loop)
+        with utils.mock.patch('aiocouchdb.instrumentation.log'):
+            resp = yield from session.request('GET', self.url + '/db')
+        self.assertEqual(resp.status, 200)
+
+    def test_unknown_event(self):
+        with self.assertRaises(ValueError):
+            self.instr.add_hook('on_whatever', print)
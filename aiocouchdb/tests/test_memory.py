@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+
+import aiocouchdb.feeds
+
+from . import utils
+
+
+class FeedMemoryTestCase(utils.MemoryTestCase):
+
+    rows = int(20000 * utils.MEMORY_SCALE)
+    #: Peak memory limit for the whole scenario, bytes
+    peak_limit = 1024 * 1024
+
+    def view_chunks(self, rows, chunk_rows=100):
+        yield '{{"total_rows":{},"offset":0,"rows":[\r\n'.format(rows).encode()
+        for start in range(0, rows, chunk_rows):
+            stop = min(start + chunk_rows, rows)
+            chunk = ',\r\n'.join(
+                '{{"id":"doc{0:08d}","key":"doc{0:08d}","value":'
+                '{{"rev":"1-{0:032x}"}}}}'.format(idx)
+                for idx in range(start, stop))
+            if start:
+                chunk = ',\r\n' + chunk
+            yield chunk.encode()
+        yield b'\r\n]}\n'
+
+    @asyncio.coroutine
+    def consume_slowly(self, feed):
+        count = 0
+        while True:
+            row = yield from feed.next()
+            if row is None:
+                break
+            count += 1
+            # downstream is slower than the network
+            yield from asyncio.sleep(0, loop=self.loop)
+        return count
+
+    def test_view_feed_slow_consumer(self):
+        with self.traced_memory() as stats:
+            resp = self.streamed_response(self.view_chunks(self.rows))
+            feed = aiocouchdb.feeds.ViewFeed(resp, loop=self.loop)
+            count = yield from self.consume_slowly(feed)
+        self.assertEqual(self.rows, count)
+        self.assertLess(stats['peak'], self.peak_limit)
+
+    def test_view_feed_small_buffer(self):
+        with self.traced_memory() as stats:
+            resp = self.streamed_response(self.view_chunks(self.rows))
+            feed = aiocouchdb.feeds.ViewFeed(resp, buffer_size=10,
+                                             loop=self.loop)
+            self.assertEqual(self.rows, (yield from self.consume_slowly(feed)))
+        self.assertLess(stats['peak'], self.peak_limit)
+
+    def test_close_slow_feed(self):
+        resp = self.streamed_response(self.view_chunks(self.rows))
+        feed = aiocouchdb.feeds.ViewFeed(resp, buffer_size=10, loop=self.loop)
+        yield from feed.next()
+        yield from asyncio.sleep(0.01, loop=self.loop)
+        self.assertEqual(10, feed.backlog)
+        feed.close(True)
+        yield from asyncio.sleep(0, loop=self.loop)
+        self.assertIsNone(feed._reader)
+
+    def check_backpressure(self, buffer_size):
+        produced = []
+
+        def chunks():
+            for chunk in self.view_chunks(self.rows):
+                produced.append(len(chunk))
+                yield chunk
+
+        resp = self.streamed_response(chunks())
+        feed = aiocouchdb.feeds.ViewFeed(resp, buffer_size=buffer_size,
+                                         loop=self.loop)
+        yield from feed.__anext__()
+        for _ in range(100):
+            yield from asyncio.sleep(0, loop=self.loop)
+
+        # consumer stopped, so feed stopped to read the stream and producer
+        # waits for the stream buffer to drain
+        self.assertEqual(buffer_size, feed.backlog)
+        self.assertLessEqual(len(resp.content._buffer),
+                             self.stream_limit + max(produced))
+        self.assertLess(sum(produced), 2 * self.stream_limit)
+        feed.close(True)
+
+    def test_backpressure(self):
+        yield from self.check_backpressure(0)
+
+    def test_backpressure_read_ahead(self):
+        yield from self.check_backpressure(10)
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+
+import aiohttp
+import aiocouchdb.breaker
+import aiocouchdb.metrics
+import aiocouchdb.v1.server
+
+from . import utils
+
+
+class MetricsCollectorTestCase(utils.TestCase):
+
+    _test_target = 'mock'
+
+    def setUp(self):
+        super().setUp()
+        self.metrics = aiocouchdb.metrics.MetricsCollector(loop=self.loop)
+        self.instr = self.metrics.instrumentation
+        self.stats = {
+            'httpd': {
+                'requests': {'current': 42, 'description': 'requests'},
+            },
+            'couchdb': {
+                'open_databases': {'current': 3, 'description': 'open dbs'},
+            },
+        }
+        self.tasks = [{'type': 'indexer'}, {'type': 'indexer'},
+                      {'type': 'replication'}]
+
+    def make_server(self, url):
+        server = aiocouchdb.v1.server.Server(url)
+        server.stats = utils.mock.Mock(
+            side_effect=lambda: self.future(self.stats))
+        server.active_tasks = utils.mock.Mock(
+            side_effect=lambda: self.future(self.tasks))
+        return server
+
+    def complete(self, method, url, status=200, size=0):
+        trace = self.instr.start(method, url)
+        trace.connection_acquired()
+        trace.status = status
+        trace.bytes = size
+        trace.complete()
+
+    def test_requests(self):
+        self.complete('GET', self.url + '/db/doc', size=10)
+        self.complete('GET', self.url + '/db/doc2', size=5)
+        self.complete('GET', self.url + '/db/doc', status=404)
+        text = self.metrics.render()
+        self.assertIn('# TYPE aiocouchdb_requests_total counter\n', text)
+        self.assertIn('aiocouchdb_requests_total{endpoint="/{db}/{docid}",'
+                      'method="GET",status="200"} 2\n', text)
+        self.assertIn('aiocouchdb_response_bytes_total{endpoint="/{db}/'
+                      '{docid}",method="GET"} 15\n', text)
+        self.assertIn('aiocouchdb_errors_total{endpoint="/{db}/{docid}",'
+                      'error="ResourceNotFound",method="GET"} 1\n', text)
+        self.assertIn('# TYPE aiocouchdb_request_duration_seconds summary\n',
+                      text)
+        self.assertIn('aiocouchdb_request_duration_seconds_count{'
+                      'endpoint="/{db}/{docid}",method="GET",phase="total"} 3',
+                      text)
+
+    def test_connection_errors(self):
+        trace = self.instr.start('GET', self.url + '/db')
+        trace.fail(aiohttp.ClientOSError())
+        self.assertIn('aiocouchdb_errors_total{endpoint="/{db}",'
+                      'error="ClientOSError",method="GET"} 1\n',
+                      self.metrics.render())
+
+    def test_pool_usage(self):
+        connector = utils.mock.Mock()
+        connector._conns = {'a': [1, 2]}
+        connector._acquired = {'a': {3}}
+        self.metrics.track_connector(connector)
+        text = self.metrics.render()
+        self.assertIn('aiocouchdb_connections{pool="default",state="idle"} 2',
+                      text)
+        self.assertIn('aiocouchdb_connections{pool="default",'
+                      'state="acquired"} 1', text)
+
+    def test_feed_backlog(self):
+        feed = utils.mock.Mock(backlog=5)
+        self.metrics.track_feed(feed, 'changes')
+        self.assertIn('aiocouchdb_feed_backlog{feed="changes"} 5',
+                      self.metrics.render())
+
+    def test_cache(self):
+        cache = utils.mock.Mock(hits=3, misses=1)
+        self.metrics.track_cache(cache, 'atts')
+        text = self.metrics.render()
+        self.assertIn('aiocouchdb_cache_requests{cache="atts",result="hit"} 3',
+                      text)
+        self.assertIn('aiocouchdb_cache_requests{cache="atts",'
+                      'result="miss"} 1', text)
+
+    def test_breaker(self):
+        policy = aiocouchdb.breaker.BreakerPolicy(loop=self.loop)
+        policy.breaker('couch1:5984').record_failure()
+        policy.limiter('couch1:5984')
+        self.metrics.track_breaker(policy)
+        text = self.metrics.render()
+        self.assertIn('aiocouchdb_breaker_state{host="couch1:5984",'
+                      'policy="default",state="closed"} 1', text)
+        self.assertIn('aiocouchdb_breaker_state{host="couch1:5984",'
+                      'policy="default",state="open"} 0', text)
+        self.assertIn('aiocouchdb_breaker_failures{host="couch1:5984",'
+                      'policy="default"} 1', text)
+        self.assertIn('aiocouchdb_breaker_limit{host="couch1:5984",'
+                      'policy="default"} 10.0', text)
+        self.assertIn('aiocouchdb_breaker_inflight{host="couch1:5984",'
+                      'policy="default"} 0', text)
+        self.assertIn('aiocouchdb_breaker_waiting{host="couch1:5984",'
+                      'policy="default"} 0', text)
+
+    def test_poll_servers(self):
+        self.metrics.add_server(self.make_server('http://couch1:5984'))
+        self.metrics.add_server(self.make_server('http://couch2:5984'))
+        yield from self.metrics.poll()
+        text = self.metrics.render()
+        self.assertEqual(text.count('# TYPE couchdb_httpd_requests gauge'), 1)
+        self.assertIn('# HELP couchdb_httpd_requests requests\n', text)
+        self.assertIn('couchdb_httpd_requests{server="http://couch1:5984"} 42',
+                      text)
+        self.assertIn('couchdb_httpd_requests{server="http://couch2:5984"} 42',
+                      text)
+        self.assertIn('couchdb_active_tasks{server="http://couch1:5984",'
+                      'type="indexer"} 2', text)
+
+    def test_skip_unchanged(self):
+        self.metrics.add_server(self.make_server(self.url))
+        yield from self.metrics.poll()
+        samples = self.metrics._server_samples[self.url]
+        yield from self.metrics.poll()
+        self.assertIs(self.metrics._server_samples[self.url], samples)
+        self.stats['httpd']['requests']['current'] = 43
+        yield from self.metrics.poll()
+        self.assertIsNot(self.metrics._server_samples[self.url], samples)
+        self.assertIn('couchdb_httpd_requests{server="%s"} 43' % self.url,
+                      self.metrics.render())
+
+    def test_poll_error(self):
+        server = self.make_server(self.url)
+        server.stats.side_effect = aiohttp.ClientOSError()
+        self.metrics.add_server(server)
+        with utils.mock.patch('aiocouchdb.metrics.log'):
+            yield from self.metrics.poll()
+        self.assertIn('aiocouchdb_poll_errors_total{server="%s"} 1' % self.url,
+                      self.metrics.render())
+
+    def test_background_polling(self):
+        self.metrics.interval = 0.01
+        server = self.make_server(self.url)
+        self.metrics.add_server(server)
+        self.metrics.start()
+        yield from asyncio.sleep(0.05, loop=self.loop)
+        self.metrics.stop()
+        self.assertGreater(server.stats.call_count, 1)
+
+    def test_handler(self):
+        resp = yield from self.metrics.handler(None)
+        self.assertEqual(resp.headers['CONTENT-TYPE'],
+                         aiocouchdb.metrics.CONTENT_TYPE)
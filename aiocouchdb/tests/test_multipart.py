@@ -0,0 +1,179 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import base64
+import gzip
+
+import aiohttp
+
+from aiocouchdb.compat import StopAsyncIteration
+from aiocouchdb.multipart import (
+    EmptyMultipartReader,
+    FastBodyPartReader,
+    FastMultipartReader
+)
+
+from . import utils
+
+
+BODY = (b'preamble\r\n'
+        b'--:b:\r\n'
+        b'Content-Type: application/json\r\n'
+        b'\r\n'
+        b'{"_id": "doc"}\r\n'
+        b'--:b:\r\n'
+        b'Content-Disposition: attachment; filename="a.txt"\r\n'
+        b'Content-Type: text/plain\r\n'
+        b'\r\n'
+        b'line\r\n--:b no boundary\r\n--:\r\n'
+        b'--:b:  \r\n'
+        b'Content-Disposition: attachment; filename="b.bin"\r\n'
+        b'\r\n'
+        b'\r\r\n\r\n-\r\n--:b:--'
+        b'\r\nepilogue')
+
+
+class FastMultipartReaderTestCase(utils.TestCase):
+
+    def reader(self, chunks, content_type='multipart/related;boundary=":b:"'):
+        content = aiohttp.streams.StreamReader(loop=self.loop)
+        for chunk in chunks:
+            content.feed_data(chunk)
+        content.feed_eof()
+        return FastMultipartReader({'CONTENT-TYPE': content_type}, content)
+
+    def split(self, data, size):
+        return [data[idx:idx + size] for idx in range(0, len(data), size)]
+
+    def read_parts(self, reader):
+        parts = []
+        while True:
+            part = yield from reader.next()
+            if part is None:
+                break
+            parts.append((dict(part.headers), (yield from part.read())))
+        return parts
+
+    def test_read_parts(self):
+        reader = self.reader([BODY])
+        parts = yield from self.read_parts(reader)
+        self.assertEqual([
+            ({'CONTENT-TYPE': 'application/json'}, b'{"_id": "doc"}'),
+            ({'CONTENT-DISPOSITION': 'attachment; filename="a.txt"',
+              'CONTENT-TYPE': 'text/plain'},
+             b'line\r\n--:b no boundary\r\n--:'),
+            ({'CONTENT-DISPOSITION': 'attachment; filename="b.bin"'},
+             b'\r\r\n\r\n-'),
+        ], parts)
+        self.assertTrue(reader.at_eof())
+        self.assertIsNone((yield from reader.next()))
+
+    def test_read_parts_split_chunks(self):
+        expected = yield from self.read_parts(self.reader([BODY]))
+        for size in range(1, 12):
+            reader = self.reader(self.split(BODY, size))
+            self.assertEqual(expected, (yield from self.read_parts(reader)))
+
+    def test_read_view(self):
+        data = bytes(range(256)) * 64
+        body = (b'--:b:\r\n\r\n' + data + b'\r\n--:b:--')
+        reader = self.reader(self.split(body, 5000))
+        part = yield from reader.next()
+        self.assertIsInstance(part, FastBodyPartReader)
+        views = []
+        while True:
+            view = yield from part.read_view(1000)
+            if not view:
+                break
+            self.assertIsInstance(view, memoryview)
+            self.assertLessEqual(len(view), 1000)
+            views.append(view)
+        self.assertEqual(data, b''.join(views))
+        self.assertTrue(part.at_eof())
+        self.assertEqual(b'', (yield from part.read_chunk()))
+
+    def test_skip_unread_part(self):
+        reader = self.reader(self.split(BODY, 7))
+        yield from reader.next()
+        part = yield from reader.next()
+        self.assertEqual(b'line\r\n', (yield from part.read_chunk(6)))
+        part = yield from reader.next()
+        self.assertEqual('b.bin', part.filename)
+        self.assertEqual(b'\r\r\n\r\n-', (yield from part.read()))
+
+    def test_json_text_filename(self):
+        reader = self.reader([BODY])
+        part = yield from reader.next()
+        self.assertEqual({'_id': 'doc'}, (yield from part.json()))
+        self.assertIsNone(part.filename)
+        part = yield from reader.next()
+        self.assertEqual('a.txt', part.filename)
+        self.assertEqual('line\r\n', (yield from part.text())[:6])
+
+    def test_decode(self):
+        body = (b'--:b:\r\n'
+                b'Content-Encoding: gzip\r\n'
+                b'Content-Transfer-Encoding: base64\r\n'
+                b'\r\n' +
+                base64.b64encode(gzip.compress(b'data')) +
+                b'\r\n--:b:--')
+        part = yield from self.reader([body]).next()
+        self.assertEqual(b'data', (yield from part.read(decode=True)))
+
+    def test_unknown_encoding(self):
+        body = b'--:b:\r\nContent-Encoding: br\r\n\r\ndata\r\n--:b:--'
+        part = yield from self.reader([body]).next()
+        with self.assertRaises(RuntimeError):
+            yield from part.read(decode=True)
+
+    def test_async_iteration(self):
+        reader = self.reader([BODY])
+        self.assertIs(reader, reader.__aiter__())
+        yield from reader.__anext__()
+        part = yield from reader.__anext__()
+        self.assertIs(part, part.__aiter__())
+        self.assertEqual(b'line\r\n--:b no boundary\r\n--:',
+                         (yield from part.__anext__()))
+        with self.assertRaises(StopAsyncIteration):
+            yield from part.__anext__()
+        yield from reader.__anext__()
+        with self.assertRaises(StopAsyncIteration):
+            yield from reader.__anext__()
+
+    def test_release(self):
+        reader = self.reader(self.split(BODY, 3))
+        yield from reader.next()
+        yield from reader.release()
+        self.assertTrue(reader.at_eof())
+
+    def test_truncated_body(self):
+        reader = self.reader([BODY[:BODY.index(b'line') + 4]])
+        yield from reader.next()
+        part = yield from reader.next()
+        with self.assertRaises(EOFError):
+            yield from part.read()
+
+    def test_invalid_boundary_line(self):
+        reader = self.reader([b'--:b:garbage\r\n\r\n--:b:--'])
+        with self.assertRaises(ValueError):
+            yield from reader.next()
+
+    def test_not_multipart(self):
+        with self.assertRaises(ValueError):
+            self.reader([], 'application/json')
+        with self.assertRaises(ValueError):
+            self.reader([], 'multipart/related')
+
+    def test_empty_reader(self):
+        reader = EmptyMultipartReader()
+        self.assertTrue(reader.at_eof())
+        self.assertIsNone((yield from reader.next()))
+        with self.assertRaises(StopAsyncIteration):
+            yield from reader.__anext__()
+        yield from reader.release()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import io
+
+import aiohttp
+import aiocouchdb.client
+import aiocouchdb.retry
+
+from . import utils
+
+
+class RetryPolicyTestCase(utils.TestCase):
+
+    _test_target = 'mock'
+
+    def setUp(self):
+        super().setUp()
+        self.outcomes = []
+        self.request.side_effect = self.fake_request
+        self.policy = aiocouchdb.retry.RetryPolicy(backoff_base=0,
+                                                   loop=self.loop)
+        self.session = aiocouchdb.client.HttpSession(retry=self.policy,
+                                                     loop=self.loop)
+
+    def fake_request(self, method, url, **kwargs):
+        fut = asyncio.Future(loop=self.loop)
+        outcome = self.outcomes.pop(0) if self.outcomes else 200
+        if isinstance(outcome, Exception):
+            fut.set_exception(outcome)
+        elif isinstance(outcome, dict):
+            fut.set_result(self.prepare_response(**outcome))
+        else:
+            fut.set_result(self.prepare_response(status=outcome))
+        return fut
+
+    def test_success(self):
+        resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_retry_get_on_connection_error(self):
+        self.outcomes = [aiohttp.ClientOSError(), 200]
+        resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.request.call_count, 2)
+        self.assertEqual(self.policy.retries, 1)
+
+    def test_retry_get_on_server_error(self):
+        self.outcomes = [500, 503, 200]
+        resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(self.request.call_count, 3)
+
+    def test_give_up(self):
+        self.outcomes = [500] * 10
+        resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 500)
+        self.assertEqual(self.request.call_count,
+                         self.policy.max_retries + 1)
+
+    def test_give_up_reraise(self):
+        self.outcomes = [aiohttp.ServerDisconnectedError()] * 10
+        with self.assertRaises(aiohttp.ServerDisconnectedError):
+            yield from self.session.request('GET', self.url)
+        self.assertEqual(self.request.call_count,
+                         self.policy.max_retries + 1)
+
+    def test_dont_retry_client_errors(self):
+        self.outcomes = [404, 200]
+        resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 404)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_dont_retry_unknown_errors(self):
+        self.outcomes = [ValueError(), 200]
+        with self.assertRaises(ValueError):
+            yield from self.session.request('GET', self.url)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_dont_retry_post(self):
+        self.outcomes = [aiohttp.ClientOSError(), 200]
+        with self.assertRaises(aiohttp.ClientOSError):
+            yield from self.session.request('POST', self.url, data={})
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_retry_put_with_rev_on_connection_error(self):
+        self.outcomes = [aiohttp.ClientOSError(), 201]
+        resp = yield from self.session.request('PUT', self.url,
+                                               params={'rev': '1-ABC'})
+        self.assertEqual(resp.status, 201)
+        self.assertEqual(self.request.call_count, 2)
+
+    def test_retry_put_with_doc_rev_on_connection_error(self):
+        self.outcomes = [aiohttp.ClientOSError(), 201]
+        resp = yield from self.session.request('PUT', self.url,
+                                               data={'_rev': '1-ABC'})
+        self.assertEqual(resp.status, 201)
+
+    def test_dont_retry_put_with_rev_on_server_error(self):
+        self.outcomes = [500, 201]
+        resp = yield from self.session.request('PUT', self.url,
+                                               params={'rev': '1-ABC'})
+        self.assertEqual(resp.status, 500)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_dont_retry_put_without_rev(self):
+        self.outcomes = [aiohttp.ClientOSError(), 201]
+        with self.assertRaises(aiohttp.ClientOSError):
+            yield from self.session.request('PUT', self.url, data={})
+
+    def test_dont_retry_generator_payload(self):
+        self.outcomes = [aiohttp.ClientOSError(), 201]
+        with self.assertRaises(aiohttp.ClientOSError):
+            yield from self.session.request('PUT', self.url,
+                                            data=(i for i in [b'foo']),
+                                            params={'rev': '1-ABC'})
+
+    def test_rewind_seekable_payload(self):
+        data = io.BytesIO(b'foobar')
+        data.seek(3)
+
+        def side_effect(method, url, **kwargs):
+            self.assertEqual(kwargs['data'].tell(), 3)
+            kwargs['data'].read()
+            return self.fake_request(method, url, **kwargs)
+        self.request.side_effect = side_effect
+        self.outcomes = [aiohttp.ClientOSError(), 201]
+        resp = yield from self.session.request('PUT', self.url, data=data,
+                                               params={'rev': '1-ABC'})
+        self.assertEqual(resp.status, 201)
+        self.assertEqual(self.request.call_count, 2)
+
+    def test_retry_budget(self):
+        self.policy._tokens = 0
+        self.policy.budget = 0
+        self.outcomes = [500, 200]
+        resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 500)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_respect_retry_after(self):
+        self.outcomes = [{'status': 503, 'headers': {'RETRY-AFTER': '1'}}]
+        sleeps = []
+
+        @asyncio.coroutine
+        def sleep(delay, *, loop=None):
+            sleeps.append(delay)
+        with utils.mock.patch('asyncio.sleep', side_effect=sleep):
+            resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 200)
+        self.assertEqual(sleeps, [1.0])
+
+    def test_too_long_retry_after(self):
+        self.outcomes = [{'status': 503, 'headers': {'RETRY-AFTER': '3600'}}]
+        resp = yield from self.session.request('GET', self.url)
+        self.assertEqual(resp.status, 503)
+        self.assertEqual(self.request.call_count, 1)
+
+    def test_backoff(self):
+        policy = aiocouchdb.retry.RetryPolicy(backoff_base=1, backoff_max=5)
+        for attempt in range(10):
+            delay = policy.backoff(attempt)
+            self.assertTrue(0 <= delay <= min(5, 2 ** attempt))
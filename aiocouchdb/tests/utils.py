@@ -19,12 +19,22 @@ import unittest.mock as mock
 import uuid as _uuid
 from collections import deque, defaultdict
 
+try:
+    import tracemalloc
+except ImportError:  # pragma: no cover
+    # Python 3.3
+    tracemalloc = None
+
+import aiohttp
 import aiocouchdb.client
 import aiocouchdb.errors
 from aiocouchdb.client import urljoin, extract_credentials
 
 
 TARGET = os.environ.get('AIOCOUCHDB_TARGET', 'mock')
+#: Multiplier of data amount for memory tests. Use 50 to stream 1M view rows
+#: and 1 GB multipart responses
+MEMORY_SCALE = float(os.environ.get('AIOCOUCHDB_MEMORY_SCALE', 1))
 
 
 def run_in_loop(f):
@@ -183,6 +193,65 @@ class TestCase(unittest.TestCase, metaclass=MetaAioTestCase):
                 self.assertEqual(value, call_kwargs[key])
 
 
+class MemoryTestCase(TestCase):
+    """Runs scenarios against responses which are streamed through real
+    :class:`aiohttp.StreamReader` with emulated TCP flow control and measures
+    allocated memory with :mod:`tracemalloc`."""
+
+    _test_target = 'mock'
+    #: Amount of buffered bytes after which stream stops to receive data,
+    #: the same as for aiohttp client responses
+    stream_limit = 2 * aiohttp.streams.DEFAULT_LIMIT
+
+    @property
+    def timeout(self):
+        return 30 * MEMORY_SCALE
+
+    def setUp(self):
+        if tracemalloc is None:
+            self.skipTest('tracemalloc is not available')
+        super().setUp()
+        self._producers = []
+
+    def tearDown(self):
+        for task in self._producers:
+            task.cancel()
+        self.loop.run_until_complete(asyncio.gather(
+            *self._producers, loop=self.loop, return_exceptions=True))
+        super().tearDown()
+
+    def streamed_response(self, chunks, *, headers=None):
+        """Returns response which content is fed by the given chunks
+        iterable while the reader keeps up with them."""
+        resp = self.prepare_response(headers=headers)
+        resp.content = aiohttp.streams.StreamReader(loop=self.loop)
+
+        @asyncio.coroutine
+        def produce(stream):
+            for chunk in chunks:
+                # the same as transport.pause_reading() does
+                while len(stream._buffer) > self.stream_limit:
+                    yield from asyncio.sleep(0, loop=self.loop)
+                stream.feed_data(chunk)
+            stream.feed_eof()
+
+        self._producers.append(asyncio.Task(produce(resp.content),
+                                            loop=self.loop))
+        return resp
+
+    @contextlib.contextmanager
+    def traced_memory(self):
+        """Traces memory allocations within the context. Peak traced memory
+        size will be available by ``"peak"`` key of the yielded dict."""
+        stats = {}
+        tracemalloc.start()
+        try:
+            yield stats
+        finally:
+            stats['peak'] = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+
 class ServerTestCase(TestCase):
 
     server_class = None
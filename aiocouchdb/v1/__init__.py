@@ -10,6 +10,7 @@
 # flake8: noqa
 
 from .attachment import Attachment
+from .cache import AttachmentCache
 from .authdb import AuthDatabase, UserDocument
 from .config import ServerConfig
 from .database import Database
@@ -18,3 +19,5 @@ from .designdoc import DesignDocument
 from .server import Server
 from .session import Session
 from .security import DatabaseSecurity
+from .sharding import HashRing, ShardedServer
+from .transfer import TransferManager
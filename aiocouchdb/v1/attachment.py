@@ -9,23 +9,220 @@
 
 import asyncio
 import base64
+import hashlib
+import io
+import json
+import os
+from collections.abc import Mapping
 from io import RawIOBase
 
+from aiohttp.errors import ClientResponseError
+from aiohttp.streams import FlowControlStreamReader
+
 from aiocouchdb.client import Resource
+from aiocouchdb.compat import StopAsyncIteration
+from aiocouchdb.errors import ResourceNotFound
 from aiocouchdb.hdrs import (
     ACCEPT_RANGES,
     CONTENT_ENCODING,
+    CONTENT_LENGTH,
+    CONTENT_RANGE,
     CONTENT_TYPE,
+    ETAG,
     IF_NONE_MATCH,
     RANGE
 )
+from aiocouchdb.multipart import GzipStream, SizedStream
 
 
 __all__ = (
     'Attachment',
+    'DigestIndex',
+    'compute_digest',
+    'format_digest',
+    'is_compressed_type',
 )
 
 
+#: Content types of data which is compressed by its format, so compressing
+#: it once again on upload is a waste of CPU
+COMPRESSED_TYPES = frozenset([
+    'application/epub+zip',
+    'application/gzip',
+    'application/java-archive',
+    'application/pdf',
+    'application/vnd.rar',
+    'application/x-7z-compressed',
+    'application/x-bzip2',
+    'application/x-compress',
+    'application/x-gzip',
+    'application/x-rar-compressed',
+    'application/x-xz',
+    'application/zip',
+    'application/zstd',
+    'font/woff',
+    'font/woff2',
+])
+#: Media types prefixes of mostly compressed data
+COMPRESSED_TYPES_PREFIXES = ('audio/', 'image/', 'video/')
+#: Exceptions from :data:`COMPRESSED_TYPES_PREFIXES`
+UNCOMPRESSED_TYPES = frozenset([
+    'audio/wav',
+    'audio/x-wav',
+    'image/bmp',
+    'image/svg+xml',
+    'image/x-icon',
+])
+
+
+def compute_digest(data, chunk_size=65536):
+    """Computes MD5 digest of attachment data in ``md5-<base64>`` form,
+    the same as CouchDB reports in attachment stubs.
+
+    >>> compute_digest(b'Hello, world!')
+    'md5-bNNVbesNpUvKBgtMOUeYOQ=='
+
+    :param data: Bytes, file path or seekable binary file object. File object
+                 is read from the current position which is restored then
+    :param int chunk_size: Size of chunks to read files by
+
+    :returns: Digest or ``None`` if data couldn't be read twice
+    :rtype: str
+    """
+    md5 = hashlib.md5()
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        md5.update(data)
+    elif isinstance(data, str):
+        with open(data, 'rb') as fileobj:
+            for chunk in iter(lambda: fileobj.read(chunk_size), b''):
+                md5.update(chunk)
+    elif (isinstance(data, io.IOBase) and data.seekable() and
+            not isinstance(data, io.TextIOBase)):
+        position = data.tell()
+        for chunk in iter(lambda: data.read(chunk_size), b''):
+            md5.update(chunk)
+        data.seek(position)
+    else:
+        return None
+    return format_digest(md5)
+
+
+def format_digest(md5):
+    """Formats digest of :func:`hashlib.md5` object in ``md5-<base64>``
+    form.
+
+    >>> format_digest(hashlib.md5(b'Hello, world!'))
+    'md5-bNNVbesNpUvKBgtMOUeYOQ=='
+
+    :rtype: str
+    """
+    return 'md5-' + base64.b64encode(md5.digest()).decode()
+
+
+def is_compressed_type(content_type):
+    """Tells whenever data of the content type is compressed already.
+
+    >>> is_compressed_type('image/png')
+    True
+    >>> is_compressed_type('image/svg+xml; charset=utf-8')
+    False
+    >>> is_compressed_type('application/vnd.openxmlformats-officedocument'
+    ...                    '.wordprocessingml.document')
+    True
+    >>> is_compressed_type('text/plain')
+    False
+
+    :param str content_type: :mimetype:`Content-Type` header value
+
+    :rtype: bool
+    """
+    mimetype = content_type.split(';', 1)[0].strip().lower()
+    if mimetype in UNCOMPRESSED_TYPES:
+        return False
+    return (mimetype in COMPRESSED_TYPES or
+            mimetype.startswith(COMPRESSED_TYPES_PREFIXES) or
+            mimetype.startswith('application/vnd.openxmlformats-') or
+            mimetype.endswith('+zip'))
+
+
+def is_range_response(reader, start, stop=None):
+    """Checks that server responded with ``206 Partial Content`` holding
+    requested bytes range. Servers and proxies are free to ignore ``Range``
+    header and send the whole content instead.
+
+    :param reader: :class:`AttachmentReader` instance
+    :param int start: First byte position
+    :param int stop: Last byte position, ``None`` for open-ended range
+
+    :rtype: bool
+    """
+    content_range = 'bytes {}-'.format(start)
+    if stop is not None:
+        content_range += '{}/'.format(stop)
+    return (reader.status == 206 and
+            reader.headers.get(CONTENT_RANGE, '').startswith(content_range))
+
+
+class RangeIgnored(ClientResponseError):
+    """Server responded on range request with something else than
+    the requested range, e.g. with the whole content."""
+
+
+class DigestIndex(object):
+    """Local index of attachments digests which are known to be stored on
+    server. It allows to skip uploads of unchanged attachments without
+    asking server about them.
+
+    The index trusts itself: if attachment was changed or removed by someone
+    else, it should be :meth:`discard`-ed from the index.
+
+    :param str path: JSON file to load index from and :meth:`save` it to
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._digests = {}
+        if path is not None and os.path.exists(path):
+            with open(path) as fileobj:
+                self._digests.update(json.load(fileobj))
+
+    def __len__(self):
+        return len(self._digests)
+
+    def get(self, attachment):
+        """Returns known digest of the attachment.
+
+        :param attachment: :class:`Attachment` instance
+
+        :rtype: str
+        """
+        return self._digests.get(attachment.resource.url)
+
+    def add(self, attachment, digest):
+        """Remembers that attachment with the digest is stored on server.
+
+        :param attachment: :class:`Attachment` instance
+        :param str digest: Attachment digest in ``md5-<base64>`` form
+        """
+        self._digests[attachment.resource.url] = digest
+
+    def discard(self, attachment):
+        """Forgets about the attachment.
+
+        :param attachment: :class:`Attachment` instance
+        """
+        self._digests.pop(attachment.resource.url, None)
+
+    def save(self):
+        """Saves the index into the file it was loaded from."""
+        if self.path is None:
+            raise ValueError('index file path is not specified')
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'w') as fileobj:
+            json.dump(self._digests, fileobj)
+        os.replace(tmp_path, self.path)
+
+
 class Attachment(object):
     """Implementation of :ref:`CouchDB Attachment API <api/doc/attachment>`."""
 
@@ -47,6 +244,18 @@ class Attachment(object):
         """Returns attachment name specified in class constructor."""
         return self._name
 
+    def document_resource(self):
+        """Returns :class:`~aiocouchdb.client.Resource` of the document
+        the attachment belongs to.
+
+        :rtype: :class:`aiocouchdb.client.Resource`
+        """
+        depth = len(self._name.split('/')) if self._name else 1
+        url = self.resource.url.rsplit('/', depth)[0]
+        return type(self.resource)(url,
+                                   loop=self.resource._loop,
+                                   session=self.resource.session)
+
     @asyncio.coroutine
     def exists(self, rev=None, *, auth=None):
         """Checks if `attachment exists`_. Assumes success on receiving response
@@ -71,7 +280,8 @@ class Attachment(object):
         """Checks if `attachment was modified`_ by known MD5 digest.
 
         :param bytes digest: Attachment MD5 digest. Optionally,
-                             may be passed in base64 encoding form
+                             may be passed in base64 encoding form, with or
+                             without ``md5-`` prefix
         :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
 
         :rtype: bool
@@ -83,6 +293,8 @@ class Attachment(object):
                 raise ValueError('MD5 digest has 16 bytes')
             digest = base64.b64encode(digest).decode()
         elif isinstance(digest, str):
+            if digest.startswith('md5-'):
+                digest = digest[4:]
             if not (len(digest) == 24 and digest.endswith('==')):
                 raise ValueError('invalid base64 encoded MD5 digest')
         else:
@@ -95,6 +307,28 @@ class Attachment(object):
         yield from resp.release()
         return resp.status != 304
 
+    @asyncio.coroutine
+    def stored(self, digest, *, auth=None, digest_index=None):
+        """Checks if server stores the attachment with the digest. The index,
+        if it's specified, is consulted first and it learns about positive
+        answers of server.
+
+        :param str digest: Attachment digest in ``md5-<base64>`` form
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+        :param digest_index: :class:`DigestIndex` instance
+
+        :rtype: bool
+        """
+        if digest_index is not None and digest_index.get(self) == digest:
+            return True
+        try:
+            modified = yield from self.modified(digest, auth=auth)
+        except ResourceNotFound:
+            return False
+        if not modified and digest_index is not None:
+            digest_index.add(self, digest)
+        return not modified
+
     @asyncio.coroutine
     def accepts_range(self, rev=None, *, auth=None):
         """Returns ``True`` if attachments accepts bytes range requests.
@@ -138,33 +372,210 @@ class Attachment(object):
                 start, stop = 0, range
             else:
                 start, stop = range
-            headers[RANGE] = 'bytes={}-{}'.format(start or 0, stop)
+            headers[RANGE] = 'bytes={}-{}'.format(
+                start or 0, '' if stop is None else stop)
         resp = yield from self.resource.get(auth=auth,
                                             headers=headers,
                                             params=params)
         yield from resp.maybe_raise_error()
         return AttachmentReader(resp)
 
+    @asyncio.coroutine
+    def download(self, path_or_fileobj, rev=None, *,
+                 auth=None,
+                 chunk_size=65536,
+                 loop=None,
+                 parts=4,
+                 retries=3):
+        """Downloads attachment fetching ``parts`` byte ranges of it
+        concurrently. Each range is written at its offset into preallocated
+        file as soon as its chunks arrive, so memory usage doesn't depend on
+        the attachment size.
+
+        Ranges that failed are retried up to ``retries`` times from the last
+        written byte. When the target is a file path, progress of incomplete
+        download is kept in ``<path>.download`` file and the next call resumes
+        it, unless attachment had changed since.
+
+        Attachments which doesn't accept ranges, like compressed ones, are
+        downloaded by single request. The same happens when server or proxy
+        responds on range request with anything but ``206 Partial Content``
+        of the requested range.
+
+        :param path_or_fileobj: File path or seekable binary file object
+        :param str rev: Document revision
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+        :param int chunk_size: Size of chunks to read ranges by
+        :param loop: Event loop instance
+        :param int parts: Amount of ranges to fetch concurrently
+        :param int retries: How many times failed ranges are retried
+
+        :returns: Attachment length
+        :rtype: int
+        """
+        loop = loop or asyncio.get_event_loop()
+        params = {}
+        if rev is not None:
+            params['rev'] = rev
+        resp = yield from self.resource.head(auth=auth, params=params)
+        yield from resp.maybe_raise_error()
+        yield from resp.release()
+        length = int(resp.headers.get(CONTENT_LENGTH, 0))
+        etag = resp.headers.get(ETAG)
+        ranged = (resp.headers.get(ACCEPT_RANGES) == 'bytes' and
+                  CONTENT_ENCODING not in resp.headers)
+
+        if isinstance(path_or_fileobj, str):
+            target = DownloadFile(path_or_fileobj, etag, length)
+        else:
+            target = DownloadFileObject(path_or_fileobj, etag, length)
+
+        @asyncio.coroutine
+        def fetch(part):
+            start, stop, written = part
+            if not ranged:
+                # nothing to resume from
+                part[2] = written = 0
+            reader = yield from self.get(
+                rev, auth=auth,
+                range=(start + written, stop) if ranged else None)
+            try:
+                if ranged and not is_range_response(reader, start + written,
+                                                    stop):
+                    raise RangeIgnored(
+                        'range {}-{} was not honoured: {} {}'.format(
+                            start + written, stop, reader.status,
+                            reader.headers.get(CONTENT_RANGE)))
+                while True:
+                    chunk = yield from reader.read(chunk_size)
+                    if not chunk:
+                        break
+                    if ranged and part[2] + len(chunk) > stop - start + 1:
+                        raise ClientResponseError(
+                            'response for bytes {}-{} is longer than'
+                            ' requested'.format(start, stop))
+                    target.write_at(start + part[2], chunk)
+                    part[2] += len(chunk)
+            finally:
+                reader.close()
+            if not ranged:
+                # decoded content length is known only now
+                part[1] = part[2] - 1
+            elif start + part[2] <= stop:
+                raise ClientResponseError(
+                    'incomplete response for bytes {}-{}: got {} bytes'
+                    ''.format(start, stop, part[2]))
+
+        ranges = target.load_state()
+        try:
+            if ranges is None and not ranged:
+                ranges = [[0, max(length, 1) - 1, 0]]
+            elif ranges is None:
+                size = -(-length // max(parts, 1))
+                ranges = [[start, min(start + size, length) - 1, 0]
+                          for start in range(0, length, size or 1)]
+            for attempt in range(retries + 1):
+                pending = [part for part in ranges
+                           if part[0] + part[2] <= part[1]]
+                if not pending:
+                    break
+                results = yield from asyncio.gather(
+                    *[fetch(part) for part in pending],
+                    loop=loop, return_exceptions=True)
+                if ranged and any(isinstance(result, RangeIgnored)
+                                  for result in results):
+                    # fall back to single request of the whole content
+                    ranged = False
+                    ranges = [[0, max(length, 1) - 1, 0]]
+                    results = yield from asyncio.gather(
+                        fetch(ranges[0]), loop=loop, return_exceptions=True)
+                errors = [result for result in results
+                          if isinstance(result, Exception)]
+                if errors and attempt == retries:
+                    raise errors[0]
+            if not ranged and ranges:
+                length = ranges[0][2]
+        except BaseException:
+            target.save_state(ranges)
+            raise
+        else:
+            target.complete(length)
+        finally:
+            target.close()
+        return length
+
     @asyncio.coroutine
     def update(self, fileobj, *,
                auth=None,
+               compress=None,
+               compress_level=None,
+               compress_threaded=False,
                content_encoding=None,
                content_type='application/octet-stream',
+               dedup=False,
+               digest_index=None,
                rev=None):
         """`Attaches a file`_ to document.
 
-        :param file fileobj: File object, should be readable
+        With ``dedup`` the upload is skipped if server already stores the
+        attachment with the same MD5 digest, as :meth:`stored` tells.
+        Seekable file object is read one more time to compute its digest.
+
+        With ``compress="gzip"`` the data is compressed on the fly while it's
+        been sent by :class:`~aiocouchdb.multipart.GzipStream` and stored
+        with ``gzip`` encoding. Data of :func:`already compressed types
+        <is_compressed_type>` is sent as is. Note, that digest of compressed
+        attachment, which server reports, is the one of compressed data, so
+        ``compress`` cannot be combined with ``dedup`` or ``digest_index``.
+
+        Data passed with ``content_encoding`` is expected to be encoded
+        already, it's sent as is.
+
+        :param file fileobj: File object, should be readable, or
+                             :class:`~aiocouchdb.multipart.SizedStream`
 
         :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+        :param str compress: Compression to apply on upload: ``gzip``
+        :param int compress_level: Compression level, from ``1`` to ``9``
+        :param bool compress_threaded: Whenever to compress data in executor
         :param str content_encoding: Content encoding: ``gzip`` or ``identity``
         :param str content_type: Attachment :mimetype:`Content-Type` header
+        :param bool dedup: Skip upload of already stored data
+        :param digest_index: :class:`DigestIndex` instance to consult before
+                             asking server. Implies ``dedup``
         :param str rev: Document revision
 
+        :returns: Server response. For skipped upload it's
+                  ``{"ok": true, "rev": <current document revision>,
+                  "skipped": true}``, where revision is requested from
+                  the server since passed ``rev`` may be outdated
         :rtype: dict
 
         .. _Attaches a file: http://docs.couchdb.org/en/latest/api/document/attachments.html#put--db-docid-attname
         """
-        assert hasattr(fileobj, 'read')
+        assert hasattr(fileobj, 'read') or isinstance(fileobj, SizedStream)
+        if compress not in (None, 'gzip'):
+            raise ValueError('unsupported compression {!r}'.format(compress))
+        if compress is not None and content_encoding is not None:
+            raise ValueError('data with content encoding cannot be compressed')
+        if compress is not None and isinstance(fileobj, SizedStream):
+            raise TypeError('SizedStream cannot be compressed,'
+                            ' pass its source instead')
+        if compress is not None and (dedup or digest_index is not None):
+            raise ValueError('compressed data cannot be deduplicated')
+
+        digest = None
+        if dedup or digest_index is not None:
+            digest = compute_digest(fileobj)
+        if digest is not None and (yield from self.stored(
+                digest, auth=auth, digest_index=digest_index)):
+            # passed revision may be stale, report the current one
+            resp = yield from self.document_resource().head(auth=auth)
+            yield from resp.maybe_raise_error()
+            yield from resp.release()
+            return {'ok': True,
+                    'rev': resp.headers[ETAG].strip('"'),
+                    'skipped': True}
 
         params = {}
         if rev is not None:
@@ -173,15 +584,24 @@ class Attachment(object):
         headers = {
             CONTENT_TYPE: content_type
         }
+        if compress is not None and not is_compressed_type(content_type):
+            fileobj = GzipStream(fileobj,
+                                 level=compress_level,
+                                 threaded=compress_threaded)
+            content_encoding = compress
         if content_encoding is not None:
             headers[CONTENT_ENCODING] = content_encoding
 
         resp = yield from self.resource.put(auth=auth,
+                                            compress=False,
                                             data=fileobj,
                                             headers=headers,
                                             params=params)
         yield from resp.maybe_raise_error()
-        return (yield from resp.json())
+        result = yield from resp.json()
+        if digest is not None and digest_index is not None:
+            digest_index.add(self, digest)
+        return result
 
     @asyncio.coroutine
     def delete(self, rev, *, auth=None):
@@ -202,12 +622,31 @@ class Attachment(object):
 
 class AttachmentReader(RawIOBase):
     """Attachment reader implements :class:`io.RawIOBase` interface
-    with the exception that all I/O bound methods are coroutines."""
+    with the exception that all I/O bound methods are coroutines.
+
+    On Python 3.5+ attachment content could be iterated by chunks of
+    :attr:`chunk_size` bytes with ``async for`` statement.
+
+    For consuming without allocations per chunk see :meth:`readinto`,
+    :meth:`iter_chunks` and :meth:`copy_to`."""
+
+    #: Size of chunks emitted on ``async for`` iteration
+    chunk_size = 8192
 
     def __init__(self, resp):
         super().__init__()
         self._resp = resp
 
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        chunk = yield from self.read(self.chunk_size)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
     def close(self):
         """Closes attachment reader and underlying connection.
 
@@ -221,6 +660,21 @@ class AttachmentReader(RawIOBase):
         """Return a bool indicating whether object is closed."""
         return self._resp.content.at_eof()
 
+    @property
+    def headers(self):
+        """Attachment response headers."""
+        return self._resp.headers
+
+    @property
+    def status(self):
+        """Attachment response status code."""
+        return self._resp.status
+
+    def _maybe_release(self):
+        # once the content is read, connection should return back to the pool
+        if self._resp.content.at_eof():
+            self._resp.close()
+
     def readable(self):
         """Return a bool indicating whether object was opened for reading."""
         return True
@@ -232,12 +686,139 @@ class AttachmentReader(RawIOBase):
         Returns an empty bytes object on EOF, or None if the object is
         set not to block and has no data to read.
         """
-        return (yield from self._resp.content.read(size))
+        data = yield from self._resp.content.read(size)
+        self._maybe_release()
+        return data
+
+    @asyncio.coroutine
+    def readinto(self, buffer):
+        """Reads bytes into a pre-allocated, writable bytes-like object
+        ``buffer`` and returns the number of bytes read. Returns ``0`` on EOF.
+
+        For :class:`aiohttp.streams.FlowControlStreamReader` responses data
+        is copied straight from the response buffer, without creating
+        intermediate :class:`bytes` objects. Other stream readers are read
+        with :meth:`read` which result is copied into the ``buffer``.
+
+        :rtype: int
+        """
+        view = memoryview(buffer).cast('B')
+        if not len(view):
+            return 0
+        content = self._resp.content
+        if not isinstance(content, FlowControlStreamReader):
+            data = yield from self.read(len(view))
+            view[:len(data)] = data
+            return len(data)
+
+        # the same what aiohttp.streams.StreamReader.read does, except
+        # the data copying; relies on FlowControlStreamReader internals
+        # of pinned aiohttp version
+        pending = content._buffer
+        if content.exception() is not None:
+            raise content.exception()
+        if not pending and not content.is_eof():
+            content._waiter = content._create_waiter('readinto')
+            try:
+                yield from content._waiter
+            finally:
+                content._waiter = None
+        size = min(len(view), len(pending))
+        with memoryview(pending) as data:
+            view[:size] = data[:size]
+        del pending[:size]
+        self._maybe_resume_reading()
+        self._maybe_release()
+        return size
+
+    def _maybe_resume_reading(self):
+        # see aiohttp.streams.maybe_resume: flow control stream reader
+        # resumes paused transport once its buffer is drained enough
+        content = self._resp.content
+        stream = content._stream
+        if stream.paused and len(content._buffer) < content._b_limit:
+            try:
+                stream.transport.resume_reading()
+            except (AttributeError, NotImplementedError):
+                pass
+            else:
+                stream.paused = False
+
+    def iter_chunks(self, size=None, *, reuse_buffer=False):
+        """Returns asynchronous iterator over the content chunks of ``size``
+        bytes at most, :attr:`chunk_size` by default.
+
+        With ``reuse_buffer`` chunks are :class:`memoryview` slices of the
+        same buffer which are valid only till the next iteration step.
+
+        :param int size: Chunk size
+        :param bool reuse_buffer: Read chunks into the same buffer
+
+        :rtype: :class:`AttachmentChunksIterator`
+        """
+        return AttachmentChunksIterator(self, size or self.chunk_size,
+                                        reuse_buffer=reuse_buffer)
+
+    @asyncio.coroutine
+    def copy_to(self, target, *, chunk_size=None):
+        """Copies the content into the target through the single buffer.
+
+        Target is a binary file object, :class:`asyncio.StreamWriter` or
+        :class:`aiohttp.web.StreamResponse`: its ``write`` method may return
+        coroutine and ``drain`` coroutine is awaited after each write, if
+        target has it. Target should not keep references to the written
+        data, since the buffer gets reused.
+
+        :param target: Object to write the content into
+        :param int chunk_size: Size of the buffer, :attr:`chunk_size`
+                               by default
+
+        :returns: Amount of copied bytes
+        :rtype: int
+        """
+        total = 0
+        drain = getattr(target, 'drain', None)
+        with memoryview(bytearray(chunk_size or self.chunk_size)) as view:
+            while True:
+                size = yield from self.readinto(view)
+                if not size:
+                    break
+                result = target.write(view[:size])
+                if asyncio.iscoroutine(result) or isinstance(result,
+                                                             asyncio.Future):
+                    yield from result
+                if drain is not None:
+                    yield from drain()
+                total += size
+        return total
 
     @asyncio.coroutine
     def readall(self, size=8192):
-        """Read until EOF, using multiple :meth:`read` call."""
-        acc = bytearray()
+        """Read until EOF, using multiple :meth:`read` call. When content
+        length is known, the data is read into the buffer of that size."""
+        length = None
+        headers = getattr(self._resp, 'headers', None)
+        if isinstance(headers, Mapping) and CONTENT_ENCODING not in headers:
+            try:
+                length = int(headers[CONTENT_LENGTH])
+            except (KeyError, ValueError):
+                pass
+        if length is None:
+            acc = bytearray()
+            while not self.closed:
+                acc.extend((yield from self.read(size)))
+            return acc
+
+        acc = bytearray(length)
+        read = 0
+        with memoryview(acc) as view:
+            while read < length:
+                chunk_size = yield from self.readinto(view[read:])
+                if not chunk_size:
+                    break
+                read += chunk_size
+        del acc[read:]
+        # the rest, if any
         while not self.closed:
             acc.extend((yield from self.read(size)))
         return acc
@@ -253,7 +834,9 @@ class AttachmentReader(RawIOBase):
         files, the newlines argument to open can be used to select the line
         terminator(s) recognized.
         """
-        return (yield from self._resp.content.readline())
+        line = yield from self._resp.content.readline()
+        self._maybe_release()
+        return line
 
     @asyncio.coroutine
     def readlines(self, hint=None):
@@ -263,21 +846,138 @@ class AttachmentReader(RawIOBase):
         lines will be read if the total size (in bytes/characters) of all
         lines so far exceeds `hint`.
         """
-        if hint is None or hint <= 0:
-            acc = []
-            while not self.closed:
-                line = yield from self.readline()
-                if line:
-                    acc.append(line)
-            return acc
         read = 0
         acc = []
         while not self.closed:
             line = yield from self.readline()
             if not line:
-                continue
+                break
             acc.append(line)
             read += len(line)
-            if read >= hint:
+            if hint is not None and 0 < hint <= read:
                 break
         return acc
+
+
+class AttachmentChunksIterator(object):
+    """Asynchronous iterator over :class:`AttachmentReader` content chunks,
+    see :meth:`AttachmentReader.iter_chunks`."""
+
+    def __init__(self, reader, size, *, reuse_buffer=False):
+        self._reader = reader
+        self._size = size
+        self._view = memoryview(bytearray(size)) if reuse_buffer else None
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if self._view is None:
+            chunk = yield from self._reader.read(self._size)
+            if not chunk:
+                raise StopAsyncIteration
+            return chunk
+        size = yield from self._reader.readinto(self._view)
+        if not size:
+            raise StopAsyncIteration
+        return self._view[:size]
+
+
+class DownloadFileObject(object):
+    """Target of :meth:`Attachment.download` and
+    :meth:`~aiocouchdb.v1.transfer.TransferManager.download` for file
+    objects. Doesn't keep download progress."""
+
+    def __init__(self, fileobj, etag, length):
+        self._fileobj = fileobj
+        fileobj.seek(0)
+        fileobj.truncate(length)
+
+    def write_at(self, offset, data):
+        self._fileobj.seek(offset)
+        self._fileobj.write(data)
+
+    def iter_chunks(self, chunk_size, length):
+        """Reads back first ``length`` bytes of written data."""
+        self._fileobj.seek(0)
+        while length > 0:
+            chunk = self._fileobj.read(min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    def load_state(self):
+        return None
+
+    def save_state(self, ranges):
+        pass
+
+    def complete(self, length):
+        self._fileobj.truncate(length)
+        self._fileobj.seek(0)
+
+    def close(self):
+        pass
+
+
+class DownloadFile(DownloadFileObject):
+    """Target of downloads for file paths. Data is written
+    with :func:`os.pwrite` where it's available. Progress of incomplete
+    download is stored in ``<path>.download`` JSON file."""
+
+    def __init__(self, path, etag, length):
+        self._path = path
+        self._state_path = path + '.download'
+        self._etag = etag
+        self._length = length
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o666)
+        if self.load_state() is None:
+            os.ftruncate(self._fd, length)
+
+    if hasattr(os, 'pwrite'):
+        def write_at(self, offset, data):
+            while data:
+                written = os.pwrite(self._fd, data, offset)
+                data = data[written:]
+                offset += written
+    else:  # pragma: no cover
+        def write_at(self, offset, data):
+            os.lseek(self._fd, offset, os.SEEK_SET)
+            os.write(self._fd, data)
+
+    def iter_chunks(self, chunk_size, length):
+        os.lseek(self._fd, 0, os.SEEK_SET)
+        while length > 0:
+            chunk = os.read(self._fd, min(chunk_size, length))
+            if not chunk:
+                break
+            length -= len(chunk)
+            yield chunk
+
+    def load_state(self):
+        try:
+            with open(self._state_path) as fileobj:
+                state = json.load(fileobj)
+        except (OSError, ValueError):
+            return None
+        if state.get('etag') != self._etag:
+            return None
+        if state.get('length') != self._length:
+            return None
+        return state['ranges']
+
+    def save_state(self, ranges):
+        with open(self._state_path, 'w') as fileobj:
+            json.dump({'etag': self._etag,
+                       'length': self._length,
+                       'ranges': ranges}, fileobj)
+
+    def complete(self, length):
+        os.ftruncate(self._fd, length)
+        if os.path.exists(self._state_path):
+            os.unlink(self._state_path)
+
+    def close(self):
+        os.close(self._fd)
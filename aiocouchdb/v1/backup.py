@@ -0,0 +1,508 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import base64
+import contextlib
+import gzip
+import hashlib
+import json
+import mimetypes
+import os
+import tempfile
+from urllib.parse import quote, unquote
+
+from aiocouchdb.errors import HttpErrorException
+
+from .attachment import compute_digest, format_digest
+from .designdoc import DesignDocument
+
+
+__all__ = (
+    'dump',
+    'export_attachments',
+    'import_attachments',
+    'restore',
+)
+
+
+#: Attachment stub fields which are meaningless for inlined content
+STUB_FIELDS = frozenset({'digest', 'encoded_length', 'encoding', 'follows',
+                         'length', 'stub'})
+
+#: Key of the dump header object, written as the first line
+HEADER_KEY = 'aiocouchdb_dump'
+
+
+@contextlib.contextmanager
+def gzip_open(fileobj_or_path, mode, compresslevel=9):
+    """Opens gzip stream over file path or binary file object. In the last
+    case file object is left open on exit."""
+    if isinstance(fileobj_or_path, str):
+        stream = gzip.open(fileobj_or_path, mode, compresslevel)
+    else:
+        stream = gzip.GzipFile(fileobj=fileobj_or_path, mode=mode,
+                               compresslevel=compresslevel)
+    try:
+        yield stream
+    finally:
+        stream.close()
+
+
+@asyncio.coroutine
+def split_ranges(db, ranges, *, auth=None):
+    """Splits database documents IDs into ``ranges`` contiguous key ranges of
+    about the same size. Bounds are picked by fetching single row at each
+    boundary offset of ``_all_docs``, so the whole IDs list is never loaded.
+
+    :returns: List of ``(startkey, endkey)`` tuples where ``endkey`` is not
+              inclusive. First ``startkey`` and last ``endkey`` are ``None``
+    :rtype: list
+    """
+    bounds = [None]
+    if ranges > 1:
+        total = (yield from db.info(auth=auth))['doc_count']
+        for idx in range(1, ranges):
+            skip = total * idx // ranges
+            if not skip:
+                continue
+            feed = yield from db.all_docs(auth=auth, skip=skip, limit=1)
+            row = yield from feed.next()
+            feed.close()
+            if row is not None and row['id'] != bounds[-1]:
+                bounds.append(row['id'])
+    bounds.append(None)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+@asyncio.coroutine
+def inline_attachments(db, doc, *, auth=None):
+    """Replaces document attachment stubs with their base64 encoded content
+    fetched via multipart API. Each attachment is read into memory as a
+    whole, together with its base64 encoded copy, so this is not the way
+    to dump large attachments."""
+    reader = yield from db[doc['_id']].get_with_atts(doc['_rev'], auth=auth)
+    try:
+        doc, atts = yield from reader.next()
+        while True:
+            part = yield from atts.next()
+            if part is None:
+                break
+            data = yield from part.read(decode=True)
+            info = doc['_attachments'][part.filename]
+            for key in STUB_FIELDS.intersection(info):
+                del info[key]
+            info['data'] = base64.b64encode(data).decode()
+    finally:
+        yield from reader.release()
+    return doc
+
+
+@asyncio.coroutine
+def dump(db, fileobj_or_path, *,
+         attachments=True,
+         auth=None,
+         compresslevel=6,
+         flush_every=1000,
+         loop=None,
+         ranges=1):
+    """Dumps documents of the database into gzip compressed stream of
+    newline delimited JSON objects, one document per line.
+
+    Documents are streamed from ``_all_docs?include_docs=true`` and written
+    as soon as they are received, so memory usage doesn't depend on database
+    size. When ``ranges`` is more than one, IDs space gets split into that
+    amount of key ranges which are fetched concurrently.
+
+    Only the winning revision of each document is dumped. Without
+    ``attachments`` the attachment stubs are dropped since they couldn't be
+    restored into another database, and so is ``_rev`` of these documents:
+    their revision without attachments is not the one which was dumped, so
+    it's stored as new edit on restore. The mode is recorded in the header
+    object at the first line of the dump.
+
+    :param db: :class:`~aiocouchdb.v1.database.Database` instance
+    :param fileobj_or_path: File path or binary file object to write to
+    :param bool attachments: Inline attachments content into documents.
+                             Attachments are fetched with
+                             :meth:`~aiocouchdb.v1.document.Document.get_with_atts`
+                             for documents which have them. Note, that
+                             each attachment is held in memory while it's
+                             been encoded
+    :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+    :param int compresslevel: Gzip compression level
+    :param int flush_every: Flushes compressed stream after each specified
+                            amount of documents, so interrupted dump remains
+                            readable up to the last flush
+    :param loop: Event loop instance
+    :param int ranges: Amount of key ranges to fetch concurrently
+
+    :returns: Amount of dumped documents
+    :rtype: int
+    """
+    loop = loop or asyncio.get_event_loop()
+    counter = [0]
+
+    with gzip_open(fileobj_or_path, 'wb', compresslevel) as stream:
+        header = {HEADER_KEY: {'attachments': bool(attachments)}}
+        stream.write(json.dumps(header).encode('utf-8') + b'\n')
+
+        @asyncio.coroutine
+        def dump_range(startkey, endkey):
+            params = {'include_docs': True}
+            if startkey is not None:
+                params['startkey'] = startkey
+            if endkey is not None:
+                params.update(endkey=endkey, inclusive_end=False)
+            feed = yield from db.all_docs(auth=auth, **params)
+            try:
+                while True:
+                    row = yield from feed.next()
+                    if row is None:
+                        break
+                    doc = row['doc']
+                    if doc.get('_attachments'):
+                        if attachments:
+                            doc = yield from inline_attachments(db, doc,
+                                                                auth=auth)
+                        else:
+                            del doc['_attachments']
+                            del doc['_rev']
+                    stream.write(json.dumps(doc).encode('utf-8') + b'\n')
+                    counter[0] += 1
+                    if flush_every and not counter[0] % flush_every:
+                        stream.flush()
+            finally:
+                feed.close()
+
+        key_ranges = yield from split_ranges(db, ranges, auth=auth)
+        tasks = [asyncio.Task(dump_range(*key_range), loop=loop)
+                 for key_range in key_ranges]
+        try:
+            yield from asyncio.gather(*tasks, loop=loop)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return counter[0]
+
+
+def read_batches(stream, batch_size):
+    batch = []
+    for line in stream:
+        line = line.strip()
+        if not line:
+            continue
+        doc = json.loads(line.decode('utf-8'))
+        if HEADER_KEY in doc and '_id' not in doc:
+            continue
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+@asyncio.coroutine
+def restore(db, fileobj_or_path, *,
+            auth=None,
+            batch_size=500,
+            concurrency=4,
+            loop=None):
+    """Restores documents from the stream written by :func:`dump`.
+
+    Documents are read in batches which are stored with
+    :meth:`~aiocouchdb.v1.database.Database.bulk_docs` using
+    ``new_edits=false``, so they keep their revisions. Documents without
+    ``_rev``, which :func:`dump` writes for documents which attachments were
+    not dumped, are stored as new edits instead. Up to ``concurrency``
+    batches are sent at the same time while the next one is being read, so
+    memory usage is bounded by ``batch_size * concurrency`` documents.
+
+    :param db: :class:`~aiocouchdb.v1.database.Database` instance
+    :param fileobj_or_path: File path or binary file object to read from
+    :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+    :param int batch_size: Amount of documents per bulk request
+    :param int concurrency: Amount of bulk requests in flight
+    :param loop: Event loop instance
+
+    :returns: Dict with amount of processed ``docs`` and list of ``errors``
+              reported for documents which were not stored
+    :rtype: dict
+    """
+    loop = loop or asyncio.get_event_loop()
+    stats = {'docs': 0, 'errors': []}
+
+    @asyncio.coroutine
+    def store(batch):
+        replicas = [doc for doc in batch if '_rev' in doc]
+        edits = [doc for doc in batch if '_rev' not in doc]
+        if replicas:
+            result = yield from db.bulk_docs(replicas, auth=auth,
+                                             new_edits=False)
+            stats['errors'].extend(item for item in result if 'error' in item)
+        if edits:
+            result = yield from db.bulk_docs(edits, auth=auth)
+            stats['errors'].extend(item for item in result if 'error' in item)
+
+    pending = set()
+    try:
+        with gzip_open(fileobj_or_path, 'rb') as stream:
+            for batch in read_batches(stream, batch_size):
+                if len(pending) >= concurrency:
+                    done, pending = yield from asyncio.wait(
+                        pending, loop=loop,
+                        return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        task.result()
+                pending.add(asyncio.Task(store(batch), loop=loop))
+                stats['docs'] += len(batch)
+        while pending:
+            done, pending = yield from asyncio.wait(
+                pending, loop=loop, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                task.result()
+    finally:
+        for task in pending:
+            task.cancel()
+
+    return stats
+
+
+def quote_filename(name):
+    """Percent-encodes document ID or attachment name to be used as file
+    name. Leading dot is encoded as well, so dotfiles are left for temporary
+    files.
+
+    >>> quote_filename('.hidden/file')
+    '%2Ehidden%2Ffile'
+    """
+    name = quote(name, safe='')
+    if name.startswith('.'):
+        name = '%2E' + name[1:]
+    return name
+
+
+def get_document(db, docid):
+    doc = db[docid]
+    if isinstance(doc, DesignDocument):
+        doc = doc.doc
+    return doc
+
+
+@asyncio.coroutine
+def worker_pool(produce, work, *, concurrency, loop):
+    """Runs ``produce`` coroutine function, which puts work items into the
+    bounded queue, and ``concurrency`` workers which call ``work`` for each
+    of them. Fails fast on the first unhandled error."""
+    queue = asyncio.Queue(concurrency, loop=loop)
+
+    @asyncio.coroutine
+    def producer():
+        yield from produce(queue.put)
+        for _ in range(concurrency):
+            yield from queue.put(None)
+
+    @asyncio.coroutine
+    def worker():
+        while True:
+            item = yield from queue.get()
+            if item is None:
+                break
+            yield from work(*item)
+
+    tasks = [asyncio.Task(producer(), loop=loop)]
+    tasks.extend(asyncio.Task(worker(), loop=loop)
+                 for _ in range(concurrency))
+    try:
+        yield from asyncio.gather(*tasks, loop=loop)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+@asyncio.coroutine
+def export_attachments(db, path, *,
+                       auth=None,
+                       chunk_size=65536,
+                       concurrency=4,
+                       loop=None):
+    """Downloads attachments of all database documents into directory tree
+    ``path/<docid>/<attname>`` where document ID and attachment name are
+    percent-encoded, including their leading dot.
+
+    Documents are walked via ``_all_docs``, attachments are downloaded by
+    ``concurrency`` workers and streamed to disk by ``chunk_size`` chunks.
+    Each file is written into temporary dotfile aside and moved in place
+    only when its MD5 digest
+    matches the attachment stub one. Attachments which already exist on disk
+    with the same digest are skipped.
+
+    Digest of compressed attachments is computed by CouchDB over the stored
+    gzip data, so such attachments are downloaded without verification and
+    are never skipped.
+
+    :param db: :class:`~aiocouchdb.v1.database.Database` instance
+    :param str path: Target directory
+    :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+    :param int chunk_size: Size of chunks to read attachments by
+    :param int concurrency: Amount of concurrent downloads
+    :param loop: Event loop instance
+
+    :returns: Dict with amount of ``transferred`` and ``skipped`` attachments
+              and list of ``errors`` for those which failed
+    :rtype: dict
+    """
+    loop = loop or asyncio.get_event_loop()
+    stats = {'transferred': 0, 'skipped': 0, 'errors': []}
+
+    @asyncio.coroutine
+    def produce(put):
+        feed = yield from db.all_docs(auth=auth, att_encoding_info=True,
+                                      include_docs=True)
+        try:
+            while True:
+                row = yield from feed.next()
+                if row is None:
+                    break
+                doc = row['doc']
+                for name, stub in sorted(doc.get('_attachments', {}).items()):
+                    yield from put((doc['_id'], doc['_rev'], name, stub))
+        finally:
+            feed.close()
+
+    @asyncio.coroutine
+    def download(docid, rev, name, stub):
+        docpath = os.path.join(path, quote_filename(docid))
+        attpath = os.path.join(docpath, quote_filename(name))
+        verify = 'encoding' not in stub
+        if (verify and os.path.exists(attpath) and
+                compute_digest(attpath) == stub['digest']):
+            stats['skipped'] += 1
+            return
+
+        os.makedirs(docpath, exist_ok=True)
+        md5 = hashlib.md5()
+        try:
+            att = get_document(db, docid)[name]
+            reader = yield from att.get(rev, auth=auth)
+        except HttpErrorException as err:
+            stats['errors'].append({'id': docid, 'name': name,
+                                    'error': err.error,
+                                    'reason': err.reason})
+            return
+        fd, tmppath = tempfile.mkstemp(dir=docpath, prefix='.')
+        try:
+            with open(fd, 'wb') as fileobj:
+                while True:
+                    chunk = yield from reader.read(chunk_size)
+                    if not chunk:
+                        break
+                    md5.update(chunk)
+                    fileobj.write(chunk)
+        except BaseException:
+            reader.close()
+            os.unlink(tmppath)
+            raise
+
+        digest = format_digest(md5)
+        if verify and digest != stub['digest']:
+            os.unlink(tmppath)
+            stats['errors'].append({'id': docid, 'name': name,
+                                    'error': 'digest_mismatch',
+                                    'reason': 'expected {}, got {}'.format(
+                                        stub['digest'], digest)})
+            return
+        os.replace(tmppath, attpath)
+        stats['transferred'] += 1
+
+    yield from worker_pool(produce, download,
+                           concurrency=concurrency, loop=loop)
+    return stats
+
+
+@asyncio.coroutine
+def import_attachments(db, path, *,
+                       auth=None,
+                       concurrency=4,
+                       loop=None):
+    """Uploads attachments from directory tree made by
+    :func:`export_attachments` with
+    :meth:`~aiocouchdb.v1.attachment.Attachment.update`. Missing documents
+    are created.
+
+    Documents are processed by ``concurrency`` workers, attachments of the
+    same document are uploaded one by one since each upload makes a new
+    document revision. Files which digest matches the stored attachment one
+    are skipped. Attachment content type is guessed by its name.
+
+    :param db: :class:`~aiocouchdb.v1.database.Database` instance
+    :param str path: Source directory
+    :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+    :param int concurrency: Amount of documents to process concurrently
+    :param loop: Event loop instance
+
+    :returns: Dict with amount of ``transferred`` and ``skipped`` attachments
+              and list of ``errors`` for those which failed
+    :rtype: dict
+    """
+    loop = loop or asyncio.get_event_loop()
+    stats = {'transferred': 0, 'skipped': 0, 'errors': []}
+
+    @asyncio.coroutine
+    def produce(put):
+        for dirname in sorted(os.listdir(path)):
+            docpath = os.path.join(path, dirname)
+            if os.path.isdir(docpath):
+                yield from put((unquote(dirname), docpath))
+
+    @asyncio.coroutine
+    def upload(docid, docpath):
+        doc = get_document(db, docid)
+        try:
+            data = yield from doc.get(auth=auth, att_encoding_info=True)
+        except HttpErrorException as err:
+            if err.code != 404:
+                raise
+            rev, stubs = None, {}
+        else:
+            rev, stubs = data['_rev'], data.get('_attachments', {})
+
+        for filename in sorted(os.listdir(docpath)):
+            attpath = os.path.join(docpath, filename)
+            if filename.startswith('.') or not os.path.isfile(attpath):
+                continue
+            name = unquote(filename)
+            stub = stubs.get(name, {})
+            if ('encoding' not in stub and
+                    stub.get('digest') == compute_digest(attpath)):
+                stats['skipped'] += 1
+                continue
+            content_type = (mimetypes.guess_type(name)[0] or
+                            'application/octet-stream')
+            try:
+                with open(attpath, 'rb') as fileobj:
+                    result = yield from doc[name].update(
+                        fileobj, auth=auth, content_type=content_type, rev=rev)
+            except HttpErrorException as err:
+                stats['errors'].append({'id': docid, 'name': name,
+                                        'error': err.error,
+                                        'reason': err.reason})
+                # document revision is unknown after conflict, so the rest
+                # attachments would fail as well
+                if err.code == 409:
+                    break
+                continue
+            rev = result['rev']
+            stats['transferred'] += 1
+
+    yield from worker_pool(produce, upload,
+                           concurrency=concurrency, loop=loop)
+    return stats
@@ -0,0 +1,349 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import base64
+import binascii
+import collections
+import hashlib
+import mmap
+import os
+import tempfile
+import time
+
+from aiocouchdb.compat import StopAsyncIteration
+from aiocouchdb.errors import ResourceNotFound
+from aiocouchdb.hdrs import CONTENT_ENCODING, ETAG
+
+from .attachment import format_digest
+from .transfer import etag_digest
+
+
+__all__ = (
+    'AttachmentCache',
+    'CachedAttachmentReader',
+    'CachingAttachmentReader',
+)
+
+
+def digest_filename(digest):
+    """Returns cache file name for the ``md5-<base64>`` digest.
+
+    >>> digest_filename('md5-XrY7u+Ae7tCTyyK7j1rNww==')
+    '5eb63bbbe01eeed093cb22bb8f5acdc3'
+    """
+    return binascii.hexlify(base64.b64decode(digest[4:])).decode()
+
+
+class AttachmentCache(object):
+    """Local on-disk cache of attachments content keyed by their MD5 digest,
+    so the same data stored in different attachments is cached once.
+
+    Cached attachment of specific revision is served without asking server
+    since it cannot change. Otherwise, it's revalidated with
+    :meth:`~aiocouchdb.v1.attachment.Attachment.modified` request.
+    Least recently used files are evicted when total size of the cache
+    exceeds :attr:`max_size`.
+
+    Cache provides ``hits`` and ``misses`` counters, so it could be tracked
+    by :meth:`aiocouchdb.metrics.MetricsCollector.track_cache`.
+
+    :param str directory: Cache directory. Files already there are reused
+    :param int chunk_size: Size of chunks to read attachments by
+    :param int max_size: Cache size limit in bytes
+    :param int tmp_max_age: Age in seconds after which temporary file is
+                            considered left by interrupted process and
+                            removed. Younger ones could be still written by
+                            another cache sharing the directory
+    """
+
+    #: Size of chunks to read attachments by
+    chunk_size = 65536
+    #: Cache size limit in bytes
+    max_size = 256 * 1024 * 1024
+    #: Age in seconds after which temporary file is removed
+    tmp_max_age = 24 * 60 * 60
+
+    def __init__(self, directory, *, chunk_size=None, max_size=None,
+                 tmp_max_age=None):
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if max_size is not None:
+            self.max_size = max_size
+        if tmp_max_age is not None:
+            self.tmp_max_age = tmp_max_age
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.hits = 0
+        self.misses = 0
+        self._digests = {}
+        self._files = collections.OrderedDict()
+        self._size = 0
+        self._scan()
+
+    def __contains__(self, digest):
+        return digest_filename(digest) in self._files
+
+    def __len__(self):
+        return len(self._files)
+
+    @property
+    def size(self):
+        """Total size of cached files in bytes."""
+        return self._size
+
+    @asyncio.coroutine
+    def get(self, attachment, rev=None, *, auth=None, digest=None):
+        """Returns reader of the attachment content, either cached or
+        the one which caches the content while it's been read.
+
+        :param attachment: :class:`~aiocouchdb.v1.attachment.Attachment`
+        :param str rev: Document revision
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+        :param str digest: Attachment digest in ``md5-<base64>`` form,
+                           if it's known, e.g. from document stub
+
+        :rtype: :class:`CachedAttachmentReader` or
+                :class:`CachingAttachmentReader`
+        """
+        key = (attachment.resource.url, rev)
+        if digest is None:
+            digest = self._digests.get(key)
+        if digest is not None and digest in self:
+            fresh = rev is not None
+            if not fresh:
+                try:
+                    fresh = not (yield from attachment.modified(digest,
+                                                                auth=auth))
+                except ResourceNotFound:
+                    self._digests.pop(key, None)
+                    raise
+            if fresh:
+                self._digests[key] = digest
+                reader = self.open(digest)
+                if reader is not None:
+                    self.hits += 1
+                    return reader
+
+        self.misses += 1
+        reader = yield from attachment.get(rev, auth=auth)
+        digest = etag_digest(reader.headers.get(ETAG))
+        if digest is None:
+            return reader
+        self._digests[key] = digest
+        return CachingAttachmentReader(
+            reader, self, digest,
+            verify=CONTENT_ENCODING not in reader.headers)
+
+    def open(self, digest):
+        """Opens cached file for the digest.
+
+        :param str digest: Attachment digest in ``md5-<base64>`` form
+
+        :returns: Reader or ``None`` if file is not cached
+        :rtype: :class:`CachedAttachmentReader`
+        """
+        name = digest_filename(digest)
+        path = os.path.join(self.directory, name)
+        try:
+            fileobj = open(path, 'rb')
+        except FileNotFoundError:
+            self._discard(name)
+            return None
+        if name in self._files:
+            self._files.move_to_end(name)
+            os.utime(path)
+        return CachedAttachmentReader(fileobj, digest,
+                                      chunk_size=self.chunk_size)
+
+    def clear(self):
+        """Removes all cached files."""
+        for name in list(self._files):
+            self._remove(name)
+        self._digests.clear()
+
+    def _scan(self):
+        entries = []
+        now = time.time()
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+                if name.endswith('.tmp'):
+                    # fresh one may be written by another cache instance
+                    if now - stat.st_mtime > self.tmp_max_age:
+                        os.unlink(path)
+                    continue
+            except FileNotFoundError:
+                # moved or removed by another cache instance meanwhile
+                continue
+            entries.append((stat.st_mtime, name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self._files[name] = size
+            self._size += size
+        self._evict()
+
+    def _store(self, tmp_path, digest):
+        name = digest_filename(digest)
+        os.replace(tmp_path, os.path.join(self.directory, name))
+        self._discard(name)
+        size = os.stat(os.path.join(self.directory, name)).st_size
+        self._files[name] = size
+        self._size += size
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_size and self._files:
+            self._remove(next(iter(self._files)))
+
+    def _remove(self, name):
+        self._discard(name)
+        try:
+            os.unlink(os.path.join(self.directory, name))
+        except FileNotFoundError:
+            pass
+
+    def _discard(self, name):
+        self._size -= self._files.pop(name, 0)
+
+
+class CachedAttachmentReader(object):
+    """Reader of cached attachment content. The file is memory mapped, so
+    the content is available as :attr:`buffer` without copying it. Note,
+    that :meth:`read` and ``async for`` iteration return copies of the
+    content as :class:`bytes`.
+
+    Slices of :attr:`buffer` taken by the caller should be released before
+    the reader is closed, otherwise the mapping stays open till the last of
+    them is gone."""
+
+    def __init__(self, fileobj, digest, *, chunk_size=65536):
+        self._fileobj = fileobj
+        self._mmap = None
+        #: Attachment digest
+        self.digest = digest
+        #: Size of chunks emitted on ``async for`` iteration
+        self.chunk_size = chunk_size
+        if os.fstat(fileobj.fileno()).st_size:
+            self._mmap = mmap.mmap(fileobj.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            #: :class:`memoryview` of the attachment content
+            self.buffer = memoryview(self._mmap)
+        else:
+            self.buffer = memoryview(b'')
+        self._position = 0
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        chunk = yield from self.read(self.chunk_size)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    @property
+    def closed(self):
+        """Return a bool indicating whether object is closed."""
+        return self._fileobj.closed
+
+    @asyncio.coroutine
+    def read(self, size=-1):
+        """Read and return up to ``size`` bytes. Returns an empty bytes
+        object on EOF."""
+        start = self._position
+        if size is None or size < 0:
+            stop = len(self.buffer)
+        else:
+            stop = min(start + size, len(self.buffer))
+        self._position = stop
+        return self.buffer[start:stop].tobytes()
+
+    def close(self):
+        """Closes the reader."""
+        if self.closed:
+            return
+        self.buffer.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # still exported, gets closed with the last buffer
+                pass
+        self._fileobj.close()
+
+
+class CachingAttachmentReader(object):
+    """Reader of attachment content which isn't cached yet. The content is
+    written into temporary file of the cache while it's been read and the
+    file gets cached once the reader reaches EOF and the content matches
+    attachment digest."""
+
+    def __init__(self, reader, cache, digest, *, verify=True):
+        self._reader = reader
+        self._cache = cache
+        self._md5 = hashlib.md5() if verify else None
+        fd, self._tmp_path = tempfile.mkstemp(suffix='.tmp',
+                                              dir=cache.directory)
+        self._fileobj = os.fdopen(fd, 'wb')
+        #: Attachment digest
+        self.digest = digest
+        #: Size of chunks emitted on ``async for`` iteration
+        self.chunk_size = cache.chunk_size
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        chunk = yield from self.read(self.chunk_size)
+        if not chunk:
+            raise StopAsyncIteration
+        return chunk
+
+    @property
+    def closed(self):
+        """Return a bool indicating whether object is closed."""
+        return self._fileobj.closed
+
+    @asyncio.coroutine
+    def read(self, size=-1):
+        """Read and return up to ``size`` bytes. Returns an empty bytes
+        object on EOF."""
+        if self.closed:
+            return (yield from self._reader.read(size))
+        try:
+            chunk = yield from self._reader.read(size)
+            if chunk:
+                self._fileobj.write(chunk)
+                if self._md5 is not None:
+                    self._md5.update(chunk)
+            if not chunk or size is None or size < 0:
+                self._complete()
+        except BaseException:
+            self.close()
+            raise
+        return chunk
+
+    def close(self):
+        """Closes the reader. Content which wasn't read till the end is not
+        cached."""
+        self._reader.close()
+        if not self.closed:
+            self._fileobj.close()
+            os.unlink(self._tmp_path)
+
+    def _complete(self):
+        self._fileobj.close()
+        if self._md5 is not None:
+            if format_digest(self._md5) != self.digest:
+                os.unlink(self._tmp_path)
+                return
+        self._cache._store(self._tmp_path, self.digest)
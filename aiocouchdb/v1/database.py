@@ -8,16 +8,23 @@
 #
 
 import asyncio
+import collections
 import json
 import uuid
 
 from aiocouchdb.client import Resource
+from aiocouchdb.errors import (
+    HttpErrorException, Forbidden, ResourceConflict, ResourceNotFound,
+    Unauthorized
+)
 from aiocouchdb.feeds import (
     ChangesFeed, LongPollChangesFeed,
-    ContinuousChangesFeed, EventSourceChangesFeed
+    ContinuousChangesFeed, EventSourceChangesFeed,
+    FilteredChangesFeed, PrefetchChangesFeed
 )
 from aiocouchdb.views import View
 
+from . import backup
 from .document import Document
 from .designdoc import DesignDocument
 from .security import DatabaseSecurity
@@ -28,6 +35,16 @@ __all__ = (
 )
 
 
+def deleted_doc(event):
+    """Returns document stub for the deleted document changes event, like
+    CouchDB emits for them with ``include_docs``, or ``None`` for others."""
+    if not event.get('deleted'):
+        return None
+    return {'_id': event['id'],
+            '_rev': event['changes'][0]['rev'],
+            '_deleted': True}
+
+
 class Database(object):
     """Implementation of :ref:`CouchDB Database API <api/db>`."""
 
@@ -295,6 +312,9 @@ class Database(object):
     def changes(self, *doc_ids,
                 auth=None,
                 feed_buffer_size=None,
+                prefetch_docs=None,
+                prefetch_batch_size=None,
+                prefetch_concurrency=None,
                 att_encoding_info=None,
                 attachments=None,
                 conflicts=None,
@@ -320,6 +340,16 @@ class Database(object):
 
         :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
         :param int feed_buffer_size: Internal buffer size for fetched feed items
+        :param prefetch_docs: Fetches the documents of emitted events
+                              concurrently with separate requests instead of
+                              ``include_docs``, so the feed stays lightweight.
+                              ``True`` or ``"all_docs"`` fetches them in
+                              batches via :meth:`all_docs`, ``"get"`` requests
+                              each document on its own
+        :param int prefetch_batch_size: Max amount of documents to fetch
+                                        with a single :meth:`all_docs` request
+        :param int prefetch_concurrency: Max amount of concurrent requests
+                                         to fetch the documents
 
         :param bool att_encoding_info: Includes encoding information in an
                                        attachment stubs
@@ -346,13 +376,32 @@ class Database(object):
         :param str view: View function name which would be used as filter.
                          Implicitly sets ``filter`` param to ``_view`` value
 
-        :rtype: :class:`aiocouchdb.feeds.ChangesFeed`
+        :rtype: :class:`aiocouchdb.feeds.ChangesFeed` or
+                :class:`aiocouchdb.feeds.PrefetchChangesFeed` if
+                ``prefetch_docs`` is set
         """
+        if prefetch_docs is True:
+            prefetch_docs = 'all_docs'
+        if prefetch_docs not in {None, False, 'all_docs', 'get'}:
+            raise ValueError('unsupported prefetch_docs value: {!r}'
+                             ''.format(prefetch_docs))
+        if prefetch_docs and include_docs:
+            raise ValueError('prefetch_docs conflicts with include_docs')
+
         params = dict(params or {})
         params.update((key, value)
                       for key, value in locals().items()
                       if key not in {'self', 'doc_ids', 'auth', 'headers',
-                                     'params'} and value is not None)
+                                     'params', 'prefetch_docs',
+                                     'prefetch_batch_size',
+                                     'prefetch_concurrency'} and
+                      value is not None)
+        if prefetch_docs:
+            # documents options are applied to the prefetch requests
+            doc_options = {key: params.pop(key)
+                           for key in ('att_encoding_info', 'attachments',
+                                       'conflicts')
+                           if key in params}
 
         if doc_ids:
             data = {'doc_ids': doc_ids}
@@ -376,13 +425,127 @@ class Database(object):
         yield from resp.maybe_raise_error()
 
         if feed == 'continuous':
-            return ContinuousChangesFeed(resp, buffer_size=feed_buffer_size)
+            changes = ContinuousChangesFeed(resp, buffer_size=feed_buffer_size)
         elif feed == 'eventsource':
-            return EventSourceChangesFeed(resp, buffer_size=feed_buffer_size)
+            changes = EventSourceChangesFeed(resp,
+                                             buffer_size=feed_buffer_size)
         elif feed == 'longpoll':
-            return LongPollChangesFeed(resp, buffer_size=feed_buffer_size)
+            changes = LongPollChangesFeed(resp, buffer_size=feed_buffer_size)
         else:
-            return ChangesFeed(resp, buffer_size=feed_buffer_size)
+            changes = ChangesFeed(resp, buffer_size=feed_buffer_size)
+
+        if not prefetch_docs:
+            return changes
+
+        if prefetch_docs == 'get':
+            # single document per request, so concurrency caps them all
+            prefetch_batch_size = 1
+            fetch = self._fetch_docs_get
+        else:
+            fetch = self._fetch_docs_all_docs
+
+        @asyncio.coroutine
+        def fetch_docs(events):
+            return (yield from fetch(events, auth=auth, **doc_options))
+
+        return PrefetchChangesFeed(changes, fetch_docs,
+                                   batch_size=prefetch_batch_size,
+                                   concurrency=prefetch_concurrency)
+
+    @asyncio.coroutine
+    def _fetch_docs_all_docs(self, events, *, auth=None, **options):
+        docids = list(collections.OrderedDict.fromkeys(
+            event['id'] for event in events))
+        docs = {}
+        feed = yield from self.all_docs(*docids, auth=auth,
+                                        include_docs=True, **options)
+        with feed:
+            while True:
+                row = yield from feed.next()
+                if row is None:
+                    break
+                if row.get('doc') is not None:
+                    docs[row['id']] = row['doc']
+        return [docs.get(event['id'], deleted_doc(event)) for event in events]
+
+    @asyncio.coroutine
+    def _fetch_docs_get(self, events, *, auth=None, **options):
+        docs = []
+        for event in events:
+            try:
+                doc = yield from self[event['id']].get(auth=auth, **options)
+            except ResourceNotFound:
+                doc = deleted_doc(event)
+            docs.append(doc)
+        return docs
+
+    @asyncio.coroutine
+    def filtered_changes(self, predicate, *,
+                         auth=None,
+                         language='javascript',
+                         pushdown=True,
+                         **options):
+        """Emits database changes events which match the declarative
+        predicate.
+
+        Predicate is compiled into filter function of an auto-managed design
+        document, which ID is derived from the function code, so the design
+        document is created only on the first use of the predicate and
+        the server sends only the matched events. If the predicate couldn't
+        be applied on the server side, e.g. user is not allowed to create
+        design documents or the server doesn't support the filter language,
+        all the events are requested with the documents and filtered by
+        client.
+
+        :param predicate: :class:`aiocouchdb.filters.Predicate` instance
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+        :param str language: Filter function language: ``javascript`` or
+                             ``python``
+        :param bool pushdown: Set to ``False`` to filter events by client
+        :param options: Other :meth:`changes` arguments except ``doc_ids``,
+                        ``filter`` and ``view``
+
+        :rtype: :class:`aiocouchdb.feeds.ChangesFeed` if predicate is applied
+                by server or :class:`aiocouchdb.feeds.FilteredChangesFeed`
+        """
+        if 'filter' in options or 'view' in options:
+            raise ValueError('predicate conflicts with filter and view')
+        if pushdown:
+            ddoc_id, ddoc = predicate.design_doc(language)
+            name = ddoc_id.split('/', 1)[1] + '/match'
+            try:
+                return (yield from self._pushdown_changes(
+                    name, ddoc_id, ddoc, auth=auth, **options))
+            except (Unauthorized, Forbidden):
+                # not allowed to create design documents
+                pass
+            except ResourceNotFound:
+                raise
+            except HttpErrorException:
+                # server failed to apply the filter
+                pass
+
+        include_docs = options.pop('include_docs', None)
+        fetch_docs = predicate.needs_doc and not options.get('prefetch_docs')
+        feed = yield from self.changes(auth=auth,
+                                       include_docs=include_docs or fetch_docs,
+                                       **options)
+        return FilteredChangesFeed(feed, predicate,
+                                   strip_docs=fetch_docs and not include_docs)
+
+    @asyncio.coroutine
+    def _pushdown_changes(self, name, ddoc_id, ddoc, *, auth=None, **options):
+        try:
+            return (yield from self.changes(auth=auth, filter=name, **options))
+        except ResourceNotFound:
+            # design document is missing, while the database could be too
+            pass
+        try:
+            yield from self[ddoc_id].doc.update(ddoc, auth=auth)
+        except ResourceConflict:
+            # created concurrently
+            pass
+        return (yield from self.changes(auth=auth, filter=name, **options))
 
     @asyncio.coroutine
     def compact(self, ddoc_name=None, *, auth=None):
@@ -402,6 +565,39 @@ class Database(object):
         yield from resp.maybe_raise_error()
         return (yield from resp.json())
 
+    @asyncio.coroutine
+    def dump(self, fileobj_or_path, *,
+             attachments=True,
+             auth=None,
+             compresslevel=6,
+             flush_every=1000,
+             loop=None,
+             ranges=1):
+        """Dumps database documents into gzip compressed newline delimited
+        JSON stream. See :func:`aiocouchdb.v1.backup.dump` for details.
+
+        :param fileobj_or_path: File path or binary file object to write to
+        :param bool attachments: Inline attachments content into documents.
+                                 Otherwise documents are dumped without
+                                 attachments and revision
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+        :param int compresslevel: Gzip compression level
+        :param int flush_every: Flushes compressed stream after each specified
+                                amount of documents
+        :param loop: Event loop instance
+        :param int ranges: Amount of key ranges to fetch concurrently
+
+        :returns: Amount of dumped documents
+        :rtype: int
+        """
+        return (yield from backup.dump(self, fileobj_or_path,
+                                       attachments=attachments,
+                                       auth=auth,
+                                       compresslevel=compresslevel,
+                                       flush_every=flush_every,
+                                       loop=loop,
+                                       ranges=ranges))
+
     @asyncio.coroutine
     def ensure_full_commit(self, *, auth=None):
         """Ensures that all bits are :ref:`committed on disk
@@ -447,6 +643,31 @@ class Database(object):
         yield from resp.maybe_raise_error()
         return (yield from resp.json())
 
+    @asyncio.coroutine
+    def restore(self, fileobj_or_path, *,
+                auth=None,
+                batch_size=500,
+                concurrency=4,
+                loop=None):
+        """Restores documents from the stream made by :meth:`dump` keeping
+        their revisions. See :func:`aiocouchdb.v1.backup.restore` for details.
+
+        :param fileobj_or_path: File path or binary file object to read from
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+        :param int batch_size: Amount of documents per bulk request
+        :param int concurrency: Amount of bulk requests in flight
+        :param loop: Event loop instance
+
+        :returns: Dict with amount of processed ``docs`` and list of
+                  ``errors`` reported for documents which were not stored
+        :rtype: dict
+        """
+        return (yield from backup.restore(self, fileobj_or_path,
+                                          auth=auth,
+                                          batch_size=batch_size,
+                                          concurrency=concurrency,
+                                          loop=loop))
+
     @asyncio.coroutine
     def revs_diff(self, id_revs, *, auth=None):
         """Returns :ref:`document revisions difference <api/db/revs_diff>`
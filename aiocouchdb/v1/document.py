@@ -10,11 +10,13 @@
 import asyncio
 import json
 import io
-import uuid
+import mmap
+import os
+import tempfile
 from collections.abc import MutableMapping
 
-from aiohttp.multidict import CIMultiDict
 from aiocouchdb.client import Resource
+from aiocouchdb.compat import StopAsyncIteration
 from aiocouchdb.hdrs import (
     ACCEPT,
     CONTENT_LENGTH,
@@ -23,9 +25,16 @@ from aiocouchdb.hdrs import (
     ETAG,
     IF_NONE_MATCH
 )
-from aiocouchdb.multipart import MultipartReader, MultipartWriter
+from aiocouchdb.multipart import (
+    EmptyMultipartReader,
+    FastMultipartReader,
+    MultipartReader,
+    MultipartResponseWrapper,
+    MultipartWriter,
+    SizedStream
+)
 
-from .attachment import Attachment
+from .attachment import Attachment, compute_digest
 
 
 __all__ = (
@@ -297,24 +306,6 @@ class Document(object):
             params=params)
 
         yield from resp.maybe_raise_error()
-
-        if resp.headers[CONTENT_TYPE].startswith('application/json'):
-            # WARNING! Here be Hacks!
-            # If document has no attachments, CouchDB returns it as JSON
-            # so we have to fake multipart response in the name of consistency.
-            # However, this hack may not lasts for too long.
-            data = yield from resp.read()
-            boundary = str(uuid.uuid4())
-            headers = dict(resp.headers.items())
-            headers[CONTENT_TYPE] = 'multipart/related;boundary=%s' % boundary
-            resp.headers = CIMultiDict(**headers)
-            resp.content._buffer.extend(
-                b'--' + boundary.encode('latin1') + b'\r\n'
-                b'Content-Type: application/json\r\n'
-                b'\r\n' + data.rstrip() + b'\r\n'
-                b'--' + boundary.encode('latin1') + b'--\r\n'
-            )
-
         return DocAttachmentsMultipartReader.from_response(resp)
 
     @asyncio.coroutine
@@ -322,6 +313,8 @@ class Document(object):
                atts=None,
                auth=None,
                batch=None,
+               dedup=False,
+               digest_index=None,
                new_edits=None,
                rev=None):
         """`Updates a document`_ on server.
@@ -332,10 +325,20 @@ class Document(object):
         :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
 
         :param dict atts: Attachments mapping where keys are represents
-                          attachment name and value is file-like object or
-                          bytes
+                          attachment name and value is bytes, file path,
+                          binary file object of known size or
+                          :class:`~aiocouchdb.multipart.SizedStream`.
+                          Attachments are streamed from their sources
+                          without loading them into memory
         :param str batch: Updates in batch mode (asynchronously)
                           This argument accepts only ``"ok"`` value.
+        :param bool dedup: Don't upload attachments which are already stored
+                           with the same MD5 digest: ones which digest matches
+                           document ``_attachments`` stub or which server
+                           reports as not modified. They are sent as stubs
+        :param digest_index: :class:`~aiocouchdb.v1.attachment.DigestIndex`
+                             instance to consult before asking server.
+                             Implies ``dedup``
         :param bool new_edits: Signs about new document edition. When ``False``
                                allows to create conflicts manually
         :param str rev: Document revision. Optional, since document ``_rev``
@@ -347,7 +350,8 @@ class Document(object):
         """
         params = dict((key, value)
                       for key, value in locals().items()
-                      if (key not in {'self', 'doc', 'auth', 'atts'} and
+                      if (key not in {'self', 'doc', 'auth', 'atts',
+                                      'dedup', 'digest_index'} and
                           value is not None))
 
         if not isinstance(doc, MutableMapping):
@@ -358,10 +362,23 @@ class Document(object):
                              '%r ; expected: %r. May be you want to .copy() it?'
                              % (doc['_id'], self.id))
 
-        if atts:
-            writer = MultipartWriter('related')
-            writer.append_json(doc)
+        digests = {}
+        if atts and (dedup or digest_index is not None):
+            atts = dict(atts)
+            stubs = doc.get('_attachments') or {}
+            for name, att in list(atts.items()):
+                digest = compute_digest(att)
+                if digest is None:
+                    continue
+                if (stubs.get(name, {}).get('digest') == digest or
+                        (yield from self[name].stored(
+                            digest, auth=auth, digest_index=digest_index))):
+                    doc.setdefault('_attachments', {})[name] = {'stub': True}
+                    del atts[name]
+                else:
+                    digests[name] = digest
 
+        if atts:
             doc.setdefault('_attachments', {})
 
             # A little hack to sync the order of attachments definition
@@ -369,40 +386,69 @@ class Document(object):
             for name in atts:
                 doc['_attachments'][name] = {}
 
-            for name, stub in doc['_attachments'].items():
-                if stub:
-                    continue
-                att = atts[name]
-                if not isinstance(att, (bytes, io.BytesIO, io.BufferedIOBase)):
-                    raise TypeError('attachment payload should be a source of'
-                                    ' binary data (bytes, BytesIO, file '
-                                    ' opened in binary mode), got %r' % att)
-                part = writer.append(att)
-                part.set_content_disposition('attachment', filename=name)
-                doc['_attachments'][name] = {
-                    'length': int(part.headers[CONTENT_LENGTH]),
-                    'follows': True,
-                    'content_type': part.headers[CONTENT_TYPE]
-                }
-
-            writer.parts[0].headers[CONTENT_LENGTH] = \
-                str(len(json.dumps(doc).encode('utf-8')))
-
-            # workaround of COUCHDB-2295
-            writer.headers[CONTENT_LENGTH] = str(writer.calc_content_length())
-
-            resp = yield from self.resource.put(auth=auth,
-                                                data=writer,
-                                                params=params)
+            writer = MultipartWriter('related')
+            parts = []
+            opened = []
+            try:
+                for name, stub in doc['_attachments'].items():
+                    if stub:
+                        continue
+                    att = atts[name]
+                    if isinstance(att, str):
+                        att = open(att, 'rb')
+                        opened.append(att)
+                    elif isinstance(att, (bytearray, memoryview)):
+                        att = bytes(att)
+                    if (not isinstance(att, (bytes, io.IOBase, SizedStream)) or
+                            isinstance(att, io.TextIOBase)):
+                        raise TypeError('attachment payload should be a source'
+                                        ' of binary data (bytes, file path,'
+                                        ' file opened in binary mode or'
+                                        ' SizedStream), got %r' % att)
+                    part = writer.part_writer_cls(att)
+                    if CONTENT_LENGTH not in part.headers:
+                        raise ValueError('unable to determine length of %r'
+                                         ' attachment payload, wrap it with'
+                                         ' SizedStream' % name)
+                    part.headers.setdefault(CONTENT_TYPE,
+                                            'application/octet-stream')
+                    part.set_content_disposition('attachment', filename=name)
+                    parts.append(part)
+                    doc['_attachments'][name] = {
+                        'length': int(part.headers[CONTENT_LENGTH]),
+                        'follows': True,
+                        'content_type': part.headers[CONTENT_TYPE]
+                    }
+
+                # document is serialized once: its length is needed for
+                # the Content-Length header anyway
+                writer.append(json.dumps(doc).encode('utf-8'),
+                              {CONTENT_TYPE: 'application/json'})
+                for part in parts:
+                    writer.append(part)
+
+                # workaround of COUCHDB-2295
+                writer.headers[CONTENT_LENGTH] = str(
+                    writer.calc_content_length())
+
+                resp = yield from self.resource.put(auth=auth,
+                                                    data=writer,
+                                                    params=params)
+            finally:
+                for fileobj in opened:
+                    fileobj.close()
 
             for info in doc['_attachments'].values():
-                info.pop('follows')
+                info.pop('follows', None)
                 info['stub'] = True
         else:
             resp = yield from self.resource.put(auth=auth,
                                                 data=doc,
                                                 params=params)
         yield from resp.maybe_raise_error()
+        if digest_index is not None:
+            for name, digest in digests.items():
+                digest_index.add(self[name], digest)
         return (yield from resp.json())
 
     @asyncio.coroutine
@@ -460,9 +506,52 @@ class Document(object):
         return (yield from resp.json())
 
 
-class DocAttachmentsMultipartReader(MultipartReader):
+class DocAttachmentsMultipartReader(object):
     """Special multipart reader optimized for requesting single document with
-    attachments. Matches output with :class:`OpenRevsMultipartReader`."""
+    attachments. Matches output with :class:`OpenRevsMultipartReader`.
+
+    The :mimetype:`multipart/related` response is parsed by
+    :class:`~aiocouchdb.multipart.FastMultipartReader`, attachments are
+    emitted as :class:`~aiocouchdb.multipart.FastBodyPartReader` parts.
+    Document without attachments which CouchDB returns as plain JSON is
+    emitted with :class:`~aiocouchdb.multipart.EmptyMultipartReader`.
+
+    On Python 3.5+ it could be iterated with ``async for`` statement which
+    emits the same tuples as :meth:`next` does."""
+
+    multipart_reader_cls = FastMultipartReader
+    response_wrapper_cls = MultipartResponseWrapper
+
+    def __init__(self, headers, content):
+        self.headers = headers
+        self._content = content
+        self._atts = None
+        self._at_eof = False
+
+    @classmethod
+    def from_response(cls, response):
+        """Constructs reader instance from HTTP response.
+
+        :param response: :class:`~aiocouchdb.client.HttpResponse` instance
+        """
+        return cls.response_wrapper_cls(response, cls(response.headers,
+                                                      response.content))
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        doc, atts = yield from self.next()
+        if doc is None:
+            raise StopAsyncIteration
+        return doc, atts
+
+    def at_eof(self):
+        """Returns ``True`` if the whole response was read."""
+        if self._atts is not None:
+            return self._atts.at_eof()
+        return self._at_eof
 
     @asyncio.coroutine
     def next(self):
@@ -471,31 +560,69 @@ class DocAttachmentsMultipartReader(MultipartReader):
 
         :rtype: tuple
         """
-        # WARNING! Here be Hacks!
-        part = self._last_part
-        if part is not None and part.at_eof():
-            self._at_eof = True
+        if self._atts is not None:
+            yield from self._atts.release()
+        if self.at_eof():
+            return None, None
 
-        reader = yield from super().next()
+        if self.headers.get(CONTENT_TYPE, '').startswith('application/json'):
+            data = yield from self._content.read()
+            self._at_eof = True
+            return json.loads(data.decode('utf-8')), EmptyMultipartReader()
 
-        if self._at_eof:
+        self._atts = self.multipart_reader_cls(self.headers, self._content)
+        part = yield from self._atts.next()
+        if part is None:
             return None, None
+        doc = yield from part.json()
+        return doc, self._atts
 
-        attsreader = MultipartReader(self.headers,
-                                     self.content)  # pylint: disable=no-member
-        self._last_part = attsreader
-        attsreader._unread = reader._unread
+    @asyncio.coroutine
+    def release(self):
+        """Reads all the response to the void."""
+        while not self.at_eof():
+            yield from self.next()
 
-        doc = yield from reader.json()
 
-        return doc, attsreader
+class OpenRevsResponseWrapper(MultipartResponseWrapper):
+    """Response wrapper of :class:`OpenRevsMultipartReader`."""
+
+    @asyncio.coroutine
+    def spool(self, *, directory=None, threshold=None):
+        """Reads all the revisions with :meth:`OpenRevsMultipartReader.spool`
+        and releases the response.
+
+        :rtype: :class:`SpooledRevisions`
+        """
+        try:
+            return (yield from self.stream.spool(directory=directory,
+                                                 threshold=threshold))
+        finally:
+            yield from self.release()
 
 
 class OpenRevsMultipartReader(MultipartReader):
     """Special multipart reader optimized for reading document`s open revisions
-    with attachments."""
+    with attachments.
+
+    On Python 3.5+ it could be iterated with ``async for`` statement which
+    emits the same tuples as :meth:`next` does."""
 
     multipart_reader_cls = MultipartReader
+    response_wrapper_cls = OpenRevsResponseWrapper
+
+    #: Attachments bigger than this amount of bytes are spooled by
+    #: :meth:`spool` to temporary file instead of been kept in memory
+    spool_threshold = 64 * 1024
+    #: Size of chunks to read attachments by
+    chunk_size = 65536
+
+    @asyncio.coroutine
+    def __anext__(self):
+        doc, atts = yield from self.next()
+        if doc is None:
+            raise StopAsyncIteration
+        return doc, atts
 
     @asyncio.coroutine
     def next(self):
@@ -516,3 +643,177 @@ class OpenRevsMultipartReader(MultipartReader):
             doc = yield from reader.json()
 
         return doc, reader
+
+    @asyncio.coroutine
+    def spool(self, *, directory=None, threshold=None):
+        """Reads all the revisions with their attachments, so they could be
+        accessed in any order after. Attachments bigger than ``threshold``
+        are written to single temporary file, which gets memory mapped, so
+        memory usage stays bounded regardless amount of conflicts.
+
+        :param str directory: Directory to create temporary file in
+        :param int threshold: Attachments size to spool to disk, bytes.
+                              Default is :attr:`spool_threshold`
+
+        :rtype: :class:`SpooledRevisions`
+        """
+        if threshold is None:
+            threshold = self.spool_threshold
+        revisions = SpooledRevisions(directory=directory)
+        try:
+            while True:
+                doc, reader = yield from self.next()
+                if doc is None:
+                    break
+                atts = {}
+                if isinstance(reader, self.multipart_reader_cls):
+                    while True:
+                        part = yield from reader.next()
+                        if part is None:
+                            break
+                        atts[part.filename] = yield from revisions._spool(
+                            part, threshold, self.chunk_size)
+                revisions._docs.append((doc, atts))
+            revisions._complete()
+        except BaseException:
+            revisions.close()
+            raise
+        return revisions
+
+
+class SpooledRevisions(object):
+    """Sequence of ``(doc, atts)`` tuples of document open revisions read by
+    :meth:`OpenRevsMultipartReader.spool`, where ``atts`` is a :class:`dict`
+    of attachments names and :class:`SpooledAttachment` handles.
+
+    Should be closed once it's not needed to remove the temporary file.
+    Could be used as context manager for that.
+    """
+
+    def __init__(self, *, directory=None):
+        self._directory = directory
+        self._docs = []
+        self._fileobj = None
+        self._mmap = None
+        self._buffer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getitem__(self, index):
+        return self._docs[index]
+
+    def __iter__(self):
+        return iter(self._docs)
+
+    def __len__(self):
+        return len(self._docs)
+
+    @property
+    def spooled_size(self):
+        """Amount of bytes written to temporary file."""
+        if self._fileobj is None or self._fileobj.closed:
+            return 0
+        return os.fstat(self._fileobj.fileno()).st_size
+
+    def close(self):
+        """Closes and removes temporary file. Buffers of spooled attachments
+        should be released before."""
+        if self._buffer is not None:
+            self._buffer.release()
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError:
+                # still exported, gets closed with the last buffer
+                pass
+        if self._fileobj is not None:
+            self._fileobj.close()
+
+    @asyncio.coroutine
+    def _spool(self, part, threshold, chunk_size):
+        data = bytearray()
+        offset = None
+        while True:
+            chunk = yield from part.read_chunk(chunk_size)
+            if not chunk:
+                break
+            if offset is None and len(data) + len(chunk) <= threshold:
+                data.extend(chunk)
+                continue
+            if offset is None:
+                if self._fileobj is None:
+                    self._fileobj = tempfile.TemporaryFile(
+                        dir=self._directory)
+                offset = self._fileobj.tell()
+                self._fileobj.write(data)
+                data = None
+            self._fileobj.write(chunk)
+        if offset is None:
+            return SpooledAttachment(self, part.headers, bytes(data))
+        return SpooledAttachment(self, part.headers, None, offset,
+                                 self._fileobj.tell() - offset)
+
+    def _complete(self):
+        if self._fileobj is None:
+            return
+        self._fileobj.flush()
+        if self._fileobj.tell():
+            self._mmap = mmap.mmap(self._fileobj.fileno(), 0,
+                                   access=mmap.ACCESS_READ)
+            self._buffer = memoryview(self._mmap)
+
+    def _slice(self, offset, size):
+        return self._buffer[offset:offset + size]
+
+
+class SpooledAttachment(object):
+    """Lightweight handle of spooled attachment content, either kept in
+    memory or in memory mapped temporary file. The content is raw, as it
+    was received: check :attr:`headers` for `Content-Encoding`."""
+
+    __slots__ = ('headers', '_data', '_offset', '_revisions', 'size')
+
+    def __init__(self, revisions, headers, data, offset=None, size=None):
+        #: Attachment part headers
+        self.headers = headers
+        #: Content size
+        self.size = len(data) if data is not None else size
+        self._data = data
+        self._offset = offset
+        self._revisions = revisions
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def content_type(self):
+        """Attachment content type."""
+        return self.headers.get(CONTENT_TYPE)
+
+    @property
+    def spooled(self):
+        """Whenever the content is stored in temporary file."""
+        return self._data is None
+
+    def getbuffer(self):
+        """Returns :class:`memoryview` of the content without copying it.
+
+        :rtype: memoryview
+        """
+        if self._data is not None:
+            return memoryview(self._data)
+        return self._revisions._slice(self._offset, self.size)
+
+    def read(self):
+        """Returns the content.
+
+        :rtype: bytes
+        """
+        if self._data is not None:
+            return self._data
+        with self.getbuffer() as buffer:
+            return buffer.tobytes()
@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""In-memory CouchDB 1.x emulator for offline tests::
+
+    emulator = Emulator(loop=loop)
+    url = yield from emulator.start()
+    server = aiocouchdb.v1.Server(url, loop=loop)
+    ...
+    yield from emulator.stop()
+"""
+
+from .server import Emulator
+from .storage import CouchError, Database
+from .views import ViewIndex, collate, compile_function
+
+
+__all__ = (
+    'CouchError',
+    'Database',
+    'Emulator',
+    'ViewIndex',
+    'collate',
+    'compile_function',
+)
@@ -0,0 +1,962 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import functools
+import json
+import socket
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+
+from aiohttp import web
+from aiohttp.multipart import MultipartReader
+
+from .storage import CouchError, Database, bad_request, conflict, not_found
+from .views import compile_function
+
+
+__all__ = (
+    'Emulator',
+)
+
+
+def handler(func):
+    """Wraps request handler to count requests and to report
+    :exc:`~aiocouchdb.v1.emulator.storage.CouchError` as JSON response."""
+    func = asyncio.coroutine(func)
+
+    @functools.wraps(func)
+    @asyncio.coroutine
+    def wrapper(self, request):
+        self.stats[request.method] += 1
+        try:
+            resp = yield from func(self, request)
+        except CouchError as err:
+            resp = self.json_response({'error': err.error,
+                                       'reason': err.reason},
+                                      status=err.status)
+        except ValueError as err:
+            resp = self.json_response({'error': 'bad_request',
+                                       'reason': str(err)},
+                                      status=400)
+        if request.method == 'HEAD' and isinstance(resp, web.Response):
+            # responses to HEAD requests must not have any body, but should
+            # report the same content length as GET does
+            length = resp.content_length
+            resp.body = b''
+            resp.content_length = length
+        self.stats[resp.status] += 1
+        return resp
+    return wrapper
+
+
+def param_json(request, *names, default=...):
+    for name in names:
+        if name in request.GET:
+            try:
+                return json.loads(request.GET[name])
+            except ValueError:
+                raise CouchError(400, 'query_parse_error',
+                                 'Invalid JSON for {} parameter'.format(name))
+    return default
+
+
+def param_bool(request, name, default=False):
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    if value not in {'true', 'false'}:
+        raise CouchError(400, 'query_parse_error',
+                         'Invalid boolean parameter: {}={}'
+                         ''.format(name, value))
+    return value == 'true'
+
+
+def param_int(request, name, default=None):
+    value = request.GET.get(name)
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        raise CouchError(400, 'query_parse_error',
+                         'Invalid integer parameter: {}={}'
+                         ''.format(name, value))
+
+
+def doc_options(request):
+    meta = param_bool(request, 'meta')
+    atts_since = param_json(request, 'atts_since', default=None)
+    return {
+        'attachments': param_bool(request, 'attachments') or bool(atts_since),
+        'att_encoding_info': param_bool(request, 'att_encoding_info'),
+        'atts_since': atts_since,
+        'conflicts': param_bool(request, 'conflicts') or meta,
+        'deleted_conflicts': param_bool(request, 'deleted_conflicts') or meta,
+        'local_seq': param_bool(request, 'local_seq'),
+        'revs': param_bool(request, 'revs'),
+        'revs_info': param_bool(request, 'revs_info') or meta,
+    }
+
+
+def etag(value):
+    return '"{}"'.format(value)
+
+
+def gzip_encode(data):
+    # unlike gzip.compress() output doesn't depend on the current time
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class Emulator(object):
+    """In-memory CouchDB 1.x server emulator which runs within the current
+    event loop on the local port.
+
+    It keeps all the data in memory and implements the API surface this
+    library is built around: databases, documents with revisions tree and
+    conflicts, attachments with ranged requests, local documents,
+    security objects, changes feeds of all types and design documents views
+    with map and reduce functions written in Python.
+
+    Python design functions follow `couchdb-python`_ view server conventions:
+    map functions are generators which ``yield key, value`` pairs, reduce
+    functions accept ``keys, values, rereduce`` arguments, changes filters
+    accept ``doc, req`` and return boolean value. The ``_count``, ``_sum``
+    and ``_stats`` built-in reducers are supported as well.
+
+    .. _couchdb-python: https://pythonhosted.org/CouchDB/views.html
+
+    :param int chunk_rows: Amount of rows written at once for views and
+                           changes feed responses
+    :param str version: Reported CouchDB version
+    """
+
+    #: Amount of rows written at once for views and changes feed responses
+    chunk_rows = 100
+    #: Default changes feed timeout in milliseconds
+    changes_timeout = 60000
+    #: Reported CouchDB version
+    version = '1.6.1'
+
+    def __init__(self, *, chunk_rows=None, loop=None, version=None):
+        if chunk_rows is not None:
+            self.chunk_rows = chunk_rows
+        if version is not None:
+            self.version = version
+        self._loop = loop or asyncio.get_event_loop()
+        self._server = None
+        self._handler = None
+        self.url = None
+        self.uuid = uuid.uuid4().hex
+        self.dbs = {}
+        self.stats = Counter()
+
+        self.app = web.Application(loop=self._loop)
+        route = self.app.router.add_route
+        route('GET', '/', self.handle_welcome)
+        route('GET', '/_all_dbs', self.handle_all_dbs)
+        route('GET', '/_active_tasks', self.handle_active_tasks)
+        route('*', '/_session', self.handle_session)
+        route('GET', '/_stats', self.handle_stats)
+        route('GET', '/_uuids', self.handle_uuids)
+        route('*', '/{db}', self.handle_db)
+        route('*', '/{db}/_all_docs', self.handle_all_docs)
+        route('POST', '/{db}/_bulk_docs', self.handle_bulk_docs)
+        route('*', '/{db}/_changes', self.handle_changes)
+        route('POST', '/{db}/_compact', self.handle_compact)
+        route('POST', '/{db}/_compact/{ddoc}', self.handle_compact)
+        route('POST', '/{db}/_ensure_full_commit',
+              self.handle_ensure_full_commit)
+        route('POST', '/{db}/_missing_revs', self.handle_missing_revs)
+        route('POST', '/{db}/_revs_diff', self.handle_revs_diff)
+        route('*', '/{db}/_revs_limit', self.handle_revs_limit)
+        route('*', '/{db}/_security', self.handle_security)
+        route('POST', '/{db}/_view_cleanup', self.handle_compact)
+        route('*', '/{db}/_local/{docid}', self.handle_local_doc)
+        route('GET', '/{db}/_design/{ddoc}/_info', self.handle_ddoc_info)
+        route('*', '/{db}/_design/{ddoc}/_view/{view}', self.handle_view)
+        route('*', '/{db}/_design/{ddoc}/{attname:.+}', self.handle_att)
+        route('*', '/{db}/_design/{ddoc}', self.handle_doc)
+        route('*', '/{db}/{docid}', self.handle_doc)
+        route('*', '/{db}/{docid}/{attname:.+}', self.handle_att)
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=0):
+        """Starts the server.
+
+        :param str host: Host to bind
+        :param int port: Port to bind. Random free one by default
+
+        :returns: Server URL
+        :rtype: str
+        """
+        self._handler = self.app.make_handler()
+        self._server = yield from self._loop.create_server(
+            self._handler, host, port, family=socket.AF_INET)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        self.url = 'http://{}:{}'.format(host, port)
+        return self.url
+
+    @asyncio.coroutine
+    def stop(self):
+        """Stops the server."""
+        if self._server is None:
+            return
+        yield from self._handler.finish_connections(1.0)
+        self._server.close()
+        yield from self._server.wait_closed()
+        yield from self.app.finish()
+        self._server = None
+
+    def database(self, request):
+        """Returns database the request is addressed to.
+
+        :rtype: :class:`~aiocouchdb.v1.emulator.storage.Database`
+        """
+        db = self.dbs.get(request.match_info['db'])
+        if db is None:
+            raise not_found('no_db_file')
+        return db
+
+    def json_response(self, obj, status=200, headers=None):
+        headers = dict(headers or {})
+        headers['CONTENT-TYPE'] = 'application/json'
+        return web.Response(body=(json.dumps(obj) + '\n').encode(),
+                            status=status,
+                            headers=headers)
+
+    def stream_response(self, request, content_type='application/json',
+                        headers=None):
+        headers = dict(headers or {})
+        headers['CONTENT-TYPE'] = content_type
+        resp = web.StreamResponse(headers=headers)
+        resp.enable_chunked_encoding()
+        resp.start(request)
+        return resp
+
+    @asyncio.coroutine
+    def read_json(self, request):
+        data = yield from request.read()
+        if not data:
+            return None
+        try:
+            return json.loads(data.decode('utf-8'),
+                              object_pairs_hook=OrderedDict)
+        except ValueError:
+            raise bad_request('invalid UTF-8 JSON')
+
+    @asyncio.coroutine
+    def write_rows(self, resp, rows, sep):
+        for idx in range(0, len(rows), self.chunk_rows):
+            chunk = sep.join(rows[idx:idx + self.chunk_rows])
+            if idx:
+                # CouchDB puts separator between rows, not after each one
+                chunk = sep + chunk
+            resp.write(chunk.encode())
+            yield from resp.drain()
+
+    # Server
+
+    @handler
+    def handle_welcome(self, request):
+        return self.json_response({'couchdb': 'Welcome',
+                                   'uuid': self.uuid,
+                                   'version': self.version,
+                                   'vendor': {'name': 'aiocouchdb emulator',
+                                              'version': self.version}})
+
+    @handler
+    def handle_all_dbs(self, request):
+        return self.json_response(sorted(self.dbs))
+
+    @handler
+    def handle_active_tasks(self, request):
+        return self.json_response([])
+
+    @handler
+    def handle_session(self, request):
+        if request.method == 'DELETE':
+            return self.json_response({'ok': True})
+        if request.method == 'POST':
+            return self.json_response({'ok': True, 'name': None,
+                                       'roles': ['_admin']})
+        return self.json_response({
+            'ok': True,
+            'userCtx': {'name': None, 'roles': ['_admin']},
+            'info': {'authentication_db': '_users',
+                     'authentication_handlers': ['default']}})
+
+    @handler
+    def handle_stats(self, request):
+        return self.json_response({'httpd_request_methods': {
+            method: {'current': self.stats[method],
+                     'description': 'number of HTTP {} requests'
+                                    ''.format(method)}
+            for method in ('COPY', 'DELETE', 'GET', 'HEAD', 'POST', 'PUT')}})
+
+    @handler
+    def handle_uuids(self, request):
+        count = param_int(request, 'count', 1)
+        return self.json_response({'uuids': [uuid.uuid4().hex
+                                             for _ in range(count)]})
+
+    # Database
+
+    @handler
+    def handle_db(self, request):
+        name = request.match_info['db']
+        if request.method == 'PUT':
+            if name in self.dbs:
+                raise CouchError(412, 'file_exists',
+                                 'The database could not be created,'
+                                 ' the file already exists.')
+            self.dbs[name] = Database(name)
+            return self.json_response({'ok': True}, status=201)
+        db = self.database(request)
+        if request.method == 'DELETE':
+            del self.dbs[name]
+            return self.json_response({'ok': True})
+        if request.method == 'POST':
+            doc = yield from self.read_json(request)
+            docid, rev = db.update(doc)
+            return self.json_response({'ok': True, 'id': docid, 'rev': rev},
+                                      status=201)
+        if request.method == 'HEAD':
+            return web.Response(status=200)
+        return self.json_response(db.info())
+
+    @handler
+    def handle_all_docs(self, request):
+        db = self.database(request)
+        body = None
+        if request.method == 'POST':
+            body = yield from self.read_json(request)
+        keys = param_json(request, 'keys', default=None)
+        if body and 'keys' in body:
+            keys = body['keys']
+        include_docs = param_bool(request, 'include_docs')
+        conflicts = param_bool(request, 'conflicts')
+        total = db.all_docs().query()[0]
+
+        if keys is None:
+            return (yield from self.view_response(
+                request, db, db.all_docs(), include_docs=include_docs))
+
+        rows = []
+        for key in keys:
+            tree = db.docs.get(key)
+            if tree is None:
+                rows.append(json.dumps({'key': key, 'error': 'not_found'}))
+                continue
+            row = {'id': tree.id, 'key': tree.id,
+                   'value': {'rev': tree.winner.rev}}
+            if tree.winner.deleted:
+                row['value']['deleted'] = True
+                if include_docs:
+                    row['doc'] = None
+            elif include_docs:
+                row['doc'] = tree.to_dict(conflicts=conflicts)
+            rows.append(json.dumps(row))
+        resp = self.stream_response(request)
+        resp.write('{{"total_rows":{},"offset":0,"rows":[\r\n'
+                   ''.format(total).encode())
+        yield from self.write_rows(resp, rows, ',\r\n')
+        resp.write(b'\r\n]}\n')
+        yield from resp.write_eof()
+        return resp
+
+    @handler
+    def handle_bulk_docs(self, request):
+        db = self.database(request)
+        body = yield from self.read_json(request)
+        if not isinstance(body, dict) or 'docs' not in body:
+            raise bad_request('Missing JSON list of `docs`')
+        new_edits = body.get('new_edits', True)
+        result = []
+        for doc in body['docs']:
+            try:
+                docid, rev = db.update(doc, new_edits=new_edits)
+            except CouchError as err:
+                result.append({'id': doc.get('_id'),
+                               'error': err.error,
+                               'reason': err.reason})
+            else:
+                if new_edits:
+                    result.append({'ok': True, 'id': docid, 'rev': rev})
+        return self.json_response(result, status=201)
+
+    @handler
+    def handle_changes(self, request):
+        db = self.database(request)
+        body = None
+        if request.method == 'POST':
+            body = yield from self.read_json(request)
+        feed = request.GET.get('feed', 'normal')
+        since = request.GET.get('since', '0')
+        since = db.update_seq if since == 'now' else int(since)
+        descending = param_bool(request, 'descending')
+        limit = param_int(request, 'limit')
+        timeout = param_int(request, 'timeout', self.changes_timeout)
+        heartbeat = request.GET.get('heartbeat')
+        if heartbeat == 'true':
+            heartbeat = self.changes_timeout
+        elif heartbeat is not None:
+            heartbeat = int(heartbeat)
+        accept = self.changes_filter(request, db, body)
+        options = {
+            'all_leaves': request.GET.get('style') == 'all_docs',
+            'include_docs': param_bool(request, 'include_docs'),
+            'doc_options': {
+                'attachments': param_bool(request, 'attachments'),
+                'att_encoding_info': param_bool(request, 'att_encoding_info'),
+                'conflicts': param_bool(request, 'conflicts')}}
+
+        def collect(since, limit):
+            rows = []
+            last_seq = since
+            for tree in db.changes(since, descending=descending):
+                if limit is not None and len(rows) >= limit:
+                    break
+                last_seq = tree.seq
+                if accept is None or accept(tree):
+                    rows.append(self.change_row(tree, **options))
+            return rows, last_seq
+
+        if feed in {'continuous', 'eventsource'}:
+            return (yield from self.stream_changes(
+                request, db, feed, collect, since, limit, timeout, heartbeat))
+
+        rows, last_seq = collect(since, limit)
+        if feed == 'longpoll' and not rows and not descending:
+            try:
+                while not rows:
+                    yield from asyncio.wait_for(db.wait_update(last_seq),
+                                                timeout / 1000,
+                                                loop=self._loop)
+                    rows, last_seq = collect(last_seq, limit)
+            except asyncio.TimeoutError:
+                pass
+
+        resp = self.stream_response(request)
+        resp.write(b'{"results":[\n')
+        yield from self.write_rows(resp, [json.dumps(row) for row in rows],
+                                   ',\n')
+        resp.write('\n],\n"last_seq":{}}}\n'.format(last_seq).encode())
+        yield from resp.write_eof()
+        return resp
+
+    @asyncio.coroutine
+    def stream_changes(self, request, db, feed, collect, since, limit,
+                       timeout, heartbeat):
+        if feed == 'eventsource':
+            resp = self.stream_response(request, 'text/event-stream')
+
+            def format_row(row):
+                return 'data: {}\nid: {}\n\n'.format(json.dumps(row),
+                                                     row['seq'])
+        else:
+            resp = self.stream_response(request)
+
+            def format_row(row):
+                return json.dumps(row) + '\n'
+
+        last_seq = since
+        while True:
+            rows, last_seq = collect(last_seq, limit)
+            if rows:
+                yield from self.write_rows(resp, [format_row(row)
+                                                  for row in rows], '')
+            if limit is not None:
+                limit -= len(rows)
+                if limit <= 0:
+                    break
+            try:
+                yield from asyncio.wait_for(db.wait_update(last_seq),
+                                            (heartbeat or timeout) / 1000,
+                                            loop=self._loop)
+            except asyncio.TimeoutError:
+                if not heartbeat:
+                    break
+                resp.write(b'\n')
+                yield from resp.drain()
+
+        if feed == 'continuous':
+            resp.write('{{"last_seq":{}}}\n'.format(last_seq).encode())
+        yield from resp.write_eof()
+        return resp
+
+    def change_row(self, tree, *, all_leaves, include_docs, doc_options):
+        winner = tree.winner
+        revs = [winner.rev]
+        if all_leaves:
+            revs.extend(tree.conflicts())
+            revs.extend(tree.conflicts(deleted=True))
+        row = {'seq': tree.seq, 'id': tree.id,
+               'changes': [{'rev': rev} for rev in revs]}
+        if winner.deleted:
+            row['deleted'] = True
+        if include_docs:
+            row['doc'] = tree.to_dict(**doc_options)
+        return row
+
+    def changes_filter(self, request, db, body):
+        name = request.GET.get('filter')
+        if not name:
+            return None
+        if name == '_doc_ids':
+            if body and 'doc_ids' in body:
+                doc_ids = set(body['doc_ids'])
+            else:
+                doc_ids = set(param_json(request, 'doc_ids', default=()))
+            return lambda tree: tree.id in doc_ids
+        if name == '_design':
+            return lambda tree: tree.id.startswith('_design/')
+        if name == '_view':
+            view = request.GET.get('view', '')
+            ddoc_name, _, view_name = view.partition('/')
+            views = db.design_doc(ddoc_name).get('views') or {}
+            if view_name not in views:
+                raise not_found('missing_named_view')
+            map_fun = compile_function(views[view_name]['map'])
+
+            def accept(tree):
+                if tree.winner.deleted:
+                    return False
+                return any(True for _ in map_fun(tree.to_dict()) or ())
+            return accept
+        ddoc_name, _, filter_name = name.partition('/')
+        fun = db.filter(ddoc_name, filter_name)
+        req = {'query': dict(request.GET), 'body': body,
+               'method': request.method}
+        return lambda tree: bool(fun(tree.to_dict(), req))
+
+    @handler
+    def handle_compact(self, request):
+        self.database(request)
+        return self.json_response({'ok': True}, status=202)
+
+    @handler
+    def handle_ensure_full_commit(self, request):
+        db = self.database(request)
+        return self.json_response(
+            {'ok': True, 'instance_start_time': db.instance_start_time},
+            status=201)
+
+    @handler
+    def handle_missing_revs(self, request):
+        db = self.database(request)
+        body = yield from self.read_json(request)
+        return self.json_response({'missing_revs': {
+            docid: info['missing']
+            for docid, info in self.revs_diff(db, body).items()}})
+
+    @handler
+    def handle_revs_diff(self, request):
+        db = self.database(request)
+        body = yield from self.read_json(request)
+        return self.json_response(self.revs_diff(db, body))
+
+    def revs_diff(self, db, id_revs):
+        result = {}
+        for docid, revs in (id_revs or {}).items():
+            tree = db.docs.get(docid)
+            known = tree.revs if tree is not None else {}
+            missing = [rev for rev in revs if rev not in known]
+            if missing:
+                result[docid] = {'missing': missing}
+        return result
+
+    @handler
+    def handle_revs_limit(self, request):
+        db = self.database(request)
+        if request.method == 'PUT':
+            value = yield from self.read_json(request)
+            if not isinstance(value, int) or value <= 0:
+                raise bad_request('`revs_limit` must be a positive integer')
+            db.revs_limit = value
+            return self.json_response({'ok': True})
+        return self.json_response(db.revs_limit)
+
+    @handler
+    def handle_security(self, request):
+        db = self.database(request)
+        if request.method == 'PUT':
+            value = yield from self.read_json(request)
+            if not isinstance(value, dict):
+                raise bad_request('Security object must be a JSON object')
+            db.security = value
+            return self.json_response({'ok': True})
+        return self.json_response(db.security)
+
+    # Documents
+
+    @handler
+    def handle_local_doc(self, request):
+        db = self.database(request)
+        return (yield from self.local_doc(
+            request, db, '_local/' + request.match_info['docid']))
+
+    @asyncio.coroutine
+    def local_doc(self, request, db, docid):
+        rev = request.GET.get('rev')
+        if request.method in {'GET', 'HEAD'}:
+            return self.json_response(db.get_local(docid))
+        if request.method == 'PUT':
+            doc = yield from self.read_json(request)
+            docid, rev = db.update_local(docid, doc, rev=rev)
+            return self.json_response({'ok': True, 'id': docid, 'rev': rev},
+                                      status=201)
+        if request.method == 'DELETE':
+            docid, rev = db.update_local(docid, {'_deleted': True}, rev=rev)
+            return self.json_response({'ok': True, 'id': docid, 'rev': rev})
+        raise CouchError(405, 'method_not_allowed',
+                         'Only DELETE,GET,HEAD,PUT allowed')
+
+    def request_docid(self, request):
+        if 'ddoc' in request.match_info:
+            return '_design/' + request.match_info['ddoc']
+        return request.match_info['docid']
+
+    @handler
+    def handle_doc(self, request):
+        db = self.database(request)
+        docid = self.request_docid(request)
+        if docid.startswith('_local/'):
+            return (yield from self.local_doc(request, db, docid))
+        method = request.method
+        if method in {'GET', 'HEAD'}:
+            return (yield from self.get_doc(request, db, docid))
+        if method == 'PUT':
+            return (yield from self.put_doc(request, db, docid))
+        if method == 'DELETE':
+            rev = request.GET.get('rev') or request.headers.get(
+                'IF-MATCH', '').strip('"') or None
+            if rev is None:
+                raise conflict()
+            docid, rev = db.update({'_id': docid, '_rev': rev,
+                                    '_deleted': True})
+            return self.json_response({'ok': True, 'id': docid, 'rev': rev},
+                                      headers={'ETAG': etag(rev)})
+        if method == 'COPY':
+            return self.copy_doc(request, db, docid)
+        raise CouchError(405, 'method_not_allowed',
+                         'Only DELETE,GET,HEAD,PUT,COPY allowed')
+
+    @asyncio.coroutine
+    def get_doc(self, request, db, docid):
+        options = doc_options(request)
+        accept = request.headers.get('ACCEPT', '')
+        if 'open_revs' in request.GET:
+            return (yield from self.get_open_revs(request, db, docid,
+                                                  options, accept))
+        rev = request.GET.get('rev')
+        tree = db.get(docid, rev)
+        current = rev or tree.winner.rev
+        headers = {'ETAG': etag(current)}
+        if request.headers.get('IF-NONE-MATCH') == etag(current):
+            return web.Response(status=304, headers=headers)
+        if request.method == 'HEAD':
+            return web.Response(status=200, headers=headers)
+
+        revision = tree.revs[current]
+        if (options['attachments'] and revision.atts and
+                'multipart/related' in accept):
+            boundary = uuid.uuid4().hex
+            resp = self.stream_response(
+                request,
+                'multipart/related; boundary="{}"'.format(boundary),
+                headers)
+            yield from self.write_related(resp, boundary, tree, rev, options)
+            resp.write('\r\n--{}--'.format(boundary).encode())
+            yield from resp.write_eof()
+            return resp
+        return self.json_response(tree.to_dict(rev, **options),
+                                  headers=headers)
+
+    @asyncio.coroutine
+    def write_related(self, resp, boundary, tree, rev, options):
+        doc = tree.to_dict(rev, follows=True, **options)
+        revision = tree.revs[doc['_rev']]
+        resp.write('--{}\r\nContent-Type: application/json\r\n\r\n'
+                   ''.format(boundary).encode())
+        resp.write(json.dumps(doc).encode())
+        for name, info in doc['_attachments'].items():
+            if not info.get('follows'):
+                continue
+            att = revision.atts[name]
+            resp.write('\r\n--{}\r\nContent-Disposition: attachment; '
+                       'filename="{}"\r\nContent-Type: {}\r\n'
+                       'Content-Length: {}\r\n\r\n'
+                       ''.format(boundary, name, att.content_type,
+                                 len(att.data)).encode())
+            resp.write(att.data)
+            yield from resp.drain()
+
+    @asyncio.coroutine
+    def get_open_revs(self, request, db, docid, options, accept):
+        tree = db.docs.get(docid)
+        if tree is None:
+            raise not_found()
+        if request.GET['open_revs'] == 'all':
+            revs = sorted(tree.leaves)
+        else:
+            revs = param_json(request, 'open_revs')
+            if not isinstance(revs, list):
+                raise bad_request('`open_revs` must be JSON array or `all`')
+        options = dict(options, conflicts=False, deleted_conflicts=False)
+
+        if 'multipart/mixed' not in accept:
+            return self.json_response([
+                {'ok': tree.to_dict(rev, **options)} if rev in tree.revs
+                else {'missing': rev}
+                for rev in revs])
+
+        # like CouchDB, multipart response always includes attachments
+        options['attachments'] = True
+        boundary = uuid.uuid4().hex
+        resp = self.stream_response(
+            request, 'multipart/mixed; boundary="{}"'.format(boundary))
+        for rev in revs:
+            resp.write('--{}\r\n'.format(boundary).encode())
+            if rev not in tree.revs:
+                resp.write(b'Content-Type: application/json; error="true"'
+                           b'\r\n\r\n')
+                resp.write(json.dumps({'missing': rev}).encode())
+            elif options['attachments'] and tree.revs[rev].atts:
+                inner = uuid.uuid4().hex
+                resp.write('Content-Type: multipart/related; boundary="{}"'
+                           '\r\n\r\n'.format(inner).encode())
+                yield from self.write_related(resp, inner, tree, rev, options)
+                resp.write('\r\n--{}--'.format(inner).encode())
+            else:
+                resp.write(b'Content-Type: application/json\r\n\r\n')
+                resp.write(json.dumps(tree.to_dict(rev, **options)).encode())
+            resp.write(b'\r\n')
+            yield from resp.drain()
+        resp.write('--{}--'.format(boundary).encode())
+        yield from resp.write_eof()
+        return resp
+
+    @asyncio.coroutine
+    def put_doc(self, request, db, docid):
+        atts = None
+        if request.content_type == 'multipart/related':
+            reader = MultipartReader(request.headers, request.content)
+            part = yield from reader.next()
+            doc = json.loads((yield from part.read()).decode('utf-8'),
+                             object_pairs_hook=OrderedDict)
+            follows = [name for name, info in
+                       doc.get('_attachments', {}).items()
+                       if info.get('follows')]
+            atts = {}
+            for name in follows:
+                part = yield from reader.next()
+                if part is None:
+                    raise bad_request('Missing attachment data for ' + name)
+                atts[part.filename or name] = yield from part.read()
+            yield from reader.release()
+        else:
+            doc = yield from self.read_json(request)
+            if not isinstance(doc, dict):
+                raise bad_request('Document must be a JSON object')
+        doc['_id'] = docid
+        if 'rev' in request.GET:
+            doc['_rev'] = request.GET['rev']
+        new_edits = param_bool(request, 'new_edits', True)
+        docid, rev = db.update(doc, atts=atts, new_edits=new_edits)
+        status = 202 if request.GET.get('batch') == 'ok' else 201
+        return self.json_response({'ok': True, 'id': docid, 'rev': rev},
+                                  status=status,
+                                  headers={'ETAG': etag(rev)})
+
+    def copy_doc(self, request, db, docid):
+        tree = db.get(docid, request.GET.get('rev'))
+        dest = request.headers.get('DESTINATION')
+        if not dest:
+            raise bad_request('Destination header is mandatory for COPY.')
+        newid, _, query = dest.partition('?')
+        doc = tree.to_dict(request.GET.get('rev'))
+        revision = tree.revs[doc['_rev']]
+        doc['_id'] = newid
+        doc.pop('_rev')
+        if query.startswith('rev='):
+            doc['_rev'] = query[4:]
+        atts = {}
+        for name, info in doc.get('_attachments', {}).items():
+            att = revision.atts[name]
+            doc['_attachments'][name] = {'follows': True,
+                                         'content_type': att.content_type}
+            atts[name] = (att.data, att.encoding)
+        newid, rev = db.update(doc, atts=atts)
+        return self.json_response({'ok': True, 'id': newid, 'rev': rev},
+                                  status=201,
+                                  headers={'ETAG': etag(rev)})
+
+    # Attachments
+
+    @handler
+    def handle_att(self, request):
+        db = self.database(request)
+        docid = self.request_docid(request)
+        name = request.match_info['attname']
+        rev = request.GET.get('rev') or request.headers.get(
+            'IF-MATCH', '').strip('"') or None
+        method = request.method
+        if method == 'PUT':
+            data = yield from request.read()
+            encoding = request.headers.get('CONTENT-ENCODING')
+            if encoding == 'gzip':
+                # aiohttp decodes request payload, while CouchDB stores
+                # it encoded
+                data = gzip_encode(data)
+            docid, rev = db.update_attachment(
+                docid, name, data,
+                content_type=request.headers.get(
+                    'CONTENT-TYPE', 'application/octet-stream'),
+                encoding=encoding,
+                rev=rev)
+            return self.json_response({'ok': True, 'id': docid, 'rev': rev},
+                                      status=201,
+                                      headers={'ETAG': etag(rev)})
+        if method == 'DELETE':
+            if rev is None:
+                raise conflict()
+            docid, rev = db.delete_attachment(docid, name, rev)
+            return self.json_response({'ok': True, 'id': docid, 'rev': rev},
+                                      headers={'ETAG': etag(rev)})
+        if method not in {'GET', 'HEAD'}:
+            raise CouchError(405, 'method_not_allowed',
+                             'Only DELETE,GET,HEAD,PUT allowed')
+
+        tree = db.get(docid, rev)
+        att = tree.revs[rev or tree.winner.rev].atts.get(name)
+        if att is None:
+            raise not_found('Document is missing attachment')
+        # like CouchDB, ETag is base64 encoded MD5 without prefix
+        headers = {'CONTENT-TYPE': att.content_type,
+                   'ACCEPT-RANGES': 'bytes',
+                   'ETAG': etag(att.digest[4:])}
+        if att.encoding:
+            headers['CONTENT-ENCODING'] = att.encoding
+        if request.headers.get('IF-NONE-MATCH') == headers['ETAG']:
+            return web.Response(status=304, headers=headers)
+
+        data = att.data
+        status = 200
+        range_header = request.headers.get('RANGE', '')
+        if range_header.startswith('bytes=') and ',' not in range_header:
+            start, _, stop = range_header[6:].partition('-')
+            size = len(data)
+            if not start:
+                start, stop = max(0, size - int(stop)), size - 1
+            else:
+                start = int(start)
+                stop = min(int(stop), size - 1) if stop else size - 1
+            if start >= size or start > stop:
+                headers['CONTENT-RANGE'] = 'bytes */{}'.format(size)
+                return web.Response(status=416, headers=headers)
+            headers['CONTENT-RANGE'] = 'bytes {}-{}/{}'.format(start, stop,
+                                                               size)
+            data = data[start:stop + 1]
+            status = 206
+        return web.Response(body=data, status=status, headers=headers)
+
+    # Views
+
+    @handler
+    def handle_ddoc_info(self, request):
+        db = self.database(request)
+        ddoc = db.design_doc(request.match_info['ddoc'])
+        return self.json_response({
+            'name': request.match_info['ddoc'],
+            'view_index': {'language': ddoc.get('language', 'python'),
+                           'update_seq': db.update_seq,
+                           'updater_running': False,
+                           'compact_running': False,
+                           'waiting_clients': 0,
+                           'waiting_commit': False,
+                           'disk_size': 0,
+                           'data_size': 0,
+                           'purge_seq': 0,
+                           'signature': ddoc['_rev']}})
+
+    @handler
+    def handle_view(self, request):
+        db = self.database(request)
+        index = db.view(request.match_info['ddoc'], request.match_info['view'])
+        return (yield from self.view_response(request, db, index))
+
+    @asyncio.coroutine
+    def view_response(self, request, db, index, *, include_docs=None):
+        body = None
+        if request.method == 'POST':
+            body = yield from self.read_json(request)
+        elif request.method not in {'GET', 'HEAD'}:
+            raise CouchError(405, 'method_not_allowed',
+                             'Only GET,HEAD,POST allowed')
+        if include_docs is None:
+            include_docs = param_bool(request, 'include_docs')
+        reduce = param_bool(request, 'reduce', index.reduce_fun is not None)
+        if reduce and include_docs:
+            raise CouchError(400, 'query_parse_error',
+                             '`include_docs` is invalid for reduce')
+        query = {
+            'descending': param_bool(request, 'descending'),
+            'endkey': param_json(request, 'endkey', 'end_key'),
+            'endkey_docid': (request.GET.get('endkey_docid') or
+                             request.GET.get('end_key_doc_id')),
+            'group': param_bool(request, 'group'),
+            'group_level': param_int(request, 'group_level'),
+            'inclusive_end': param_bool(request, 'inclusive_end', True),
+            'key': param_json(request, 'key'),
+            'keys': param_json(request, 'keys', default=None),
+            'limit': param_int(request, 'limit'),
+            'reduce': reduce,
+            'skip': param_int(request, 'skip', 0),
+            'startkey': param_json(request, 'startkey', 'start_key'),
+            'startkey_docid': (request.GET.get('startkey_docid') or
+                               request.GET.get('start_key_doc_id')),
+        }
+        if body and 'keys' in body:
+            query['keys'] = body['keys']
+        try:
+            total, offset, rows = index.query(**query)
+        except ValueError as err:
+            raise CouchError(400, 'query_parse_error', str(err))
+
+        resp = self.stream_response(request)
+        if reduce:
+            resp.write(b'{"rows":[\r\n')
+            lines = [json.dumps({'key': key, 'value': value})
+                     for _, key, value in rows]
+        else:
+            header = '{{"total_rows":{},"offset":{}'.format(total, offset)
+            if param_bool(request, 'update_seq'):
+                header += ',"update_seq":{}'.format(index.update_seq)
+            resp.write((header + ',"rows":[\r\n').encode())
+            lines = []
+            for docid, key, value in rows:
+                row = {'id': docid, 'key': key, 'value': value}
+                if include_docs:
+                    row['doc'] = self.include_doc(db, docid, value)
+                lines.append(json.dumps(row))
+        yield from self.write_rows(resp, lines, ',\r\n')
+        resp.write(b'\r\n]}\n')
+        yield from resp.write_eof()
+        return resp
+
+    def include_doc(self, db, docid, value):
+        if isinstance(value, dict) and '_id' in value:
+            docid = value['_id']
+        tree = db.docs.get(docid)
+        if tree is None or tree.winner.deleted:
+            return None
+        return tree.to_dict()
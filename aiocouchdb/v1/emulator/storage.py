@@ -0,0 +1,578 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import base64
+import hashlib
+import json
+import re
+import uuid
+from collections import OrderedDict
+
+from .views import ViewIndex, compile_function
+
+
+__all__ = (
+    'Attachment',
+    'CouchError',
+    'Database',
+    'DocumentTree',
+    'Revision',
+)
+
+
+#: Document fields which are allowed to start with underscore
+SPECIAL_FIELDS = frozenset({'_id', '_rev', '_deleted', '_attachments',
+                            '_revisions', '_conflicts', '_deleted_conflicts',
+                            '_revs_info', '_local_seq'})
+#: Valid database name pattern
+DBNAME_RE = re.compile(r'^[a-z][a-z0-9_$()+/-]*$')
+
+
+class CouchError(Exception):
+    """Error which is reported to the client as JSON response."""
+
+    def __init__(self, status, error, reason):
+        super().__init__(status, error, reason)
+        self.status = status
+        self.error = error
+        self.reason = reason
+
+
+def not_found(reason='missing'):
+    return CouchError(404, 'not_found', reason)
+
+
+def conflict():
+    return CouchError(409, 'conflict', 'Document update conflict.')
+
+
+def bad_request(reason):
+    return CouchError(400, 'bad_request', reason)
+
+
+class Attachment(object):
+    """Stored attachment."""
+
+    __slots__ = ('content_type', 'data', 'digest', 'encoding', 'revpos')
+
+    def __init__(self, data, content_type, revpos, encoding=None):
+        self.data = bytes(data)
+        self.content_type = content_type
+        self.revpos = revpos
+        self.encoding = encoding
+        self.digest = 'md5-' + base64.b64encode(
+            hashlib.md5(data).digest()).decode()
+
+    def stub(self, *, data=False, follows=False, encoding_info=False):
+        """Returns attachment stub for the document body.
+
+        :rtype: dict
+        """
+        info = {'content_type': self.content_type,
+                'digest': self.digest,
+                'length': len(self.data),
+                'revpos': self.revpos}
+        if data:
+            info['data'] = base64.b64encode(self.data).decode()
+        elif follows:
+            info['follows'] = True
+        else:
+            info['stub'] = True
+        if encoding_info and self.encoding:
+            info['encoding'] = self.encoding
+            info['encoded_length'] = len(self.data)
+        return info
+
+
+class Revision(object):
+    """Single document revision."""
+
+    __slots__ = ('atts', 'body', 'deleted', 'parent', 'pos', 'rev')
+
+    def __init__(self, rev, parent, body, deleted, atts):
+        self.rev = rev
+        self.pos = int(rev.split('-', 1)[0])
+        self.parent = parent
+        self.body = body
+        self.deleted = deleted
+        self.atts = atts
+
+
+class DocumentTree(object):
+    """Document revisions tree."""
+
+    __slots__ = ('id', 'leaves', 'revs', 'seq', '_winner')
+
+    def __init__(self, docid):
+        self.id = docid
+        self.revs = {}
+        self.leaves = set()
+        self.seq = 0
+        self._winner = None
+
+    @property
+    def winner(self):
+        """Returns winning revision following CouchDB rules: not deleted
+        leaf with the longest history and the highest revision hash wins.
+
+        :rtype: :class:`Revision`
+        """
+        if self._winner is None:
+            self._winner = max(
+                (self.revs[rev] for rev in self.leaves),
+                key=lambda item: (not item.deleted, item.pos, item.rev))
+        return self._winner
+
+    def add(self, revision):
+        """Adds new revision to the tree.
+
+        :param revision: :class:`Revision` instance
+        """
+        self.revs[revision.rev] = revision
+        self.leaves.discard(revision.parent)
+        self.leaves.add(revision.rev)
+        self._winner = None
+
+    def conflicts(self, *, deleted=False):
+        """Returns conflicted leaf revisions.
+
+        :param bool deleted: Return deleted conflicts instead of active ones
+
+        :rtype: list
+        """
+        winner = self.winner.rev
+        return sorted((rev for rev in self.leaves
+                       if rev != winner and self.revs[rev].deleted == deleted),
+                      key=lambda rev: (int(rev.split('-', 1)[0]), rev),
+                      reverse=True)
+
+    def history(self, rev):
+        """Returns revisions path from the given one to the root.
+
+        :rtype: list
+        """
+        path = []
+        while rev is not None:
+            path.append(rev)
+            revision = self.revs.get(rev)
+            rev = revision.parent if revision is not None else None
+        return path
+
+    def to_dict(self, rev=None, *,
+                attachments=False,
+                att_encoding_info=False,
+                atts_since=None,
+                conflicts=False,
+                deleted_conflicts=False,
+                follows=False,
+                local_seq=False,
+                revs=False,
+                revs_info=False):
+        """Returns document body of the revision.
+
+        :rtype: dict
+        """
+        revision = self.winner if rev is None else self.revs[rev]
+        doc = {'_id': self.id, '_rev': revision.rev}
+        doc.update(revision.body)
+        if revision.deleted:
+            doc['_deleted'] = True
+        if revision.atts:
+            since = None
+            if atts_since:
+                since = min(int(item.split('-', 1)[0]) for item in atts_since)
+            doc['_attachments'] = {
+                name: att.stub(
+                    data=attachments and not follows and (
+                        since is None or att.revpos > since),
+                    follows=attachments and follows and (
+                        since is None or att.revpos > since),
+                    encoding_info=att_encoding_info)
+                for name, att in revision.atts.items()}
+        if conflicts and rev is None:
+            items = self.conflicts()
+            if items:
+                doc['_conflicts'] = items
+        if deleted_conflicts and rev is None:
+            items = self.conflicts(deleted=True)
+            if items:
+                doc['_deleted_conflicts'] = items
+        if local_seq:
+            doc['_local_seq'] = self.seq
+        if revs:
+            path = self.history(revision.rev)
+            doc['_revisions'] = {
+                'start': revision.pos,
+                'ids': [item.split('-', 1)[1] for item in path]}
+        if revs_info:
+            doc['_revs_info'] = [
+                {'rev': item,
+                 'status': ('missing' if item not in self.revs else
+                            'deleted' if self.revs[item].deleted else
+                            'available')}
+                for item in self.history(revision.rev)]
+        return doc
+
+
+class Database(object):
+    """In-memory database.
+
+    :param str name: Database name
+    """
+
+    #: Maximum amount of revisions to track
+    revs_limit = 1000
+
+    def __init__(self, name):
+        if not DBNAME_RE.match(name):
+            raise CouchError(400, 'illegal_database_name',
+                             'Name: {!r}. Only lowercase characters (a-z),'
+                             ' digits (0-9), and any of the characters _, $,'
+                             ' (, ), +, -, and / are allowed. Must begin with'
+                             ' a letter.'.format(name))
+        self.name = name
+        self.docs = {}
+        self.local_docs = {}
+        self.security = {}
+        self.update_seq = 0
+        self.instance_start_time = str(int(uuid.uuid1().time))
+        self._by_seq = OrderedDict()
+        self._all_docs = ViewIndex(self._all_docs_map)
+        self._indexes = {}
+        self._waiters = []
+
+    @property
+    def doc_count(self):
+        return sum(1 for tree in self.docs.values()
+                   if not tree.winner.deleted)
+
+    @property
+    def doc_del_count(self):
+        return len(self.docs) - self.doc_count
+
+    def info(self):
+        """Returns database information.
+
+        :rtype: dict
+        """
+        return {
+            'db_name': self.name,
+            'doc_count': self.doc_count,
+            'doc_del_count': self.doc_del_count,
+            'update_seq': self.update_seq,
+            'purge_seq': 0,
+            'compact_running': False,
+            'disk_size': 0,
+            'data_size': 0,
+            'instance_start_time': self.instance_start_time,
+            'disk_format_version': 6,
+            'committed_update_seq': self.update_seq,
+        }
+
+    def get(self, docid, rev=None):
+        """Returns document revisions tree.
+
+        :param str docid: Document ID
+        :param str rev: Revision which should exist in the tree
+
+        :rtype: :class:`DocumentTree`
+        """
+        tree = self.docs.get(docid)
+        if tree is None:
+            raise not_found()
+        if rev is None:
+            if tree.winner.deleted:
+                raise not_found('deleted')
+        elif rev not in tree.revs:
+            raise not_found()
+        return tree
+
+    def update(self, doc, *, atts=None, new_edits=True):
+        """Stores new document revision.
+
+        :param dict doc: Document body with special fields
+        :param dict atts: Attachments data which `follows` the document in
+                          multipart request
+        :param bool new_edits: If ``False``, stores revision as is, like
+                               replicator does
+
+        :returns: Document ID and stored revision
+        :rtype: tuple
+        """
+        if not isinstance(doc, dict):
+            raise bad_request('Document must be a JSON object')
+        docid = doc.get('_id') or uuid.uuid4().hex
+        if not isinstance(docid, str):
+            raise bad_request('Document id must be a string')
+        if docid.startswith('_') and not docid.startswith('_design/'):
+            raise bad_request('Only reserved document ids may start with'
+                              ' underscore.')
+        for key in doc:
+            if key.startswith('_') and key not in SPECIAL_FIELDS:
+                raise CouchError(400, 'doc_validation',
+                                 'Bad special document member: ' + key)
+        body = {key: value for key, value in doc.items()
+                if not key.startswith('_')}
+        deleted = bool(doc.get('_deleted'))
+        tree = self.docs.get(docid)
+
+        if new_edits:
+            rev = doc.get('_rev')
+            if tree is None:
+                if rev:
+                    raise conflict()
+                parent = None
+            elif rev is None:
+                parent = tree.winner
+                if not parent.deleted:
+                    raise conflict()
+            elif rev not in tree.leaves:
+                raise conflict()
+            else:
+                parent = tree.revs[rev]
+            pos = parent.pos + 1 if parent is not None else 1
+            revatts = self._merge_atts(doc.get('_attachments'), parent,
+                                       atts, pos)
+            digest = hashlib.md5(json.dumps(
+                [deleted, parent and parent.rev, body,
+                 sorted((name, att.digest) for name, att in revatts.items())],
+                sort_keys=True).encode()).hexdigest()
+            newrev = '{}-{}'.format(pos, digest)
+            parent_rev = parent.rev if parent is not None else None
+        else:
+            newrev = doc.get('_rev')
+            if not newrev:
+                raise bad_request('Document revision is required when'
+                                  ' new_edits is false')
+            if tree is not None and newrev in tree.revs:
+                return docid, newrev
+            pos = int(newrev.split('-', 1)[0])
+            parent_rev = None
+            revisions = doc.get('_revisions')
+            if revisions and len(revisions.get('ids', ())) > 1:
+                parent_rev = '{}-{}'.format(revisions['start'] - 1,
+                                            revisions['ids'][1])
+            parent = tree.revs.get(parent_rev) if tree is not None else None
+            revatts = self._merge_atts(doc.get('_attachments'), parent,
+                                       atts, pos)
+
+        if tree is None:
+            tree = self.docs[docid] = DocumentTree(docid)
+        tree.add(Revision(newrev, parent_rev, body, deleted, revatts))
+        self._touch(tree)
+        return docid, newrev
+
+    def update_attachment(self, docid, name, data, *,
+                          content_type='application/octet-stream',
+                          encoding=None,
+                          rev=None):
+        """Adds or replaces document attachment.
+
+        :returns: Document ID and stored revision
+        :rtype: tuple
+        """
+        tree = self.docs.get(docid)
+        if tree is None or (rev is None and tree.winner.deleted):
+            doc = {'_id': docid}
+            if rev is not None:
+                doc['_rev'] = rev
+        else:
+            if rev is None:
+                raise conflict()
+            if rev not in tree.revs:
+                raise conflict()
+            doc = tree.to_dict(rev)
+        atts = doc.setdefault('_attachments', {})
+        atts[name] = {'follows': True, 'content_type': content_type}
+        newatts = {name: (data, encoding)}
+        return self.update(doc, atts=newatts)
+
+    def delete_attachment(self, docid, name, rev):
+        """Removes document attachment.
+
+        :returns: Document ID and stored revision
+        :rtype: tuple
+        """
+        tree = self.get(docid)
+        if rev not in tree.leaves:
+            raise conflict()
+        doc = tree.to_dict(rev)
+        if name not in doc.get('_attachments', {}):
+            raise not_found('Document is missing attachment')
+        del doc['_attachments'][name]
+        return self.update(doc)
+
+    def get_local(self, docid):
+        doc = self.local_docs.get(docid)
+        if doc is None:
+            raise not_found()
+        return dict(doc)
+
+    def update_local(self, docid, doc, *, rev=None):
+        """Stores local document which is never replicated and doesn't
+        appear in changes feed.
+
+        :returns: Document ID and stored revision
+        :rtype: tuple
+        """
+        rev = rev or doc.get('_rev')
+        current = self.local_docs.get(docid)
+        if current is not None and current['_rev'] != rev:
+            raise conflict()
+        if current is None and rev:
+            raise conflict()
+        if doc.get('_deleted'):
+            self.local_docs.pop(docid, None)
+            return docid, '0-0'
+        num = int(current['_rev'].split('-')[1]) + 1 if current else 1
+        newrev = '0-{}'.format(num)
+        stored = {key: value for key, value in doc.items()
+                  if not key.startswith('_')}
+        stored['_id'] = docid
+        stored['_rev'] = newrev
+        self.local_docs[docid] = stored
+        return docid, newrev
+
+    def changes(self, since=0, *, descending=False):
+        """Iterates over document trees changed since the given sequence.
+
+        :param int since: Update sequence to start from
+        :param bool descending: Return changes in reverse order
+
+        :rtype: list
+        """
+        items = []
+        # OrderedDict views are not reversible until Python 3.5
+        for docid in reversed(self._by_seq):
+            tree = self._by_seq[docid]
+            if tree.seq <= since:
+                break
+            items.append(tree)
+        if not descending:
+            items.reverse()
+        return items
+
+    @asyncio.coroutine
+    def wait_update(self, since, *, loop=None):
+        """Waits until database update sequence gets greater than given one.
+
+        :param int since: Update sequence to wait after
+        """
+        while self.update_seq <= since:
+            waiter = asyncio.Future(loop=loop)
+            self._waiters.append(waiter)
+            try:
+                yield from waiter
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def all_docs(self):
+        """Returns up to date index of all documents.
+
+        :rtype: :class:`~aiocouchdb.v1.emulator.views.ViewIndex`
+        """
+        self._refresh(self._all_docs, design=True)
+        return self._all_docs
+
+    def view(self, ddoc_name, view_name):
+        """Returns up to date index of the design document view.
+
+        :rtype: :class:`~aiocouchdb.v1.emulator.views.ViewIndex`
+        """
+        ddoc = self.design_doc(ddoc_name)
+        views = ddoc.get('views') or {}
+        if view_name not in views:
+            raise not_found('missing_named_view')
+        key = (ddoc['_id'], view_name)
+        cached = self._indexes.get(key)
+        if cached is None or cached[0] != ddoc['_rev']:
+            funs = views[view_name]
+            try:
+                index = ViewIndex(funs['map'], funs.get('reduce'))
+            except Exception as err:
+                raise CouchError(400, 'compilation_error', str(err))
+            cached = self._indexes[key] = (ddoc['_rev'], index)
+        self._refresh(cached[1])
+        return cached[1]
+
+    def filter(self, ddoc_name, filter_name):
+        """Returns compiled changes filter function.
+
+        :rtype: callable
+        """
+        ddoc = self.design_doc(ddoc_name)
+        filters = ddoc.get('filters') or {}
+        if filter_name not in filters:
+            raise not_found('missing json key: ' + filter_name)
+        try:
+            return compile_function(filters[filter_name])
+        except Exception as err:
+            raise CouchError(400, 'compilation_error', str(err))
+
+    def design_doc(self, ddoc_name):
+        return self.get('_design/' + ddoc_name).to_dict()
+
+    def _all_docs_map(self, doc):
+        yield doc['_id'], {'rev': doc['_rev']}
+
+    def _refresh(self, index, *, design=False):
+        if index.update_seq >= self.update_seq:
+            return
+        for tree in self.changes(index.update_seq):
+            doc = None
+            if not tree.winner.deleted:
+                if design or not tree.id.startswith('_design/'):
+                    doc = tree.to_dict()
+            index.update(tree.id, doc, tree.seq)
+        index.update_seq = self.update_seq
+
+    def _touch(self, tree):
+        self.update_seq += 1
+        tree.seq = self.update_seq
+        self._by_seq.pop(tree.id, None)
+        self._by_seq[tree.id] = tree
+        waiters, self._waiters = self._waiters, []
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    def _merge_atts(self, stubs, parent, data, pos):
+        atts = {}
+        for name, info in (stubs or {}).items():
+            if info.get('stub'):
+                if parent is None or name not in parent.atts:
+                    raise CouchError(412, 'missing_stub',
+                                     'Invalid attachment stub for ' + name)
+                atts[name] = parent.atts[name]
+            elif 'data' in info:
+                try:
+                    content = base64.b64decode(info['data'])
+                except Exception:
+                    raise bad_request('Invalid attachment data for ' + name)
+                atts[name] = Attachment(
+                    content,
+                    info.get('content_type', 'application/octet-stream'),
+                    pos)
+            elif info.get('follows'):
+                if data is None or name not in data:
+                    raise bad_request('Missing attachment data for ' + name)
+                content = data[name]
+                encoding = None
+                if isinstance(content, tuple):
+                    content, encoding = content
+                atts[name] = Attachment(
+                    content,
+                    info.get('content_type', 'application/octet-stream'),
+                    pos,
+                    encoding)
+            else:
+                raise bad_request('Invalid attachment stub for ' + name)
+        return atts
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import bisect
+import logging
+import textwrap
+
+
+__all__ = (
+    'ViewIndex',
+    'collate',
+    'compile_function',
+)
+
+
+log = logging.getLogger(__name__)
+
+
+def collate(value):
+    """Returns sort key which follows CouchDB `views collation`_ rules:
+    ``null`` < ``false`` < ``true`` < numbers < strings < arrays < objects.
+
+    Strings are compared by code points, not by ICU rules.
+
+    >>> sorted([[1], 'a', None, 2, {}, True, False], key=collate)
+    [None, False, True, 2, 'a', [1], {}]
+
+    .. _views collation: http://docs.couchdb.org/en/latest/couchapp/views/collation.html
+    """
+    if value is None:
+        return (0,)
+    if value is False:
+        return (1,)
+    if value is True:
+        return (2,)
+    if isinstance(value, (int, float)):
+        return (3, value)
+    if isinstance(value, str):
+        return (4, value)
+    if isinstance(value, (list, tuple)):
+        return (5, tuple(collate(item) for item in value))
+    if isinstance(value, dict):
+        return (6, tuple((collate(key), collate(val))
+                         for key, val in value.items()))
+    raise TypeError('unsupported key type: %r' % type(value))
+
+
+#: Document ID which is greater than any other one
+MAX_DOCID = '\U0010ffff'
+
+
+def compile_function(source):
+    """Compiles design function written in Python. The source should
+    define exactly one function, as `couchdb-python`_ view server expects.
+
+    >>> fun = compile_function('def fun(doc): yield doc["_id"], None')
+    >>> list(fun({'_id': 'foo'}))
+    [('foo', None)]
+
+    .. _couchdb-python: https://pythonhosted.org/CouchDB/views.html
+
+    :param str source: Function source code
+
+    :rtype: callable
+    """
+    if callable(source):
+        return source
+    namespace = {}
+    exec(compile(textwrap.dedent(source), '<design function>', 'exec'),
+         namespace)
+    funcs = [value for key, value in namespace.items()
+             if callable(value) and not key.startswith('__')]
+    if len(funcs) != 1:
+        raise ValueError('design function source should define exactly'
+                         ' one function')
+    return funcs[0]
+
+
+def builtin_count(keys, values, rereduce):
+    if rereduce:
+        return sum(values)
+    return len(values)
+
+
+def builtin_sum(keys, values, rereduce):
+    return sum(values)
+
+
+def builtin_stats(keys, values, rereduce):
+    if rereduce:
+        return {
+            'sum': sum(item['sum'] for item in values),
+            'count': sum(item['count'] for item in values),
+            'min': min(item['min'] for item in values),
+            'max': max(item['max'] for item in values),
+            'sumsqr': sum(item['sumsqr'] for item in values),
+        }
+    return {
+        'sum': sum(values),
+        'count': len(values),
+        'min': min(values),
+        'max': max(values),
+        'sumsqr': sum(value * value for value in values),
+    }
+
+
+#: Built-in reduce functions
+BUILTIN_REDUCERS = {
+    '_count': builtin_count,
+    '_sum': builtin_sum,
+    '_stats': builtin_stats,
+}
+
+
+class ViewIndex(object):
+    """Incrementally updated view index.
+
+    Emitted rows are kept per document, so only changed documents get
+    passed through the map function on index update. Sorted rows list is
+    rebuilt lazily when it's needed by query.
+
+    :param map_fun: Map function or its Python source
+    :param reduce_fun: Reduce function, its Python source or name of
+                       built-in one: ``_count``, ``_sum`` or ``_stats``
+    """
+
+    def __init__(self, map_fun, reduce_fun=None):
+        self.map_fun = compile_function(map_fun)
+        if reduce_fun is None:
+            self.reduce_fun = None
+        elif reduce_fun in BUILTIN_REDUCERS:
+            self.reduce_fun = BUILTIN_REDUCERS[reduce_fun]
+        else:
+            self.reduce_fun = compile_function(reduce_fun)
+        self.update_seq = 0
+        self._emitted = {}
+        self._rows = []
+        self._keys = []
+        self._dirty = False
+
+    def __len__(self):
+        self._maybe_sort()
+        return len(self._rows)
+
+    def update(self, docid, doc, seq):
+        """Updates rows emitted for the document.
+
+        :param str docid: Document ID
+        :param dict doc: Document body or ``None`` if document was deleted
+        :param int seq: Update sequence of the change
+        """
+        self.update_seq = max(self.update_seq, seq)
+        rows = []
+        if doc is not None:
+            try:
+                for key, value in self.map_fun(doc) or ():
+                    rows.append((collate(key), docid, key, value))
+            except Exception:
+                # like CouchDB does, document which fails map function
+                # just doesn't get into the index
+                log.exception('map function failed for document %r', docid)
+                rows = []
+        if rows or self._emitted.pop(docid, None) is not None:
+            if rows:
+                self._emitted[docid] = rows
+            self._dirty = True
+
+    def query(self, *,
+              descending=False,
+              endkey=...,
+              endkey_docid=None,
+              group=False,
+              group_level=None,
+              inclusive_end=True,
+              key=...,
+              keys=None,
+              reduce=None,
+              skip=0,
+              limit=None,
+              startkey=...,
+              startkey_docid=None):
+        """Queries the index.
+
+        :returns: Tuple of total rows amount, offset and list of rows as
+                  ``(docid, key, value)`` tuples. For reduced results
+                  ``docid`` is ``None``
+        :rtype: tuple
+        """
+        self._maybe_sort()
+        if reduce is None:
+            reduce = self.reduce_fun is not None
+        if reduce and self.reduce_fun is None:
+            raise ValueError('reduce is invalid for map-only views')
+
+        if keys is not None:
+            rows = []
+            for item in keys:
+                lo, hi = self._bounds(item, item, None, None, True, False)
+                rows.extend(self._rows[lo:hi])
+            offset = 0
+        else:
+            if key is not ...:
+                startkey = endkey = key
+                inclusive_end = True
+            lo, hi = self._bounds(startkey, endkey,
+                                  startkey_docid, endkey_docid,
+                                  inclusive_end, descending)
+            rows = self._rows[lo:hi]
+            if descending:
+                rows.reverse()
+                offset = len(self._rows) - hi
+            else:
+                offset = lo
+
+        if reduce:
+            rows = self._reduce(rows, group, group_level)
+        else:
+            rows = [(docid, key, value) for _, docid, key, value in rows]
+            offset += skip
+        rows = rows[skip:]
+        if limit is not None:
+            rows = rows[:limit]
+        return len(self._rows), offset, rows
+
+    def _maybe_sort(self):
+        if not self._dirty:
+            return
+        rows = []
+        for items in self._emitted.values():
+            rows.extend(items)
+        rows.sort(key=lambda row: (row[0], row[1]))
+        self._rows = rows
+        self._keys = [(row[0], row[1]) for row in rows]
+        self._dirty = False
+
+    def _bounds(self, startkey, endkey, startkey_docid, endkey_docid,
+                inclusive_end, descending):
+        if descending:
+            lower = (endkey, endkey_docid, inclusive_end)
+            upper = (startkey, startkey_docid, True)
+        else:
+            lower = (startkey, startkey_docid, True)
+            upper = (endkey, endkey_docid, inclusive_end)
+
+        key, docid, inclusive = lower
+        if key is ...:
+            lo = 0
+        elif inclusive:
+            lo = bisect.bisect_left(self._keys, (collate(key), docid or ''))
+        else:
+            lo = bisect.bisect_right(self._keys,
+                                     (collate(key), docid or MAX_DOCID))
+
+        key, docid, inclusive = upper
+        if key is ...:
+            hi = len(self._keys)
+        elif inclusive:
+            hi = bisect.bisect_right(self._keys,
+                                     (collate(key), docid or MAX_DOCID))
+        else:
+            hi = bisect.bisect_left(self._keys, (collate(key), docid or ''))
+        return lo, max(lo, hi)
+
+    def _reduce(self, rows, group, group_level):
+        if not group and group_level is None:
+            if not rows:
+                return []
+            return [(None, None, self.reduce_fun(
+                [[row[2], row[1]] for row in rows],
+                [row[3] for row in rows], False))]
+
+        def group_key(key):
+            if group_level is not None and isinstance(key, list):
+                return key[:group_level]
+            return key
+
+        result = []
+        current = ...
+        keys = []
+        values = []
+        for _, docid, key, value in rows:
+            gkey = group_key(key)
+            if current is not ... and collate(gkey) != collate(current):
+                result.append((None, current,
+                               self.reduce_fun(keys, values, False)))
+                keys, values = [], []
+            current = gkey
+            keys.append([key, docid])
+            values.append(value)
+        if current is not ...:
+            result.append((None, current,
+                           self.reduce_fun(keys, values, False)))
+        return result
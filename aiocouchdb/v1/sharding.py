@@ -0,0 +1,374 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import bisect
+import hashlib
+
+from .server import Server
+
+
+__all__ = (
+    'HashRing',
+    'ShardedServer',
+)
+
+
+def md5_hash(key):
+    """Default :class:`HashRing` hash function: first 8 bytes of MD5 digest
+    of the key as an unsigned integer.
+
+    >>> md5_hash('foo')
+    12447132275286669404
+    """
+    if isinstance(key, str):
+        key = key.encode('utf-8')
+    return int.from_bytes(hashlib.md5(key).digest()[:8], 'big')
+
+
+class HashRing(object):
+    """Consistent hash ring with virtual nodes.
+
+    Each node is placed on the ring ``replicas * weight`` times, so keys are
+    spread evenly and adding or removing a node moves only about ``1/N`` of
+    them to other nodes.
+
+    >>> ring = HashRing(['a', 'b', 'c'])
+    >>> ring.get('foo') in ('a', 'b', 'c')
+    True
+    >>> ring.get('foo') == ring.get('foo')
+    True
+    >>> len(ring)
+    3
+    """
+
+    #: Default amount of virtual nodes per node
+    replicas = 160
+
+    def __init__(self, nodes=(), *, hash_func=md5_hash, replicas=None):
+        if replicas is not None:
+            self.replicas = replicas
+        self._hash = hash_func
+        self._keys = []
+        self._ring = {}
+        self._nodes = {}
+        for node in nodes:
+            self.add(node)
+
+    def __contains__(self, node):
+        return node in self._nodes
+
+    def __iter__(self):
+        return iter(self._nodes)
+
+    def __len__(self):
+        return len(self._nodes)
+
+    def add(self, node, weight=1):
+        """Places the node on the ring.
+
+        :param str node: Node name
+        :param int weight: Relative node capacity. Node with weight ``2``
+                           receives about twice more keys than with ``1``
+        """
+        if node in self._nodes:
+            raise ValueError('node %r is already on the ring' % node)
+        if weight < 1:
+            raise ValueError('weight should be positive integer')
+        self._nodes[node] = weight
+        for idx in range(self.replicas * weight):
+            point = self._hash('{}-{}'.format(node, idx))
+            if point in self._ring:
+                # extremely rare collision: all owners are kept sorted by
+                # name, so the point goes to the same node whatever order
+                # they were added and passes to the next one on removal
+                bisect.insort(self._ring[point], node)
+                continue
+            self._ring[point] = [node]
+            bisect.insort(self._keys, point)
+
+    def remove(self, node):
+        """Removes the node from the ring. Keys it owned are moved
+        to the next nodes clockwise.
+
+        :param str node: Node name
+        """
+        weight = self._nodes.pop(node)
+        for idx in range(self.replicas * weight):
+            point = self._hash('{}-{}'.format(node, idx))
+            owners = self._ring[point]
+            owners.remove(node)
+            if owners:
+                continue
+            del self._ring[point]
+            del self._keys[bisect.bisect_left(self._keys, point)]
+
+    def get(self, key):
+        """Returns node which owns the specified key.
+
+        :param str key: Routing key
+
+        :rtype: str
+        """
+        if not self._keys:
+            raise LookupError('hash ring is empty')
+        idx = bisect.bisect(self._keys, self._hash(key))
+        if idx == len(self._keys):
+            idx = 0
+        return self._ring[self._keys[idx]][0]
+
+
+class ShardedServer(object):
+    """Routes databases across independent CouchDB servers with a
+    :class:`consistent hash ring <HashRing>`.
+
+    Each database lives entirely on a single server picked by its name.
+    Alternatively, databases could be split by document ID partitions (the
+    part of document ID before ``partition_sep``) with :meth:`partition`,
+    so a single logical database is spread among all the servers.
+
+    >>> shards = ShardedServer(['http://couch1:5984', 'http://couch2:5984'])
+    >>> len(shards)
+    2
+    >>> shards['db'].resource.url == shards.node('db').resource.url + '/db'
+    True
+    """
+
+    #: Default :class:`~aiocouchdb.v1.server.Server` instance class
+    server_class = Server
+
+    #: Default :class:`HashRing` instance class
+    ring_class = HashRing
+
+    #: Separator between partition name and the rest of document ID
+    partition_sep = ':'
+
+    def __init__(self, urls_or_servers=(), *,
+                 loop=None,
+                 partition_sep=None,
+                 replicas=None,
+                 ring_class=None,
+                 server_class=None):
+        if partition_sep is not None:
+            self.partition_sep = partition_sep
+        if ring_class is not None:
+            self.ring_class = ring_class
+        if server_class is not None:
+            self.server_class = server_class
+        self._loop = loop
+        self._servers = {}
+        self._ring = self.ring_class(replicas=replicas)
+        for url_or_server in urls_or_servers:
+            self.add_node(url_or_server)
+
+    def __getitem__(self, dbname):
+        return self.node(dbname)[dbname]
+
+    def __len__(self):
+        return len(self._servers)
+
+    def __repr__(self):
+        return '<{}.{}({}) object at {}>'.format(
+            self.__module__,
+            self.__class__.__qualname__,  # pylint: disable=no-member
+            ', '.join(self._servers),
+            hex(id(self)))
+
+    @property
+    def servers(self):
+        """Returns list of :attr:`server_class` instances, one per node."""
+        return list(self._servers.values())
+
+    def add_node(self, url_or_server, *, weight=1):
+        """Adds CouchDB server to the ring.
+
+        :param url_or_server: Server URL or
+                              :class:`~aiocouchdb.v1.server.Server` instance
+        :param int weight: Relative node capacity
+
+        :rtype: :attr:`aiocouchdb.v1.sharding.ShardedServer.server_class`
+        """
+        if isinstance(url_or_server, str):
+            server = self.server_class(url_or_server, loop=self._loop)
+        else:
+            server = url_or_server
+        url = server.resource.url
+        self._ring.add(url, weight)
+        self._servers[url] = server
+        return server
+
+    def remove_node(self, url):
+        """Removes CouchDB server from the ring. Note, that data it holds
+        won't get moved anywhere automatically.
+
+        :param str url: Server URL
+
+        :rtype: :attr:`aiocouchdb.v1.sharding.ShardedServer.server_class`
+        """
+        self._ring.remove(url)
+        return self._servers.pop(url)
+
+    def node(self, key):
+        """Returns server which owns the specified routing key.
+
+        :param str key: Routing key: database name or partition key
+
+        :rtype: :attr:`aiocouchdb.v1.sharding.ShardedServer.server_class`
+        """
+        return self._servers[self._ring.get(key)]
+
+    @asyncio.coroutine
+    def db(self, dbname, *, auth=None):
+        """Returns :class:`~aiocouchdb.v1.database.Database` instance against
+        specified database name located on owner node.
+        See :meth:`aiocouchdb.v1.server.Server.db` for details.
+
+        :param str dbname: Database name
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+
+        :rtype: :attr:`aiocouchdb.v1.server.Server.database_class`
+        """
+        return (yield from self.node(dbname).db(dbname, auth=auth))
+
+    def partition(self, dbname, docid):
+        """Returns :class:`~aiocouchdb.v1.database.Database` instance
+        located on the node which owns the partition of the specified document.
+
+        Partition is the document ID part before :attr:`partition_sep`. If the
+        separator is missed, the whole document ID is used as the partition.
+
+        :param str dbname: Database name
+        :param str docid: Document ID
+
+        :rtype: :attr:`aiocouchdb.v1.server.Server.database_class`
+        """
+        partition = docid.split(self.partition_sep, 1)[0]
+        return self.node(dbname + '/' + partition)[dbname]
+
+    @asyncio.coroutine
+    def _fanout(self, method, *args, **kwargs):
+        servers = self.servers
+        results = yield from asyncio.gather(
+            *[getattr(server, method)(*args, **kwargs) for server in servers],
+            loop=self._loop)
+        return [(server.resource.url, result)
+                for server, result in zip(servers, results)]
+
+    @asyncio.coroutine
+    def all_dbs(self, *, auth=None):
+        """Returns sorted list of databases available on all the nodes.
+
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+
+        :rtype: list
+        """
+        dbnames = set()
+        for _, result in (yield from self._fanout('all_dbs', auth=auth)):
+            dbnames.update(result)
+        return sorted(dbnames)
+
+    @asyncio.coroutine
+    def active_tasks(self, *, auth=None):
+        """Returns list of active tasks which runs on all the nodes. Each task
+        object is extended with ``node`` field which holds server URL.
+
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+
+        :rtype: list
+        """
+        tasks = []
+        results = yield from self._fanout('active_tasks', auth=auth)
+        for url, result in results:
+            for task in result:
+                task['node'] = url
+                tasks.append(task)
+        return tasks
+
+    @asyncio.coroutine
+    def stats(self, metric=None, *, auth=None, flush=None, range=None,
+              merge=True):
+        """Returns statistics of all the nodes.
+        See :meth:`aiocouchdb.v1.server.Server.stats` for arguments definition.
+
+        When ``merge`` is ``True``, metrics are aggregated in the single
+        :meth:`~aiocouchdb.v1.server.Server.stats`-like object: ``current``
+        and ``sum`` values are summed up, ``min`` and ``max`` are picked among
+        the nodes and ``mean`` is averaged. ``stddev`` cannot be combined
+        without the raw samples and set to ``None``. Otherwise, mapping of
+        server URL to its stats is returned.
+
+        :param bool merge: Whenever to merge stats into single object
+
+        :rtype: dict
+        """
+        results = yield from self._fanout('stats', metric, auth=auth,
+                                          flush=flush, range=range)
+        if not merge:
+            return dict(results)
+        merged = {}
+        for _, result in results:
+            merge_stats(merged, result)
+        for group in merged.values():
+            for value in group.values():
+                value['mean'] = _avg(value['mean'])
+        return merged
+
+
+def merge_stats(acc, stats):
+    """Merges CouchDB :meth:`~aiocouchdb.v1.server.Server.stats` object into
+    accumulator. Collected ``mean`` values are kept as a list.
+
+    >>> acc = {}
+    >>> metric = {'current': 2, 'sum': 2, 'min': 0, 'max': 1, 'mean': 0.5}
+    >>> merge_stats(acc, {'httpd': {'requests': dict(metric)}})
+    >>> merge_stats(acc, {'httpd': {'requests': dict(metric, max=3)}})
+    >>> requests = acc['httpd']['requests']
+    >>> sorted(requests.items())  # doctest: +NORMALIZE_WHITESPACE
+    [('current', 4), ('max', 3), ('mean', [0.5, 0.5]), ('min', 0),
+     ('stddev', None), ('sum', 4)]
+    """
+    for group_name, group in stats.items():
+        acc_group = acc.setdefault(group_name, {})
+        for name, value in group.items():
+            if name not in acc_group:
+                acc_group[name] = dict(value,
+                                       mean=[value.get('mean')],
+                                       stddev=None)
+                continue
+            acc_value = acc_group[name]
+            for key in ('current', 'sum'):
+                acc_value[key] = _add(acc_value.get(key), value.get(key))
+            acc_value['min'] = _pick(min, acc_value.get('min'),
+                                     value.get('min'))
+            acc_value['max'] = _pick(max, acc_value.get('max'),
+                                     value.get('max'))
+            acc_value['mean'].append(value.get('mean'))
+
+
+def _add(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return a + b
+
+
+def _pick(func, a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return func(a, b)
+
+
+def _avg(values):
+    values = [value for value in values if value is not None]
+    if not values:
+        return None
+    return sum(values) / len(values)
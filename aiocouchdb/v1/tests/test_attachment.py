@@ -7,13 +7,24 @@
 # you should have received as part of this distribution.
 #
 
+import asyncio
 import base64
+import gzip
 import hashlib
 import io
+import os
+import shutil
+import tempfile
+
+import aiohttp
+from aiohttp.errors import ClientOSError
 
 import aiocouchdb.client
+import aiocouchdb.multipart
 import aiocouchdb.v1.attachment
 import aiocouchdb.v1.document
+from aiocouchdb.client import request
+from aiocouchdb.compat import StopAsyncIteration
 
 from . import utils
 
@@ -98,6 +109,13 @@ class AttachmentTestCase(utils.AttachmentTestCase):
                                         headers={'IF-NONE-MATCH': reqdigest})
         self.assertTrue(result)
 
+    def test_modified_with_stub_digest(self):
+        digest = 'md5-rL0Y20zC+Fzt72VPzMSk2A=='
+        reqdigest = '"rL0Y20zC+Fzt72VPzMSk2A=="'
+        yield from self.attbin.modified(digest)
+        self.assert_request_called_with('HEAD', *self.request_path(),
+                                        headers={'IF-NONE-MATCH': reqdigest})
+
     def test_modified_invalid_digest(self):
         with self.assertRaises(TypeError):
             yield from self.attbin.modified({})
@@ -146,6 +164,11 @@ class AttachmentTestCase(utils.AttachmentTestCase):
         self.assert_request_called_with('GET', *self.request_path(),
                                         headers={'RANGE': 'bytes=0-42'})
 
+    def test_get_range_till_end(self):
+        yield from self.attbin.get(range=slice(42, None))
+        self.assert_request_called_with('GET', *self.request_path(),
+                                        headers={'RANGE': 'bytes=42-'})
+
     def test_get_range_iterable(self):
         yield from self.attbin.get(range=[11, 22])
         self.assert_request_called_with('GET', *self.request_path(),
@@ -234,10 +257,32 @@ class AttachmentReaderTestCase(utils.TestCase):
         yield from self.att.read()
         self.request.content.read.assert_called_once_with(-1)
 
+    def test_release_connection_on_eof(self):
+        self.request.content.at_eof.return_value = False
+        yield from self.att.read(10)
+        self.assertFalse(self.request.close.called)
+        self.request.content.at_eof.return_value = True
+        yield from self.att.read(10)
+        self.assertTrue(self.request.close.called)
+
     def test_read_some(self):
         yield from self.att.read(10)
         self.request.content.read.assert_called_once_with(10)
 
+    def test_async_iteration(self):
+        with self.response(data=[b'foo', b'bar']) as resp:
+            self.att._resp = resp
+            self.assertIs(self.att, self.att.__aiter__())
+            chunks = []
+            while True:
+                try:
+                    chunks.append((yield from self.att.__anext__()))
+                except StopAsyncIteration:
+                    break
+
+        resp.content.read.assert_called_with(self.att.chunk_size)
+        self.assertEqual([b'foo', b'bar'], chunks)
+
     def test_readall(self):
         with self.response(data=[b'...', b'---']) as resp:
             self.att._resp = resp
@@ -271,6 +316,17 @@ class AttachmentReaderTestCase(utils.TestCase):
         self.assertEqual(resp.content.read.call_count, 1)
         self.assertEqual(res, [b'...'])
 
+    def test_readlines_stops_on_eof(self):
+        lines = [b'foo\n', b'']
+
+        @asyncio.coroutine
+        def readline():
+            return lines.pop(0)
+        self.request.content.at_eof.return_value = False
+        self.request.content.readline = readline
+        res = yield from self.att.readlines()
+        self.assertEqual([b'foo\n'], res)
+
     def test_readlines_hint_more(self):
         with self.response(data=[b'...', b'---']) as resp:
             resp.content.readline = resp.content.read
@@ -280,3 +336,477 @@ class AttachmentReaderTestCase(utils.TestCase):
         self.assertTrue(resp.content.readline.called)
         self.assertEqual(resp.content.read.call_count, 3)
         self.assertEqual(res, [b'...', b'---'])
+
+
+class AttachmentStreamingTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(100000)
+        self.att = self.db['doc']['data.bin']
+        self.loop.run_until_complete(self.att.update(io.BytesIO(self.data)))
+
+    def test_readinto(self):
+        reader = yield from self.att.get()
+        buffer = bytearray(30000)
+        chunks = []
+        while True:
+            size = yield from reader.readinto(buffer)
+            if not size:
+                break
+            self.assertLessEqual(size, 30000)
+            chunks.append(bytes(buffer[:size]))
+        self.assertEqual(self.data, b''.join(chunks))
+        self.assertTrue(reader.closed)
+        self.assertEqual(0, (yield from reader.readinto(buffer)))
+
+    def test_readinto_flow_control_internals(self):
+        # readinto fast path relies on these internals of aiohttp
+        reader = yield from self.att.get()
+        content = reader._resp.content
+        self.assertIsInstance(content, aiohttp.streams.FlowControlStreamReader)
+        self.assertIsInstance(content._buffer, bytearray)
+        self.assertIsNone(content._waiter)
+        self.assertTrue(callable(content._create_waiter))
+        self.assertIsInstance(content._stream.paused, bool)
+        self.assertIsInstance(content._b_limit, int)
+        reader.close()
+
+    def test_readinto_other_stream_reader(self):
+        reader = yield from self.att.get()
+        content = aiohttp.streams.StreamReader(loop=self.loop)
+        content.feed_data(self.data)
+        content.feed_eof()
+        reader._resp.close()
+        reader._resp.content = content
+        buffer = bytearray(30000)
+        self.assertEqual(30000, (yield from reader.readinto(buffer)))
+        self.assertEqual(self.data[:30000], buffer)
+
+    def test_readinto_empty_buffer(self):
+        reader = yield from self.att.get()
+        self.assertEqual(0, (yield from reader.readinto(bytearray())))
+        reader.close()
+
+    def test_iter_chunks(self):
+        reader = yield from self.att.get()
+        chunks = []
+        iterator = reader.iter_chunks(30000)
+        self.assertIs(iterator, iterator.__aiter__())
+        while True:
+            try:
+                chunk = yield from iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            self.assertIsInstance(chunk, bytes)
+            chunks.append(chunk)
+        self.assertEqual(self.data, b''.join(chunks))
+
+    def test_iter_chunks_reuse_buffer(self):
+        reader = yield from self.att.get()
+        chunks = []
+        views = set()
+        iterator = reader.iter_chunks(30000, reuse_buffer=True)
+        while True:
+            try:
+                chunk = yield from iterator.__anext__()
+            except StopAsyncIteration:
+                break
+            self.assertIsInstance(chunk, memoryview)
+            views.add(id(chunk.obj))
+            chunks.append(chunk.tobytes())
+        self.assertEqual(self.data, b''.join(chunks))
+        self.assertEqual(1, len(views))
+
+    def test_copy_to_file(self):
+        reader = yield from self.att.get()
+        fileobj = io.BytesIO()
+        total = yield from reader.copy_to(fileobj, chunk_size=4096)
+        self.assertEqual(100000, total)
+        self.assertEqual(self.data, fileobj.getvalue())
+
+    def test_copy_to_stream_writer(self):
+        writer = StreamWriter(self.loop)
+        reader = yield from self.att.get()
+        yield from reader.copy_to(writer)
+        self.assertEqual(self.data, bytes(writer.data))
+        self.assertEqual(writer.writes, writer.drains)
+
+    def test_readall_known_length(self):
+        reader = yield from self.att.get()
+        data = yield from reader.readall()
+        self.assertIsInstance(data, bytearray)
+        self.assertEqual(self.data, data)
+
+
+class StreamWriter(object):
+
+    def __init__(self, loop):
+        self.loop = loop
+        self.data = bytearray()
+        self.writes = 0
+        self.drains = 0
+
+    def write(self, data):
+        self.data.extend(data)
+        self.writes += 1
+
+    @asyncio.coroutine
+    def drain(self):
+        yield from asyncio.sleep(0, loop=self.loop)
+        self.drains += 1
+
+
+class AttachmentDownloadTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(1000)
+        self.att = self.db['doc']['data.bin']
+        self.loop.run_until_complete(self.att.update(io.BytesIO(self.data)))
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'data.bin')
+        self.emulator.stats.clear()
+
+    def read_file(self):
+        with open(self.path, 'rb') as fileobj:
+            return fileobj.read()
+
+    def fail_ranges(self, *ranges, times=1):
+        failures = dict.fromkeys(ranges, times)
+
+        def side_effect(method, url, **kwargs):
+            rng = dict(kwargs.get('headers') or {}).get('RANGE')
+            if failures.get(rng):
+                failures[rng] -= 1
+                raise ClientOSError('connection reset')
+            return request(method, url, **kwargs)
+        self.request.side_effect = side_effect
+
+    def test_download(self):
+        length = yield from self.att.download(self.path, parts=4,
+                                              loop=self.loop)
+        self.assertEqual(1000, length)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(1, self.emulator.stats['HEAD'])
+        self.assertEqual(4, self.emulator.stats[206])
+        self.assertFalse(os.path.exists(self.path + '.download'))
+
+    def rewrite_ranges(self, rewrite):
+        def side_effect(method, url, **kwargs):
+            headers = dict(kwargs.get('headers') or {})
+            if 'RANGE' in headers:
+                kwargs['headers'] = rewrite(headers)
+            return request(method, url, **kwargs)
+        self.request.side_effect = side_effect
+
+    def test_download_range_ignored(self):
+        # proxy drops Range header, so server responds with whole content
+        self.rewrite_ranges(lambda headers: {})
+        length = yield from self.att.download(self.path, parts=4,
+                                              loop=self.loop)
+        self.assertEqual(1000, length)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(0, self.emulator.stats[206])
+        self.assertFalse(os.path.exists(self.path + '.download'))
+
+    def test_download_unexpected_range(self):
+        def rewrite(headers):
+            if headers['RANGE'] == 'bytes=250-499':
+                headers['RANGE'] = 'bytes=250-'
+            return headers
+        self.rewrite_ranges(rewrite)
+        length = yield from self.att.download(self.path, parts=4,
+                                              loop=self.loop)
+        self.assertEqual(1000, length)
+        self.assertEqual(self.data, self.read_file())
+
+    def test_upload_regular_file(self):
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write(self.data[::-1])
+        with open(self.path, 'rb') as fileobj:
+            yield from self.att.update(fileobj,
+                                       rev=(yield from self.db['doc'].rev()))
+        reader = yield from self.att.get()
+        self.assertEqual(self.data[::-1], (yield from reader.read()))
+
+    def test_download_fileobj(self):
+        fileobj = io.BytesIO(b'garbage' * 1000)
+        yield from self.att.download(fileobj, parts=3, chunk_size=7,
+                                     loop=self.loop)
+        self.assertEqual(self.data, fileobj.getvalue())
+        self.assertEqual(0, fileobj.tell())
+
+    def test_download_more_parts_than_bytes(self):
+        yield from self.att.update(io.BytesIO(b'abc'),
+                                   rev=(yield from self.db['doc'].rev()))
+        yield from self.att.download(self.path, parts=8, loop=self.loop)
+        self.assertEqual(b'abc', self.read_file())
+        self.assertEqual(3, self.emulator.stats[206])
+
+    def test_download_empty(self):
+        yield from self.att.update(io.BytesIO(b''),
+                                   rev=(yield from self.db['doc'].rev()))
+        self.assertEqual(0, (yield from self.att.download(self.path,
+                                                          loop=self.loop)))
+        self.assertEqual(b'', self.read_file())
+
+    def test_download_encoded(self):
+        yield from self.att.update(io.BytesIO(gzip.compress(self.data)),
+                                   content_encoding='gzip',
+                                   rev=(yield from self.db['doc'].rev()))
+        yield from self.att.download(self.path, parts=4, loop=self.loop)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(0, self.emulator.stats[206])
+
+    def test_retry_failed_ranges(self):
+        self.fail_ranges('bytes=250-499')
+        yield from self.att.download(self.path, parts=4, loop=self.loop)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(4, self.emulator.stats[206])
+
+    def test_resume(self):
+        self.fail_ranges('bytes=500-749', times=2)
+        with self.assertRaises(ClientOSError):
+            yield from self.att.download(self.path, parts=4, retries=1,
+                                         loop=self.loop)
+        self.assertTrue(os.path.exists(self.path + '.download'))
+        self.assertEqual(3, self.emulator.stats[206])
+
+        yield from self.att.download(self.path, parts=4, loop=self.loop)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(4, self.emulator.stats[206])
+        self.assertFalse(os.path.exists(self.path + '.download'))
+
+    def test_restart_changed_attachment(self):
+        self.fail_ranges('bytes=0-249')
+        with self.assertRaises(ClientOSError):
+            yield from self.att.download(self.path, retries=0,
+                                         loop=self.loop)
+        data = os.urandom(1000)
+        yield from self.att.update(io.BytesIO(data),
+                                   rev=(yield from self.db['doc'].rev()))
+        yield from self.att.download(self.path, loop=self.loop)
+        self.assertEqual(data, self.read_file())
+        self.assertEqual(7, self.emulator.stats[206])
+
+
+class AttachmentDedupTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(1000)
+        self.att = self.db['doc']['data.bin']
+        result = self.loop.run_until_complete(
+            self.att.update(io.BytesIO(self.data)))
+        self.rev = result['rev']
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.emulator.stats.clear()
+
+    def test_compute_digest(self):
+        fileobj = io.BytesIO(b'skip' + self.data)
+        fileobj.seek(4)
+        digest = aiocouchdb.v1.attachment.compute_digest(fileobj)
+        self.assertEqual(4, fileobj.tell())
+        doc = yield from self.db['doc'].get()
+        self.assertEqual(doc['_attachments']['data.bin']['digest'], digest)
+        self.assertIsNone(
+            aiocouchdb.v1.attachment.compute_digest(io.StringIO('foo')))
+
+    def test_format_digest(self):
+        digest = aiocouchdb.v1.attachment.format_digest(
+            hashlib.md5(self.data))
+        doc = yield from self.db['doc'].get()
+        self.assertEqual(doc['_attachments']['data.bin']['digest'], digest)
+
+    def test_update_skips_stored(self):
+        fileobj = io.BytesIO(self.data)
+        result = yield from self.att.update(fileobj, dedup=True, rev=self.rev)
+        self.assertEqual({'ok': True, 'rev': self.rev, 'skipped': True},
+                         result)
+        self.assertEqual(0, fileobj.tell())
+        self.assertEqual(2, self.emulator.stats['HEAD'])
+        self.assertEqual(0, self.emulator.stats['PUT'])
+
+    def test_update_skipped_reports_current_rev(self):
+        yield from self.db['doc']['other.bin'].update(io.BytesIO(b'...'),
+                                                      rev=self.rev)
+        rev = yield from self.db['doc'].rev()
+        self.assertNotEqual(self.rev, rev)
+        self.emulator.stats.clear()
+        for stale in (None, self.rev):
+            result = yield from self.att.update(io.BytesIO(self.data),
+                                                dedup=True, rev=stale)
+            self.assertEqual({'ok': True, 'rev': rev, 'skipped': True},
+                             result)
+        self.assertEqual(0, self.emulator.stats['PUT'])
+
+    def test_document_resource(self):
+        self.assertEqual(self.db['doc'].resource.url,
+                         self.att.document_resource().url)
+        att = self.db['doc']['path/to/data.bin']
+        self.assertEqual(self.db['doc'].resource.url,
+                         att.document_resource().url)
+        self.assertIs(self.att.resource.session,
+                      self.att.document_resource().session)
+
+    def test_update_uploads_changed(self):
+        result = yield from self.att.update(io.BytesIO(self.data[::-1]),
+                                            dedup=True, rev=self.rev)
+        self.assertTrue(result['rev'].startswith('2-'))
+        self.assertEqual(1, self.emulator.stats['PUT'])
+
+    def test_update_uploads_missing(self):
+        att = self.db['doc']['other.bin']
+        result = yield from att.update(io.BytesIO(self.data),
+                                       dedup=True, rev=self.rev)
+        self.assertTrue(result['rev'].startswith('2-'))
+        self.assertEqual(1, self.emulator.stats[404])
+
+    def test_digest_index(self):
+        path = os.path.join(self.tmpdir, 'index.json')
+        index = aiocouchdb.v1.attachment.DigestIndex(path)
+        result = yield from self.att.update(io.BytesIO(self.data[::-1]),
+                                            digest_index=index, rev=self.rev)
+        self.assertEqual(1, len(index))
+        self.assertEqual(1, self.emulator.stats['HEAD'])
+        index.save()
+
+        index = aiocouchdb.v1.attachment.DigestIndex(path)
+        result = yield from self.att.update(io.BytesIO(self.data[::-1]),
+                                            digest_index=index,
+                                            rev=result['rev'])
+        self.assertTrue(result['skipped'])
+        # the only new request is for the current document revision
+        self.assertEqual(2, self.emulator.stats['HEAD'])
+        self.assertEqual(1, self.emulator.stats['PUT'])
+
+        index.discard(self.att)
+        self.assertIsNone(index.get(self.att))
+
+    def test_digest_index_learns_stored(self):
+        index = aiocouchdb.v1.attachment.DigestIndex()
+        yield from self.att.update(io.BytesIO(self.data),
+                                   digest_index=index, rev=self.rev)
+        yield from self.att.update(io.BytesIO(self.data),
+                                   digest_index=index, rev=self.rev)
+        # one check of attachment digest and two of document revision
+        self.assertEqual(3, self.emulator.stats['HEAD'])
+        self.assertEqual(0, self.emulator.stats['PUT'])
+        with self.assertRaises(ValueError):
+            index.save()
+
+
+class AttachmentCompressionTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = b'\n'.join(b'line %d' % i for i in range(10000))
+        self.att = self.db['doc']['data.txt']
+        self.payloads = []
+
+        @asyncio.coroutine
+        def side_effect(method, url, **kwargs):
+            if method == 'PUT':
+                self.payloads.append((kwargs['data'],
+                                      dict(kwargs['headers'])))
+            return (yield from request(method, url, **kwargs))
+        self.request.side_effect = side_effect
+
+    @asyncio.coroutine
+    def stub(self):
+        doc = yield from self.db['doc'].get(att_encoding_info=True)
+        return doc['_attachments'][self.att.name]
+
+    @asyncio.coroutine
+    def read_att(self):
+        reader = yield from self.att.get()
+        return bytes((yield from reader.read()))
+
+    def test_update_compress(self):
+        yield from self.att.update(io.BytesIO(self.data),
+                                   compress='gzip',
+                                   content_type='text/plain')
+        self.assertEqual('gzip', (yield from self.stub())['encoding'])
+        self.assertEqual(self.data, (yield from self.read_att()))
+
+        payload, headers = self.payloads[0]
+        self.assertIsInstance(payload, aiocouchdb.multipart.GzipStream)
+        self.assertEqual('gzip', headers['CONTENT-ENCODING'])
+        self.assertEqual(len(self.data), payload.length)
+        self.assertLess(payload.compressed_length, len(self.data) // 4)
+
+    def test_update_compress_failing_source(self):
+        class Source(object):
+            @asyncio.coroutine
+            def read(self, size):
+                raise OSError('disk is gone')
+
+        with self.assertRaises(aiohttp.ClientRequestError) as ctx:
+            yield from self.att.update(Source(), compress='gzip',
+                                       content_type='text/plain')
+        self.assertIsInstance(ctx.exception.__cause__, OSError)
+
+    def test_update_compress_threaded(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'data.txt')
+        with open(path, 'wb') as fileobj:
+            fileobj.write(self.data)
+        with open(path, 'rb') as fileobj:
+            yield from self.att.update(fileobj,
+                                       compress='gzip',
+                                       compress_level=1,
+                                       compress_threaded=True,
+                                       content_type='text/plain')
+        self.assertEqual('gzip', (yield from self.stub())['encoding'])
+        self.assertEqual(self.data, (yield from self.read_att()))
+
+    def test_update_compress_async_source(self):
+        yield from self.att.update(io.BytesIO(self.data),
+                                   content_type='text/plain')
+        reader = yield from self.att.get()
+        att = self.db['doc']['copy.txt']
+        yield from att.update(reader,
+                              compress='gzip',
+                              content_type='text/plain',
+                              rev=(yield from self.db['doc'].rev()))
+        reader = yield from att.get()
+        self.assertEqual(self.data, bytes((yield from reader.read())))
+
+    def test_update_skips_compressed_type(self):
+        yield from self.att.update(io.BytesIO(self.data),
+                                   compress='gzip',
+                                   content_type='image/png')
+        self.assertNotIn('encoding', (yield from self.stub()))
+        self.assertEqual(self.data, (yield from self.read_att()))
+        self.assertIsInstance(self.payloads[0][0], io.BytesIO)
+
+    def test_update_encoded(self):
+        yield from self.att.update(io.BytesIO(gzip.compress(self.data)),
+                                   content_encoding='gzip',
+                                   content_type='text/plain')
+        self.assertEqual('gzip', (yield from self.stub())['encoding'])
+        self.assertEqual(self.data, (yield from self.read_att()))
+
+    def test_update_compress_bad_args(self):
+        with self.assertRaises(ValueError):
+            yield from self.att.update(io.BytesIO(self.data), compress='br')
+        with self.assertRaises(ValueError):
+            yield from self.att.update(io.BytesIO(self.data),
+                                       compress='gzip',
+                                       content_encoding='gzip')
+        with self.assertRaises(TypeError):
+            yield from self.att.update(
+                aiocouchdb.multipart.SizedStream(io.BytesIO(self.data), 10),
+                compress='gzip')
+        with self.assertRaises(ValueError):
+            yield from self.att.update(io.BytesIO(self.data),
+                                       compress='gzip', dedup=True)
+        with self.assertRaises(ValueError):
+            yield from self.att.update(
+                io.BytesIO(self.data), compress='gzip',
+                digest_index=aiocouchdb.v1.attachment.DigestIndex())
+        self.assertEqual([], self.payloads)
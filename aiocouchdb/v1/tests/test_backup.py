@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import gzip
+import io
+import json
+import os
+import shutil
+import tempfile
+
+from aiocouchdb.v1.backup import (
+    export_attachments,
+    import_attachments,
+    split_ranges
+)
+
+from . import utils
+
+
+class DatabasesTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.target = self.loop.run_until_complete(self.server.db('target'))
+        self.loop.run_until_complete(self.target.create())
+        self.loop.run_until_complete(self.db.bulk_docs(
+            [{'_id': 'doc{:02}'.format(idx), 'idx': idx}
+             for idx in range(20)]))
+
+
+class BackupTestCase(DatabasesTestCase):
+
+    def read_dump(self, fileobj):
+        fileobj.seek(0)
+        with gzip.GzipFile(fileobj=fileobj) as stream:
+            header, *docs = [json.loads(line.decode()) for line in stream]
+        self.header = header['aiocouchdb_dump']
+        return docs
+
+    def test_split_ranges(self):
+        ranges = yield from split_ranges(self.db, 4)
+        self.assertEqual([(None, 'doc05'), ('doc05', 'doc10'),
+                          ('doc10', 'doc15'), ('doc15', None)], ranges)
+
+    def test_split_single_range(self):
+        self.assertEqual([(None, None)], (yield from split_ranges(self.db, 1)))
+
+    def test_split_more_ranges_than_docs(self):
+        yield from self.target['doc'].update({})
+        ranges = yield from split_ranges(self.target, 3)
+        self.assertEqual([(None, None)], ranges)
+
+    def test_dump(self):
+        fileobj = io.BytesIO()
+        count = yield from self.db.dump(fileobj, ranges=3, loop=self.loop)
+        self.assertEqual(20, count)
+        self.assertFalse(fileobj.closed)
+        docs = self.read_dump(fileobj)
+        self.assertEqual(['doc{:02}'.format(idx) for idx in range(20)],
+                         sorted(doc['_id'] for doc in docs))
+        self.assertTrue(all(doc['_rev'].startswith('1-') for doc in docs))
+
+    def test_dump_drops_attachment_stubs(self):
+        yield from self.db['doc00']['att.txt'].update(
+            io.BytesIO(b'foo'), rev=(yield from self.db['doc00'].rev()))
+        fileobj = io.BytesIO()
+        yield from self.db.dump(fileobj, attachments=False, loop=self.loop)
+        docs = self.read_dump(fileobj)
+        self.assertEqual({'attachments': False}, self.header)
+        self.assertNotIn('_attachments', docs[0])
+        self.assertNotIn('_rev', docs[0])
+        self.assertIn('_rev', docs[1])
+
+    def test_dump_restore_without_attachments(self):
+        doc = self.db['doc00']
+        yield from doc['att.txt'].update(io.BytesIO(b'foo'),
+                                         rev=(yield from doc.rev()))
+        rev = yield from doc.rev()
+        fileobj = io.BytesIO()
+        yield from self.db.dump(fileobj, attachments=False, loop=self.loop)
+        fileobj.seek(0)
+        stats = yield from self.target.restore(fileobj, loop=self.loop)
+        self.assertEqual({'docs': 20, 'errors': []}, stats)
+
+        # attachment-less document gets a revision of its own, so it
+        # can't shadow the original one on replication
+        restored = self.target['doc00']
+        self.assertNotEqual(rev, (yield from restored.rev()))
+        self.assertEqual('1-', (yield from restored.rev())[:2])
+        self.assertEqual(0, (yield from restored.get())['idx'])
+        self.assertEqual(
+            (yield from self.db['doc01'].rev()),
+            (yield from self.target['doc01'].rev()))
+
+    def test_dump_restore(self):
+        doc = self.db['doc00']
+        yield from doc.update({'idx': 0, 'updated': True},
+                              rev=(yield from doc.rev()))
+        yield from doc['att.txt'].update(io.BytesIO(b'Hello, world!'),
+                                         content_type='text/plain',
+                                         rev=(yield from doc.rev()))
+        rev = yield from doc.rev()
+
+        fileobj = io.BytesIO()
+        yield from self.db.dump(fileobj, ranges=2, loop=self.loop)
+        self.read_dump(fileobj)
+        self.assertEqual({'attachments': True}, self.header)
+        fileobj.seek(0)
+        stats = yield from self.target.restore(fileobj, batch_size=3,
+                                               concurrency=2, loop=self.loop)
+        self.assertEqual({'docs': 20, 'errors': []}, stats)
+
+        self.assertEqual(20, (yield from self.target.info())['doc_count'])
+        restored = self.target['doc00']
+        self.assertEqual(rev, (yield from restored.rev()))
+        self.assertTrue((yield from restored.get())['updated'])
+        reader = yield from restored['att.txt'].get()
+        self.assertEqual(b'Hello, world!', (yield from reader.read()))
+        self.assertEqual('1-', (yield from self.target['doc19'].rev())[:2])
+
+    def test_dump_restore_file(self):
+        fd, path = tempfile.mkstemp(suffix='.ndjson.gz')
+        os.close(fd)
+        self.addCleanup(os.unlink, path)
+        yield from self.db.dump(path, flush_every=3, loop=self.loop)
+        stats = yield from self.target.restore(path, loop=self.loop)
+        self.assertEqual(20, stats['docs'])
+        self.assertEqual(20, (yield from self.target.info())['doc_count'])
+
+    def test_restore_errors(self):
+        fileobj = io.BytesIO()
+        with gzip.GzipFile(fileobj=fileobj, mode='wb') as stream:
+            stream.write(b'{"_id": "foo", "_rev": "1-abc"}\n\n')
+            stream.write(b'{"_id": "bar", "_rev": "1-abc",'
+                         b' "_attachments": {"a": {"stub": true}}}\n')
+        fileobj.seek(0)
+        stats = yield from self.target.restore(fileobj, loop=self.loop)
+        self.assertEqual(2, stats['docs'])
+        self.assertEqual(['bar'], [item['id'] for item in stats['errors']])
+        self.assertEqual('1-abc', (yield from self.target['foo'].rev()))
+
+
+class AttachmentsExportTestCase(DatabasesTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.loop.run_until_complete(self.attach('doc00', 'a.txt', b'foo'))
+        self.loop.run_until_complete(self.attach('doc00', 'dir/b.bin', b'bar'))
+        self.loop.run_until_complete(self.attach('doc07', 'c.txt', b'baz'))
+
+    @asyncio.coroutine
+    def attach(self, docid, name, data, db=None):
+        doc = (db or self.db)[docid]
+        rev = yield from doc.rev()
+        yield from doc[name].update(io.BytesIO(data), rev=rev)
+
+    def read_file(self, *path):
+        with open(os.path.join(self.path, *path), 'rb') as fileobj:
+            return fileobj.read()
+
+    def test_export(self):
+        stats = yield from export_attachments(self.db, self.path,
+                                              chunk_size=2, concurrency=2,
+                                              loop=self.loop)
+        self.assertEqual({'transferred': 3, 'skipped': 0, 'errors': []},
+                         stats)
+        self.assertEqual(['doc00', 'doc07'], sorted(os.listdir(self.path)))
+        self.assertEqual(b'foo', self.read_file('doc00', 'a.txt'))
+        self.assertEqual(b'bar', self.read_file('doc00', 'dir%2Fb.bin'))
+        self.assertEqual(b'baz', self.read_file('doc07', 'c.txt'))
+
+    def test_export_skips_same_digest(self):
+        yield from export_attachments(self.db, self.path, loop=self.loop)
+        with open(os.path.join(self.path, 'doc07', 'c.txt'), 'wb') as f:
+            f.write(b'corrupted')
+        stats = yield from export_attachments(self.db, self.path,
+                                              loop=self.loop)
+        self.assertEqual({'transferred': 1, 'skipped': 2, 'errors': []},
+                         stats)
+        self.assertEqual(b'baz', self.read_file('doc07', 'c.txt'))
+
+    def test_import(self):
+        yield from export_attachments(self.db, self.path, loop=self.loop)
+        yield from self.target['doc00'].update({'keep': True})
+        stats = yield from import_attachments(self.target, self.path,
+                                              concurrency=2, loop=self.loop)
+        self.assertEqual({'transferred': 3, 'skipped': 0, 'errors': []},
+                         stats)
+        doc = yield from self.target['doc00'].get()
+        self.assertTrue(doc['keep'])
+        self.assertEqual({'a.txt', 'dir/b.bin'}, set(doc['_attachments']))
+        self.assertEqual('text/plain',
+                         doc['_attachments']['a.txt']['content_type'])
+        reader = yield from self.target['doc07']['c.txt'].get()
+        self.assertEqual(b'baz', (yield from reader.read()))
+
+    def test_import_skips_same_digest(self):
+        yield from export_attachments(self.db, self.path, loop=self.loop)
+        yield from self.target['doc00'].update({})
+        yield from self.attach('doc00', 'a.txt', b'foo', self.target)
+        stats = yield from import_attachments(self.target, self.path,
+                                              loop=self.loop)
+        self.assertEqual({'transferred': 2, 'skipped': 1, 'errors': []},
+                         stats)
+
+    def test_export_import_names_like_temporary_files(self):
+        yield from self.attach('doc07', 'video.part', b'part')
+        yield from self.attach('doc07', '.hidden', b'hidden')
+        stats = yield from export_attachments(self.db, self.path,
+                                              loop=self.loop)
+        self.assertEqual({'transferred': 5, 'skipped': 0, 'errors': []},
+                         stats)
+        self.assertEqual(['%2Ehidden', 'c.txt', 'video.part'],
+                         sorted(os.listdir(os.path.join(self.path, 'doc07'))))
+        with open(os.path.join(self.path, 'doc07', '.tmp1234'), 'wb') as f:
+            f.write(b'leftover')
+
+        stats = yield from import_attachments(self.target, self.path,
+                                              loop=self.loop)
+        self.assertEqual({'transferred': 5, 'skipped': 0, 'errors': []},
+                         stats)
+        doc = yield from self.target['doc07'].get()
+        self.assertEqual({'.hidden', 'c.txt', 'video.part'},
+                         set(doc['_attachments']))
+        reader = yield from self.target['doc07']['video.part'].get()
+        self.assertEqual(b'part', (yield from reader.read()))
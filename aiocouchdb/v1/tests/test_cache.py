@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import gzip
+import io
+import os
+import shutil
+import tempfile
+
+from aiohttp.multidict import CIMultiDict
+
+from aiocouchdb.client import request
+from aiocouchdb.errors import ResourceNotFound
+from aiocouchdb.metrics import MetricsCollector
+from aiocouchdb.v1.attachment import AttachmentReader
+from aiocouchdb.v1.cache import (
+    AttachmentCache,
+    CachedAttachmentReader,
+    CachingAttachmentReader
+)
+
+from . import utils
+
+
+class AttachmentCacheTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(1000)
+        self.att = self.db['doc']['data.bin']
+        result = self.loop.run_until_complete(
+            self.att.update(io.BytesIO(self.data)))
+        self.rev = result['rev']
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.cache = AttachmentCache(self.directory, chunk_size=100)
+        self.emulator.stats.clear()
+
+    def read(self, reader):
+        try:
+            return (yield from reader.read())
+        finally:
+            reader.close()
+
+    def test_miss_then_hit(self):
+        reader = yield from self.cache.get(self.att)
+        self.assertIsInstance(reader, CachingAttachmentReader)
+        self.assertEqual(self.data, (yield from self.read(reader)))
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(1000, self.cache.size)
+
+        reader = yield from self.cache.get(self.att)
+        self.assertIsInstance(reader, CachedAttachmentReader)
+        self.assertEqual(self.data, reader.buffer.tobytes())
+        self.assertEqual(self.data, (yield from self.read(reader)))
+        self.assertEqual((1, 1), (self.cache.hits, self.cache.misses))
+        # revalidated with If-None-Match
+        self.assertEqual(1, self.emulator.stats[304])
+        self.assertEqual(1, self.emulator.stats['GET'])
+
+    def test_close_with_exported_buffer(self):
+        yield from self.read((yield from self.cache.get(self.att)))
+        reader = yield from self.cache.get(self.att)
+        head = reader.buffer[:10]
+        reader.close()
+        self.assertTrue(reader.closed)
+        self.assertEqual(self.data[:10], head.tobytes())
+        head.release()
+
+    def test_read_by_chunks(self):
+        chunks = []
+        reader = yield from self.cache.get(self.att)
+        while True:
+            chunk = yield from reader.read(300)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        reader.close()
+        self.assertEqual(self.data, b''.join(chunks))
+
+        reader = yield from self.cache.get(self.att)
+        self.assertEqual(self.data[:300], (yield from reader.read(300)))
+        self.assertEqual(self.data[300:], (yield from reader.read(800)))
+        self.assertEqual(b'', (yield from reader.read(100)))
+        reader.close()
+        self.assertTrue(reader.closed)
+
+    def test_revision_is_not_revalidated(self):
+        yield from self.read((yield from self.cache.get(self.att, self.rev)))
+        reader = yield from self.cache.get(self.att, self.rev)
+        self.assertIsInstance(reader, CachedAttachmentReader)
+        reader.close()
+        self.assertEqual(1, self.emulator.stats['GET'])
+        self.assertEqual(0, self.emulator.stats['HEAD'])
+
+    def test_known_digest(self):
+        yield from self.read((yield from self.cache.get(self.att)))
+        yield from self.db['copy'].update({}, atts={'same.bin': self.data})
+        doc = yield from self.db['copy'].get()
+        digest = doc['_attachments']['same.bin']['digest']
+        reader = yield from self.cache.get(self.db['copy']['same.bin'],
+                                           doc['_rev'], digest=digest)
+        self.assertIsInstance(reader, CachedAttachmentReader)
+        self.assertEqual(self.data, (yield from self.read(reader)))
+
+    def test_changed_attachment(self):
+        yield from self.read((yield from self.cache.get(self.att)))
+        yield from self.att.update(io.BytesIO(b'changed'), rev=self.rev)
+        reader = yield from self.cache.get(self.att)
+        self.assertIsInstance(reader, CachingAttachmentReader)
+        self.assertEqual(b'changed', (yield from self.read(reader)))
+        self.assertEqual(2, len(self.cache))
+        self.assertEqual(2, self.cache.misses)
+
+    def test_deleted_attachment(self):
+        yield from self.read((yield from self.cache.get(self.att)))
+        yield from self.att.delete(self.rev)
+        with self.assertRaises(ResourceNotFound):
+            yield from self.cache.get(self.att)
+
+    def test_partial_read_is_not_cached(self):
+        reader = yield from self.cache.get(self.att)
+        yield from reader.read(100)
+        reader.close()
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_corrupted_content_is_not_cached(self):
+        reader = yield from self.cache.get(self.att)
+        reader.digest = 'md5-XrY7u+Ae7tCTyyK7j1rNww=='
+        yield from self.read(reader)
+        self.assertEqual(0, len(self.cache))
+        self.assertEqual([], os.listdir(self.directory))
+
+    def test_encoded_attachment(self):
+        yield from self.att.update(io.BytesIO(gzip.compress(self.data)),
+                                   content_encoding='gzip', rev=self.rev)
+        yield from self.read((yield from self.cache.get(self.att)))
+        reader = yield from self.cache.get(self.att)
+        self.assertIsInstance(reader, CachedAttachmentReader)
+        self.assertEqual(self.data, (yield from self.read(reader)))
+
+    def test_empty_attachment(self):
+        yield from self.att.update(io.BytesIO(b''), rev=self.rev)
+        yield from self.read((yield from self.cache.get(self.att)))
+        reader = yield from self.cache.get(self.att)
+        self.assertIsInstance(reader, CachedAttachmentReader)
+        self.assertEqual(b'', (yield from self.read(reader)))
+
+    def test_lru_eviction(self):
+        cache = AttachmentCache(self.directory, max_size=2500)
+        atts = []
+        for idx in range(3):
+            att = self.db['doc{}'.format(idx)]['data.bin']
+            yield from att.update(io.BytesIO(os.urandom(1000)))
+            atts.append(att)
+        for att in atts[:2]:
+            yield from self.read((yield from cache.get(att)))
+        # touch the first one, so the second gets evicted
+        yield from self.read((yield from cache.get(atts[0])))
+        yield from self.read((yield from cache.get(atts[2])))
+        self.assertEqual(2, len(cache))
+        self.assertEqual(2000, cache.size)
+        self.assertIsInstance((yield from cache.get(atts[1])),
+                              CachingAttachmentReader)
+
+        # cache directory is reused
+        cache = AttachmentCache(self.directory, max_size=1500)
+        self.assertEqual(1, len(cache))
+
+    def test_shared_directory(self):
+        reader = yield from self.cache.get(self.att)
+        yield from reader.read(100)
+        stale = os.path.join(self.directory, 'stale.tmp')
+        open(stale, 'wb').close()
+        os.utime(stale, (0, 0))
+
+        # another instance keeps temporary file which is still written
+        cache = AttachmentCache(self.directory)
+        self.assertFalse(os.path.exists(stale))
+        self.assertEqual(0, len(cache))
+        yield from self.read(reader)
+        self.assertEqual(1, len(self.cache))
+        self.assertEqual(self.data,
+                         (yield from self.read(cache.open(reader.digest))))
+
+    def test_not_digest_etag(self):
+        def side_effect(method, url, **kwargs):
+            resp = yield from request(method, url, **kwargs)
+            resp.headers = CIMultiDict((key, value)
+                                       for key, value in resp.headers.items()
+                                       if key != 'ETAG')
+            return resp
+        self.request.side_effect = side_effect
+        reader = yield from self.cache.get(self.att)
+        self.assertIsInstance(reader, AttachmentReader)
+        reader.close()
+
+    def test_metrics(self):
+        collector = MetricsCollector(loop=self.loop)
+        collector.track_cache(self.cache, 'attachments')
+        yield from self.read((yield from self.cache.get(self.att)))
+        yield from self.read((yield from self.cache.get(self.att)))
+        output = collector.render()
+        self.assertIn('cache="attachments",result="hit"} 1', output)
+        self.assertIn('cache="attachments",result="miss"} 1', output)
@@ -19,6 +19,8 @@ import aiocouchdb.v1.database
 import aiocouchdb.v1.server
 import aiocouchdb.v1.security
 
+from aiocouchdb.filters import Equals, Prefix
+
 from . import utils
 
 
@@ -533,3 +535,161 @@ class DatabaseTestCase(utils.DatabaseTestCase):
     def test_view_cleanup(self):
         yield from self.db.view_cleanup()
         self.assert_request_called_with('POST', self.db.name, '_view_cleanup')
+
+
+class ChangesPrefetchTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop.run_until_complete(self.db.bulk_docs(
+            [{'_id': 'doc{:02}'.format(idx), 'num': idx}
+             for idx in range(10)]))
+        self.loop.run_until_complete(self.db.bulk_docs(
+            [{'_id': 'doc03', '_rev': '1-' + 'x' * 32, 'num': 3}],
+            new_edits=False))
+        doc = self.loop.run_until_complete(self.db['doc05'].get())
+        self.loop.run_until_complete(self.db.bulk_docs(
+            [{'_id': 'doc05', '_rev': doc['_rev'], '_deleted': True}]))
+        self.emulator.stats.clear()
+
+    def read(self, feed):
+        events = []
+        with feed:
+            while True:
+                event = yield from feed.next()
+                if event is None:
+                    break
+                events.append(event)
+        return events
+
+    def check_events(self, events):
+        self.assertEqual(sorted(event['seq'] for event in events),
+                         [event['seq'] for event in events])
+        self.assertEqual(10, len(events))
+        for event in events:
+            doc = event['doc']
+            self.assertEqual(event['id'], doc['_id'])
+            self.assertEqual(event['changes'][0]['rev'], doc['_rev'])
+            if event['id'] == 'doc05':
+                self.assertTrue(doc['_deleted'])
+            else:
+                self.assertEqual(int(event['id'][3:]), doc['num'])
+
+    def test_prefetch_all_docs(self):
+        feed = yield from self.db.changes(prefetch_docs=True,
+                                          prefetch_batch_size=3,
+                                          conflicts=True)
+        self.assertIsInstance(feed, aiocouchdb.feeds.PrefetchChangesFeed)
+        events = yield from self.read(feed)
+        self.check_events(events)
+        docs = {event['id']: event['doc'] for event in events}
+        self.assertIn('_conflicts', docs['doc03'])
+        # single _changes request and a few _all_docs ones
+        requests = self.emulator.stats['GET'] + self.emulator.stats['POST']
+        self.assertLessEqual(5, requests)
+        self.assertLess(requests, 10)
+
+    def test_prefetch_get(self):
+        feed = yield from self.db.changes(feed='continuous', timeout=10,
+                                          prefetch_docs='get',
+                                          prefetch_concurrency=2)
+        self.assertEqual(1, feed.batch_size)
+        self.check_events((yield from self.read(feed)))
+        self.assertEqual(11, self.emulator.stats['GET'])
+
+    def test_prefetch_missing_doc(self):
+        events = [{'seq': 1, 'id': 'missing', 'changes': [{'rev': '1-a'}]},
+                  {'seq': 2, 'id': 'doc05', 'changes': [{'rev': '2-b'}],
+                   'deleted': True}]
+        expected = [None, {'_id': 'doc05', '_rev': '2-b', '_deleted': True}]
+        self.assertEqual(expected,
+                         (yield from self.db._fetch_docs_all_docs(events)))
+        self.assertEqual(expected,
+                         (yield from self.db._fetch_docs_get(events)))
+
+    def test_prefetch_conflicts_with_include_docs(self):
+        with self.assertRaises(ValueError):
+            yield from self.db.changes(prefetch_docs=True, include_docs=True)
+        with self.assertRaises(ValueError):
+            yield from self.db.changes(prefetch_docs='head')
+
+
+class FilteredChangesTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.loop.run_until_complete(self.db.bulk_docs(
+            [{'_id': 'order:{}'.format(idx), 'type': 'order'}
+             for idx in range(5)] +
+            [{'_id': 'user:{}'.format(idx), 'type': 'user'}
+             for idx in range(5)]))
+        self.emulator.stats.clear()
+
+    def read(self, feed):
+        events = []
+        with feed:
+            while True:
+                event = yield from feed.next()
+                if event is None:
+                    break
+                events.append(event)
+        return events
+
+    def test_pushdown(self):
+        predicate = Equals('type', 'order')
+        for _ in range(2):
+            feed = yield from self.db.filtered_changes(predicate,
+                                                       language='python')
+            self.assertIsInstance(feed, aiocouchdb.feeds.ChangesFeed)
+            events = yield from self.read(feed)
+            self.assertEqual(['order:{}'.format(idx) for idx in range(5)],
+                             [event['id'] for event in events])
+        # design document is created once
+        self.assertEqual(1, self.emulator.stats['PUT'])
+        ddoc_id, ddoc = predicate.design_doc('python')
+        stored = yield from self.db[ddoc_id].doc.get()
+        self.assertEqual(ddoc['filters'], stored['filters'])
+
+    def test_fallback(self):
+        # emulator doesn't support javascript
+        feed = yield from self.db.filtered_changes(Equals('type', 'user'))
+        self.assertIsInstance(feed, aiocouchdb.feeds.FilteredChangesFeed)
+        events = yield from self.read(feed)
+        self.assertEqual(['user:{}'.format(idx) for idx in range(5)],
+                         [event['id'] for event in events])
+        self.assertNotIn('doc', events[0])
+
+    def test_fallback_include_docs(self):
+        feed = yield from self.db.filtered_changes(Equals('type', 'user'),
+                                                   pushdown=False,
+                                                   include_docs=True)
+        events = yield from self.read(feed)
+        self.assertEqual(5, len(events))
+        self.assertEqual('user', events[0]['doc']['type'])
+        self.assertEqual(0, self.emulator.stats['PUT'])
+
+    def test_fallback_prefetch_docs(self):
+        feed = yield from self.db.filtered_changes(Equals('type', 'user'),
+                                                   pushdown=False,
+                                                   prefetch_docs=True)
+        events = yield from self.read(feed)
+        self.assertEqual(5, len(events))
+        self.assertEqual('user', events[0]['doc']['type'])
+
+    def test_fallback_by_id(self):
+        feed = yield from self.db.filtered_changes(Prefix('_id', 'order:'),
+                                                   pushdown=False)
+        events = yield from self.read(feed)
+        self.assertEqual(5, len(events))
+        self.assertNotIn('doc', events[0])
+
+    def test_missing_database(self):
+        db = yield from self.server.db('missing')
+        with self.assertRaises(aiocouchdb.errors.ResourceNotFound):
+            yield from db.filtered_changes(Equals('type', 'user'),
+                                           language='python')
+
+    def test_conflicting_filter(self):
+        with self.assertRaises(ValueError):
+            yield from self.db.filtered_changes(Equals('type', 'user'),
+                                                filter='ddoc/filter')
@@ -10,10 +10,16 @@
 import asyncio
 import json
 import io
+import os
+import tempfile
 
+import aiohttp
 import aiocouchdb.client
+import aiocouchdb.v1.attachment
 import aiocouchdb.v1.database
 import aiocouchdb.v1.document
+from aiocouchdb.compat import StopAsyncIteration
+from aiocouchdb.multipart import SizedStream
 
 from . import utils
 
@@ -231,6 +237,61 @@ class DocumentTestCase(utils.DocumentTestCase):
             aiocouchdb.v1.document.DocAttachmentsMultipartReader)
         yield from result.release()
 
+    def test_get_with_atts_read(self):
+        data = (b'--:\r\n'
+                b'Content-Type: application/json\r\n'
+                b'\r\n'
+                b'{"_id": "docid"}\r\n'
+                b'--:\r\n'
+                b'Content-Disposition: attachment; filename="att"\r\n'
+                b'\r\n'
+                b'foobar\r\n'
+                b'--:--')
+        with self.response(
+            data=data,
+            headers={'CONTENT-TYPE': 'multipart/related;boundary=:'}
+        ) as resp:
+            resp.content = aiohttp.streams.StreamReader(loop=self.loop)
+            resp.content.feed_data(data)
+            resp.content.feed_eof()
+            result = yield from self.doc.get_with_atts()
+            doc, atts = yield from result.next()
+            self.assertEqual(doc, {'_id': 'docid'})
+            att = yield from atts.next()
+            self.assertEqual((yield from att.read()), b'foobar')
+            self.assertIsNone((yield from atts.next()))
+
+    def test_get_with_atts_async_iteration(self):
+        data = (b'--:\r\n'
+                b'Content-Type: application/json\r\n'
+                b'\r\n'
+                b'{"_id": "docid"}\r\n'
+                b'--:\r\n'
+                b'Content-Disposition: attachment; filename="att"\r\n'
+                b'Content-Length: 6\r\n'
+                b'\r\n'
+                b'foobar\r\n'
+                b'--:--')
+        with self.response(
+            data=data,
+            headers={'CONTENT-TYPE': 'multipart/related;boundary=:'}
+        ) as resp:
+            resp.content = aiohttp.streams.StreamReader(loop=self.loop)
+            resp.content.feed_data(data)
+            resp.content.feed_eof()
+            result = yield from self.doc.get_with_atts()
+            self.assertIs(result, result.__aiter__())
+            doc, atts = yield from result.__anext__()
+            self.assertEqual(doc, {'_id': 'docid'})
+            att = yield from atts.__anext__()
+            self.assertEqual(b'foobar', (yield from att.__anext__()))
+            with self.assertRaises(StopAsyncIteration):
+                yield from att.__anext__()
+            with self.assertRaises(StopAsyncIteration):
+                yield from atts.__anext__()
+            with self.assertRaises(StopAsyncIteration):
+                yield from result.__anext__()
+
     def test_get_with_atts_json(self):
         with self.response(headers={
             'CONTENT-TYPE': 'application/json'
@@ -248,30 +309,21 @@ class DocumentTestCase(utils.DocumentTestCase):
             aiocouchdb.v1.document.DocAttachmentsMultipartReader)
         yield from result.release()
 
-    def test_get_with_atts_json_hacks(self):
-        jsondoc = json.dumps({'_id': self.doc.id, '_rev': self.rev},
-                             sort_keys=True).replace(' ', '').encode()
+    def test_get_with_atts_json_only(self):
+        jsondoc = json.dumps({'_id': self.doc.id, '_rev': self.rev}).encode()
 
         with self.response(
             data=jsondoc,
             headers={'CONTENT-TYPE': 'application/json'}
         ):
             result = yield from self.doc.get_with_atts()
-            self.assert_request_called_with(
-                'GET', *self.request_path(),
-                headers={'ACCEPT': 'multipart/related, application/json'},
-                params={'attachments': True})
+            doc, atts = yield from result.next()
 
-        resp = result.resp
-        self.assertTrue(
-            resp.headers['CONTENT-TYPE'].startswith('multipart/related'))
-
-        head, *body, tail = resp.content._buffer.splitlines()
-        self.assertTrue(tail.startswith(head))
-        self.assertEqual(
-            b'Content-Type: application/json\r\n\r\n' + jsondoc,
-            b'\r\n'.join(body))
-        yield from result.release()
+        self.assertEqual({'_id': self.doc.id, '_rev': self.rev}, doc)
+        self.assertIsNone((yield from atts.next()))
+        self.assertTrue(atts.at_eof())
+        self.assertTrue(result.stream.at_eof())
+        self.assertEqual((None, None), (yield from result.stream.next()))
 
     def test_get_with_atts_params(self):
         all_params = {
@@ -437,6 +489,189 @@ class DocumentTestCase(utils.DocumentTestCase):
                                         headers={'DESTINATION': 'idx?rev=1-A'})
 
 
+class Chunks(object):
+
+    def __init__(self, *chunks):
+        self.chunks = list(chunks)
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self.chunks:
+            raise StopAsyncIteration
+        yield from asyncio.sleep(0)
+        return self.chunks.pop(0)
+
+
+class DocumentUploadTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.doc = self.db['doc']
+
+    @asyncio.coroutine
+    def read_atts(self, doc):
+        contents = {}
+        for attname in (yield from doc.get())['_attachments']:
+            reader = yield from doc[attname].get()
+            contents[attname] = yield from reader.read()
+        return contents
+
+    def test_update_with_path(self):
+        fd, path = tempfile.mkstemp(suffix='.txt')
+        with os.fdopen(fd, 'wb') as fileobj:
+            fileobj.write(b'Hello, world!')
+        self.addCleanup(os.unlink, path)
+
+        doc = {}
+        yield from self.doc.update(doc, atts={'hello.txt': path})
+        self.assertEqual({'content_type': 'text/plain',
+                          'length': 13,
+                          'stub': True}, doc['_attachments']['hello.txt'])
+        self.assertEqual({'hello.txt': b'Hello, world!'},
+                         (yield from self.read_atts(self.doc)))
+
+    def test_update_sends_files_without_reading(self):
+        fd, path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as fileobj:
+            fileobj.write(b'skipped:' + b'data' * 100000)
+        self.addCleanup(os.unlink, path)
+
+        class File(io.FileIO):
+            reads = 0
+
+            def read(self, *args):
+                File.reads += 1
+                return super().read(*args)
+
+            def readinto(self, *args):
+                File.reads += 1
+                return super().readinto(*args)
+
+        with File(path) as fileobj:
+            fileobj.seek(8)
+            yield from self.doc.update({}, atts={'att': fileobj,
+                                                 'bytes': b'bytes'})
+            self.assertEqual(400008, fileobj.tell())
+        self.assertEqual(0, File.reads)
+        self.assertEqual({'att': b'data' * 100000, 'bytes': b'bytes'},
+                         (yield from self.read_atts(self.doc)))
+
+    def test_update_with_seekable_stream(self):
+        stream = io.BytesIO(b'skipped:data')
+        stream.seek(8)
+        yield from self.doc.update({}, atts={'att': stream,
+                                             'view': memoryview(b'view')})
+        self.assertEqual({'att': b'data', 'view': b'view'},
+                         (yield from self.read_atts(self.doc)))
+
+    def test_update_with_sized_stream(self):
+        doc = {}
+        stream = SizedStream(Chunks(b'foo', b'bar', b'baz'), 9,
+                             content_type='text/plain', chunk_size=2)
+        yield from self.doc.update(doc, atts={'att.txt': stream})
+        self.assertEqual('text/plain',
+                         doc['_attachments']['att.txt']['content_type'])
+        self.assertEqual({'att.txt': b'foobarbaz'},
+                         (yield from self.read_atts(self.doc)))
+
+    def test_update_from_attachment_reader(self):
+        yield from self.doc.update({}, atts={'att': b'x' * 100000})
+        info = yield from self.doc.get()
+        reader = yield from self.doc['att'].get()
+        stream = SizedStream(reader, info['_attachments']['att']['length'])
+
+        target = self.db['target']
+        yield from target.update({}, atts={'att': stream})
+        self.assertEqual({'att': b'x' * 100000},
+                         (yield from self.read_atts(target)))
+
+    def test_update_with_short_stream(self):
+        stream = SizedStream(Chunks(b'foo'), 10)
+        with self.assertRaises(aiohttp.ClientRequestError) as ctx:
+            yield from self.doc.update({}, atts={'att': stream})
+        self.assertIsInstance(ctx.exception.__cause__, EOFError)
+
+    def test_update_with_failing_stream(self):
+        class Source(object):
+            @asyncio.coroutine
+            def read(self, size):
+                raise OSError('disk is gone')
+
+        stream = SizedStream(Source(), 10)
+        with self.assertRaises(aiohttp.ClientRequestError) as ctx:
+            yield from self.doc.update({}, atts={'att': stream})
+        self.assertIsInstance(ctx.exception.__cause__, OSError)
+
+    def test_update_with_unknown_length(self):
+        yield from self.doc.update({}, atts={'att': b'foo'})
+        reader = yield from self.doc['att'].get()
+        with self.assertRaises(ValueError):
+            yield from self.db['target'].update({}, atts={'att': reader})
+        reader.close()
+
+    def test_update_with_unsupported_payload(self):
+        with self.assertRaises(TypeError):
+            yield from self.doc.update({}, atts={'att': Chunks(b'foo')})
+        with self.assertRaises(TypeError):
+            yield from self.doc.update({}, atts={'att': io.StringIO('foo')})
+
+
+class DocumentDedupTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.doc = self.db['doc']
+        self.loop.run_until_complete(
+            self.doc.update({}, atts={'a.bin': b'foo', 'b.bin': b'bar'}))
+        self.emulator.stats.clear()
+
+    @asyncio.coroutine
+    def stubs(self):
+        return (yield from self.doc.get())['_attachments']
+
+    def test_update_skips_matched_stubs(self):
+        doc = yield from self.doc.get()
+        yield from self.doc.update(doc, atts={'a.bin': b'foo',
+                                              'b.bin': io.BytesIO(b'baz')},
+                                   dedup=True)
+        stubs = yield from self.stubs()
+        self.assertEqual(1, stubs['a.bin']['revpos'])
+        self.assertEqual(2, stubs['b.bin']['revpos'])
+        # only changed attachment was checked on server
+        self.assertEqual(1, self.emulator.stats['HEAD'])
+        reader = yield from self.doc['b.bin'].get()
+        self.assertEqual(b'baz', (yield from reader.read()))
+
+    def test_update_skips_stored(self):
+        rev = yield from self.doc.rev()
+        doc = {'foo': 'bar'}
+        result = yield from self.doc.update(doc, atts={'a.bin': b'foo'},
+                                            dedup=True, rev=rev)
+        self.assertEqual({'a.bin': {'stub': True}}, doc['_attachments'])
+        stubs = yield from self.stubs()
+        self.assertEqual(['a.bin'], list(stubs))
+        self.assertEqual(1, stubs['a.bin']['revpos'])
+        self.assertTrue(result['rev'].startswith('2-'))
+
+    def test_update_digest_index(self):
+        index = aiocouchdb.v1.attachment.DigestIndex()
+        rev = yield from self.doc.rev()
+        result = yield from self.doc.update({}, atts={'c.bin': b'baz'},
+                                            digest_index=index, rev=rev)
+        self.assertEqual(
+            (yield from self.stubs())['c.bin']['digest'],
+            index.get(self.doc['c.bin']))
+        self.emulator.stats.clear()
+
+        yield from self.doc.update({}, atts={'c.bin': b'baz'},
+                                   digest_index=index, rev=result['rev'])
+        self.assertEqual(0, self.emulator.stats['HEAD'])
+        self.assertEqual(2, (yield from self.stubs())['c.bin']['revpos'])
+
+
 class OpenRevsMultipartReader(utils.TestCase):
 
     def test_next(self):
@@ -510,3 +745,53 @@ class OpenRevsMultipartReader(utils.TestCase):
         next_data = yield from reader.next()
         self.assertEqual((None, None), next_data)
         self.assertTrue(reader.at_eof())
+
+
+class OpenRevsSpoolTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.doc = self.db['doc']
+        self.data = {'1-a': os.urandom(10), '1-b': os.urandom(100000),
+                     '1-c': os.urandom(200000)}
+        for rev, data in sorted(self.data.items()):
+            self.loop.run_until_complete(self.doc.update(
+                {'_rev': rev}, atts={'data.bin': data}, new_edits=False))
+
+    def test_spool(self):
+        reader = yield from self.doc.get_open_revs()
+        with (yield from reader.spool()) as revisions:
+            self.assertEqual(3, len(revisions))
+            self.assertEqual(300000, revisions.spooled_size)
+            for doc, atts in revisions:
+                att = atts['data.bin']
+                data = self.data[doc['_rev']]
+                self.assertEqual(len(data), len(att))
+                self.assertEqual(len(data) > 65536, att.spooled)
+                self.assertEqual('application/octet-stream',
+                                 att.content_type)
+                self.assertEqual(data, att.read())
+                with att.getbuffer() as buffer:
+                    self.assertEqual(data[:10], buffer[:10])
+        self.assertEqual(0, revisions.spooled_size)
+
+    def test_spool_threshold(self):
+        reader = yield from self.doc.get_open_revs('1-a', '1-b')
+        revisions = yield from reader.spool(threshold=0)
+        try:
+            self.assertEqual(100010, revisions.spooled_size)
+            self.assertTrue(all(atts['data.bin'].spooled
+                                for _, atts in revisions))
+            doc, atts = revisions[0]
+            self.assertEqual(self.data[doc['_rev']], atts['data.bin'].read())
+        finally:
+            revisions.close()
+
+    def test_spool_in_memory(self):
+        reader = yield from self.doc.get_open_revs('1-a', '1-x')
+        with (yield from reader.spool()) as revisions:
+            self.assertEqual(0, revisions.spooled_size)
+            doc, atts = revisions[0]
+            self.assertEqual('1-a', doc['_rev'])
+            self.assertFalse(atts['data.bin'].spooled)
+            self.assertEqual(({'missing': '1-x'}, {}), revisions[1])
@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import io
+import unittest
+
+import aiocouchdb.v1.server
+from aiocouchdb.client import request
+from aiocouchdb.errors import HttpErrorException
+from aiocouchdb.v1.emulator import Emulator, ViewIndex
+
+from . import utils
+
+
+class ViewIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        def map_fun(doc):
+            yield doc['type'], doc['num']
+        self.index = ViewIndex(map_fun, '_sum')
+        for seq, (docid, type_, num) in enumerate([('a', 'x', 1),
+                                                   ('b', 'y', 2),
+                                                   ('c', 'x', 3),
+                                                   ('d', None, 4)], 1):
+            self.index.update(docid, {'type': type_, 'num': num}, seq)
+
+    def test_query(self):
+        total, offset, rows = self.index.query(reduce=False)
+        self.assertEqual(4, total)
+        self.assertEqual(0, offset)
+        self.assertEqual([('d', None, 4), ('a', 'x', 1), ('c', 'x', 3),
+                          ('b', 'y', 2)], rows)
+
+    def test_query_range(self):
+        _, offset, rows = self.index.query(reduce=False, startkey='x',
+                                           endkey='x', skip=1)
+        self.assertEqual(2, offset)
+        self.assertEqual([('c', 'x', 3)], rows)
+
+    def test_query_descending(self):
+        _, offset, rows = self.index.query(reduce=False, descending=True,
+                                           startkey='y', endkey='x',
+                                           inclusive_end=False)
+        self.assertEqual(0, offset)
+        self.assertEqual([('b', 'y', 2)], rows)
+
+    def test_query_keys(self):
+        _, _, rows = self.index.query(reduce=False, keys=['y', None])
+        self.assertEqual([('b', 'y', 2), ('d', None, 4)], rows)
+
+    def test_reduce(self):
+        self.assertEqual([(None, None, 10)], self.index.query()[2])
+        self.assertEqual([(None, None, 4), (None, 'x', 4), (None, 'y', 2)],
+                         self.index.query(group=True)[2])
+
+    def test_update_removes_rows(self):
+        self.index.update('a', None, 5)
+        self.assertEqual(5, self.index.update_seq)
+        self.assertEqual(3, len(self.index))
+
+    def test_map_function_error(self):
+        self.index.update('e', {}, 6)
+        self.assertEqual(4, len(self.index))
+
+
+class EmulatorTestCase(utils.TestCase):
+
+    _test_target = 'mock'
+
+    def setUp(self):
+        super().setUp()
+        self.request.side_effect = request
+        self.emulator = Emulator(loop=self.loop, chunk_rows=2)
+        url = self.loop.run_until_complete(self.emulator.start())
+        self.server = aiocouchdb.v1.server.Server(url, loop=self.loop)
+        self.db = self.loop.run_until_complete(self.server.db('db'))
+        self.loop.run_until_complete(self.db.create())
+
+    def tearDown(self):
+        self.server.resource.session.connector.close()
+        self.loop.run_until_complete(self.emulator.stop())
+        super().tearDown()
+
+    @asyncio.coroutine
+    def consume(self, feed):
+        items = []
+        while True:
+            item = yield from feed.next()
+            if item is None:
+                break
+            items.append(item)
+        return items
+
+    def test_server_info(self):
+        info = yield from self.server.info()
+        self.assertEqual('Welcome', info['couchdb'])
+        self.assertEqual(['db'], (yield from self.server.all_dbs()))
+
+    def test_create_existed_db(self):
+        with self.assertRaises(HttpErrorException) as ctx:
+            yield from self.db.create()
+        self.assertEqual(412, ctx.exception.code)
+
+    def test_document_lifecycle(self):
+        doc = yield from self.db.doc('doc')
+        result = yield from doc.update({'foo': 'bar'})
+        rev1 = result['rev']
+        self.assertTrue(rev1.startswith('1-'))
+        self.assertEqual(rev1, (yield from doc.rev()))
+
+        with self.assertRaises(HttpErrorException) as ctx:
+            yield from doc.update({'foo': 'baz'})
+        self.assertEqual(409, ctx.exception.code)
+
+        result = yield from doc.update({'foo': 'baz'}, rev=rev1)
+        self.assertTrue(result['rev'].startswith('2-'))
+        data = yield from doc.get(revs=True)
+        self.assertEqual('baz', data['foo'])
+        self.assertEqual(2, data['_revisions']['start'])
+
+        yield from doc.delete(result['rev'])
+        self.assertFalse((yield from doc.exists()))
+        info = yield from self.db.info()
+        self.assertEqual(0, info['doc_count'])
+        self.assertEqual(1, info['doc_del_count'])
+        self.assertEqual(3, info['update_seq'])
+
+    def test_conflicts(self):
+        doc = self.db['doc']
+        yield from doc.update({'_rev': '1-a'}, new_edits=False)
+        yield from doc.update({'_rev': '1-b'}, new_edits=False)
+        data = yield from doc.get(conflicts=True)
+        self.assertEqual('1-b', data['_rev'])
+        self.assertEqual(['1-a'], data['_conflicts'])
+
+        revs = yield from doc.get(open_revs='all')
+        self.assertEqual(['1-a', '1-b'], [item['ok']['_rev'] for item in revs])
+
+        yield from doc.delete('1-b')
+        data = yield from doc.get()
+        self.assertEqual('1-a', data['_rev'])
+
+    def test_bulk_docs_and_all_docs(self):
+        docs = [{'_id': 'doc{}'.format(idx), 'idx': idx} for idx in range(5)]
+        result = yield from self.db.bulk_docs(docs)
+        self.assertTrue(all(item['ok'] for item in result))
+
+        feed = yield from self.db.all_docs(include_docs=True,
+                                           startkey='doc1', limit=3)
+        rows = yield from self.consume(feed)
+        self.assertEqual(['doc1', 'doc2', 'doc3'], [row['id'] for row in rows])
+        self.assertEqual(5, feed.total_rows)
+        self.assertEqual(1, feed.offset)
+        self.assertEqual(2, rows[1]['doc']['idx'])
+
+        feed = yield from self.db.all_docs('doc4', 'missing')
+        rows = yield from self.consume(feed)
+        self.assertEqual('doc4', rows[0]['id'])
+        self.assertEqual('not_found', rows[1]['error'])
+
+    def test_local_docs(self):
+        doc = self.db['_local/checkpoint']
+        result = yield from doc.update({'seq': 1})
+        self.assertEqual('0-1', result['rev'])
+        result = yield from doc.update({'seq': 2}, rev=result['rev'])
+        self.assertEqual('0-2', result['rev'])
+        self.assertEqual(2, (yield from doc.get())['seq'])
+        self.assertEqual(0, (yield from self.db.info())['update_seq'])
+
+    def test_security(self):
+        security = self.db.security
+        yield from security.update(admins={'names': ['foo']})
+        data = yield from security.get()
+        self.assertEqual(['foo'], data['admins']['names'])
+
+    def test_attachments(self):
+        doc = self.db['doc']
+        att = doc['att.txt']
+        result = yield from att.update(io.BytesIO(b'Hello, world!'),
+                                       content_type='text/plain')
+        reader = yield from att.get()
+        self.assertEqual(b'Hello, world!', (yield from reader.read()))
+        reader = yield from att.get(range=slice(7, 11))
+        self.assertEqual(b'world', (yield from reader.read()))
+
+        data = yield from doc.get(attachments=True)
+        self.assertEqual('SGVsbG8sIHdvcmxkIQ==',
+                         data['_attachments']['att.txt']['data'])
+
+        result = yield from att.delete(result['rev'])
+        data = yield from doc.get()
+        self.assertNotIn('_attachments', data)
+
+    def test_multipart_document(self):
+        doc = self.db['doc']
+        yield from doc.update({'foo': 'bar'},
+                              atts={'a.bin': b'abc', 'b.bin': b'defg'})
+        reader = yield from doc.get_with_atts()
+        data, atts = yield from reader.next()
+        self.assertEqual('bar', data['foo'])
+        contents = {}
+        while True:
+            part = yield from atts.next()
+            if part is None:
+                break
+            contents[part.filename] = yield from part.read()
+        yield from reader.release()
+        self.assertEqual({'a.bin': b'abc', 'b.bin': b'defg'}, contents)
+
+    def test_copy(self):
+        doc = self.db['doc']
+        yield from doc.update({'foo': 'bar'}, atts={'a.bin': b'abc'})
+        yield from doc.copy('copy')
+        reader = yield from self.db['copy']['a.bin'].get()
+        self.assertEqual(b'abc', (yield from reader.read()))
+
+    def test_changes(self):
+        yield from self.db.bulk_docs([{'_id': 'a'}, {'_id': 'b'},
+                                      {'_id': 'c'}])
+        feed = yield from self.db.changes()
+        events = yield from self.consume(feed)
+        self.assertEqual([1, 2, 3], [event['seq'] for event in events])
+        self.assertEqual(3, feed.last_seq)
+
+        feed = yield from self.db.changes('a', 'c', include_docs=True)
+        events = yield from self.consume(feed)
+        self.assertEqual(['a', 'c'], [event['doc']['_id']
+                                      for event in events])
+
+        feed = yield from self.db.changes(feed='eventsource', since=1,
+                                          timeout=10)
+        events = yield from self.consume(feed)
+        self.assertEqual(['b', 'c'], [event['id'] for event in events])
+
+    def test_continuous_changes(self):
+        feed = yield from self.db.changes(feed='continuous', timeout=1000)
+        yield from self.db['doc'].update({})
+        event = yield from feed.next()
+        self.assertEqual('doc', event['id'])
+        feed.close(True)
+
+    def test_longpoll_changes(self):
+        task = asyncio.Task(self.db.changes(feed='longpoll', since='now'),
+                            loop=self.loop)
+        yield from asyncio.sleep(0.05, loop=self.loop)
+        yield from self.db['doc'].update({})
+        feed = yield from task
+        events = yield from self.consume(feed)
+        self.assertEqual(['doc'], [event['id'] for event in events])
+
+    def test_changes_filter(self):
+        ddoc = self.db['_design/test']
+        yield from ddoc.doc.update({
+            'language': 'python',
+            'filters': {'odd': 'def fun(doc, req):\n'
+                               '    return doc.get("num", 0) % 2'}})
+        yield from self.db.bulk_docs([{'num': num} for num in range(4)])
+        feed = yield from self.db.changes(filter='test/odd')
+        events = yield from self.consume(feed)
+        self.assertEqual(2, len(events))
+
+    def test_view(self):
+        ddoc = self.db['_design/test']
+        yield from ddoc.doc.update({
+            'language': 'python',
+            'views': {
+                'by_type': {
+                    'map': 'def fun(doc):\n'
+                           '    yield doc["type"], doc["num"]',
+                    'reduce': '_sum'}}})
+        yield from self.db.bulk_docs([
+            {'_id': 'a', 'type': 'x', 'num': 1},
+            {'_id': 'b', 'type': 'y', 'num': 2},
+            {'_id': 'c', 'type': 'x', 'num': 3}])
+
+        feed = yield from ddoc.view('by_type', 'x', reduce=False,
+                                    include_docs=True)
+        rows = yield from self.consume(feed)
+        self.assertEqual(['a', 'c'], [row['id'] for row in rows])
+        self.assertEqual(3, rows[1]['doc']['num'])
+        self.assertEqual(3, feed.total_rows)
+
+        feed = yield from ddoc.view('by_type', group=True)
+        rows = yield from self.consume(feed)
+        self.assertEqual([{'key': 'x', 'value': 4}, {'key': 'y', 'value': 2}],
+                         rows)
+
+        # the index is updated incrementally
+        yield from self.db['b'].delete((yield from self.db['b'].rev()))
+        feed = yield from ddoc.view('by_type')
+        self.assertEqual([{'key': None, 'value': 4}],
+                         (yield from self.consume(feed)))
+
+    def test_missing_view(self):
+        yield from self.db['_design/test'].doc.update({'views': {}})
+        with self.assertRaises(HttpErrorException) as ctx:
+            yield from self.db['_design/test'].view('missing')
+        self.assertEqual(404, ctx.exception.code)
+
+    def test_revs_diff(self):
+        yield from self.db['doc'].update({'_rev': '1-a'}, new_edits=False)
+        result = yield from self.db.revs_diff({'doc': ['1-a', '2-b']})
+        self.assertEqual({'doc': {'missing': ['2-b']}}, result)
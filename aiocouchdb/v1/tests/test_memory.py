@@ -0,0 +1,266 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import json
+import os
+import tempfile
+
+from aiocouchdb.client import request
+from aiocouchdb.compat import StopAsyncIteration
+from aiocouchdb.multipart import SizedStream
+from aiocouchdb.tests import utils
+from aiocouchdb.v1.attachment import AttachmentReader
+from aiocouchdb.v1.document import (
+    DocAttachmentsMultipartReader,
+    Document,
+    OpenRevsMultipartReader
+)
+
+
+class MultipartMemoryTestCase(utils.MemoryTestCase):
+
+    atts = 4
+    att_size = int(5 * 1024 * 1024 * utils.MEMORY_SCALE)
+    chunk = bytes(range(256)) * 256
+    #: Peak memory limit for the whole scenario, bytes
+    peak_limit = 1024 * 1024
+
+    def multipart_chunks(self, boundary):
+        doc = {'_id': 'doc', '_rev': '1-abc', '_attachments': {
+            'att{}'.format(idx): {'content_type': 'application/octet-stream',
+                                  'length': self.att_size,
+                                  'follows': True}
+            for idx in range(self.atts)}}
+        yield ('--{}\r\nContent-Type: application/json\r\n\r\n{}'
+               ''.format(boundary, json.dumps(doc)).encode())
+        for idx in range(self.atts):
+            yield ('\r\n--{}\r\nContent-Disposition: attachment; '
+                   'filename="att{}"\r\nContent-Type: application/octet-stream'
+                   '\r\nContent-Length: {}\r\n\r\n'
+                   ''.format(boundary, idx, self.att_size).encode())
+            size = self.att_size
+            while size >= len(self.chunk):
+                yield self.chunk
+                size -= len(self.chunk)
+            if size:
+                yield self.chunk[:size]
+        yield '\r\n--{}--'.format(boundary).encode()
+
+    def test_get_with_atts_chunked_read(self):
+        boundary = 'b0undary'
+        headers = {'CONTENT-TYPE':
+                   'multipart/related; boundary="{}"'.format(boundary)}
+        total = 0
+        with self.traced_memory() as stats:
+            resp = self.streamed_response(self.multipart_chunks(boundary),
+                                          headers=headers)
+            reader = DocAttachmentsMultipartReader.from_response(resp)
+            doc, atts = yield from reader.next()
+            while True:
+                part = yield from atts.next()
+                if part is None:
+                    break
+                while True:
+                    chunk = yield from part.read_chunk()
+                    if not chunk:
+                        break
+                    total += len(chunk)
+            yield from reader.release()
+        self.assertEqual(self.atts, len(doc['_attachments']))
+        self.assertEqual(self.atts * self.att_size, total)
+        self.assertLess(stats['peak'], self.peak_limit)
+
+    def test_spool_open_revs(self):
+        boundary = 'b0undary'
+        revs = 3
+
+        def chunks():
+            for idx in range(revs):
+                inner = 'inner{}'.format(idx)
+                yield ('--{}\r\nContent-Type: multipart/related; '
+                       'boundary="{}"\r\n\r\n'.format(boundary, inner)
+                       ).encode()
+                yield from self.multipart_chunks(inner)
+                yield b'\r\n'
+            yield '--{}--'.format(boundary).encode()
+
+        headers = {'CONTENT-TYPE':
+                   'multipart/mixed; boundary="{}"'.format(boundary)}
+        with self.traced_memory() as stats:
+            resp = self.streamed_response(chunks(), headers=headers)
+            reader = OpenRevsMultipartReader.from_response(resp)
+            with (yield from reader.spool()) as revisions:
+                self.assertEqual(revs, len(revisions))
+                self.assertEqual(revs * self.atts * self.att_size,
+                                 revisions.spooled_size)
+        self.assertLess(stats['peak'], self.peak_limit)
+
+
+class AttachmentMemoryTestCase(utils.MemoryTestCase):
+
+    size = int(4 * 1024 * 1024 * utils.MEMORY_SCALE)
+    chunk = bytes(range(256)) * 256
+    #: Peak memory limit for chunked reading, bytes
+    peak_limit = 1024 * 1024
+
+    def chunks(self):
+        for _ in range(self.size // len(self.chunk)):
+            yield self.chunk
+
+    def test_chunked_read(self):
+        total = 0
+        with self.traced_memory() as stats:
+            reader = AttachmentReader(self.streamed_response(self.chunks()))
+            while True:
+                chunk = yield from reader.read(8192)
+                if not chunk:
+                    break
+                total += len(chunk)
+        self.assertEqual(self.size, total)
+        self.assertLess(stats['peak'], self.peak_limit)
+
+    def test_readall(self):
+        with self.traced_memory() as stats:
+            reader = AttachmentReader(self.streamed_response(self.chunks()))
+            data = yield from reader.readall()
+        self.assertEqual(self.size, len(data))
+        # the whole content is expected to be in memory, but only once
+        self.assertLess(stats['peak'], self.size * 1.5 + self.peak_limit)
+
+    def test_readall_known_length(self):
+        headers = {'CONTENT-LENGTH': str(self.size)}
+        with self.traced_memory() as stats:
+            reader = AttachmentReader(self.streamed_response(self.chunks(),
+                                                             headers=headers))
+            data = yield from reader.readall()
+        self.assertEqual(self.size, len(data))
+        # preallocated buffer is never grown
+        self.assertLess(stats['peak'], self.size + self.peak_limit)
+
+    def test_copy_to(self):
+        target = NullWriter()
+        with self.traced_memory() as stats:
+            reader = AttachmentReader(self.streamed_response(self.chunks()))
+            total = yield from reader.copy_to(target)
+        self.assertEqual(self.size, total)
+        self.assertEqual(self.size, target.written)
+        self.assertLess(stats['peak'], self.peak_limit)
+
+
+class NullWriter(object):
+    """Counts written bytes and forgets them."""
+
+    def __init__(self):
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+
+
+class ChunksSource(object):
+    """Asynchronous iterator over the same chunk repeated."""
+
+    def __init__(self, chunk, times):
+        self.chunk = chunk
+        self.times = times
+
+    def __aiter__(self):
+        return self
+
+    @asyncio.coroutine
+    def __anext__(self):
+        if not self.times:
+            raise StopAsyncIteration
+        self.times -= 1
+        yield from asyncio.sleep(0)
+        return self.chunk
+
+
+class UploadMemoryTestCase(utils.MemoryTestCase):
+
+    size = int(4 * 1024 * 1024 * utils.MEMORY_SCALE)
+    chunk = bytes(range(256)) * 256
+    #: Peak memory limit for the whole upload, bytes
+    peak_limit = 1024 * 1024
+
+    def setUp(self):
+        super().setUp()
+        self.request.side_effect = request
+        self.received = 0
+        self.server = self.loop.run_until_complete(
+            asyncio.start_server(self.handle, '127.0.0.1', 0, loop=self.loop))
+        port = self.server.sockets[0].getsockname()[1]
+        self.doc = Document('http://127.0.0.1:{}/db/doc'.format(port),
+                            loop=self.loop)
+
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as fileobj:
+            for _ in range(self.size // len(self.chunk)):
+                fileobj.write(self.chunk)
+        self.addCleanup(os.unlink, self.path)
+
+    def tearDown(self):
+        self.doc.resource.session.connector.close()
+        self.server.close()
+        self.loop.run_until_complete(self.server.wait_closed())
+        super().tearDown()
+
+    @asyncio.coroutine
+    def handle(self, reader, writer):
+        # consumes request body without keeping it in memory
+        headers = []
+        while True:
+            line = yield from reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            headers.append(line.decode().lower().strip())
+        length = 0
+        for line in headers:
+            if line.startswith('content-length:'):
+                length = int(line.split(':')[1])
+            elif line == 'transfer-encoding: chunked':
+                size = None
+                while size != 0:
+                    size = int((yield from reader.readline()), 16)
+                    yield from reader.readexactly(size + 2)
+                    self.received += size
+        while length:
+            chunk = yield from reader.read(min(length, 65536))
+            self.received += len(chunk)
+            length -= len(chunk)
+        body = b'{"ok": true, "id": "doc", "rev": "1-abc"}'
+        writer.write(b'HTTP/1.1 201 Created\r\n'
+                     b'Content-Type: application/json\r\n'
+                     b'Content-Length: ' + str(len(body)).encode() +
+                     b'\r\n\r\n' + body)
+        yield from writer.drain()
+        writer.close()
+
+    def test_update_with_atts(self):
+        doc = {'foo': 'bar'}
+        stream = SizedStream(ChunksSource(self.chunk,
+                                          self.size // len(self.chunk)),
+                             self.size)
+        with self.traced_memory() as stats:
+            yield from self.doc.update(doc, atts={'file': self.path,
+                                                  'stream': stream})
+        self.assertGreater(self.received, 2 * self.size)
+        self.assertEqual(self.size, doc['_attachments']['file']['length'])
+        self.assertEqual(self.size, doc['_attachments']['stream']['length'])
+        self.assertLess(stats['peak'], self.peak_limit)
+
+    def test_compressed_attachment(self):
+        with open(self.path, 'rb') as fileobj:
+            with self.traced_memory() as stats:
+                yield from self.doc['file.txt'].update(
+                    fileobj, compress='gzip', content_type='text/plain')
+        self.assertGreater(self.received, 0)
+        self.assertLess(self.received, self.size // 10)
+        self.assertLess(stats['peak'], self.peak_limit)
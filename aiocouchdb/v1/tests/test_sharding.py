@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import unittest
+
+import aiocouchdb.v1.database
+import aiocouchdb.v1.server
+import aiocouchdb.v1.sharding
+
+from . import utils
+
+
+class HashRingTestCase(unittest.TestCase):
+
+    def test_empty_ring(self):
+        ring = aiocouchdb.v1.sharding.HashRing()
+        with self.assertRaises(LookupError):
+            ring.get('foo')
+
+    def test_stable_routing(self):
+        ring1 = aiocouchdb.v1.sharding.HashRing(['a', 'b', 'c'])
+        ring2 = aiocouchdb.v1.sharding.HashRing(['c', 'a', 'b'])
+        for idx in range(100):
+            key = 'key%d' % idx
+            self.assertEqual(ring1.get(key), ring2.get(key))
+
+    def test_even_distribution(self):
+        ring = aiocouchdb.v1.sharding.HashRing(['a', 'b', 'c', 'd'])
+        counts = dict.fromkeys(ring, 0)
+        for idx in range(10000):
+            counts[ring.get('key%d' % idx)] += 1
+        for count in counts.values():
+            self.assertTrue(1750 < count < 3250, counts)
+
+    def test_weight(self):
+        ring = aiocouchdb.v1.sharding.HashRing()
+        ring.add('a')
+        ring.add('b', weight=3)
+        counts = dict.fromkeys(ring, 0)
+        for idx in range(10000):
+            counts[ring.get('key%d' % idx)] += 1
+        self.assertTrue(counts['b'] > counts['a'] * 2, counts)
+
+    def test_add_moves_few_keys(self):
+        ring = aiocouchdb.v1.sharding.HashRing(['a', 'b', 'c'])
+        keys = ['key%d' % idx for idx in range(10000)]
+        before = {key: ring.get(key) for key in keys}
+        ring.add('d')
+        moved = [key for key in keys if ring.get(key) != before[key]]
+        self.assertTrue(len(moved) < 3500, len(moved))
+        for key in moved:
+            self.assertEqual(ring.get(key), 'd')
+
+    def test_remove(self):
+        ring = aiocouchdb.v1.sharding.HashRing(['a', 'b', 'c'])
+        keys = ['key%d' % idx for idx in range(1000)]
+        before = {key: ring.get(key) for key in keys}
+        ring.remove('b')
+        self.assertNotIn('b', ring)
+        for key in keys:
+            if before[key] != 'b':
+                self.assertEqual(ring.get(key), before[key])
+            else:
+                self.assertIn(ring.get(key), ('a', 'c'))
+
+    def test_collision(self):
+        def hash_func(key):
+            # nodes share their virtual nodes
+            return int(key.rsplit('-', 1)[-1]) * 10 if '-' in key else 5
+        for nodes in (['a', 'b'], ['b', 'a']):
+            ring = aiocouchdb.v1.sharding.HashRing(nodes, hash_func=hash_func,
+                                                   replicas=2)
+            self.assertEqual('a', ring.get('key'))
+            ring.remove('a')
+            self.assertEqual('b', ring.get('key'))
+            ring.remove('b')
+            with self.assertRaises(LookupError):
+                ring.get('key')
+
+    def test_add_twice(self):
+        ring = aiocouchdb.v1.sharding.HashRing(['a'])
+        with self.assertRaises(ValueError):
+            ring.add('a')
+
+
+class ShardedServerTestCase(utils.TestCase):
+
+    _test_target = 'mock'
+
+    urls = ['http://couch1:5984', 'http://couch2:5984', 'http://couch3:5984']
+
+    def setUp(self):
+        super().setUp()
+        self.shards = aiocouchdb.v1.sharding.ShardedServer(self.urls,
+                                                           loop=self.loop)
+
+    def test_init(self):
+        self.assertEqual(len(self.shards), 3)
+        for server in self.shards.servers:
+            self.assertIsInstance(server, aiocouchdb.v1.server.Server)
+
+    def test_getitem(self):
+        db = self.shards['db']
+        self.assertIsInstance(db, aiocouchdb.v1.database.Database)
+        self.assertEqual(db.name, 'db')
+        self.assertEqual(db.resource.url,
+                         self.shards.node('db').resource.url + '/db')
+
+    def test_db(self):
+        db = yield from self.shards.db('db')
+        owner = self.shards.node('db').resource.url
+        self.assertEqual(db.resource.url, owner + '/db')
+        self.assertEqual(self.request.call_args[0], ('HEAD', owner + '/db'))
+
+    def test_partition(self):
+        nodes = set()
+        for idx in range(100):
+            db = self.shards.partition('db', 'tenant%d:doc' % idx)
+            self.assertEqual(db.name, 'db')
+            nodes.add(db.resource.url)
+            other = self.shards.partition('db', 'tenant%d:other' % idx)
+            self.assertEqual(db.resource.url, other.resource.url)
+        self.assertEqual(len(nodes), 3)
+
+    def test_remove_node(self):
+        server = self.shards.remove_node(self.urls[0])
+        self.assertEqual(server.resource.url, self.urls[0])
+        self.assertEqual(len(self.shards), 2)
+        for idx in range(100):
+            self.assertNotEqual(self.shards.node('db%d' % idx), server)
+
+    def test_all_dbs(self):
+        with self.response(data=b'["b", "a"]'):
+            result = yield from self.shards.all_dbs()
+        self.assertEqual(result, ['a', 'b'])
+        self.assertEqual(self.request.call_count, 3)
+        urls = sorted(call[0][1] for call in self.request.call_args_list)
+        self.assertEqual(urls, [url + '/_all_dbs' for url in self.urls])
+
+    def test_active_tasks(self):
+        with self.response(data=b'[{"type": "indexer"}]'):
+            result = yield from self.shards.active_tasks()
+        self.assertEqual(len(result), 3)
+        self.assertEqual(sorted(task['node'] for task in result), self.urls)
+
+    def test_stats(self):
+        data = (b'{"httpd": {"requests": {"current": 2, "sum": 2, "min": 0,'
+                b' "max": 1, "mean": 0.5, "stddev": 0.1}}}')
+        with self.response(data=data):
+            result = yield from self.shards.stats()
+        self.assertEqual(self.request.call_count, 3)
+        self.assertEqual(result['httpd']['requests'],
+                         {'current': 6, 'sum': 6, 'min': 0, 'max': 1,
+                          'mean': 0.5, 'stddev': None})
+
+    def test_stats_no_merge(self):
+        with self.response(data=b'{}'):
+            result = yield from self.shards.stats(merge=False)
+        self.assertEqual(result, dict.fromkeys(self.urls, {}))
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import gzip
+import io
+import os
+import shutil
+import tempfile
+
+from aiohttp.errors import ClientOSError
+
+from aiocouchdb.client import request
+from aiocouchdb.v1.transfer import (
+    DigestMismatch,
+    RateLimiter,
+    Transfer,
+    TransferManager
+)
+
+from . import utils
+
+
+class TransferManagerTestCase(utils.EmulatorTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.data = os.urandom(1000)
+        self.att = self.db['doc']['data.bin']
+        self.loop.run_until_complete(self.att.update(io.BytesIO(self.data)))
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+        self.path = os.path.join(self.tmpdir, 'data.bin')
+        self.manager = TransferManager(chunk_size=100, retry_delay=0,
+                                       loop=self.loop)
+        self.ranges = []
+        self.emulator.stats.clear()
+
+    def read_file(self, path=None):
+        with open(path or self.path, 'rb') as fileobj:
+            return fileobj.read()
+
+    @asyncio.coroutine
+    def stub(self):
+        doc = yield from self.db['doc'].get()
+        return doc['_attachments']['data.bin']
+
+    def break_reads(self, after, *, times=1, corrupt=False):
+        failures = {'left': times}
+
+        @asyncio.coroutine
+        def side_effect(method, url, **kwargs):
+            self.ranges.append(dict(kwargs.get('headers') or {}).get('RANGE'))
+            resp = yield from request(method, url, **kwargs)
+            if method != 'GET' or not failures['left']:
+                return resp
+            failures['left'] -= 1
+            read = resp.content.read
+            state = {'read': 0}
+
+            @asyncio.coroutine
+            def broken_read(size=-1):
+                if state['read'] >= after:
+                    if corrupt:
+                        return b''
+                    raise ClientOSError('connection reset')
+                chunk = yield from read(size)
+                state['read'] += len(chunk)
+                if corrupt:
+                    chunk = bytes(len(chunk))
+                return chunk
+            resp.content.read = broken_read
+            return resp
+        self.request.side_effect = side_effect
+
+    def test_download(self):
+        transfer = yield from self.manager.download(self.att, self.path)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(Transfer.DONE, transfer.state)
+        self.assertEqual(1000, transfer.length)
+        self.assertEqual(1000, transfer.transferred)
+        self.assertEqual(1.0, transfer.progress)
+        self.assertEqual((yield from self.stub())['digest'], transfer.digest)
+        self.assertEqual([transfer], self.manager.transfers)
+        self.assertEqual(['data.bin'], os.listdir(self.tmpdir))
+
+    def test_download_fileobj(self):
+        fileobj = io.BytesIO(b'garbage' * 1000)
+        yield from self.manager.download(self.att, fileobj)
+        self.assertEqual(self.data, fileobj.getvalue())
+        self.assertEqual(0, fileobj.tell())
+
+    def test_download_encoded(self):
+        yield from self.att.update(io.BytesIO(gzip.compress(self.data)),
+                                   content_encoding='gzip',
+                                   rev=(yield from self.db['doc'].rev()))
+        transfer = yield from self.manager.download(self.att, self.path)
+        self.assertEqual(self.data, self.read_file())
+        self.assertIsNone(transfer.digest)
+        self.assertEqual(1000, transfer.length)
+
+    def test_download_retry_resumes(self):
+        self.break_reads(300)
+        transfer = yield from self.manager.download(self.att, self.path)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(2, transfer.attempts)
+        self.assertIsInstance(transfer.error, ClientOSError)
+        self.assertEqual([None, None, None, 'bytes=300-'], self.ranges)
+
+    def test_download_resume_next_call(self):
+        self.break_reads(300)
+        manager = TransferManager(chunk_size=100, retries=0, loop=self.loop)
+        with self.assertRaises(ClientOSError):
+            yield from manager.download(self.att, self.path)
+        self.assertEqual(Transfer.FAILED, manager.transfers[0].state)
+        self.assertEqual(300, manager.transfers[0].transferred)
+        self.assertEqual(self.data[:300], self.read_file()[:300])
+        self.assertTrue(os.path.exists(self.path + '.download'))
+
+        transfer = yield from self.manager.download(self.att, self.path)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual('bytes=300-', self.ranges[-1])
+        self.assertEqual(1, self.emulator.stats[206])
+        self.assertEqual(1, transfer.attempts)
+
+    def test_download_resumes_attachment_download(self):
+        def side_effect(method, url, **kwargs):
+            rng = dict(kwargs.get('headers') or {}).get('RANGE')
+            self.ranges.append(rng)
+            if rng == 'bytes=500-999':
+                raise ClientOSError('connection reset')
+            return request(method, url, **kwargs)
+        self.request.side_effect = side_effect
+
+        with self.assertRaises(ClientOSError):
+            yield from self.att.download(self.path, parts=2, retries=0,
+                                         loop=self.loop)
+        transfer = yield from self.manager.download(self.att, self.path)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual('bytes=500-', self.ranges[-1])
+        self.assertEqual(1, transfer.attempts)
+        self.assertEqual(['data.bin'], os.listdir(self.tmpdir))
+
+    def test_download_resume_range_ignored(self):
+        self.break_reads(300)
+        manager = TransferManager(chunk_size=100, retries=0, loop=self.loop)
+        with self.assertRaises(ClientOSError):
+            yield from manager.download(self.att, self.path)
+
+        @asyncio.coroutine
+        def side_effect(method, url, **kwargs):
+            headers = dict(kwargs.pop('headers', None) or {})
+            self.ranges.append(headers.pop('RANGE', None))
+            return (yield from request(method, url, headers=headers,
+                                       **kwargs))
+        self.request.side_effect = side_effect
+
+        transfer = yield from self.manager.download(self.att, self.path)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(1000, transfer.transferred)
+        self.assertEqual('bytes=300-', self.ranges[-1])
+        self.assertEqual(0, self.emulator.stats[206])
+
+    def test_download_restarts_changed_attachment(self):
+        self.break_reads(300)
+        manager = TransferManager(chunk_size=100, retries=0, loop=self.loop)
+        with self.assertRaises(ClientOSError):
+            yield from manager.download(self.att, self.path)
+
+        data = os.urandom(500)
+        yield from self.att.update(io.BytesIO(data),
+                                   rev=(yield from self.db['doc'].rev()))
+        yield from self.manager.download(self.att, self.path)
+        self.assertEqual(data, self.read_file())
+        self.assertEqual(0, self.emulator.stats[206])
+
+    def test_download_digest_mismatch(self):
+        self.break_reads(1000, corrupt=True)
+        transfer = yield from self.manager.download(self.att, self.path)
+        self.assertEqual(self.data, self.read_file())
+        self.assertEqual(2, transfer.attempts)
+        self.assertIsInstance(transfer.error, DigestMismatch)
+        self.assertEqual(0, self.emulator.stats[206])
+
+    def test_upload(self):
+        with open(self.path, 'wb') as fileobj:
+            fileobj.write(self.data[::-1])
+        transfer = yield from self.manager.upload(
+            self.att, self.path, (yield from self.db['doc'].rev()))
+        self.assertEqual(Transfer.DONE, transfer.state)
+        self.assertEqual(1000, transfer.transferred)
+        self.assertTrue(transfer.result['rev'].startswith('2-'))
+        self.assertEqual((yield from self.stub())['digest'], transfer.digest)
+        reader = yield from self.att.get()
+        self.assertEqual(self.data[::-1], (yield from reader.read()))
+
+    def test_upload_fileobj_from_position(self):
+        fileobj = io.BytesIO(b'skip' + self.data)
+        fileobj.seek(4)
+        transfer = yield from self.manager.upload(
+            self.att, fileobj, (yield from self.db['doc'].rev()))
+        self.assertEqual(1000, transfer.length)
+        self.assertEqual((yield from self.stub())['digest'], transfer.digest)
+
+    def test_upload_lost_response(self):
+        failures = {'left': 1}
+
+        @asyncio.coroutine
+        def side_effect(method, url, **kwargs):
+            resp = yield from request(method, url, **kwargs)
+            if method == 'PUT' and failures['left']:
+                failures['left'] -= 1
+                yield from resp.release()
+                raise ClientOSError('connection reset')
+            return resp
+        self.request.side_effect = side_effect
+
+        transfer = yield from self.manager.upload(
+            self.att, io.BytesIO(self.data[::-1]),
+            (yield from self.db['doc'].rev()))
+        self.assertEqual(Transfer.DONE, transfer.state)
+        self.assertEqual(2, transfer.attempts)
+        self.assertIsNone(transfer.result)
+        self.assertEqual(1, self.emulator.stats['PUT'])
+        self.assertEqual((yield from self.stub())['digest'], transfer.digest)
+
+    def test_upload_not_retried_on_conflict(self):
+        with self.assertRaises(Exception) as ctx:
+            yield from self.manager.upload(self.att, io.BytesIO(b'foo'), '1-x')
+        self.assertEqual(409, ctx.exception.code)
+        self.assertEqual(1, self.manager.transfers[0].attempts)
+
+    def test_concurrency_per_host(self):
+        manager = TransferManager(concurrency=2, loop=self.loop)
+        active = {'now': 0, 'max': 0}
+
+        @asyncio.coroutine
+        def side_effect(method, url, **kwargs):
+            active['now'] += 1
+            active['max'] = max(active['now'], active['max'])
+            try:
+                yield from asyncio.sleep(0.01, loop=self.loop)
+                return (yield from request(method, url, **kwargs))
+            finally:
+                active['now'] -= 1
+        self.request.side_effect = side_effect
+
+        yield from asyncio.gather(*[
+            manager.download(self.att, io.BytesIO()) for _ in range(6)],
+            loop=self.loop)
+        self.assertEqual(2, active['max'])
+        self.assertEqual(12, self.emulator.stats['HEAD'] +
+                         self.emulator.stats['GET'])
+
+
+class RateLimiterTestCase(utils.TestCase):
+
+    def test_consume(self):
+        limiter = RateLimiter(10000, loop=self.loop)
+        start = self.loop.time()
+        yield from limiter.consume(10000)
+        self.assertLess(self.loop.time() - start, 0.05)
+        yield from limiter.consume(1000)
+        self.assertGreaterEqual(self.loop.time() - start, 0.09)
@@ -7,6 +7,7 @@
 # you should have received as part of this distribution.
 #
 
+from aiocouchdb.client import request
 from aiocouchdb.tests import utils
 from aiocouchdb.tests.utils import (
     modify_server,
@@ -24,6 +25,7 @@ from .. import database
 from .. import designdoc
 from .. import document
 from .. import server
+from ..emulator import Emulator
 
 
 class ServerTestCase(utils.ServerTestCase):
@@ -44,3 +46,24 @@ class DesignDocumentTestCase(DatabaseTestCase, utils.DesignDocumentTestCase):
 
 class AttachmentTestCase(DocumentTestCase, utils.AttachmentTestCase):
     attachment_class = attachment.Attachment
+
+
+class EmulatorTestCase(TestCase):
+    """Runs requests against in-process
+    :class:`~aiocouchdb.v1.emulator.Emulator` with ``db`` database created."""
+
+    _test_target = 'mock'
+
+    def setUp(self):
+        super().setUp()
+        self.request.side_effect = request
+        self.emulator = Emulator(loop=self.loop, chunk_rows=2)
+        url = self.loop.run_until_complete(self.emulator.start())
+        self.server = server.Server(url, loop=self.loop)
+        self.db = self.loop.run_until_complete(self.server.db('db'))
+        self.loop.run_until_complete(self.db.create())
+
+    def tearDown(self):
+        self.server.resource.session.connector.close()
+        self.loop.run_until_complete(self.emulator.stop())
+        super().tearDown()
@@ -0,0 +1,540 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+import urllib.parse
+
+from aiohttp.errors import ClientRequestError
+
+from aiocouchdb.errors import HttpErrorException
+from aiocouchdb.hdrs import (
+    ACCEPT_RANGES,
+    CONTENT_ENCODING,
+    CONTENT_LENGTH,
+    ETAG
+)
+from aiocouchdb.multipart import SizedStream
+from aiocouchdb.retry import CONNECTION_ERRORS
+
+from .attachment import (
+    DownloadFile,
+    DownloadFileObject,
+    format_digest,
+    is_range_response
+)
+
+
+__all__ = (
+    'DigestMismatch',
+    'RateLimiter',
+    'Transfer',
+    'TransferManager',
+)
+
+
+class DigestMismatch(ValueError):
+    """Raised when MD5 digest of transferred data doesn't match the one
+    reported by server."""
+
+
+def etag_digest(etag):
+    """Extracts attachment MD5 digest from its ETag.
+
+    >>> etag_digest('"md5-XrY7u+Ae7tCTyyK7j1rNww=="')
+    'md5-XrY7u+Ae7tCTyyK7j1rNww=='
+    >>> etag_digest('"XrY7u+Ae7tCTyyK7j1rNww=="')
+    'md5-XrY7u+Ae7tCTyyK7j1rNww=='
+    >>> etag_digest('"1-abc"') is None
+    True
+
+    :param str etag: ETag header value
+
+    :returns: Digest in ``md5-<base64>`` form or ``None`` if ETag is not
+              a digest
+    :rtype: str
+    """
+    if not etag:
+        return None
+    value = etag.strip('"')
+    if value.startswith('md5-'):
+        value = value[4:]
+    try:
+        if len(base64.b64decode(value.encode(), validate=True)) != 16:
+            return None
+    except (binascii.Error, ValueError):
+        return None
+    return 'md5-' + value
+
+
+def resumed_offset(ranges):
+    """Returns amount of contiguous bytes from the start of file which are
+    already downloaded according to download state.
+
+    >>> resumed_offset([[0, 99, 100], [100, 199, 50], [200, 299, 100]])
+    150
+    >>> resumed_offset(None)
+    0
+
+    :param list ranges: Download state: list of ``[start, stop, written]``
+
+    :rtype: int
+    """
+    offset = 0
+    for start, stop, written in sorted(ranges or ()):
+        if start != offset:
+            break
+        offset += written
+        if start + written <= stop:
+            break
+    return offset
+
+
+class RateLimiter(object):
+    """Token bucket which limits amount of bytes transferred per second.
+
+    Consumers may take more than there is tokens in bucket: the debt makes
+    them and the next consumers to wait, so concurrent transfers share the
+    bandwidth.
+
+    :param float rate: Amount of bytes per second
+    :param loop: Event loop instance
+    """
+
+    def __init__(self, rate, *, loop=None):
+        self.rate = rate
+        self._loop = loop or asyncio.get_event_loop()
+        self._tokens = float(rate)
+        self._stamp = self._loop.time()
+
+    @asyncio.coroutine
+    def consume(self, amount):
+        """Takes ``amount`` tokens from the bucket, waiting for them
+        if needed.
+
+        :param int amount: Amount of bytes to transfer
+        """
+        now = self._loop.time()
+        self._tokens = min(self.rate,
+                           self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        self._tokens -= amount
+        if self._tokens < 0:
+            yield from asyncio.sleep(-self._tokens / self.rate,
+                                     loop=self._loop)
+
+
+class Transfer(object):
+    """State of single attachment transfer made by :class:`TransferManager`.
+    """
+
+    #: Transfer is waiting for a free slot
+    PENDING = 'pending'
+    #: Transfer is in progress
+    ACTIVE = 'active'
+    #: Transfer is completed and verified
+    DONE = 'done'
+    #: Transfer had failed after all the retries
+    FAILED = 'failed'
+
+    #: Download direction
+    DOWNLOAD = 'download'
+    #: Upload direction
+    UPLOAD = 'upload'
+
+    def __init__(self, direction, attachment, target, rev=None):
+        #: Transfer direction: :attr:`DOWNLOAD` or :attr:`UPLOAD`
+        self.direction = direction
+        #: :class:`~aiocouchdb.v1.attachment.Attachment` instance
+        self.attachment = attachment
+        #: File path or file object
+        self.target = target
+        #: Document revision
+        self.rev = rev
+        #: Transfer state
+        self.state = self.PENDING
+        #: Attachment length, if known
+        self.length = None
+        #: Amount of bytes transferred and kept so far
+        self.transferred = 0
+        #: Attachment ETag reported by server
+        self.etag = None
+        #: Expected attachment digest in ``md5-<base64>`` form
+        self.digest = None
+        #: Amount of made attempts
+        self.attempts = 0
+        #: The last occurred error
+        self.error = None
+        #: Server response for completed upload
+        self.result = None
+
+    def __repr__(self):
+        return '<{}.{}({}) {} {}/{}>'.format(
+            self.__module__,
+            self.__class__.__qualname__,
+            self.direction,
+            self.state,
+            self.transferred,
+            self.length)
+
+    @property
+    def progress(self):
+        """Transfer progress from ``0.0`` to ``1.0``."""
+        if self.state == self.DONE:
+            return 1.0
+        if not self.length:
+            return 0.0
+        return min(self.transferred / self.length, 1.0)
+
+
+class TransferManager(object):
+    """Manages attachment downloads and uploads which survive network
+    failures.
+
+    Each transfer is tracked with :class:`Transfer` object. Failed transfers
+    are retried with exponential backoff:
+
+    - downloads continue from the last received byte by ranged requests,
+      or start over if server ignores the range. When the target is a file
+      path, progress is kept in ``<path>.download`` file like
+      :meth:`~aiocouchdb.v1.attachment.Attachment.download` does, so
+      interrupted download is resumed by the next call of either of them
+      unless the attachment had changed. Completed download is verified
+      with attachment digest;
+    - uploads compute MD5 digest of the data while it's sent and compare it
+      with the one server reports for the new revision. Upload retry is
+      skipped if server already has the attachment with the same digest.
+
+    Amount of concurrent transfers and the bandwidth are limited per host.
+
+    :param int bandwidth: Bandwidth limit per host, bytes per second
+    :param int chunk_size: Size of chunks to transfer data by
+    :param int concurrency: Amount of concurrent transfers per host
+    :param loop: Event loop instance
+    :param int retries: How many times failed transfer is retried
+    :param float retry_delay: Base delay in seconds before retrying failed
+                              transfer
+    """
+
+    #: Bandwidth limit per host in bytes per second, ``None`` means unlimited
+    bandwidth = None
+    #: Size of chunks to transfer data by
+    chunk_size = 65536
+    #: Amount of concurrent transfers per host
+    concurrency = 4
+    #: How many times failed transfer is retried
+    retries = 3
+    #: Base delay in seconds before retrying failed transfer
+    retry_delay = 0.1
+
+    def __init__(self, *,
+                 bandwidth=None,
+                 chunk_size=None,
+                 concurrency=None,
+                 loop=None,
+                 retries=None,
+                 retry_delay=None):
+        if bandwidth is not None:
+            self.bandwidth = bandwidth
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if retries is not None:
+            self.retries = retries
+        if retry_delay is not None:
+            self.retry_delay = retry_delay
+        self._loop = loop or asyncio.get_event_loop()
+        self._semaphores = {}
+        self._limiters = {}
+        #: List of all :class:`Transfer` made by manager
+        self.transfers = []
+
+    def host(self, attachment):
+        """Returns host key of the attachment.
+
+        :param attachment: :class:`~aiocouchdb.v1.attachment.Attachment`
+
+        :rtype: str
+        """
+        url = attachment.resource.url
+        return urllib.parse.urlsplit(url).netloc.rsplit('@', 1)[-1]
+
+    def semaphore(self, host):
+        """Returns :class:`asyncio.Semaphore` which bounds amount of
+        concurrent transfers for the host.
+
+        :param str host: Host key
+
+        :rtype: :class:`asyncio.Semaphore`
+        """
+        if host not in self._semaphores:
+            self._semaphores[host] = asyncio.Semaphore(self.concurrency,
+                                                       loop=self._loop)
+        return self._semaphores[host]
+
+    def limiter(self, host):
+        """Returns :class:`RateLimiter` for the host or ``None`` if bandwidth
+        is unlimited.
+
+        :param str host: Host key
+
+        :rtype: :class:`RateLimiter`
+        """
+        if self.bandwidth is None:
+            return None
+        if host not in self._limiters:
+            self._limiters[host] = RateLimiter(self.bandwidth, loop=self._loop)
+        return self._limiters[host]
+
+    @asyncio.coroutine
+    def download(self, attachment, path_or_fileobj, rev=None, *, auth=None):
+        """Downloads attachment into the file.
+
+        :param attachment: :class:`~aiocouchdb.v1.attachment.Attachment`
+        :param path_or_fileobj: File path or seekable binary file object
+        :param str rev: Document revision
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+
+        :rtype: :class:`Transfer`
+        """
+        transfer = Transfer(Transfer.DOWNLOAD, attachment, path_or_fileobj,
+                            rev)
+        yield from self._run(transfer, self._download, auth)
+        return transfer
+
+    @asyncio.coroutine
+    def upload(self, attachment, path_or_fileobj, rev=None, *,
+               auth=None,
+               content_type='application/octet-stream'):
+        """Uploads file as attachment.
+
+        :param attachment: :class:`~aiocouchdb.v1.attachment.Attachment`
+        :param path_or_fileobj: File path or seekable binary file object
+        :param str rev: Document revision
+        :param auth: :class:`aiocouchdb.authn.AuthProvider` instance
+        :param str content_type: Attachment :mimetype:`Content-Type`
+
+        :returns: Transfer which :attr:`~Transfer.result` holds server
+                  response or ``None`` if server already had the attachment
+        :rtype: :class:`Transfer`
+        """
+        transfer = Transfer(Transfer.UPLOAD, attachment, path_or_fileobj, rev)
+        if isinstance(path_or_fileobj, str):
+            position = 0
+        else:
+            position = path_or_fileobj.tell()
+
+        @asyncio.coroutine
+        def upload(transfer, auth, limiter):
+            return (yield from self._upload(transfer, auth, limiter,
+                                            content_type, position))
+
+        yield from self._run(transfer, upload, auth)
+        return transfer
+
+    def is_retryable(self, exc):
+        """Checks if failed transfer could be retried.
+
+        :param Exception exc: Transfer error
+
+        :rtype: bool
+        """
+        if isinstance(exc, HttpErrorException):
+            return exc.code >= 500
+        return isinstance(exc, CONNECTION_ERRORS + (ClientRequestError,
+                                                    DigestMismatch,
+                                                    EOFError,
+                                                    asyncio.TimeoutError))
+
+    @asyncio.coroutine
+    def _run(self, transfer, func, auth):
+        self.transfers.append(transfer)
+        host = self.host(transfer.attachment)
+        limiter = self.limiter(host)
+        while True:
+            transfer.attempts += 1
+            with (yield from self.semaphore(host)):
+                transfer.state = Transfer.ACTIVE
+                try:
+                    yield from func(transfer, auth, limiter)
+                except Exception as exc:
+                    transfer.error = exc
+                    if (transfer.attempts > self.retries or
+                            not self.is_retryable(exc)):
+                        transfer.state = Transfer.FAILED
+                        raise
+                    transfer.state = Transfer.PENDING
+                except BaseException:
+                    transfer.state = Transfer.FAILED
+                    raise
+                else:
+                    transfer.state = Transfer.DONE
+                    return
+            yield from asyncio.sleep(
+                self.retry_delay * 2 ** (transfer.attempts - 1),
+                loop=self._loop)
+
+    @asyncio.coroutine
+    def _download(self, transfer, auth, limiter):
+        attachment = transfer.attachment
+        params = {}
+        if transfer.rev is not None:
+            params['rev'] = transfer.rev
+        resp = yield from attachment.resource.head(auth=auth, params=params)
+        yield from resp.maybe_raise_error()
+        yield from resp.release()
+        encoded = CONTENT_ENCODING in resp.headers
+        ranged = (resp.headers.get(ACCEPT_RANGES) == 'bytes' and not encoded)
+        etag = resp.headers.get(ETAG)
+        length = int(resp.headers.get(CONTENT_LENGTH, 0))
+
+        if isinstance(transfer.target, str):
+            target = DownloadFile(transfer.target, etag, length)
+        else:
+            target = DownloadFileObject(transfer.target, etag, length)
+        try:
+            offset = resumed_offset(target.load_state())
+            if not offset and etag == transfer.etag:
+                # data of the previous attempt
+                offset = transfer.transferred
+            if not ranged:
+                offset = 0
+            transfer.transferred = offset
+            transfer.etag = etag
+            transfer.digest = None if encoded else etag_digest(etag)
+            transfer.length = None if encoded else length
+
+            md5 = hashlib.md5()
+            if transfer.digest is not None:
+                for chunk in target.iter_chunks(self.chunk_size, offset):
+                    md5.update(chunk)
+
+            if transfer.length is not None and offset >= transfer.length:
+                reader = None
+            elif offset:
+                reader = yield from attachment.get(transfer.rev, auth=auth,
+                                                   range=(offset, None))
+                if not is_range_response(reader, offset):
+                    # range wasn't honoured, start over
+                    if reader.status != 200:
+                        reader.close()
+                        reader = yield from attachment.get(transfer.rev,
+                                                           auth=auth)
+                    transfer.transferred = 0
+                    md5 = hashlib.md5()
+            else:
+                reader = yield from attachment.get(transfer.rev, auth=auth)
+            try:
+                while reader is not None:
+                    chunk = yield from reader.read(self.chunk_size)
+                    if not chunk:
+                        break
+                    if limiter is not None:
+                        yield from limiter.consume(len(chunk))
+                    target.write_at(transfer.transferred, chunk)
+                    md5.update(chunk)
+                    transfer.transferred += len(chunk)
+            finally:
+                if reader is not None:
+                    reader.close()
+
+            if transfer.length is None:
+                transfer.length = transfer.transferred
+            elif transfer.transferred < transfer.length:
+                raise EOFError('attachment data ended {} bytes earlier than'
+                               ' expected'.format(transfer.length -
+                                                  transfer.transferred))
+            if (transfer.digest is not None and
+                    format_digest(md5) != transfer.digest):
+                transfer.transferred = 0
+                raise DigestMismatch('downloaded data digest {} mismatches'
+                                     ' attachment one {}'
+                                     ''.format(format_digest(md5),
+                                               transfer.digest))
+        except BaseException:
+            target.save_state([[0, max(length, 1) - 1,
+                                transfer.transferred]])
+            raise
+        else:
+            target.complete(transfer.length)
+        finally:
+            target.close()
+
+    @asyncio.coroutine
+    def _upload(self, transfer, auth, limiter, content_type, position):
+        attachment = transfer.attachment
+        if transfer.digest is not None:
+            # previous attempt had sent all the data, but the result is
+            # unknown: server may already have it
+            resp = yield from attachment.resource.head(auth=auth)
+            yield from resp.release()
+            if (resp.status == 200 and
+                    etag_digest(resp.headers.get(ETAG)) == transfer.digest):
+                transfer.transferred = transfer.length
+                return
+
+        if isinstance(transfer.target, str):
+            fileobj = open(transfer.target, 'rb')
+        else:
+            fileobj = transfer.target
+        md5 = hashlib.md5()
+        transfer.transferred = 0
+        try:
+            transfer.length = fileobj.seek(0, io.SEEK_END) - position
+            fileobj.seek(position)
+            source = UploadSource(fileobj, transfer, md5, limiter)
+            stream = SizedStream(source, transfer.length,
+                                 chunk_size=self.chunk_size)
+            result = yield from attachment.update(stream,
+                                                  auth=auth,
+                                                  content_type=content_type,
+                                                  rev=transfer.rev)
+        except Exception:
+            if transfer.transferred == transfer.length:
+                transfer.digest = format_digest(md5)
+            raise
+        finally:
+            if fileobj is not transfer.target:
+                fileobj.close()
+
+        transfer.digest = format_digest(md5)
+        transfer.result = result
+        resp = yield from attachment.resource.head(
+            auth=auth, params={'rev': result['rev']})
+        yield from resp.maybe_raise_error()
+        yield from resp.release()
+        digest = etag_digest(resp.headers.get(ETAG))
+        if digest is not None and digest != transfer.digest:
+            raise DigestMismatch('uploaded data digest {} mismatches'
+                                 ' attachment one {}'
+                                 ''.format(transfer.digest, digest))
+
+
+class UploadSource(object):
+    """Reads file for :class:`TransferManager` uploads, updating MD5 digest
+    and transfer progress."""
+
+    def __init__(self, fileobj, transfer, md5, limiter):
+        self._fileobj = fileobj
+        self._transfer = transfer
+        self._md5 = md5
+        self._limiter = limiter
+
+    @asyncio.coroutine
+    def read(self, size):
+        if self._limiter is not None:
+            yield from self._limiter.consume(size)
+        chunk = self._fileobj.read(size)
+        self._md5.update(chunk)
+        self._transfer.transferred += len(chunk)
+        return chunk
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Runs aiocouchdb benchmarks against in-process fake CouchDB server and
+reports results as JSON::
+
+    python -m benchmarks --rows 10000 --output results.json
+
+Compare two reports to find regressions between releases::
+
+    python -m benchmarks.compare old.json new.json
+"""
+
+import argparse
+import asyncio
+import json
+import sys
+
+from .bench import SCENARIOS, run
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(prog='python -m benchmarks',
+                                     description=__doc__.split('\n')[0])
+    parser.add_argument('scenarios', nargs='*', metavar='SCENARIO',
+                        help='scenarios to run: {}. All by default'
+                             ''.format(', '.join(sorted(SCENARIOS))))
+    parser.add_argument('--rows', type=int, default=10000,
+                        help='rows per view, changes feed and bulk request')
+    parser.add_argument('--chunk-rows', type=int, default=100,
+                        help='rows per chunk sent by the fake server')
+    parser.add_argument('--doc-size', type=int, default=256,
+                        help='generated documents size in bytes')
+    parser.add_argument('--atts', type=int, default=2,
+                        help='attachments per document')
+    parser.add_argument('--att-size', type=int, default=1024 * 1024,
+                        help='attachment size in bytes')
+    parser.add_argument('--chunk-size', type=int, default=8192,
+                        help='attachment read chunk size in bytes')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='measured runs per scenario')
+    parser.add_argument('--warmup', type=int, default=1,
+                        help='warm up runs per scenario')
+    parser.add_argument('--output', '-o', default='-',
+                        help='file to write JSON report to. stdout by default')
+    args = parser.parse_args(argv)
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+    return args
+
+
+def main(argv=None):
+    args = parse_args(sys.argv[1:] if argv is None else argv)
+    options = {key: value for key, value in vars(args).items()
+               if key not in {'scenarios', 'output'}}
+    names = args.scenarios or sorted(SCENARIOS)
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        report = loop.run_until_complete(run(names, options, loop=loop))
+    finally:
+        loop.close()
+
+    data = json.dumps(report, indent=2, sort_keys=True)
+    if args.output == '-':
+        print(data)
+    else:
+        with open(args.output, 'w') as fobj:
+            fobj.write(data + '\n')
+
+
+if __name__ == '__main__':
+    main()
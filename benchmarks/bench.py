@@ -0,0 +1,214 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Benchmark scenarios and measurement routines.
+
+Each scenario is a coroutine function which accepts
+:class:`~aiocouchdb.v1.server.Server` instance connected to
+:class:`~benchmarks.fakecouch.FakeCouchDB` and returns amount of processed
+rows (or bytes for attachment scenarios).
+"""
+
+import asyncio
+import gc
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+
+import aiocouchdb
+import aiocouchdb.version
+
+
+__all__ = (
+    'SCENARIOS',
+    'run',
+    'run_scenario',
+)
+
+
+#: Registered scenarios: name -> (unit, coroutine function)
+SCENARIOS = {}
+
+
+def scenario(name, unit='rows'):
+    def decorator(func):
+        SCENARIOS[name] = (unit, asyncio.coroutine(func))
+        return func
+    return decorator
+
+
+@asyncio.coroutine
+def _consume(feed):
+    count = 0
+    while True:
+        item = yield from feed.next()
+        if item is None:
+            break
+        count += 1
+    return count
+
+
+@scenario('all_docs')
+def bench_all_docs(server, options):
+    feed = yield from server['db'].all_docs(include_docs=True)
+    return (yield from _consume(feed))
+
+
+@scenario('view')
+def bench_view(server, options):
+    feed = yield from server['db']['_design/ddoc'].view('view')
+    return (yield from _consume(feed))
+
+
+@scenario('changes_normal')
+def bench_changes_normal(server, options):
+    feed = yield from server['db'].changes()
+    return (yield from _consume(feed))
+
+
+@scenario('changes_continuous')
+def bench_changes_continuous(server, options):
+    feed = yield from server['db'].changes(feed='continuous')
+    return (yield from _consume(feed))
+
+
+@scenario('changes_eventsource')
+def bench_changes_eventsource(server, options):
+    feed = yield from server['db'].changes(feed='eventsource')
+    return (yield from _consume(feed))
+
+
+@scenario('bulk_docs')
+def bench_bulk_docs(server, options):
+    docs = ({'_id': 'doc{:08d}'.format(idx), 'idx': idx}
+            for idx in range(options['rows']))
+    result = yield from server['db'].bulk_docs(docs)
+    return len(result)
+
+
+@scenario('get_with_atts', unit='bytes')
+def bench_get_with_atts(server, options):
+    reader = yield from server['db']['doc'].get_with_atts()
+    total = 0
+    doc, atts = yield from reader.next()
+    while True:
+        att = yield from atts.next()
+        if att is None:
+            break
+        total += len((yield from att.read()))
+    yield from reader.release()
+    return total
+
+
+@scenario('attachment_get', unit='bytes')
+def bench_attachment_get(server, options):
+    reader = yield from server['db']['doc']['att'].get()
+    total = 0
+    while True:
+        chunk = yield from reader.read(options['chunk_size'])
+        if not chunk:
+            break
+        total += len(chunk)
+    reader.close()
+    return total
+
+
+def peak_rss():
+    """Returns peak resident set size of the process in bytes.
+
+    :rtype: int
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, OS X - bytes
+    return usage if sys.platform == 'darwin' else usage * 1024
+
+
+@asyncio.coroutine
+def run_scenario(name, server, options, *, loop):
+    """Runs single scenario and measures its throughput and memory usage.
+
+    Timings and memory are measured in separate runs since tracing memory
+    allocations slows down the code a lot.
+
+    :rtype: dict
+    """
+    unit, func = SCENARIOS[name]
+    for _ in range(options['warmup']):
+        yield from func(server, options)
+
+    processed = 0
+    gc.collect()
+    started = time.perf_counter()
+    for _ in range(options['repeat']):
+        processed += yield from func(server, options)
+    elapsed = time.perf_counter() - started
+
+    gc.collect()
+    tracemalloc.start()
+    snapshot = tracemalloc.take_snapshot()
+    yield from func(server, options)
+    allocated = sum(stat.size_diff for stat in
+                    tracemalloc.take_snapshot().compare_to(snapshot, 'filename')
+                    if stat.size_diff > 0)
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {
+        'name': name,
+        'unit': unit,
+        'repeat': options['repeat'],
+        'processed': processed,
+        'elapsed': elapsed,
+        '{}_per_sec'.format(unit): processed / elapsed if elapsed else None,
+        'requests_per_sec': options['repeat'] / elapsed if elapsed else None,
+        'allocated_bytes': allocated,
+        'traced_peak_bytes': traced_peak,
+        'peak_rss_bytes': peak_rss(),
+    }
+
+
+@asyncio.coroutine
+def run(names, options, *, loop):
+    """Runs the scenarios against freshly started fake CouchDB server.
+
+    :param list names: Scenario names
+    :param dict options: Benchmark options
+
+    :returns: Report which could be dumped as JSON
+    :rtype: dict
+    """
+    from .fakecouch import FakeCouchDB
+
+    fake = FakeCouchDB(atts=options['atts'],
+                       att_size=options['att_size'],
+                       chunk_rows=options['chunk_rows'],
+                       doc_size=options['doc_size'],
+                       loop=loop,
+                       rows=options['rows'])
+    url = yield from fake.start()
+    server = aiocouchdb.Server(url, loop=loop)
+    results = []
+    try:
+        for name in names:
+            results.append((yield from run_scenario(name, server, options,
+                                                    loop=loop)))
+    finally:
+        server.resource.session.connector.close()
+        yield from fake.stop()
+
+    return {
+        'aiocouchdb': aiocouchdb.version.__version__,
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'platform': platform.platform(),
+        'options': options,
+        'results': results,
+    }
@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Compares two benchmark reports::
+
+    python -m benchmarks.compare old.json new.json
+"""
+
+import json
+import sys
+
+
+#: Metrics to compare and whenever bigger value is better
+METRICS = (
+    ('rows_per_sec', True),
+    ('bytes_per_sec', True),
+    ('requests_per_sec', True),
+    ('allocated_bytes', False),
+    ('traced_peak_bytes', False),
+)
+
+
+def compare(old, new):
+    """Returns relative changes of the metrics for each common scenario.
+
+    >>> old = {'results': [{'name': 'view', 'rows_per_sec': 100.0}]}
+    >>> new = {'results': [{'name': 'view', 'rows_per_sec': 150.0}]}
+    >>> compare(old, new)
+    [('view', 'rows_per_sec', 100.0, 150.0, 0.5)]
+
+    :param dict old: Baseline report
+    :param dict new: Compared report
+
+    :rtype: list
+    """
+    baseline = {item['name']: item for item in old['results']}
+    changes = []
+    for item in new['results']:
+        base = baseline.get(item['name'])
+        if base is None:
+            continue
+        for metric, _ in METRICS:
+            if not base.get(metric) or item.get(metric) is None:
+                continue
+            delta = (item[metric] - base[metric]) / base[metric]
+            changes.append((item['name'], metric, base[metric], item[metric],
+                            delta))
+    return changes
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 2:
+        sys.exit(__doc__.strip())
+    with open(argv[0]) as old, open(argv[1]) as new:
+        changes = compare(json.load(old), json.load(new))
+    better = dict(METRICS)
+    for name, metric, base, value, delta in changes:
+        sign = delta if better[metric] else -delta
+        mark = '+' if sign >= 0 else '-'
+        print('{} {:<22} {:<18} {:>14.1f} -> {:>14.1f} ({:+.1%})'.format(
+            mark, name, metric, base, value, delta))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+#
+# Copyright (C) 2016 Alexander Shorin
+# All rights reserved.
+#
+# This software is licensed as described in the file LICENSE, which
+# you should have received as part of this distribution.
+#
+
+"""Fake CouchDB server which generates responses on the fly.
+
+Unlike real CouchDB it doesn't store anything: all the rows, changes and
+attachments are synthetic, so response time depends on the client side only.
+The response formats are byte to byte the same as CouchDB 1.x emits.
+"""
+
+import asyncio
+import json
+import socket
+import uuid
+
+from aiohttp import web
+
+
+__all__ = (
+    'FakeCouchDB',
+)
+
+
+class FakeCouchDB(object):
+    """In-process fake CouchDB server.
+
+    :param int rows: Amount of rows in views, ``_all_docs`` and ``_changes``
+    :param int chunk_rows: Amount of rows written at once
+    :param int doc_size: Approximate size of generated documents in bytes
+    :param int att_size: Size of generated attachments in bytes
+    :param int atts: Amount of attachments per document
+    :param int heartbeat: Send heartbeat each specified amount of rows for
+                          continuous and eventsource feeds
+    """
+
+    #: Amount of rows in views, ``_all_docs`` and ``_changes``
+    rows = 1000
+    #: Amount of rows written at once
+    chunk_rows = 100
+    #: Approximate size of generated documents in bytes
+    doc_size = 256
+    #: Size of generated attachments in bytes
+    att_size = 64 * 1024
+    #: Amount of attachments per document
+    atts = 2
+    #: Send heartbeat each specified amount of rows for continuous feeds
+    heartbeat = 0
+
+    def __init__(self, *,
+                 atts=None,
+                 att_size=None,
+                 chunk_rows=None,
+                 doc_size=None,
+                 heartbeat=None,
+                 loop=None,
+                 rows=None):
+        if atts is not None:
+            self.atts = atts
+        if att_size is not None:
+            self.att_size = att_size
+        if chunk_rows is not None:
+            self.chunk_rows = chunk_rows
+        if doc_size is not None:
+            self.doc_size = doc_size
+        if heartbeat is not None:
+            self.heartbeat = heartbeat
+        if rows is not None:
+            self.rows = rows
+        self._loop = loop or asyncio.get_event_loop()
+        self._server = None
+        self._handler = None
+        self.url = None
+        self.requests = 0
+
+        self.app = web.Application(loop=self._loop)
+        router = self.app.router
+        router.add_route('GET', '/', self.handle_welcome)
+        router.add_route('GET', '/{db}', self.handle_db_info)
+        router.add_route('GET', '/{db}/_all_docs', self.handle_view)
+        router.add_route('POST', '/{db}/_all_docs', self.handle_view)
+        router.add_route('GET', '/{db}/_changes', self.handle_changes)
+        router.add_route('POST', '/{db}/_changes', self.handle_changes)
+        router.add_route('POST', '/{db}/_bulk_docs', self.handle_bulk_docs)
+        router.add_route('GET', '/{db}/_design/{ddoc}/_view/{view}',
+                         self.handle_view)
+        router.add_route('POST', '/{db}/_design/{ddoc}/_view/{view}',
+                         self.handle_view)
+        router.add_route('GET', '/{db}/{docid}', self.handle_doc)
+        router.add_route('GET', '/{db}/{docid}/{attname}', self.handle_att)
+
+    @asyncio.coroutine
+    def start(self, host='127.0.0.1', port=0):
+        """Starts the server.
+
+        :param str host: Host to bind
+        :param int port: Port to bind. Random free one by default
+
+        :returns: Server URL
+        :rtype: str
+        """
+        self._handler = self.app.make_handler()
+        self._server = yield from self._loop.create_server(
+            self._handler, host, port, family=socket.AF_INET)
+        host, port = self._server.sockets[0].getsockname()[:2]
+        self.url = 'http://{}:{}'.format(host, port)
+        return self.url
+
+    @asyncio.coroutine
+    def stop(self):
+        """Stops the server."""
+        if self._server is None:
+            return
+        yield from self._handler.finish_connections(1.0)
+        self._server.close()
+        yield from self._server.wait_closed()
+        yield from self.app.finish()
+        self._server = None
+
+    def make_doc(self, idx):
+        """Generates document.
+
+        :param int idx: Document index
+
+        :rtype: dict
+        """
+        return {
+            '_id': 'doc{:08d}'.format(idx),
+            '_rev': '1-{:032x}'.format(idx),
+            'idx': idx,
+            'data': 'x' * max(0, self.doc_size - 80),
+        }
+
+    def make_att(self, size=None):
+        """Generates attachment content.
+
+        :param int size: Content size. :attr:`att_size` by default
+
+        :rtype: bytes
+        """
+        size = self.att_size if size is None else size
+        pattern = bytes(range(256))
+        return (pattern * (size // 256 + 1))[:size]
+
+    @asyncio.coroutine
+    def handle_welcome(self, request):
+        self.requests += 1
+        return self.json_response({'couchdb': 'Welcome',
+                                   'version': '1.6.1'})
+
+    @asyncio.coroutine
+    def handle_db_info(self, request):
+        self.requests += 1
+        return self.json_response({'db_name': request.match_info['db'],
+                                   'doc_count': self.rows,
+                                   'update_seq': self.rows})
+
+    @asyncio.coroutine
+    def handle_view(self, request):
+        self.requests += 1
+        rows = self.limit(request)
+        include_docs = request.GET.get('include_docs') == 'true'
+        resp = self.stream_response(request)
+        resp.write('{{"total_rows":{},"offset":0,"rows":[\r\n'.format(
+            self.rows).encode())
+
+        def row(idx):
+            doc = self.make_doc(idx)
+            item = {'id': doc['_id'], 'key': doc['_id'],
+                    'value': {'rev': doc['_rev']}}
+            if include_docs:
+                item['doc'] = doc
+            return json.dumps(item)
+        yield from self.write_rows(resp, rows, row, ',\r\n')
+        resp.write(b'\r\n]}\n')
+        yield from resp.write_eof()
+        return resp
+
+    @asyncio.coroutine
+    def handle_changes(self, request):
+        self.requests += 1
+        feed = request.GET.get('feed', 'normal')
+        rows = self.limit(request)
+        since = int(request.GET.get('since', 0) or 0)
+        include_docs = request.GET.get('include_docs') == 'true'
+        last_seq = since + rows
+
+        def change(idx):
+            doc = self.make_doc(since + idx)
+            event = {'seq': since + idx + 1, 'id': doc['_id'],
+                     'changes': [{'rev': doc['_rev']}]}
+            if include_docs:
+                event['doc'] = doc
+            return event
+
+        if feed == 'eventsource':
+            resp = self.stream_response(request, 'text/event-stream')
+
+            def row(idx):
+                event = change(idx)
+                return 'data: {}\nid: {}\n'.format(json.dumps(event),
+                                                   event['seq'])
+            yield from self.write_rows(resp, rows, row, '\n', heartbeat=True)
+            resp.write(b'\n')
+        elif feed == 'continuous':
+            resp = self.stream_response(request)
+            yield from self.write_rows(
+                resp, rows, lambda idx: json.dumps(change(idx)), '\n',
+                heartbeat=True)
+            resp.write('\n{{"last_seq":{}}}\n'.format(last_seq).encode())
+        else:
+            resp = self.stream_response(request)
+            resp.write(b'{"results":[\n')
+            yield from self.write_rows(
+                resp, rows, lambda idx: json.dumps(change(idx)), ',\n')
+            resp.write('\n],\n"last_seq":{}}}\n'.format(last_seq).encode())
+        yield from resp.write_eof()
+        return resp
+
+    @asyncio.coroutine
+    def handle_bulk_docs(self, request):
+        self.requests += 1
+        body = yield from request.json()
+        result = []
+        for doc in body.get('docs', []):
+            docid = doc.get('_id') or uuid.uuid4().hex
+            result.append({'ok': True, 'id': docid,
+                           'rev': '1-{:032x}'.format(hash(docid) & 0xffff)})
+        return self.json_response(result, status=201)
+
+    @asyncio.coroutine
+    def handle_doc(self, request):
+        self.requests += 1
+        doc = self.make_doc(0)
+        doc['_id'] = request.match_info['docid']
+        accept = request.headers.get('ACCEPT', '')
+        with_atts = request.GET.get('attachments') == 'true'
+        if not (with_atts and self.atts):
+            return self.json_response(doc)
+
+        att = self.make_att()
+        doc['_attachments'] = {
+            'att{}'.format(idx): {'content_type': 'application/octet-stream',
+                                  'revpos': 1,
+                                  'digest': 'md5-fake',
+                                  'length': len(att),
+                                  'stub': False,
+                                  'follows': True}
+            for idx in range(self.atts)}
+        if 'multipart/related' not in accept:
+            return self.json_response(doc)
+
+        boundary = uuid.uuid4().hex
+        resp = self.stream_response(
+            request, 'multipart/related; boundary="{}"'.format(boundary))
+        resp.write('--{}\r\nContent-Type: application/json\r\n\r\n'
+                   ''.format(boundary).encode())
+        resp.write(json.dumps(doc).encode())
+        for name in sorted(doc['_attachments']):
+            resp.write('\r\n--{}\r\nContent-Disposition: attachment; '
+                       'filename="{}"\r\nContent-Type: application/octet-stream'
+                       '\r\nContent-Length: {}\r\n\r\n'
+                       ''.format(boundary, name, len(att)).encode())
+            resp.write(att)
+            yield from resp.drain()
+        resp.write('\r\n--{}--'.format(boundary).encode())
+        yield from resp.write_eof()
+        return resp
+
+    @asyncio.coroutine
+    def handle_att(self, request):
+        self.requests += 1
+        data = self.make_att()
+        status = 200
+        headers = {'CONTENT-TYPE': 'application/octet-stream',
+                   'ACCEPT-RANGES': 'bytes'}
+        range_header = request.headers.get('RANGE', '')
+        if range_header.startswith('bytes='):
+            start, _, stop = range_header[6:].partition('-')
+            start = int(start or 0)
+            stop = int(stop) if stop and stop != 'None' else len(data) - 1
+            headers['CONTENT-RANGE'] = 'bytes {}-{}/{}'.format(
+                start, stop, len(data))
+            data = data[start:stop + 1]
+            status = 206
+        return web.Response(body=data, status=status, headers=headers)
+
+    def limit(self, request):
+        if 'limit' in request.GET:
+            return min(self.rows, int(request.GET['limit']))
+        return self.rows
+
+    def json_response(self, obj, status=200):
+        return web.Response(body=json.dumps(obj).encode(), status=status,
+                            headers={'CONTENT-TYPE': 'application/json'})
+
+    def stream_response(self, request, content_type='application/json'):
+        resp = web.StreamResponse(headers={'CONTENT-TYPE': content_type})
+        resp.enable_chunked_encoding()
+        resp.start(request)
+        return resp
+
+    @asyncio.coroutine
+    def write_rows(self, resp, rows, make_row, sep, *, heartbeat=False):
+        chunk = []
+        for idx in range(rows):
+            chunk.append(make_row(idx))
+            if heartbeat and self.heartbeat and (idx + 1) % self.heartbeat == 0:
+                chunk.append('')
+            if len(chunk) >= self.chunk_rows or idx == rows - 1:
+                data = sep.join(chunk)
+                if idx >= len(chunk):
+                    # CouchDB puts separator between rows, not after each one
+                    data = sep + data
+                resp.write(data.encode())
+                yield from resp.drain()
+                chunk = []
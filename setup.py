@@ -57,7 +57,7 @@ setup(
         'Topic :: Software Development :: Libraries :: Python Modules'
     ],
 
-    packages=find_packages(),
+    packages=find_packages(exclude=['benchmarks', 'benchmarks.*']),
     test_suite='nose.collector',
     zip_safe=False,
 